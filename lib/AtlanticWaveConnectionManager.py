@@ -13,6 +13,16 @@ import logging
 from threading import Thread
 from select import select
 from time import sleep
+from Queue import Queue
+
+# Number of threads handling new connections' handshakes when a reactor is
+# used to accept connections.
+DEFAULT_HANDSHAKE_WORKERS = 4
+
+# Seconds that a socket operation can take during a new connection's handshake
+# before the connection is dropped, so that peers that connect and then go
+# quiet can't hold on to the handshake workers.
+DEFAULT_HANDSHAKE_TIMEOUT = 30.0
 
 class ConnectionManagerTypeError(AtlanticWaveModuleTypeError):
     pass
@@ -24,9 +34,12 @@ class AtlanticWaveConnectionManager(AtlanticWaveModule):
     ''' This is a parent class for handling connections, dispatching the new 
         connection to handling functions, and otherwise tracking what's going 
         on. One per incoming connection. One for outbound connections. Needs to
-        be subclassed, even though much will be in common. Singleton. '''
+        be subclassed, even though much will be in common. Singleton. 
+        If a ConnectionReactor is passed in, the listening socket is handled by
+        the reactor rather than by a blocking accept() loop. '''
 
-    def __init__(self, loggerid, connection_cls=Connection, loggerid_for_connections=None):
+    def __init__(self, loggerid, connection_cls=Connection, loggerid_for_connections=None,
+                 reactor=None):
         
         super(AtlanticWaveConnectionManager, self).__init__(loggerid)
         
@@ -39,6 +52,11 @@ class AtlanticWaveConnectionManager(AtlanticWaveModule):
         self.loggerid_for_cxns = loggerid_for_connections
         self.listening_callback = None
 
+        self.reactor = reactor
+        self.handshake_workers = DEFAULT_HANDSHAKE_WORKERS
+        self.handshake_timeout = DEFAULT_HANDSHAKE_TIMEOUT
+        self._handshake_q = None
+
     def __repr__(self):
         clientstr = ""
         for entry in self.clients:
@@ -81,6 +99,11 @@ class AtlanticWaveConnectionManager(AtlanticWaveModule):
             self.listening_sock.bind((self.listening_address,
                                       self.listening_port))
             self.listening_sock.listen(1)
+            if self.reactor != None:
+                self._start_handshake_workers()
+                self.reactor.add_listener(self.listening_sock,
+                                          self._queue_new_connection)
+                return
             while True:
                 client_sock, client_address = self.listening_sock.accept()
                 new_cxn_thread = Thread(target=self._internal_new_connection,
@@ -91,8 +114,48 @@ class AtlanticWaveConnectionManager(AtlanticWaveModule):
         except:
             raise
 
+    def _start_handshake_workers(self):
+        ''' New connections accepted by the reactor are handed to a fixed
+            pool of threads, as the handshake itself is blocking. Each socket
+            operation in the handshake times out after handshake_timeout
+            seconds. '''
+        if self._handshake_q != None:
+            return
+        self._handshake_q = Queue()
+        for i in range(self.handshake_workers):
+            worker = Thread(target=self._handshake_worker)
+            worker.daemon = True
+            worker.start()
+
+    def _queue_new_connection(self, sock, address):
+        self._handshake_q.put((sock, address))
+
+    def _handshake_worker(self):
+        while True:
+            (sock, address) = self._handshake_q.get()
+            try:
+                sock.settimeout(self.handshake_timeout)
+                self._internal_new_connection(sock, address)
+                # Back to blocking, unless the handshake has changed the
+                # socket's mode itself, as SDXControllerConnection does.
+                try:
+                    if sock.gettimeout() == self.handshake_timeout:
+                        sock.settimeout(None)
+                except socket_error:
+                    # Closed during the handshake.
+                    pass
+            except Exception as e:
+                self.logger.error("New connection from %s failed: %s" %
+                                  (address, e))
+                try:
+                    sock.close()
+                except:
+                    pass
+
     def close_listening_port(self):
         if self.listening_sock is not None:
+            if self.reactor != None:
+                self.reactor.unregister(self.listening_sock)
             try:
                 self.listening_sock.close()
             except:
@@ -10,12 +10,117 @@ import threading
 import sys
 import struct
 
+# Receive buffers start out this big, grow to fit the largest frame seen, and
+# go back to the initial size after a frame bigger than DEFAULT_MAX_IDLE_BUFFER.
+DEFAULT_FRAME_BUFFER = 65536
+DEFAULT_MAX_IDLE_BUFFER = 4194304
+
 class ConnectionTypeError(TypeError):
     pass
 
 class ConnectionValueError(ValueError):
     pass
 
+class ConnectionClosedError(IOError):
+    pass
+
+
+class FrameReader(object):
+    ''' Reads length-prefixed frames from a socket. header_format is a struct
+        format whose last field is the length of the payload that follows.
+        Bytes are received with recv_into() straight into a buffer that is
+        reused from frame to frame, so frames aren't put together from lists
+        of chunks, and the work done is proportional to the size of the frame
+        however it's split up on the way.
+        If a recv fails part way through a frame, such as with EAGAIN on a
+        non-blocking socket, what has arrived so far is kept, and the next
+        read_frame() carries on from there.
+        Nothing past the end of the current frame is taken from the socket,
+        so the socket stays readable as long as there are frames waiting,
+        which select() and the ConnectionReactor rely on.
+        Bits of the length field in flags_mask are flags, rather than part of
+        the length. They're left in the header fields that are returned. '''
+    def __init__(self, header_format='>i', buffer_size=DEFAULT_FRAME_BUFFER,
+                 max_idle_buffer=DEFAULT_MAX_IDLE_BUFFER, flags_mask=0):
+        self.header = struct.Struct(header_format)
+        self.flags_mask = flags_mask
+        self.buffer_size = max(buffer_size, self.header.size)
+        self.max_idle_buffer = max_idle_buffer
+        self._buf = bytearray(self.buffer_size)
+        self._view = memoryview(self._buf)
+        # Bytes of the current frame received so far, and its header, once
+        # that has all arrived.
+        self._have = 0
+        self._fields = None
+        self._length = None
+        self._stats = {'frames':0,
+                       'bytes':0,
+                       'recv_calls':0,
+                       'max_frame':0,
+                       'buffer_grows':0}
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['buffer_size'] = len(self._buf)
+        stats['partial'] = self._have
+        return stats
+
+    def reset(self):
+        ''' Drops any partly received frame. '''
+        self._have = 0
+        self._fields = None
+        self._length = None
+
+    def _fill(self, sock, target):
+        ''' Receives into the buffer until it holds target bytes. '''
+        while self._have < target:
+            count = sock.recv_into(self._view[self._have:target],
+                                   target - self._have)
+            self._stats['recv_calls'] += 1
+            if count == 0:
+                raise ConnectionClosedError("Connection closed by peer, %d "
+                                            "bytes into a frame" % self._have)
+            self._have += count
+
+    def _grow(self, size):
+        ''' Makes room for size bytes, keeping what's been received. '''
+        new = bytearray(max(size, 2 * len(self._buf)))
+        new[:self._have] = self._view[:self._have]
+        self._buf = new
+        self._view = memoryview(self._buf)
+        self._stats['buffer_grows'] += 1
+
+    def read_frame(self, sock):
+        ''' Returns (header fields, payload) for the next frame on sock. The
+            payload is a str, as that's what the decoders take, so it is
+            copied out of the buffer once. '''
+        hsize = self.header.size
+        if self._fields == None:
+            self._fill(sock, hsize)
+            fields = self.header.unpack_from(self._buf, 0)
+            if fields[-1] < 0:
+                self.reset()
+                raise ConnectionValueError("Invalid frame length %d" %
+                                           fields[-1])
+            self._fields = fields
+            self._length = fields[-1] & ~self.flags_mask
+            if hsize + self._length > len(self._buf):
+                self._grow(hsize + self._length)
+
+        end = hsize + self._length
+        self._fill(sock, end)
+        fields = self._fields
+        payload = self._view[hsize:end].tobytes()
+        self.reset()
+
+        self._stats['frames'] += 1
+        self._stats['bytes'] += end
+        self._stats['max_frame'] = max(self._stats['max_frame'], end)
+        if len(self._buf) > self.max_idle_buffer:
+            self._buf = bytearray(self.buffer_size)
+            self._view = memoryview(self._buf)
+        return (fields, payload)
+
 
 class Connection(object):
     ''' Handed out by the ConnectionManager. It's basically the same as a 
@@ -23,6 +128,11 @@ class Connection(object):
         it'll be a socket, but in the future, this can be changed to be a TLS 
         socket, for instance. '''
 
+    # Framing used by recv(), see FrameReader. Subclasses with their own
+    # headers override these.
+    FRAME_HEADER = '>i'
+    FRAME_FLAGS = 0
+
     def __init__(self, address, port, sock, loggerid=None):
         # Setup logging
         self.loggerid = None
@@ -42,6 +152,11 @@ class Connection(object):
 
         self.recv_cb = None
         self.recv_thread = None
+        self.frame_reader = FrameReader(self.FRAME_HEADER,
+                                        flags_mask=self.FRAME_FLAGS)
+
+        # Set by ConnectionReactor.register() or by the ConnectionManager
+        self.reactor = None
         
     def __del__(self):
         # Destructor
@@ -105,39 +220,19 @@ class Connection(object):
     def get_socket(self):
         return self.sock
 
+    def set_reactor(self, reactor):
+        ''' Sets the ConnectionReactor that this Connection is, or will be,
+            registered with. '''
+        self.reactor = reactor
+
     
     def recv(self):
         ''' Receives an item. This is a blocking call. '''
-        try:
-            # Based on https://code.activestate.com/recipes/408859-socketrecv-three-ways-to-turn-it-into-recvall/
-            sock_data = ''
-            size_data = ''
-            while len(size_data) < 4:
-                sock_data = self.sock.recv(4 - len(size_data))
-                size_data += sock_data
-                if len(size_data) == 4:
-                    size = struct.unpack('>i', size_data)[0]
-
-            total_len = 0
-            total_data = []
-            recv_size = size
-            if recv_size > 524388:
-                recv_size = 524288
-            while total_len < size:
-                sock_data = self.sock.recv(recv_size)
-                total_data.append(sock_data)
-                total_len = sum([len(i) for i in total_data])
-                recv_size = size - total_len
-                if recv_size > 524388:
-                    recv_size = 524288
-            data_raw = ''.join(total_data)
-
-            # Unpickle!
-            data = pickle.loads(data_raw)
-            return data
+        (fields, data_raw) = self.frame_reader.read_frame(self.sock)
 
-        except:
-            raise
+        # Unpickle!
+        data = pickle.loads(data_raw)
+        return data
 
 
     def send(self, data):
@@ -160,6 +255,10 @@ class Connection(object):
     def close(self):
         ''' Close out the connection. '''
         try:
+            # Unregister first: once the socket is closed, its file descriptor
+            # can be reused by a new Connection.
+            if self.reactor != None:
+                self.reactor.unregister(self)
             if self.sock != None:
                 self.sock.close()
             self.sock = None
@@ -225,23 +324,9 @@ def select(rlist, wlist, xlist, timeout=0.0):
                                                       xlistsocket,
                                                       timeout)
 
-        # Now, map the sockets back to the Connection
-    rcxn = []
-    for s_entry in readable:
-        for c_entry in rlist:
-            if s_entry == c_entry.sock:
-                rcxn.append(c_entry)
-
-    wcxn = []
-    for s_entry in writable:
-        for c_entry in wlist:
-            if s_entry == c_entry.sock:
-                wcxn.append(c_entry)
-
-    xcxn = []
-    for s_entry in exceptional:
-        for c_entry in xlist:
-            if s_entry == c_entry.sock:
-                xcxn.append(c_entry)
+    # Now, map the sockets back to the Connection
+    rcxn = [cxn for cxn in rlist if cxn.sock in readable]
+    wcxn = [cxn for cxn in wlist if cxn.sock in writable]
+    xcxn = [cxn for cxn in xlist if cxn.sock in exceptional]
 
     return (rcxn, wcxn, xcxn)
@@ -0,0 +1,272 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+# The ConnectionReactor owns a set of Connections and listening sockets, waits
+# on all of them with a single epoll (poll where epoll isn't available), and
+# dispatches readable sockets to callbacks by file descriptor. It also contains
+# a timer scheduler so that periodic work, such as heartbeats, can be run from
+# the reactor rather than from a thread per connection.
+
+import select
+import socket
+import threading
+import logging
+import heapq
+import os
+import errno
+import fcntl
+from itertools import count
+from time import time
+
+from lib.Connection import Connection
+
+class ConnectionReactorTypeError(TypeError):
+    pass
+
+class ConnectionReactorValueError(ValueError):
+    pass
+
+
+if hasattr(select, 'epoll'):
+    _READ_EVENTS = select.EPOLLIN | select.EPOLLPRI
+    _ERROR_EVENTS = select.EPOLLERR | select.EPOLLHUP
+else:
+    _READ_EVENTS = select.POLLIN | select.POLLPRI
+    _ERROR_EVENTS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class ReactorTimer(object):
+    ''' Handle returned by ConnectionReactor.call_later() and call_every().
+        Can be passed to ConnectionReactor.cancel(). '''
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __repr__(self):
+        return "%s : %s : %s : %s" % (self.__class__.__name__,
+                                      self.deadline, self.interval,
+                                      self.callback)
+
+
+class ConnectionReactor(object):
+    ''' Event loop for Connections. Callbacks are run on the thread that calls
+        run() or run_once(). register(), unregister(), call_later(),
+        call_every(), and cancel() can be called from any thread. '''
+
+    def __init__(self, loggerid=None):
+        if loggerid == None:
+            loggerid = 'reactor'
+        else:
+            loggerid = loggerid + '.reactor'
+        self.logger = logging.getLogger(loggerid)
+        self.dlogger = logging.getLogger("debug." + loggerid)
+
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+        else:
+            self._poller = select.poll()
+
+        # fd -> (Connection or socket, callback), and Connection -> fd, as the
+        # socket is gone by the time a closed Connection is unregistered.
+        self._handlers = {}
+        self._fds = {}
+        self._lock = threading.Lock()
+
+        # Timers are a heap of (deadline, sequence number, ReactorTimer)
+        self._timers = []
+        self._timer_seq = count()
+
+        # Used to interrupt a poll() in progress when registrations or timers
+        # change from another thread.
+        # Non-blocking, so that many wakeups between polls can't block the
+        # writer once the pipe is full.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._poller.register(self._wakeup_r, _READ_EVENTS)
+
+    def __repr__(self):
+        return "%s : %d handlers : %d timers" % (self.__class__.__name__,
+                                                 len(self._handlers),
+                                                 len(self._timers))
+
+    def register(self, cxn, callback):
+        ''' Registers a Connection. callback(cxn) will be called whenever the
+            Connection's socket is readable or has an error. '''
+        if not isinstance(cxn, Connection):
+            raise ConnectionReactorTypeError("cxn must be a Connection: %s" %
+                                             type(cxn))
+        self._register(cxn.get_socket().fileno(), cxn, callback)
+        cxn.set_reactor(self)
+
+    def add_listener(self, sock, callback):
+        ''' Registers a listening socket. callback(sock, address) is called
+            with each accepted socket. '''
+        if not isinstance(sock, socket.socket):
+            raise ConnectionReactorTypeError("sock must be a socket: %s" %
+                                             type(sock))
+        sock.setblocking(0)
+        self._register(sock.fileno(), sock, callback)
+
+    def _register(self, fd, obj, callback):
+        with self._lock:
+            if fd in self._handlers:
+                raise ConnectionReactorValueError("fd %d already registered: %s"
+                                                  % (fd, self._handlers[fd]))
+            self._handlers[fd] = (obj, callback)
+            self._fds[obj] = fd
+            self._poller.register(fd, _READ_EVENTS)
+        self.wakeup()
+
+    def unregister(self, obj):
+        ''' Unregisters a Connection or listening socket. Safe to call more than
+            once. '''
+        with self._lock:
+            fd = self._fds.pop(obj, None)
+            if fd == None:
+                return
+            del self._handlers[fd]
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, ValueError, KeyError):
+                # Already closed. epoll forgets closed fds on its own.
+                pass
+
+    def is_registered(self, obj):
+        return obj in self._fds
+
+    def call_later(self, delay, callback, *args):
+        ''' Calls callback(*args) once, delay seconds from now. '''
+        return self._add_timer(ReactorTimer(time() + delay, None,
+                                            callback, args))
+
+    def call_every(self, interval, callback, *args):
+        ''' Calls callback(*args) now, and every interval seconds afterwards
+            until the timer is cancelled or callback returns False. '''
+        return self._add_timer(ReactorTimer(time(), interval, callback, args))
+
+    def cancel(self, timer):
+        ''' Cancels a timer. The entry is dropped lazily from the heap. '''
+        timer.cancelled = True
+
+    def _add_timer(self, timer):
+        with self._lock:
+            heapq.heappush(self._timers,
+                           (timer.deadline, next(self._timer_seq), timer))
+        self.wakeup()
+        return timer
+
+    def wakeup(self):
+        ''' Interrupts a run_once() that is waiting. '''
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass
+
+    def _next_timeout(self, timeout):
+        with self._lock:
+            while len(self._timers) > 0 and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            if len(self._timers) == 0:
+                return timeout
+            until_next = max(0.0, self._timers[0][0] - time())
+        if timeout == None or until_next < timeout:
+            return until_next
+        return timeout
+
+    def _run_timers(self):
+        now = time()
+        due = []
+        with self._lock:
+            while len(self._timers) > 0 and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers)[2])
+
+        for timer in due:
+            if timer.cancelled:
+                continue
+            try:
+                retval = timer.callback(*timer.args)
+            except Exception as e:
+                self.logger.error("Timer %s raised %s" % (timer, e))
+                continue
+            if timer.interval != None and retval != False:
+                timer.deadline = now + timer.interval
+                self._add_timer(timer)
+
+    def run_once(self, timeout=None):
+        ''' Waits up to timeout seconds (forever if None) for events, then
+            dispatches readable Connections and due timers. '''
+        timeout = self._next_timeout(timeout)
+        try:
+            if hasattr(select, 'epoll'):
+                if timeout == None:
+                    timeout = -1
+                events = self._poller.poll(timeout)
+            else:
+                if timeout != None:
+                    timeout = timeout * 1000
+                events = self._poller.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for (fd, event) in events:
+            if fd == self._wakeup_r:
+                try:
+                    os.read(self._wakeup_r, 4096)
+                except OSError:
+                    pass
+                continue
+
+            # Dictionary lookup, rather than searching through Connections.
+            handler = self._handlers.get(fd, None)
+            if handler == None:
+                continue
+            (obj, callback) = handler
+
+            if isinstance(obj, socket.socket):
+                self._accept(obj, callback)
+                continue
+
+            if event & (_READ_EVENTS | _ERROR_EVENTS):
+                try:
+                    callback(obj)
+                except Exception as e:
+                    self.logger.error("Callback for %s raised %s" % (obj, e))
+                    self.unregister(obj)
+
+        self._run_timers()
+
+    def _accept(self, sock, callback):
+        try:
+            client_sock, client_address = sock.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        client_sock.setblocking(1)
+        callback(client_sock, client_address)
+
+    def run(self):
+        ''' Runs forever. '''
+        while True:
+            self.run_once()
+
+    def close(self):
+        for fd in self._handlers.keys():
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        self._handlers = {}
+        self._fds = {}
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        if hasattr(self._poller, 'close'):
+            self._poller.close()
@@ -0,0 +1,194 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+from bisect import bisect_left, bisect_right
+
+# Reservations with no stop time run until FOREVER.
+FOREVER = float('inf')
+
+
+class ReservationCalendarError(Exception):
+    pass
+
+
+class ReservationCalendar(object):
+    ''' Keeps track of what is reserved over time, for any number of keys
+        (edges, nodes, ports...). For each key, this is a step function: a
+        sorted list of times, and the amount reserved from each time until the
+        next one. Outside of the list, nothing is reserved, so the last amount
+        is always EMPTY.
+        Finding the times covering an interval is a binary search. Asking what
+        is reserved between t1 and t2 then costs the number of steps between
+        t1 and t2, except for intervals that run past the last step, such as
+        open-ended ones, which are answered from a cached combination of each
+        step with every step after it. That cache is rebuilt, in O(n), the
+        first time it is needed after a change to the key.
+        Reserving or releasing changes the steps in the interval, and inserts
+        or deletes at most a few times, each of which shifts the rest of the
+        list: O(n) for n steps, but a memmove rather than a loop in Python.
+        Subclasses define what an amount is, and how amounts are added
+        together, taken away, and combined over an interval. EMPTY must make
+        no difference to a combination. '''
+    EMPTY = 0
+
+    def __init__(self):
+        # key -> ([times], [amounts])
+        self.calendar = {}
+        # key -> [combination of amounts[i:] for each i], built on demand
+        self.suffixes = {}
+        # Keys whose lists are shared with a copy, see copy()
+        self.shared = set()
+
+    def _add(self, current, amount):
+        raise NotImplementedError("Subclasses must implement this.")
+
+    def _remove(self, current, amount):
+        raise NotImplementedError("Subclasses must implement this.")
+
+    def _combine(self, amounts):
+        raise NotImplementedError("Subclasses must implement this.")
+
+    def _split(self, times, amounts, t):
+        ''' Makes sure that t is in times, and returns its index. '''
+        i = bisect_left(times, t)
+        if i < len(times) and times[i] == t:
+            return i
+        if i == 0:
+            previous = self.EMPTY
+        else:
+            previous = amounts[i-1]
+        times.insert(i, t)
+        amounts.insert(i, previous)
+        return i
+
+    def _change(self, key, start, stop, amount, change):
+        if start >= stop:
+            raise ReservationCalendarError(
+                "Empty interval %s-%s for %s" % (start, stop, key))
+        if key not in self.calendar:
+            self.calendar[key] = ([], [])
+        elif key in self.shared:
+            (times, amounts) = self.calendar[key]
+            self.calendar[key] = (list(times), list(amounts))
+        self.shared.discard(key)
+        self.suffixes.pop(key, None)
+        (times, amounts) = self.calendar[key]
+        # start is split first, so that splitting stop doesn't move it.
+        first = self._split(times, amounts, start)
+        last = self._split(times, amounts, stop)
+        try:
+            changed = [change(a, amount) for a in amounts[first:last]]
+        except:
+            # Undo the splits
+            self._compact(key, first, last)
+            raise
+        amounts[first:last] = changed
+        self._compact(key, first, last)
+
+    def _compact(self, key, first, last):
+        ''' Merges steps from first to last, inclusive, into the step before
+            them if they have the same amount, and drops the key if nothing is
+            reserved for it. Only the steps that were changed, and the one
+            after them, need to be looked at. '''
+        (times, amounts) = self.calendar[key]
+        for i in range(min(last, len(times) - 1), first - 1, -1):
+            if i == 0:
+                previous = self.EMPTY
+            else:
+                previous = amounts[i-1]
+            if amounts[i] == previous:
+                del times[i]
+                del amounts[i]
+        if len(times) == 0:
+            del self.calendar[key]
+
+    def _get_suffixes(self, key):
+        suffixes = self.suffixes.get(key)
+        if suffixes == None:
+            amounts = self.calendar[key][1]
+            suffixes = list(amounts)
+            for i in range(len(suffixes) - 2, -1, -1):
+                suffixes[i] = self._combine([suffixes[i], suffixes[i+1]])
+            self.suffixes[key] = suffixes
+        return suffixes
+
+    def reserve(self, key, start, stop, amount):
+        ''' Adds amount to what is reserved for key from start until stop.
+            Doesn't check that amount is available: see get_reserved(). '''
+        self._change(key, start, stop, amount, self._add)
+
+    def release(self, key, start, stop, amount):
+        ''' Takes amount back off what is reserved for key from start until
+            stop. '''
+        self._change(key, start, stop, amount, self._remove)
+
+    def get_reserved(self, key, start, stop):
+        ''' Returns the combined amount reserved for key at any time from start
+            until stop. '''
+        if key not in self.calendar:
+            return self.EMPTY
+        (times, amounts) = self.calendar[key]
+        first = max(bisect_right(times, start) - 1, 0)
+        last = bisect_left(times, stop)
+        if first >= last:
+            return self.EMPTY
+        if last >= len(times) - 1:
+            # Everything from first onwards, as the last step is EMPTY.
+            return self._get_suffixes(key)[first]
+        return self._combine(amounts[first:last])
+
+    def get_keys(self):
+        ''' Returns all keys that have something reserved. '''
+        return self.calendar.keys()
+
+    def clear(self):
+        self.calendar = {}
+        self.suffixes = {}
+        self.shared = set()
+
+    def copy(self):
+        ''' Returns an independent copy of the calendar. The copy shares each
+            key's lists with the original until either of them changes that
+            key, so copying costs O(number of keys). '''
+        new = self.__class__()
+        new.calendar = dict(self.calendar)
+        new.suffixes = dict(self.suffixes)
+        self.shared = set(self.calendar.keys())
+        new.shared = set(self.shared)
+        return new
+
+
+class BandwidthCalendar(ReservationCalendar):
+    ''' Amounts are bandwidths. get_reserved() returns the most bandwidth
+        reserved at any point in the interval. '''
+    def _add(self, current, amount):
+        return current + amount
+
+    def _remove(self, current, amount):
+        if amount > current:
+            raise ReservationCalendarError(
+                "Releasing %s, only %s reserved" % (amount, current))
+        return current - amount
+
+    def _combine(self, amounts):
+        return max(amounts)
+
+
+class VLANCalendar(ReservationCalendar):
+    ''' Amounts are VLAN bitmaps, with bit N set for VLAN N. get_reserved()
+        returns the VLANs reserved at any point in the interval. '''
+    def _add(self, current, amount):
+        if current & amount:
+            raise ReservationCalendarError(
+                "VLANs %s already reserved" % hex(current & amount))
+        return current | amount
+
+    def _remove(self, current, amount):
+        if amount & ~current:
+            raise ReservationCalendarError(
+                "VLANs %s not reserved" % hex(amount & ~current))
+        return current & ~amount
+
+    def _combine(self, amounts):
+        return reduce(lambda a, b: a | b, amounts)
@@ -15,12 +15,57 @@ from heapq import *
 from networkx import *
 from networkx import Graph
 
+## Shortest paths between vertices of interest, computed lazily and kept until
+## the graph changes. One single-source Dijkstra per vertex replaces a
+## bidirectional Dijkstra per pair, and the same closure can be handed to
+## make_steiner_tree() over and over for different sets of vertices.
+class MetricClosure(object):
+        ## @param G  A Graph with weighted edges. Must not change while the
+        #            closure is in use - make a new closure instead.
+        def __init__(self, G):
+                self.G = G
+                self._dists = {}
+                self._paths = {}
+
+        ## \returns number of vertices whose shortest paths are cached
+        def __len__(self):
+                return len(self._dists)
+
+        ## @param v1, v2  Vertices in G
+        # \returns (distance, list of vertices) for the shortest path from v1
+        #          to v2. Raises NetworkXNoPath if they are not connected.
+        def get_path(self, v1, v2):
+                # The graph is undirected, so a path already found from v2
+                # will do just as well.
+                if v1 not in self._dists and v2 in self._dists:
+                        distance, vertList = self.get_path(v2, v1)
+                        return distance, list(reversed(vertList))
+                if v1 not in self._dists:
+                        dists, paths = single_source_dijkstra(self.G, v1)
+                        self._dists[v1] = dists
+                        self._paths[v1] = paths
+                if v2 not in self._dists[v1]:
+                        raise NetworkXNoPath("No path between %s and %s." %
+                                             (v1, v2))
+                return self._dists[v1][v2], self._paths[v1][v2]
+
+
+## Total weight of the edges of a tree returned by make_steiner_tree()
+# @param tree  A Graph with weighted edges
+def steiner_tree_cost(tree):
+        cost = 0
+        for (v1, v2, data) in tree.edges_iter(data=True):
+                cost += data.get('weight', 1)
+        return cost
+
+
 ## Extract a Steiner tree from a weighted graph, given a list of vertices of interest
 # @param G  A Graph with weighted edges
 # @param voi  A list of vertices of interest
 # @param generator A method to make a new Graph instance (in the case that you've extended Graph)
+# @param closure A MetricClosure of G to reuse between calls, if any
 # \returns a new graph if no errors, None otherwise
-def make_steiner_tree(G, voi, generator=None):
+def make_steiner_tree(G, voi, generator=None, closure=None):
         mst = Graph()
         for v in voi:
                 if not v in G:
@@ -39,13 +84,15 @@ def make_steiner_tree(G, voi, generator=None):
         # extract all shortest paths among the voi
         heapq = []
         paths = {}
+        if closure is None:
+                closure = MetricClosure(G)
 
         # load all the paths bwteen the Steiner vertices. Store them in a heap queue
         # and reconstruct the MST of the complete graph using Kruskal's algorithm
         for i in range(len(voi) - 1):
                 v1 = voi[i]
                 for v2  in voi[i+1:]:
-                        result = bidirectional_dijkstra(G, v1, v2)
+                        result = closure.get_path(v1, v2)
                         if result == False:
                                 raise RuntimeError, "The two vertices given (%s, %s) don't exist on the same connected graph" % (v1, v2)
                                 #print "The two vertices given (%s, %s) don't exist on the same connected graph" % (v1, v2)
@@ -57,11 +104,21 @@ def make_steiner_tree(G, voi, generator=None):
                         heappush(heapq, (distance, v1, v2))
 
                                
-        # construct the minimum spanning tree of the complete graph
+        # construct the minimum spanning tree of the complete graph. The
+        # components joined so far are tracked with a union-find.
+        parents = dict((v, v) for v in voi)
+        def _find(v):
+                while parents[v] != v:
+                        parents[v] = parents[parents[v]]
+                        v = parents[v]
+                return v
         while heapq:
                 w, v1, v2 = heappop(heapq)
                 # if no path exists yet between v1 and v2, add this one
-                if v1 not in mst or v2 not in mst or not has_path(mst, v1, v2):
+                root1 = _find(v1)
+                root2 = _find(v2)
+                if root1 != root2:
+                        parents[root1] = root2
                         mst.add_edge(v1, v2,weight=w)
 
         # check if the graph is tree and correct
@@ -146,7 +203,8 @@ def make_prim_mst(G, generator=None):
                         raise ValueError, "make_prim_mst accepts a weighted graph only (with numerical weights)"
                 heappush(priorityQ, (edge[2], edge))
 
-        while len(mst.edges()) < (G.order()-1):
+        edgeCount = 0
+        while edgeCount < (G.order()-1):
                 w, minEdge = heappop(priorityQ)
                 if len(minEdge) != 3 or minEdge[2] is None:
                         raise ValueError, "make_prim_mst accepts a weighted graph only (with numerical weights)"
@@ -165,4 +223,5 @@ def make_prim_mst(G, generator=None):
                         # non-crossing edge
                         continue
                 mst.add_edge(minEdge[0],minEdge[1],minEdge[2])
+                edgeCount += 1
         return mst
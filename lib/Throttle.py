@@ -0,0 +1,185 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+# Building blocks for suppressing repeated events and limiting the rate at
+# which events are acted on, such as unknown-source packets from a chatty host
+# each turning into a new learned-destination rule.
+
+import logging
+from collections import OrderedDict
+from threading import Thread, Condition
+from time import time
+
+
+class SeenCache(object):
+    ''' Remembers keys for ttl seconds. add() says whether a key is new, so
+        that repeats of an event within ttl can be suppressed. At most
+        max_entries keys are kept: if there are more, the oldest are
+        forgotten early. '''
+    def __init__(self, ttl, max_entries=65536, clock=time):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # key -> expiry, oldest first
+        self.entries = OrderedDict()
+        # Number of add() calls that found the key already there.
+        self.suppressed = 0
+
+    def add(self, key):
+        ''' Returns True, and remembers key, if key hasn't been seen in the
+            last ttl seconds. Returns False otherwise. '''
+        now = self.clock()
+        expiry = self.entries.get(key)
+        if expiry != None and expiry > now:
+            self.suppressed += 1
+            return False
+        if expiry != None:
+            del self.entries[key]
+        self.entries[key] = now + self.ttl
+        self._expire(now)
+        return True
+
+    def discard(self, key):
+        ''' Forgets key, so that the next add() of it is new. '''
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        expiry = self.entries.get(key)
+        return expiry != None and expiry > self.clock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _expire(self, now):
+        # Entries all have the same ttl, so they expire oldest first.
+        while len(self.entries) > 0:
+            (key, expiry) = next(self.entries.iteritems())
+            if expiry > now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+
+class TokenBucket(object):
+    ''' Allows rate events per second on average, with bursts of up to burst
+        events. '''
+    def __init__(self, rate, burst=None, clock=time):
+        if burst == None:
+            burst = max(rate, 1)
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self):
+        ''' Takes a token and returns True if one is available, else returns
+            False. '''
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def get_delay(self):
+        ''' Returns the number of seconds until a token is available. '''
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class CoalescingAdmitter(object):
+    ''' Queues keyed items and hands them to handler, on its own thread, at
+        no more than rate items per second. An item submitted while another
+        with the same key is still queued is merged into it, and one
+        submitted within ttl seconds of the same key being handled is
+        dropped. get_counters() reports how many items were submitted,
+        coalesced, suppressed, admitted, and failed in handler. '''
+    def __init__(self, handler, rate, ttl, burst=None,
+                 loggerid='admitter', clock=time):
+        self.handler = handler
+        self.logger = logging.getLogger(loggerid)
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.admitted = SeenCache(ttl, clock=clock)
+        self.pending = OrderedDict()
+        self.cv = Condition()
+        self.counters = {'submitted':0,
+                         'coalesced':0,
+                         'suppressed':0,
+                         'admitted':0,
+                         'failed':0}
+        self.stopped = False
+        self.thread = Thread(target=self._admit_thread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, key, item):
+        ''' Queues item under key. The latest item for a key is the one
+            handed to handler. Returns True if item was queued, False if it
+            was coalesced or suppressed. '''
+        with self.cv:
+            if self.stopped:
+                return False
+            self.counters['submitted'] += 1
+            if key in self.pending:
+                self.counters['coalesced'] += 1
+                self.pending[key] = item
+                return False
+            if key in self.admitted:
+                self.counters['suppressed'] += 1
+                return False
+            self.pending[key] = item
+            self.cv.notify()
+            return True
+
+    def forget(self, key):
+        ''' Lets the next submit() of key through, even within ttl. '''
+        with self.cv:
+            self.admitted.discard(key)
+
+    def stop(self):
+        ''' Stops the thread, once any item being handled is done. Anything
+            still queued is dropped, and nothing more can be submitted. '''
+        with self.cv:
+            self.stopped = True
+            self.pending.clear()
+            self.cv.notify()
+
+    def get_counters(self):
+        with self.cv:
+            counters = dict(self.counters)
+            counters['pending'] = len(self.pending)
+            return counters
+
+    def _admit_thread(self):
+        while True:
+            with self.cv:
+                while len(self.pending) == 0 and not self.stopped:
+                    self.cv.wait()
+                if self.stopped:
+                    return
+                delay = self.bucket.get_delay()
+                if delay > 0:
+                    self.cv.wait(delay)
+                    continue
+                self.bucket.consume()
+                (key, item) = self.pending.popitem(last=False)
+                self.admitted.add(key)
+                self.counters['admitted'] += 1
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.logger.error("Admitting %s failed: %s" % (key, e))
+                with self.cv:
+                    self.counters['failed'] += 1
+                    self.admitted.discard(key)
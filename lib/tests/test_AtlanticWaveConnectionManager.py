@@ -131,6 +131,50 @@ class OpenSendingText(unittest.TestCase):
             # Clean up the connection
             connection.close()
 
+class HandshakeTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.manager = AtlanticWaveConnectionManager(loggerid)
+        self.received = []
+        self.cxns = []
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.manager.handshake_timeout = DEFAULT_HANDSHAKE_TIMEOUT
+
+    def handshake(self, cxn):
+        self.cxns.append(cxn)
+        self.received.append(cxn.recv())
+
+    def connect(self):
+        (local, remote) = socket.socketpair()
+        self.socks.append(remote)
+        self.manager._queue_new_connection(socket.socket(_sock=local),
+                                           ("127.0.0.1", 0))
+        return remote
+
+    def test_silent_peer(self):
+        # A single worker, so the silent peer would hold up everyone else.
+        self.manager.handshake_workers = 1
+        self.manager.handshake_timeout = 0.25
+        self.manager.new_connection_callback(self.handshake)
+        self.manager._start_handshake_workers()
+
+        self.connect()
+        talker = self.connect()
+        data_raw = pickle.dumps("hello")
+        talker.sendall(struct.pack('>i', len(data_raw)) + data_raw)
+
+        sleep(1)
+        self.failUnlessEqual(self.received, ["hello"])
+        self.failUnlessEqual(len(self.cxns), 2)
+        # The silent peer's socket was closed, the other went back to
+        # blocking.
+        self.failUnlessRaises(socket.error, self.cxns[0].get_socket().fileno)
+        self.failUnlessEqual(self.cxns[1].get_socket().gettimeout(), None)
+
+
 class FailureTests(unittest.TestCase):
     def test_connection_type_failure(self):
         self.failUnlessRaises(TypeError, AtlanticWaveConnectionManager,
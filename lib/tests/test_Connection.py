@@ -6,6 +6,8 @@
 import unittest
 import socket
 import threading
+import struct
+import select as pyselect
 import cPickle as pickle
 from time import sleep
 from lib.Connection import *
@@ -241,6 +243,78 @@ class ValidSelectTest(unittest.TestCase):
         self.object_received=cxn.recv()
         self.failUnlessEqual(self.object_received, self.object_to_send)
 
+class FrameReaderTest(unittest.TestCase):
+    def setUp(self):
+        (self.SendingSock, self.ReceivingSock) = socket.socketpair()
+
+    def tearDown(self):
+        self.SendingSock.close()
+        self.ReceivingSock.close()
+
+    def frame(self, data):
+        return struct.pack('>i', len(data)) + data
+
+    def test_partial_frames(self):
+        reader = FrameReader(buffer_size=16)
+        self.ReceivingSock.setblocking(0)
+        raw = self.frame('x' * 100) + self.frame('abc')
+
+        for piece in [raw[:2], raw[2:50]]:
+            self.SendingSock.sendall(piece)
+            self.failUnlessRaises(socket.error, reader.read_frame,
+                                  self.ReceivingSock)
+        self.SendingSock.sendall(raw[50:])
+        self.failUnlessEqual(reader.read_frame(self.ReceivingSock),
+                             ((100,), 'x' * 100))
+        self.failUnlessEqual(reader.read_frame(self.ReceivingSock),
+                             ((3,), 'abc'))
+        stats = reader.get_stats()
+        self.failUnlessEqual(stats['frames'], 2)
+        self.failUnlessEqual(stats['bytes'], len(raw))
+        self.failUnlessEqual(stats['buffer_grows'], 1)
+
+    def test_frames_left_on_socket(self):
+        # Only the current frame is read, so the socket stays readable.
+        reader = FrameReader()
+        self.SendingSock.sendall(self.frame('one') + self.frame('two'))
+        self.failUnlessEqual(reader.read_frame(self.ReceivingSock)[1], 'one')
+        (r, w, x) = pyselect.select([self.ReceivingSock], [], [], 1.0)
+        self.failUnlessEqual(r, [self.ReceivingSock])
+        self.failUnlessEqual(reader.read_frame(self.ReceivingSock)[1], 'two')
+
+    def test_large_frame(self):
+        reader = FrameReader('>ii', buffer_size=1024, max_idle_buffer=65536)
+        data = ''.join(chr(i % 256) for i in range(1000000))
+        sender = threading.Thread(target=self.SendingSock.sendall,
+                                  args=(struct.pack('>ii', 5, len(data)) +
+                                        data,))
+        sender.daemon = True
+        sender.start()
+        self.failUnlessEqual(reader.read_frame(self.ReceivingSock),
+                             ((5, len(data)), data))
+        sender.join()
+        # The buffer goes back to its initial size afterwards.
+        self.failUnlessEqual(reader.get_stats()['buffer_size'], 1024)
+
+    def test_flags(self):
+        reader = FrameReader('>ii', flags_mask=0x40000000)
+        self.SendingSock.sendall(struct.pack('>ii', 3, 0x40000000 | 4) +
+                                 'abcd')
+        self.failUnlessEqual(reader.read_frame(self.ReceivingSock),
+                             ((3, 0x40000004), 'abcd'))
+
+    def test_errors(self):
+        reader = FrameReader()
+        self.SendingSock.sendall(struct.pack('>i', -1))
+        self.failUnlessRaises(ConnectionValueError, reader.read_frame,
+                              self.ReceivingSock)
+
+        self.SendingSock.sendall(self.frame('abcdef')[:7])
+        self.SendingSock.shutdown(socket.SHUT_WR)
+        self.failUnlessRaises(ConnectionClosedError, reader.read_frame,
+                              self.ReceivingSock)
+
+
 class invalidSelectTest(unittest.TestCase):
     def test_invalid_select_init1(self):
         ip = "127.0.0.1"
@@ -0,0 +1,165 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for lib.ConnectionReactor module.
+
+import unittest
+import socket
+import threading
+from time import sleep, time
+from lib.Connection import Connection
+from lib.ConnectionReactor import *
+
+
+def make_pair():
+    ''' Returns (Connection, raw socket) for the two ends of a socket pair. '''
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(("127.0.0.1", 0))
+    listen_sock.listen(1)
+    a = socket.create_connection(listen_sock.getsockname())
+    b, addr = listen_sock.accept()
+    listen_sock.close()
+    return (Connection("127.0.0.1", 0, a), b)
+
+
+class InitTest(unittest.TestCase):
+    def test_basic_init(self):
+        reactor = ConnectionReactor()
+        print reactor
+        reactor.close()
+
+    def test_register_invalid(self):
+        reactor = ConnectionReactor()
+        self.failUnlessRaises(ConnectionReactorTypeError,
+                              reactor.register, "not a cxn", None)
+        self.failUnlessRaises(ConnectionReactorTypeError,
+                              reactor.add_listener, "not a sock", None)
+        reactor.close()
+
+    def test_register_twice(self):
+        reactor = ConnectionReactor()
+        cxn, other = make_pair()
+        reactor.register(cxn, None)
+        self.failUnlessRaises(ConnectionReactorValueError,
+                              reactor.register, cxn, None)
+        reactor.close()
+
+
+class DispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = ConnectionReactor()
+        self.received = []
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def readable_cb(self, cxn):
+        self.received.append((cxn, cxn.recv()))
+
+    def test_readable(self):
+        cxns = []
+        for i in range(5):
+            cxn, other = make_pair()
+            self.reactor.register(cxn, self.readable_cb)
+            cxns.append((cxn, other))
+
+        # Only the third Connection has something to read.
+        sender = Connection("127.0.0.1", 0, cxns[2][1])
+        sender.send({'a':1})
+        self.reactor.run_once(1.0)
+        self.failUnlessEqual(self.received, [(cxns[2][0], {'a':1})])
+
+        # Nothing else to read
+        self.reactor.run_once(0.1)
+        self.failUnlessEqual(len(self.received), 1)
+
+    def test_close_unregisters(self):
+        cxn, other = make_pair()
+        self.reactor.register(cxn, self.readable_cb)
+        self.failUnless(self.reactor.is_registered(cxn))
+        cxn.close()
+        self.failIf(self.reactor.is_registered(cxn))
+        # Safe to do twice
+        self.reactor.unregister(cxn)
+
+    def test_callback_exception(self):
+        def bad_cb(cxn):
+            raise Exception("Bad callback")
+        cxn, other = make_pair()
+        self.reactor.register(cxn, bad_cb)
+        other.send('x')
+        self.reactor.run_once(1.0)
+        self.failIf(self.reactor.is_registered(cxn))
+
+    def test_listener(self):
+        accepted = []
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(("127.0.0.1", 0))
+        listen_sock.listen(5)
+        self.reactor.add_listener(listen_sock,
+                                  lambda s, a: accepted.append(s))
+
+        client = socket.create_connection(listen_sock.getsockname())
+        start = time()
+        while len(accepted) == 0 and time() - start < 2.0:
+            self.reactor.run_once(0.5)
+        self.failUnlessEqual(len(accepted), 1)
+        self.reactor.unregister(listen_sock)
+        client.close()
+        listen_sock.close()
+
+    def test_wakeup(self):
+        threading.Timer(0.1, self.reactor.wakeup).start()
+        start = time()
+        self.reactor.run_once(5.0)
+        self.failUnless(time() - start < 2.0)
+
+
+class TimerTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = ConnectionReactor()
+        self.calls = []
+
+    def tearDown(self):
+        self.reactor.close()
+
+    def run_for(self, seconds):
+        end = time() + seconds
+        while time() < end:
+            self.reactor.run_once(end - time())
+
+    def test_call_later(self):
+        self.reactor.call_later(0.1, self.calls.append, 'later')
+        self.run_for(0.3)
+        self.failUnlessEqual(self.calls, ['later'])
+
+    def test_call_every(self):
+        self.reactor.call_every(0.1, self.calls.append, 'every')
+        self.run_for(0.35)
+        self.failUnless(len(self.calls) >= 3)
+
+    def test_call_every_stops(self):
+        def tick():
+            self.calls.append(1)
+            return len(self.calls) < 2
+        self.reactor.call_every(0.05, tick)
+        self.run_for(0.3)
+        self.failUnlessEqual(len(self.calls), 2)
+
+    def test_cancel(self):
+        timer = self.reactor.call_later(0.1, self.calls.append, 'later')
+        self.reactor.cancel(timer)
+        self.run_for(0.2)
+        self.failUnlessEqual(self.calls, [])
+
+    def test_timer_from_other_thread(self):
+        threading.Timer(0.05, self.reactor.call_later,
+                        args=(0, self.calls.append, 'thread')).start()
+        start = time()
+        while len(self.calls) == 0 and time() - start < 2.0:
+            self.reactor.run_once(5.0)
+        self.failUnlessEqual(self.calls, ['thread'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for lib.ReservationCalendar module.
+
+import unittest
+import random
+from lib.ReservationCalendar import *
+
+
+class BandwidthCalendarTest(unittest.TestCase):
+    def test_empty(self):
+        cal = BandwidthCalendar()
+        self.failUnlessEqual(cal.get_reserved('e', 0, FOREVER), 0)
+
+    def test_overlapping(self):
+        cal = BandwidthCalendar()
+        cal.reserve('e', 10, 20, 100)
+        cal.reserve('e', 15, 30, 50)
+        cal.reserve('other', 0, FOREVER, 1)
+
+        self.failUnlessEqual(cal.get_reserved('e', 0, 10), 0)
+        self.failUnlessEqual(cal.get_reserved('e', 0, 11), 100)
+        self.failUnlessEqual(cal.get_reserved('e', 10, 15), 100)
+        self.failUnlessEqual(cal.get_reserved('e', 12, 16), 150)
+        self.failUnlessEqual(cal.get_reserved('e', 20, 25), 50)
+        self.failUnlessEqual(cal.get_reserved('e', 30, FOREVER), 0)
+        self.failUnlessEqual(cal.get_reserved('e', 0, FOREVER), 150)
+
+        cal.release('e', 15, 30, 50)
+        self.failUnlessEqual(cal.get_reserved('e', 0, FOREVER), 100)
+        self.failUnlessEqual(cal.get_reserved('e', 20, 30), 0)
+        cal.release('e', 10, 20, 100)
+        self.failUnlessEqual(cal.get_keys(), ['other'])
+
+    def test_open_ended(self):
+        cal = BandwidthCalendar()
+        cal.reserve('e', 10, FOREVER, 100)
+        self.failUnlessEqual(cal.get_reserved('e', 1000, 2000), 100)
+        cal.release('e', 10, FOREVER, 100)
+        self.failUnlessEqual(cal.get_keys(), [])
+
+    def test_copy(self):
+        cal = BandwidthCalendar()
+        cal.reserve('e', 10, 20, 100)
+        copy = cal.copy()
+        cal.reserve('e', 10, 20, 100)
+        self.failUnlessEqual(copy.get_reserved('e', 0, FOREVER), 100)
+        self.failUnless(isinstance(copy, BandwidthCalendar))
+
+    def test_copy_on_write(self):
+        cal = BandwidthCalendar()
+        cal.reserve('e', 10, 20, 100)
+        cal.reserve('f', 10, 20, 100)
+        copy = cal.copy()
+        # Unchanged keys are shared
+        self.failUnless(copy.calendar['e'] is cal.calendar['e'])
+
+        copy.release('e', 10, 20, 100)
+        cal.reserve('f', 30, 40, 50)
+        self.failUnlessEqual(cal.get_reserved('e', 0, FOREVER), 100)
+        self.failUnlessEqual(copy.get_keys(), ['f'])
+        self.failUnlessEqual(copy.get_reserved('f', 25, FOREVER), 0)
+        self.failUnlessEqual(cal.get_reserved('f', 25, FOREVER), 50)
+
+    def test_open_ended_after_change(self):
+        # Open-ended answers are cached, and must follow changes.
+        cal = BandwidthCalendar()
+        cal.reserve('e', 10, 20, 100)
+        self.failUnlessEqual(cal.get_reserved('e', 15, FOREVER), 100)
+        cal.reserve('e', 30, FOREVER, 200)
+        self.failUnlessEqual(cal.get_reserved('e', 15, FOREVER), 200)
+        self.failUnlessEqual(cal.get_reserved('e', 15, 25), 100)
+        cal.release('e', 30, FOREVER, 200)
+        self.failUnlessEqual(cal.get_reserved('e', 15, FOREVER), 100)
+        self.failUnlessEqual(cal.get_reserved('e', 20, FOREVER), 0)
+
+    def test_against_brute_force(self):
+        rand = random.Random(1)
+        cal = BandwidthCalendar()
+        reservations = []
+        for i in range(300):
+            if len(reservations) > 0 and rand.random() < 0.4:
+                (start, stop, amount) = reservations.pop(
+                    rand.randrange(len(reservations)))
+                cal.release('e', start, stop, amount)
+            else:
+                start = rand.randrange(100)
+                stop = rand.choice([start + rand.randrange(1, 20), FOREVER])
+                amount = rand.randrange(1, 10)
+                reservations.append((start, stop, amount))
+                cal.reserve('e', start, stop, amount)
+
+            (times, amounts) = cal.calendar.get('e', ([], []))
+            # Fully compacted
+            for j in range(len(amounts)):
+                self.failIfEqual(amounts[j], amounts[j-1] if j else 0)
+            for (start, stop) in [(0, FOREVER), (rand.randrange(120),
+                                                 FOREVER)]:
+                stop = rand.choice([stop, start + rand.randrange(1, 30)])
+                expected = max([0] + [
+                    sum([a for (b, e, a) in reservations if b <= t < e])
+                    for t in range(start, min(stop, 121))])
+                self.failUnlessEqual(cal.get_reserved('e', start, stop),
+                                     expected)
+
+    def test_bad_release(self):
+        cal = BandwidthCalendar()
+        cal.reserve('e', 10, 20, 100)
+        self.failUnlessRaises(ReservationCalendarError,
+                              cal.release, 'e', 5, 20, 100)
+        self.failUnlessRaises(ReservationCalendarError,
+                              cal.reserve, 'e', 20, 20, 100)
+        # Unchanged
+        self.failUnlessEqual(cal.calendar['e'], ([10, 20], [100, 0]))
+
+
+class VLANCalendarTest(unittest.TestCase):
+    def test_vlans(self):
+        cal = VLANCalendar()
+        cal.reserve('n', 10, 20, 1 << 5)
+        cal.reserve('n', 20, 30, 1 << 5)
+        cal.reserve('n', 15, 25, 1 << 6)
+
+        self.failUnlessEqual(cal.get_reserved('n', 0, 12), 1 << 5)
+        self.failUnlessEqual(cal.get_reserved('n', 0, 40),
+                             (1 << 5) | (1 << 6))
+        # Same VLAN, same time
+        self.failUnlessRaises(ReservationCalendarError,
+                              cal.reserve, 'n', 25, 35, 1 << 5)
+        self.failUnlessEqual(cal.get_reserved('n', 30, 40), 0)
+
+        cal.release('n', 10, 20, 1 << 5)
+        cal.release('n', 20, 30, 1 << 5)
+        self.failUnlessEqual(cal.get_reserved('n', 0, 40), 1 << 6)
+        self.failUnlessRaises(ReservationCalendarError,
+                              cal.release, 'n', 15, 25, 1 << 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
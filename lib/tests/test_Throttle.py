@@ -0,0 +1,120 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for lib.Throttle module.
+
+import unittest
+import threading
+from time import sleep
+from lib.Throttle import *
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+
+class SeenCacheTest(unittest.TestCase):
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = SeenCache(10, clock=clock)
+        self.failUnless(cache.add('a'))
+        self.failIf(cache.add('a'))
+        self.failUnless(cache.add('b'))
+        clock.now += 11
+        self.failUnless(cache.add('a'))
+        self.failIf('b' in cache)
+        self.failUnlessEqual(len(cache), 1)
+        self.failUnlessEqual(cache.suppressed, 1)
+
+        cache.discard('a')
+        self.failUnless(cache.add('a'))
+
+    def test_max_entries(self):
+        cache = SeenCache(10, max_entries=2, clock=FakeClock())
+        for key in ['a', 'b', 'c']:
+            cache.add(key)
+        self.failUnlessEqual(len(cache), 2)
+        self.failUnless(cache.add('a'))
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=2, clock=clock)
+        self.failUnless(bucket.consume())
+        self.failUnless(bucket.consume())
+        self.failIf(bucket.consume())
+        self.failUnlessAlmostEqual(bucket.get_delay(), 0.5)
+        clock.now += 0.5
+        self.failUnless(bucket.consume())
+        # Doesn't fill above burst
+        clock.now += 100
+        self.failUnless(bucket.consume())
+        self.failUnless(bucket.consume())
+        self.failIf(bucket.consume())
+
+
+class CoalescingAdmitterTest(unittest.TestCase):
+    def test_coalesce(self):
+        handled = []
+        release = threading.Event()
+        def handler(item):
+            release.wait()
+            handled.append(item)
+        admitter = CoalescingAdmitter(handler, 1000, 60)
+
+        # The first is taken straight away, and blocks the thread.
+        self.failUnless(admitter.submit('a', 1))
+        sleep(0.1)
+        self.failUnless(admitter.submit('b', 1))
+        self.failIf(admitter.submit('b', 2))
+        self.failIf(admitter.submit('a', 2))
+        release.set()
+        sleep(0.1)
+
+        self.failUnlessEqual(handled, [1, 2])
+        counters = admitter.get_counters()
+        self.failUnlessEqual(counters['submitted'], 4)
+        self.failUnlessEqual(counters['coalesced'], 1)
+        self.failUnlessEqual(counters['suppressed'], 1)
+        self.failUnlessEqual(counters['admitted'], 2)
+        self.failUnlessEqual(counters['pending'], 0)
+
+        admitter.forget('a')
+        self.failUnless(admitter.submit('a', 3))
+
+    def test_rate(self):
+        handled = []
+        admitter = CoalescingAdmitter(handled.append, 10, 60, burst=1)
+        for i in range(3):
+            admitter.submit(i, i)
+        sleep(0.1)
+        self.failUnless(len(handled) < 3)
+        sleep(0.3)
+        self.failUnlessEqual(handled, [0, 1, 2])
+
+    def test_failure(self):
+        def handler(item):
+            raise Exception("Failed")
+        admitter = CoalescingAdmitter(handler, 1000, 60)
+        admitter.submit('a', 1)
+        sleep(0.1)
+        self.failUnlessEqual(admitter.get_counters()['failed'], 1)
+        # Failures can be retried
+        self.failUnless(admitter.submit('a', 1))
+
+    def test_stop(self):
+        handled = []
+        admitter = CoalescingAdmitter(handled.append, 1000, 60)
+        admitter.stop()
+        admitter.thread.join(1)
+        self.failIf(admitter.thread.is_alive())
+        self.failIf(admitter.submit('a', 1))
+        self.failUnlessEqual(handled, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+# Client for the Corsa REST API. Connections are kept alive in a session per
+# worker thread, so that each call doesn't start a new TLS connection, and
+# independent calls can be sent concurrently with dispatch().
+# Tunnels (and their meters) are cached per bridge. The cache is filled with a
+# single list request, and is then kept up to date by the posts, patches and
+# deletes that go through this client. Changes made by anyone else are picked
+# up when the cache expires, after cache_ttl seconds, or when find_tunnels()
+# finds nothing in the cache.
+
+import logging
+import re
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+from threading import local, RLock
+from time import time
+
+# Tunnel URLs look like <corsaurl>api/v1/bridges/<bridge>/tunnels[/<ofport>]
+TUNNEL_URL_RE = re.compile(r'^(?P<base>.*)api/v1/bridges/(?P<bridge>[^/]+)'
+                           r'/tunnels(/(?P<ofport>[^/?]+))?(\?.*)?$')
+
+CORSA_CACHE_TTL = 300
+CORSA_WORKERS = 4
+
+
+class CorsaRestClientError(Exception):
+    pass
+
+
+class CorsaRestClient(object):
+    ''' Sends REST calls to Corsa switches. Calls can be made with request(),
+        or with send() and dispatch() for anything with the same getters as
+        TranslatedCorsaRuleContainer: get_function(), get_url(), get_json(),
+        get_token() and get_valid_responses(). '''
+    def __init__(self, loggerid='corsarestclient', workers=CORSA_WORKERS,
+                 cache_ttl=CORSA_CACHE_TTL, verify=False):
+        self.logger = logging.getLogger(loggerid)
+        self.workers = workers
+        self.cache_ttl = cache_ttl
+        self.verify = verify # FIXME: Hardcoded by the callers, for now.
+
+        self.sessions = local()
+        self.pool = None
+
+        # (base, bridge) -> (fetch time, {ofport:tunnel})
+        self.tunnels = {}
+        self.cache_lock = RLock()
+        self.counters = {'requests':0,
+                         'cache_hits':0,
+                         'cache_misses':0}
+
+    def _get_session(self):
+        # requests.Session isn't guaranteed to be thread safe, so there's one
+        # per thread. They keep their connections open between calls.
+        session = getattr(self.sessions, 'session', None)
+        if session == None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.sessions.session = session
+        return session
+
+    def request(self, function, url, token, json=None, valid_responses=None):
+        ''' Sends a single REST call, and returns the response. If
+            valid_responses is given, raises CorsaRestClientError if the
+            response's status code isn't in it. The tunnel cache is updated
+            to match. '''
+        if function not in ['get', 'post', 'patch', 'delete']:
+            raise ValueError("Function not valid: %s:%s" % (function, json))
+        with self.cache_lock:
+            self.counters['requests'] += 1
+        response = self._get_session().request(function, url, json=json,
+                                                headers={'Authorization':token},
+                                                verify=self.verify)
+
+        if (valid_responses != None and
+            response.status_code not in valid_responses):
+            # Not sure what state the switch is in now.
+            self._invalidate_url(url)
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text
+            raise CorsaRestClientError("REST command failed %s:%s:%s\n    %s\n    %s" %
+                                       (function, url, json,
+                                        response.status_code, body))
+        if response.status_code < 300:
+            self._update_cache(function, url, json, response)
+        return response
+
+    def send(self, rc):
+        ''' Sends a TranslatedCorsaRuleContainer, or anything that looks like
+            one. '''
+        return self.request(rc.get_function(), rc.get_url(), rc.get_token(),
+                            rc.get_json(), rc.get_valid_responses())
+
+    def dispatch(self, rcs):
+        ''' Sends a list of independent calls concurrently, and waits for all
+            of them to finish. Returns the responses in the same order. If any
+            fail, the first failure is raised once they have all finished. '''
+        if len(rcs) == 0:
+            return []
+        if len(rcs) == 1 or self.workers <= 1:
+            return [self.send(rc) for rc in rcs]
+        if self.pool == None:
+            self.pool = ThreadPool(self.workers)
+        results = self.pool.map(self._send_catching, rcs)
+        for (response, error) in results:
+            if error != None:
+                raise error
+        return [response for (response, error) in results]
+
+    def _send_catching(self, rc):
+        try:
+            return (self.send(rc), None)
+        except Exception as e:
+            self.logger.error("Corsa REST call %s failed: %s" % (rc, e))
+            return (None, e)
+
+    def get_tunnels(self, base, bridge, token, refresh=False):
+        ''' Returns {ofport:tunnel} for all tunnels on bridge. Only asks the
+            switch if they aren't cached, have expired, or refresh is set. '''
+        with self.cache_lock:
+            cached = self._get_cached(base, bridge)
+            if not refresh and cached != None:
+                self.counters['cache_hits'] += 1
+                return cached
+            self.counters['cache_misses'] += 1
+        url = base + "api/v1/bridges/" + bridge + "/tunnels?list=true"
+        self.request('get', url, token, valid_responses=[200])
+        with self.cache_lock:
+            return self.tunnels[(base, bridge)][1]
+
+    def _get_cached(self, base, bridge):
+        ''' Returns the cached {ofport:tunnel} for bridge, or None if they
+            aren't cached or have expired. '''
+        with self.cache_lock:
+            cached = self.tunnels.get((base, bridge))
+            if cached == None or cached[0] + self.cache_ttl <= time():
+                return None
+            return cached[1]
+
+    def find_tunnels(self, base, bridge, token, vlan, ports):
+        ''' Returns the tunnels on bridge with vlan-id vlan on any of ports.
+            Tunnels made by anyone else since the cache was filled aren't in
+            it, so if none are found in the cache, the switch is asked. '''
+        cached = self._get_cached(base, bridge) != None
+        found = self._match_tunnels(self.get_tunnels(base, bridge, token),
+                                    vlan, ports)
+        if len(found) == 0 and cached:
+            found = self._match_tunnels(
+                self.get_tunnels(base, bridge, token, refresh=True),
+                vlan, ports)
+        return found
+
+    def _match_tunnels(self, tunnels, vlan, ports):
+        with self.cache_lock:
+            return [t for t in tunnels.values()
+                    if (t.get('vlan-id') == vlan and
+                        int(t.get('port')) in ports)]
+
+    def invalidate(self, base=None, bridge=None):
+        ''' Forgets cached tunnels for bridge, or for everything if bridge is
+            None. '''
+        with self.cache_lock:
+            if bridge == None:
+                self.tunnels = {}
+            else:
+                self.tunnels.pop((base, bridge), None)
+
+    def get_counters(self):
+        with self.cache_lock:
+            return dict(self.counters)
+
+    def _invalidate_url(self, url):
+        m = TUNNEL_URL_RE.match(url)
+        if m != None:
+            self.invalidate(m.group('base'), m.group('bridge'))
+
+    def _update_cache(self, function, url, json, response):
+        m = TUNNEL_URL_RE.match(url)
+        if m == None:
+            return
+        key = (m.group('base'), m.group('bridge'))
+        ofport = m.group('ofport')
+        collection = (m.group('base') + "api/v1/bridges/" + m.group('bridge') +
+                      "/tunnels")
+
+        with self.cache_lock:
+            if function == 'get' and ofport == None:
+                tunnels = {}
+                for entry in response.json()['list']:
+                    tunnels[int(entry['ofport'])] = entry
+                self.tunnels[key] = (time(), tunnels)
+                return
+
+            if key not in self.tunnels:
+                return
+            tunnels = self.tunnels[key][1]
+            if function == 'post' and ofport == None:
+                entry = dict(json)
+                entry['links'] = {'self':{'href':collection + "/" +
+                                          str(json['ofport'])}}
+                tunnels[int(json['ofport'])] = entry
+            elif function == 'delete' and ofport != None:
+                tunnels.pop(int(ofport), None)
+            elif function == 'patch' and ofport != None:
+                if int(ofport) not in tunnels:
+                    return
+                for op in json:
+                    self._apply_patch(tunnels[int(ofport)], op)
+
+    def _apply_patch(self, entry, op):
+        # Only 'replace' and 'add' are used against tunnels.
+        path = op['path'].strip('/').split('/')
+        for field in path[:-1]:
+            entry = entry.setdefault(field, {})
+        if op['op'] in ['replace', 'add']:
+            entry[path[-1]] = op['value']
+        elif op['op'] == 'remove':
+            entry.pop(path[-1], None)
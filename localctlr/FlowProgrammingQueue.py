@@ -0,0 +1,302 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+from threading import Lock
+from time import time
+
+# Default maximum number of messages in a batch. If more are added before the
+# batch is flushed, the batch is flushed early and a new one is started.
+DEFAULT_MAX_BATCH_SIZE = 256
+
+
+class FlowProgrammingQueueError(Exception):
+    pass
+
+
+class FlowBatch(object):
+    ''' A batch of OpenFlow messages sent to one switch, closed by either a
+        barrier or a bundle commit. Keeps track of the SDX cookies the batch
+        installs and removes, and which cookie each message belongs to, so
+        that the batch's completion, and which rules failed, can be reported
+        upwards. '''
+    def __init__(self, switch_id, bundle_id=None):
+        self.switch_id = switch_id
+        self.bundle_id = bundle_id
+        self.msgs = []
+        self.xids = []
+        self.closing_xid = None
+        self.installed = []
+        self.removed = []
+        self.errors = []
+        # SDX cookie of each message in msgs, None if not part of a rule
+        self.msg_cookies = []
+        # xid -> SDX cookie, for the messages that belong to a rule
+        self.xid_cookies = {}
+        # SDX cookies of rules the switch rejected messages for
+        self.failed_cookies = []
+        # Set if an error couldn't be tied to a particular rule
+        self.failed_all = False
+        self.start_time = None
+        self.end_time = None
+
+    def __str__(self):
+        return "FlowBatch(%s, %d msgs, installed %s, removed %s)" % (
+            self.switch_id, len(self.msgs), self.installed, self.removed)
+
+    def is_empty(self):
+        return (len(self.msgs) == 0 and len(self.installed) == 0 and
+                len(self.removed) == 0 and len(self.failed_cookies) == 0)
+
+    def is_successful(self):
+        return len(self.errors) == 0
+
+    def get_failed(self):
+        ''' Returns the SDX cookies of the rules in this batch that failed. A
+            bundle is all or nothing, as is a batch with an error that isn't
+            for any particular rule, such as a disconnect. '''
+        if self.is_successful():
+            return []
+        if self.bundle_id != None or self.failed_all:
+            failed = list(self.installed)
+        else:
+            failed = [c for c in self.installed if c in self.failed_cookies]
+        # Rules split across batches by an early flush.
+        failed += [c for c in self.failed_cookies if c not in failed]
+        return failed
+
+    def get_latency(self):
+        ''' Seconds from sending the batch to the switch confirming it. '''
+        if self.start_time == None or self.end_time == None:
+            return None
+        return self.end_time - self.start_time
+
+    def get_report(self):
+        ''' Returns a dictionary describing the completed batch. This is what
+            is passed up to the RyuControllerInterface. '''
+        return {'switch_id':self.switch_id,
+                'installed':self.installed,
+                'removed':self.removed,
+                'messages':len(self.msgs),
+                'bundle':self.bundle_id != None,
+                'latency':self.get_latency(),
+                'success':self.is_successful(),
+                'failed':self.get_failed(),
+                'errors':self.errors}
+
+
+class FlowProgrammingQueue(object):
+    ''' Per-datapath queue of OpenFlow messages. Messages (FlowMods, GroupMods,
+        etc.) are added to the current batch, and flush() sends the batch to
+        the switch in a single write, closed by a barrier request. If the
+        switch supports OpenFlow bundles, the batch is instead sent as a
+        bundle and committed atomically.
+        When the switch replies to the barrier or commit, completion_cb is
+        called with the FlowBatch. Errors the switch sends for any message in
+        the batch are collected in the FlowBatch.
+        datapath is a Ryu Datapath: only its id, ofproto, ofproto_parser,
+        set_xid() and send() are used. '''
+
+    def __init__(self, datapath, completion_cb, logger,
+                 max_batch_size=DEFAULT_MAX_BATCH_SIZE, use_bundles=None):
+        self.datapath = datapath
+        self.completion_cb = completion_cb
+        self.logger = logger
+        self.max_batch_size = max_batch_size
+
+        # Bundles are only in OpenFlow 1.4 and later.
+        if use_bundles == None:
+            use_bundles = hasattr(datapath.ofproto_parser,
+                                  'OFPBundleCtrlMsg')
+        self.use_bundles = use_bundles
+        self.next_bundle_id = 1
+
+        self.lock = Lock()
+        self.current = None
+        # SDX cookie of the rule being installed, set by note_installed()
+        self.current_cookie = None
+        # xid of any sent message -> FlowBatch, until the batch completes
+        self.outstanding = {}
+        # closing xid or bundle ID -> FlowBatch
+        self.closing = {}
+
+    def _get_current(self):
+        if self.current == None:
+            bundle_id = None
+            if self.use_bundles:
+                bundle_id = self.next_bundle_id
+                self.next_bundle_id += 1
+            self.current = FlowBatch(self.datapath.id, bundle_id)
+        return self.current
+
+    def add(self, msg):
+        ''' Adds an OpenFlow message to the current batch. '''
+        with self.lock:
+            batch = self._get_current()
+            batch.msgs.append(msg)
+            cookie = self.current_cookie
+            batch.msg_cookies.append(cookie)
+            full = len(batch.msgs) >= self.max_batch_size
+        if full:
+            self.flush()
+            # The rest of the rule's messages go in the next batch.
+            with self.lock:
+                self.current_cookie = cookie
+
+    def start_rule(self, sdx_cookie):
+        ''' Messages added afterwards belong to sdx_cookie, until the next
+            start_rule(), note_installed() or note_removed(). '''
+        with self.lock:
+            self.current_cookie = sdx_cookie
+
+    def note_installed(self, sdx_cookie):
+        ''' Records that the current batch installs sdx_cookie, even if it
+            contains no messages for it. Messages added afterwards belong to
+            sdx_cookie, as for start_rule(). '''
+        with self.lock:
+            self._get_current().installed.append(sdx_cookie)
+            self.current_cookie = sdx_cookie
+
+    def fail_cookie(self, sdx_cookie, description):
+        ''' Records that installing sdx_cookie failed before anything was
+            confirmed by the switch, so that the current batch reports it as
+            failed. '''
+        with self.lock:
+            batch = self._get_current()
+            batch.errors.append(description)
+            if sdx_cookie not in batch.failed_cookies:
+                batch.failed_cookies.append(sdx_cookie)
+            self.current_cookie = None
+
+    def note_removed(self, sdx_cookie):
+        ''' Records that the current batch removes sdx_cookie. '''
+        with self.lock:
+            self._get_current().removed.append(sdx_cookie)
+            self.current_cookie = None
+
+    def flush(self):
+        ''' Sends the current batch, if there is one. Returns the FlowBatch
+            sent, or None. '''
+        with self.lock:
+            batch = self.current
+            self.current = None
+            self.current_cookie = None
+            if batch == None or batch.is_empty():
+                return None
+
+            if batch.bundle_id != None:
+                msgs = self._bundle_msgs(batch)
+                cookies = [None] + batch.msg_cookies + [None]
+            else:
+                msgs = batch.msgs + [
+                    self.datapath.ofproto_parser.OFPBarrierRequest(
+                        self.datapath)]
+                cookies = batch.msg_cookies + [None]
+
+            bufs = []
+            for (msg, cookie) in zip(msgs, cookies):
+                if msg.xid == None:
+                    self.datapath.set_xid(msg)
+                msg.serialize()
+                bufs.append(msg.buf)
+                batch.xids.append(msg.xid)
+                if cookie != None:
+                    batch.xid_cookies[msg.xid] = cookie
+                self.outstanding[msg.xid] = batch
+            batch.closing_xid = msgs[-1].xid
+            if batch.bundle_id != None:
+                self.closing[batch.bundle_id] = batch
+            else:
+                self.closing[batch.closing_xid] = batch
+
+            batch.start_time = time()
+            self.datapath.send(''.join(bufs))
+
+        self.logger.debug("FlowProgrammingQueue: sent %s" % batch)
+        return batch
+
+    def _bundle_msgs(self, batch):
+        ''' Wraps the messages of batch in an atomic bundle. '''
+        ofp = self.datapath.ofproto
+        parser = self.datapath.ofproto_parser
+        flags = ofp.OFPBF_ATOMIC
+        msgs = [parser.OFPBundleCtrlMsg(self.datapath, batch.bundle_id,
+                                        ofp.OFPBCT_OPEN_REQUEST, flags, [])]
+        for msg in batch.msgs:
+            msgs.append(parser.OFPBundleAddMsg(self.datapath, batch.bundle_id,
+                                               flags, msg, []))
+        msgs.append(parser.OFPBundleCtrlMsg(self.datapath, batch.bundle_id,
+                                            ofp.OFPBCT_COMMIT_REQUEST,
+                                            flags, []))
+        return msgs
+
+    def barrier_reply(self, xid):
+        ''' Called on a barrier reply. Returns True if it completed a batch. '''
+        with self.lock:
+            batch = self.closing.get(xid)
+            if batch == None or batch.bundle_id != None:
+                return False
+            del self.closing[xid]
+        self._complete(batch)
+        return True
+
+    def bundle_reply(self, bundle_id, committed=True):
+        ''' Called on a bundle control reply for the commit. Returns True if it
+            completed a batch. '''
+        with self.lock:
+            batch = self.closing.pop(bundle_id, None)
+        if batch == None:
+            return False
+        if not committed:
+            batch.errors.append("Bundle %s not committed" % bundle_id)
+        self._complete(batch)
+        return True
+
+    def error(self, xid, description):
+        ''' Called on an error message from the switch. Returns True if the
+            failed message was part of an outstanding batch. '''
+        with self.lock:
+            batch = self.outstanding.get(xid)
+            if batch == None:
+                return False
+            batch.errors.append(description)
+            cookie = batch.xid_cookies.get(xid)
+            if cookie == None:
+                batch.failed_all = True
+            elif cookie not in batch.failed_cookies:
+                batch.failed_cookies.append(cookie)
+        return True
+
+    def fail_all(self, reason):
+        ''' Called when the switch has gone away. Every batch that was sent
+            and not yet confirmed, and the batch that hasn't been sent yet, 
+            fails with reason. '''
+        with self.lock:
+            batches = self.closing.values()
+            self.closing = {}
+            if self.current != None and not self.current.is_empty():
+                batches.append(self.current)
+            self.current = None
+            self.current_cookie = None
+        for batch in batches:
+            batch.errors.append(reason)
+            batch.failed_all = True
+            self._complete(batch)
+
+    def get_outstanding_count(self):
+        ''' Number of batches sent but not yet confirmed by the switch. '''
+        with self.lock:
+            return len(self.closing)
+
+    def _complete(self, batch):
+        batch.end_time = time()
+        with self.lock:
+            for xid in batch.xids:
+                self.outstanding.pop(xid, None)
+        if batch.is_successful():
+            self.logger.debug("FlowProgrammingQueue: completed %s in %f" %
+                              (batch, batch.get_latency()))
+        else:
+            self.logger.error("FlowProgrammingQueue: %s failed: %s" %
+                              (batch, batch.errors))
+        self.completion_cb(batch)
@@ -8,6 +8,7 @@ from lib.AtlanticWaveConnectionManager import AtlanticWaveConnectionManager
 # RyuControllerInterface to RyuTranslateInterface
 ICX_ADD = "ADD"
 ICX_REMOVE = "REMOVE"
+ICX_CORSA_DELETE = "CORSA_DELETE"
     
 
 # Responses
@@ -15,6 +16,7 @@ ICX_REMOVE = "REMOVE"
 ICX_DATAPATHS = "DATAPATHS"
 ICX_UNKNOWN_SOURCE = "UNKNOWN_SOURCE"
 ICX_L2MULTIPOINT_UNKNOWN_SOURCE = "L2MULTIPOINT_UNKNOWN_SOURCE"
+ICX_BATCH_COMPLETE = "BATCH_COMPLETE"
 
 
 class InterRyuControllerConnectionManager(AtlanticWaveConnectionManager):
@@ -2,8 +2,10 @@
 # AtlanticWave/SDX Project
 
 import cPickle as pickle
+from threading import Condition, Lock, RLock, Thread
 from lib.AtlanticWaveManager import AtlanticWaveManager
 from shared.ManagementLCRecoverRule import *
+from shared.RuleDigest import RuleDigest, DEFAULT_COOKIE_RANGE, rule_bucket
 
 # List of rule statuses
 RULE_STATUS_ACTIVE       = 1
@@ -29,12 +31,28 @@ class LCRuleManagerDeletionError(LCRuleManagerError):
 class LCRuleManager(AtlanticWaveManager):
     ''' This keeps track of LCRules. It provideds a database for easier 
         filtering.
+        Rules are kept in memory, indexed by cookie, by (cookie, switch_id)
+        and by status, along with a RuleDigest of them. The rule_table is
+        only read at initialization: after that, it is written to in the
+        background, for persistence.
         Singleton. '''
 
     def __init__(self, loggeridprefix='localcontroller',
                  db_filename=':memory:'):
         loggerid = loggeridprefix + '.lcrulemanager'
         super(LCRuleManager, self).__init__(loggerid)
+
+        # Write-behind for the rule_table. Only set up once: if this is being
+        # reinitialized, finish writing to the old DB first.
+        if getattr(self, '_writer_thread', None) == None:
+            self._write_cv = Condition()
+            self._flush_lock = Lock()
+            self._write_queue = []
+            self._writer_thread = Thread(target=self._write_behind_thread)
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+        else:
+            self.flush()
         
         # Setup DB.
         db_tuples = [('rule_table', 'lcrules')] 
@@ -45,12 +63,105 @@ class LCRuleManager(AtlanticWaveManager):
 
         self._valid_table_columns = ['cookie','switch_id','status','rule']
 
+        # Rule cache. Entries are keyed by their rule_table id.
+        self.cache_lock = RLock()
+        self._load_rule_cache()
+
         # Setup initial rules related stuff.
         self._initial_rules_list = []
 
         self.logger.warning("%s initialized: %s" % (self.__class__.__name__,
                                                     hex(id(self))))
 
+    def _load_rule_cache(self):
+        ''' Reads the rule_table into the rule cache and its indexes. '''
+        with self.cache_lock:
+            self._rules = {}
+            self._rule_indexes = {'cookie':{},
+                                  'key':{},
+                                  'status':{}}
+            self._digest = RuleDigest()
+            self._next_id = 1
+            for x in self.rule_table.find(order_by='id'):
+                self._cache_rule({'id':x['id'],
+                                  'cookie':x['cookie'],
+                                  'switch_id':x['switch_id'],
+                                  'status':x['status'],
+                                  'rule':pickle.loads(str(x['rule']))})
+                self._next_id = max(self._next_id, x['id'] + 1)
+
+    def _cache_rule(self, entry):
+        with self.cache_lock:
+            self._rules[entry['id']] = entry
+            self._digest.add(entry['cookie'], entry['switch_id'],
+                             entry['rule'])
+            for index in self._rule_indexes.keys():
+                value = self._index_value(entry, index)
+                self._rule_indexes[index].setdefault(value, set()).add(
+                    entry['id'])
+
+    def _uncache_rule(self, entry):
+        with self.cache_lock:
+            del self._rules[entry['id']]
+            self._digest.remove(entry['cookie'], entry['switch_id'],
+                                entry['rule'])
+            for index in self._rule_indexes.keys():
+                self._unindex(entry, index)
+
+    def _unindex(self, entry, index):
+        value = self._index_value(entry, index)
+        ids = self._rule_indexes[index][value]
+        ids.discard(entry['id'])
+        if len(ids) == 0:
+            del self._rule_indexes[index][value]
+
+    def _index_value(self, entry, index):
+        if index == 'key':
+            return (entry['cookie'], entry['switch_id'])
+        return entry[index]
+
+    def _get_entries(self, cookie, switch_id):
+        ''' Returns the cache entries for (cookie, switch_id), oldest
+            first. '''
+        with self.cache_lock:
+            ids = self._rule_indexes['key'].get((cookie, switch_id), set())
+            return [self._rules[i] for i in sorted(ids)]
+
+    def _write_behind(self, op):
+        ''' Queues op for the rule_table. '''
+        with self._write_cv:
+            self._write_queue.append(op)
+            self._write_cv.notify()
+
+    def _write_behind_thread(self):
+        while True:
+            with self._write_cv:
+                while len(self._write_queue) == 0:
+                    self._write_cv.wait()
+            self.flush()
+
+    def flush(self):
+        ''' Writes all queued changes to the rule_table, in a single 
+            transaction. Returns once they have been written. '''
+        with self._flush_lock:
+            with self._write_cv:
+                ops = self._write_queue
+                self._write_queue = []
+            if len(ops) == 0:
+                return
+            try:
+                with self.db:
+                    table = self.rule_table
+                    for (op, row) in ops:
+                        if op == 'insert':
+                            table.insert(row)
+                        elif op == 'update':
+                            table.update(row, ['id'])
+                        elif op == 'delete':
+                            table.delete(**row)
+            except Exception as e:
+                self.logger.error("Writing %d changes to rule_table failed: %s"
+                                  % (len(ops), e))
 
     def add_rule(self, cookie, switch_id, lcrule, 
                  status=RULE_STATUS_INSTALLING):
@@ -61,12 +172,10 @@ class LCRuleManager(AtlanticWaveManager):
 
         textrule = pickle.dumps(lcrule)
 
-        # Confirm that we're not inserting a duplicate rule.
-        dupes = self._find_rules({'cookie':cookie,
-                                  'switch_id':switch_id})
-        if dupes != None:
-            for dupe in dupes:
-                (c,sid,lcr,stat) = dupe
+        with self.cache_lock:
+            # Confirm that we're not inserting a duplicate rule.
+            for dupe in self._get_entries(cookie, switch_id):
+                lcr = dupe['rule']
                 if lcr == lcrule:
                     if isinstance(lcr, ManagementLCRecoverRule):
                         self.logger.debug("ManagementLCRecoverRule, ignored.")
@@ -75,75 +184,101 @@ class LCRuleManager(AtlanticWaveManager):
                             "Duplicate add_rule for %s:%s:%s" %
                             (cookie, switch_id, str(lcrule)))
 
-        # Translate rule into a string so it can be stored
-        self.rule_table.insert({'cookie':cookie,
-                                'switch_id':switch_id,
-                                'status':status,
-                                'rule':textrule})
+            entry = {'id':self._next_id,
+                     'cookie':cookie,
+                     'switch_id':switch_id,
+                     'status':status,
+                     'rule':lcrule}
+            self._next_id += 1
+            self._cache_rule(entry)
 
-        listrules = self._find_rules({})
-        self.logger.debug("%s - %s --- MCEVIK add_rule: listrules: %s" % (self.__class__.__name__, hex(id(self)), str(listrules)))
+        # Translate rule into a string so it can be stored
+        self._write_behind(('insert', {'id':entry['id'],
+                                       'cookie':cookie,
+                                       'switch_id':switch_id,
+                                       'status':status,
+                                       'rule':textrule}))
+        self.logger.debug("add_rule: %s:%s, %d rules" % (cookie, switch_id,
+                                                         len(self._rules)))
 
     def rm_rule(self, cookie, switch_id):
         # Remove LC rule identified by cookie and switch_id
-        
-        record = self.rule_table.find_one(cookie=cookie, switch_id=switch_id)
-        if record != None:
-            self.rule_table.delete(cookie=cookie, switch_id=switch_id)
-        else:
-            raise LCRuleManagerDeletionError(
-                "Cannot delete %s:%s: doesn't exist" %
-                (cookie, switch_id))
+        with self.cache_lock:
+            entries = self._get_entries(cookie, switch_id)
+            if len(entries) == 0:
+                raise LCRuleManagerDeletionError(
+                    "Cannot delete %s:%s: doesn't exist" %
+                    (cookie, switch_id))
+            for entry in entries:
+                self._uncache_rule(entry)
+                self._write_behind(('delete', {'id':entry['id']}))
 
     def set_status(self, cookie, switch_id, status):
         if status not in VALID_RULE_STATUSES:
             raise LCRuleManagerValidationError(
                 "Invalid Rule Status provided: %s" % status)
         # Changes the status of a particular rule
-        record = self.rule_table.find_one(cookie=cookie, switch_id=switch_id)
-        if record != None:
-            self.rule_table.update({'cookie':cookie,
-                                    'switch_id':switch_id,
-                                    'status':status},
-                                   ['cookie','switch_id'])
-        listrules = self._find_rules({})
-        self.logger.debug("%s - %s --- MCEVIK set_status: listrules: %s" % (self.__class__.__name__, hex(id(self)), str(listrules)))
+        with self.cache_lock:
+            for entry in self._get_entries(cookie, switch_id):
+                self._unindex(entry, 'status')
+                entry['status'] = status
+                self._rule_indexes['status'].setdefault(status, set()).add(
+                    entry['id'])
+                self._write_behind(('update', {'id':entry['id'],
+                                               'status':status}))
+        self.logger.debug("set_status: %s:%s to %s" % (cookie, switch_id,
+                                                       status))
 
     def _find_rules(self, filter={}):
         # If filter=={}, return all rules.
         # Returns a list of (cookie, switch_id, rule, status) tuples
 
         # Validate the filter
-        if filter != None:
-            if type(filter) != dict:
-                raise LCRuleManagerTypeError("filter is not a dictionary: %s" %
-                                             type(filter))
-            for key in filter.keys():
-                if key not in self._valid_table_columns:
-                    raise LCRuleManagerValidationError(
-                        "filter column '%s' is not a valid filtering field %s" %
-                        (key, self._valid_table_columns))
-
-        # Do the search on the table. 
-        results = self.rule_table.find(**filter)
+        if filter == None:
+            filter = {}
+        if type(filter) != dict:
+            raise LCRuleManagerTypeError("filter is not a dictionary: %s" %
+                                         type(filter))
+        for key in filter.keys():
+            if key not in self._valid_table_columns:
+                raise LCRuleManagerValidationError(
+                    "filter column '%s' is not a valid filtering field %s" %
+                    (key, self._valid_table_columns))
+
+        # Do the search on the cache. Indexed columns narrow down the
+        # candidates, the rest are checked against each candidate.
+        indexed = dict((k, v) for (k, v) in filter.items()
+                       if k in self._rule_indexes)
+        if 'cookie' in filter and 'switch_id' in filter:
+            indexed['key'] = (filter['cookie'], filter['switch_id'])
+        with self.cache_lock:
+            ids = None
+            for (key, value) in indexed.items():
+                matched = self._rule_indexes[key].get(value, set())
+                if ids == None:
+                    ids = set(matched)
+                else:
+                    ids &= matched
+            if ids == None:
+                ids = self._rules.keys()
+            results = [self._rules[i] for i in sorted(ids)]
+        for (key, value) in filter.items():
+            if key not in indexed:
+                results = [x for x in results if x[key] == value]
 
         # Send Back results.
         retval = [(x['cookie'],
                    x['switch_id'],
-                   pickle.loads(str(x['rule'])),
+                   x['rule'],
                    x['status']) for x in results]
         return retval
 
     def list_all_rules(self, full_tuple=False):
-        rules = self.rule_table.find()
         self.logger.debug("Retrieving all rules.")
+        rules = self._find_rules()
         if full_tuple:
-            retval = [(x['cookie'],
-                       x['switch_id'],
-                       pickle.loads(str(x['rule'])),
-                       x['status']) for x in rules]
-            return retval
-        retval = [pickle.loads(str(x['rule'])) for x in rules]
+            return rules
+        retval = [r for (c, s, r, st) in rules]
         return retval
 
     def get_rules(self, cookie, switch_id, full_tuple=False):
@@ -152,26 +287,31 @@ class LCRuleManager(AtlanticWaveManager):
             If  full_tuple==True, then a list of tuples will be returned:
                 (cookie, switch_id, rule, status)
         '''
-
-        listrules = self._find_rules({})
-        self.logger.debug("%s - %s --- MCEVIK get_rules: listrules: %s" % (self.__class__.__name__, hex(id(self)), str(listrules)))
-
         # Get the rule specified by cookie
-        rules = self.rule_table.find(cookie=cookie, switch_id=switch_id)
-        self.logger.debug("%s - %s --- MCEVIK get_rules: rules: %s" % (self.__class__.__name__, hex(id(self)), str(rules)))
+        rules = self._get_entries(cookie, switch_id)
+        self.logger.debug("get_rules: %s:%s, %d found" % (cookie, switch_id,
+                                                          len(rules)))
 
         if full_tuple:
             retval = [(x['cookie'],
                        x['switch_id'],
-                       pickle.loads(str(x['rule'])),
+                       x['rule'],
                        x['status']) for x in rules]
-            self.logger.debug("%s - %s --- MCEVIK get_rules: retval full_tuple: %s" % (self.__class__.__name__, hex(id(self)), str(retval)))
             return retval
 
-        retval = [pickle.loads(str(x['rule'])) for x in rules]
-        self.logger.debug("%s - %s --- MCEVIK get_rules: retval : %s" % (self.__class__.__name__, hex(id(self)), str(retval)))
+        retval = [x['rule'] for x in rules]
         return retval
 
+    def get_rule_digest(self, cookie_range=DEFAULT_COOKIE_RANGE):
+        ''' Returns a RuleDigest of all rules, bucketed by cookie_range. '''
+        with self.cache_lock:
+            if cookie_range == self._digest.cookie_range:
+                return self._digest.copy()
+            digest = RuleDigest(cookie_range)
+            for x in self._rules.values():
+                digest.add(x['cookie'], x['switch_id'], x['rule'])
+            return digest
+
     def add_initial_rule(self, rule, cookie, switch_id):
         # Used during initial rule stage of inialization.
         self.logger.debug(
@@ -179,47 +319,52 @@ class LCRuleManager(AtlanticWaveManager):
             (cookie, switch_id, rule.get_data()['rule']))
         self._initial_rules_list.append((cookie, switch_id, rule))
 
-    def initial_rules_complete(self):
+    def initial_rules_complete(self, buckets=None,
+                               cookie_range=DEFAULT_COOKIE_RANGE):
         ''' Returns two lists: rules for deletion, rules to be added. None of 
             the rules in either of these lists are added or removed from this 
             DB. This is just a service for the LC to make life a bit easier.
+            If only the initial rules in some buckets were received, buckets
+            is the set of them, see reconcile().
             NOTE: clear_initial_rules() *must* be called afterwards.
         '''
-        delete_list = []
-        add_list = []
-
-        # Build up the delete_list:
-        # Go through all installed rules. If it's not in the
-        # _initial_rules_list, add to delete list.
-        # Anything left over in the _initial_rules_list is now the add_list
-        # Empty the _initial_rules_list for the next reconnection.
-        # NOTE: _initial_rules_list is a list of SDXMessageInstallRules
-        self.logger.debug("IRC RULE_TABLE %s" % self.rule_table)
-        
-        self.logger.debug("IRC _INITIAL_RULES_LIST %s" % 
-                          self._initial_rules_list)
-        
-        list_of_c_and_s = [(x['cookie'], x['switch_id'])
-                           for x in self.rule_table.find()]
-        c_and_s_from_irl = [(c,s) for (c,s,r) in self._initial_rules_list]
-
-        for t in list_of_c_and_s:
-            if t not in c_and_s_from_irl:
-                (c,s) = t
-                rules = self.get_rules(c,s, True)
-                for rule in rules:
-                    (c,s,r,t) = rule
-                    delete_list.append((r,c,s))
-
-        for t in c_and_s_from_irl:
-            if t not in list_of_c_and_s:
-                (c,s) = t
-                for (c1,s1,r1) in self._initial_rules_list:
-                    if (c==c1 and s==s1):
-                        add_list.append((r1,c1,s1))
-
+        self.logger.debug("IRC %d rules, %d initial rules" %
+                          (len(self._rules), len(self._initial_rules_list)))
+        return self.reconcile(self._initial_rules_list, buckets, cookie_range)
+
+    def reconcile(self, initial_rules, buckets=None,
+                  cookie_range=DEFAULT_COOKIE_RANGE):
+        ''' Compares installed rules against initial_rules, a list of
+            (cookie, switch_id, rule) tuples, by (cookie, switch_id). Returns
+            two lists of (rule, cookie, switch_id) tuples: installed rules
+            that aren't in initial_rules, to be deleted, and initial_rules
+            that aren't installed, to be added. Nothing is changed here.
+            If buckets is not None, initial_rules only covers those 
+            (switch_id, cookie range) buckets, and installed rules in any
+            other bucket are left alone.
+        '''
+        wanted = set((c, s) for (c, s, r) in initial_rules)
+        with self.cache_lock:
+            installed = set(self._rule_indexes['key'].keys())
+            if buckets != None:
+                installed = set((c, s) for (c, s) in installed
+                                if rule_bucket(c, s, cookie_range) in buckets)
+            delete_list = [(x['rule'], x['cookie'], x['switch_id'])
+                           for x in self._find_rules_by_keys(installed -
+                                                             wanted)]
+        add_list = [(r, c, s) for (c, s, r) in initial_rules
+                    if (c, s) not in installed]
         return (delete_list, add_list)
 
+    def _find_rules_by_keys(self, keys):
+        ''' Returns cache entries for all (cookie, switch_id) in keys, 
+            oldest first. '''
+        with self.cache_lock:
+            ids = []
+            for key in keys:
+                ids.extend(self._rule_indexes['key'][key])
+            return [self._rules[i] for i in sorted(ids)]
+
     def clear_initial_rules(self):
         ''' Called by LC once current set of initial rules are not needed 
             anymore.
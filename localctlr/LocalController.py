@@ -16,7 +16,8 @@ from Queue import Queue, Empty
 from time import sleep
 
 from lib.AtlanticWaveModule import AtlanticWaveModule
-from lib.Connection import select as cxnselect
+from lib.ConnectionReactor import ConnectionReactor
+from lib.Throttle import SeenCache
 from RyuControllerInterface import *
 from RyuTranslateInterface import *
 from LCRuleManager import *
@@ -60,13 +61,20 @@ class LocalController(AtlanticWaveModule):
 
         # Initial Rules
         self._initial_rules_dict = {}
+
+        # Unknown sources already sent to the SDX controller. The 
+        # RyuTranslateInterface suppresses repeats too, but loses track of 
+        # them when it is restarted.
+        self.unknown_sources = SeenCache(UNKNOWN_SOURCE_TTL)
         
         # Setup switch
         self._setup_switch()
 
         # Setup connection manager
         self.cxn_q = Queue()
-        self.sdx_cm = SDXControllerConnectionManager(self.loggerid)
+        self.reactor = ConnectionReactor(self.loggerid)
+        self.sdx_cm = SDXControllerConnectionManager(self.loggerid,
+                                                     self.reactor)
         self.sdx_connection = None
         self.start_cxn_thread = None
 
@@ -104,49 +112,36 @@ class LocalController(AtlanticWaveModule):
     def _main_loop(self):
         ''' This is the main loop for the Local Controller. User should call 
             start_main_loop() to start it. ''' 
-        rlist = []
-        wlist = []
-        xlist = rlist
+        # Connections registered with the reactor. A closed Connection has
+        # already unregistered itself by the time its DEL_CXN is seen, so this
+        # is tracked separately.
+        active = set()
         timeout = 1.0
-        num_of_retry = 0
-        all_rules = []
 
         self.logger.debug("Inside Main Loop, SDX connection: %s" % (self.sdx_connection))
 
         while(True):
-            # Based, in part, on https://pymotw.com/2/select/ and
-            # https://stackoverflow.com/questions/17386487/
-            try:
+            q_ele = self.sdx_cm.get_cxn_queue_element()
+            while q_ele != None:
+                (action, cxn) = q_ele
+                if action == NEW_CXN:
+                    self.logger.warning("Adding connection %s" % cxn)
+                    if cxn not in active:
+                        self.logger.debug("Registering Cxn: %s" % cxn)
+                        active.add(cxn)
+                        self.reactor.register(cxn, self._handle_readable)
+                    
+                elif action == DEL_CXN:
+                    self.logger.warning("Removing connection %s" % cxn)
+                    if cxn in active:
+                        # Need to clean up the sdx_connection, as it has
+                        # already failed and been (mostly) cleaned up.
+                        self.sdx_connection = None
+                        active.remove(cxn)
+                        self.reactor.unregister(cxn)
+
+                # Next queue element
                 q_ele = self.sdx_cm.get_cxn_queue_element()
-                while q_ele != None:
-                    (action, cxn) = q_ele
-                    if action == NEW_CXN:
-                        self.logger.warning("Adding connection %s" % cxn)
-                        if cxn in rlist:
-                            # Already there. Weird, but OK
-                            pass
-                        self.logger.debug("Adding Cxn to rlist: %s" % cxn)
-                        rlist.append(cxn)
-                        wlist = []
-                        xlist = rlist
-                        
-                    elif action == DEL_CXN:
-                        self.logger.warning("Removing connection %s" % cxn)
-                        if cxn in rlist:
-                            # Need to clean up the sdx_connection, as it has
-                            # already failed and been (mostly) cleaned up.
-                            self.sdx_connection = None
-                            rlist.remove(cxn)
-                            wlist = []
-                            xlist = rlist
-
-
-                    # Next queue element
-                    q_ele = self.sdx_cm.get_cxn_queue_element()
-            except Empty as e:
-                # This is raised if the cxn_q is empty of events.
-                # Normal behaviour
-                pass
  
             if self.sdx_connection == None:
                 print "SDX_CXN = None, start_cxn_thread = %s" % str(self.start_cxn_thread)
@@ -161,107 +156,78 @@ class LocalController(AtlanticWaveModule):
                     self.logger.debug("ManagementLCRecoverRule sent. About to restart SDX connection.")
                 self.start_sdx_controller_connection() #Restart!
 
-            if len(rlist) == 0:
-                sleep(timeout/2)
-                continue
-
-            try:
-                readable, writable, exceptional = cxnselect(rlist,
-                                                            wlist,
-                                                            xlist,
-                                                            timeout)
-            except Exception as e:
-                self.logger.error("LocalController: Error in select - %s" % (e))
-                
-            # Loop through readable
-            for entry in readable:
-                # Get Message
-                try:
-                    msg = entry.recv_protocol()
-                except SDXMessageConnectionFailure as e:
-                    # Connection needs to be disconnected.
-                    self.logger.warning("CXN Failure: %s %s" % (entry, e))
-                    self.cxn_q.put((DEL_CXN, entry))
-                    entry.close()
-                    continue
-                except:
-                    raise
+            # Dispatch messages and heartbeats. The reactor is woken up on
+            # connection events, so this doesn't need to poll.
+            self.reactor.run_once(timeout)
 
-                 # Can return None if there was some internal message.
-                if msg == None:
-                    #self.logger.debug("Received None from recv_protocol %s" %
-                    #                  (entry))
-                    continue
+    def _handle_readable(self, entry):
+        ''' Called by the reactor when the SDX connection is readable. '''
+        # Get Message
+        try:
+            msg = entry.recv_protocol()
+        except SDXMessageConnectionFailure as e:
+            # Connection needs to be disconnected.
+            self.logger.warning("CXN Failure: %s %s" % (entry, e))
+            self.cxn_q.put((DEL_CXN, entry))
+            entry.close()
+            return
 
-                #FIXME: Check if the SDXMessage is valid at this stage
-                
-                # If HeartbeatRequest, send a HeartbeatResponse. This doesn't
-                # require tracking anything, unlike when sending out a
-                # HeartbeatRequest ourselves.
-                if type(msg) == SDXMessageHeartbeatRequest:
-                    self.logger.debug("Received a HBREQ message from %s" %
-                                      hex(id(entry)))
-
-                    hbr = SDXMessageHeartbeatResponse()
-                    entry.send_protocol(hbr)
-                
-                # If HeartbeatResponse, call HeartbeatResponseHandler
-                elif type(msg) == SDXMessageHeartbeatResponse:
-                    self.logger.debug("Received a HBRES message from %s" %
-                                      hex(id(entry)))
-                    entry.heartbeat_response_handler(msg)
-
-                # If InstallRule
-                elif type(msg) == SDXMessageInstallRule:
-                    self.logger.debug("Received a INSTL message from %s" %
-                                      hex(id(entry)))
-                    self.install_rule_sdxmsg(msg)
-
-                # If RemoveRule
-                elif type(msg) == SDXMessageRemoveRule:
-                    self.logger.debug("Received a REMOV message from %s" %
-                                      hex(id(entry)))
-                    self.remove_rule_sdxmsg(msg)
-                    
-                # If InstallRuleComplete - ERROR! LC shouldn't receive this.
-                # If InstallRuleFailure -  ERROR! LC shouldn't receive this.
-                # If RemoveRuleComplete - ERROR! LC shouldn't receive this.
-                # If RemoveRuleFailure -  ERROR! LC shouldn't receive this.
-                # If UnknownSource - ERROR! LC shouldn't receive this.
-                # If SwitchChangeCallback -  ERROR! LC shouldn't receive this.
-                elif (type(msg) == SDXMessageInstallRuleComplete and
-                      type(msg) == SDXMessageInstallRuleFailure and
-                      type(msg) == SDXMessageRemoveRuleComplete and
-                      type(msg) == SDXMessageRemoveRuleFailure and
-                      type(msg) == SDXMessageUnknownSource and
-                      type(msg) == SDXMessageSwitchChangeCallback):
-                    self.logger.warning("msg type %s - not valid: %s" % 
-                                        (type(msg), msg))
-                
-                # All other types are something that shouldn't be seen, likely
-                # because they're from the a Message that's not currently valid
-                else:
-                    self.logger.warning("msg type %s - not valid: %s" % 
-                                        (type(msg), msg))
-
-
-            # Loop through writable
-            for entry in writable:
-                # Anything to do here?
-                pass
-
-            # Loop through exceptional
-            for entry in exceptional:
-                # FIXME: Handle connection failures
-                # Clean up current connection
-                self.sdx_connection.close()
-                self.sdx_connection = None
-                self.cxn_q.put((DEL_CXN, cxn))
-
-                # Restart new connection
-                self.start_sdx_controller_connection()                
-    
+        # Can return None if there was some internal message.
+        if msg == None:
+            #self.logger.debug("Received None from recv_protocol %s" %
+            #                  (entry))
+            return
 
+        #FIXME: Check if the SDXMessage is valid at this stage
+        
+        # If HeartbeatRequest, send a HeartbeatResponse. This doesn't
+        # require tracking anything, unlike when sending out a
+        # HeartbeatRequest ourselves.
+        if type(msg) == SDXMessageHeartbeatRequest:
+            self.logger.debug("Received a HBREQ message from %s" %
+                              hex(id(entry)))
+
+            hbr = SDXMessageHeartbeatResponse()
+            entry.send_protocol(hbr)
+        
+        # If HeartbeatResponse, call HeartbeatResponseHandler
+        elif type(msg) == SDXMessageHeartbeatResponse:
+            self.logger.debug("Received a HBRES message from %s" %
+                              hex(id(entry)))
+            entry.heartbeat_response_handler(msg)
+
+        # If InstallRule
+        elif type(msg) == SDXMessageInstallRule:
+            self.logger.debug("Received a INSTL message from %s" %
+                              hex(id(entry)))
+            self.install_rule_sdxmsg(msg)
+
+        # If RemoveRule
+        elif type(msg) == SDXMessageRemoveRule:
+            self.logger.debug("Received a REMOV message from %s" %
+                              hex(id(entry)))
+            self.remove_rule_sdxmsg(msg)
+            
+        # If InstallRuleComplete - ERROR! LC shouldn't receive this.
+        # If InstallRuleFailure -  ERROR! LC shouldn't receive this.
+        # If RemoveRuleComplete - ERROR! LC shouldn't receive this.
+        # If RemoveRuleFailure -  ERROR! LC shouldn't receive this.
+        # If UnknownSource - ERROR! LC shouldn't receive this.
+        # If SwitchChangeCallback -  ERROR! LC shouldn't receive this.
+        elif (type(msg) == SDXMessageInstallRuleComplete and
+              type(msg) == SDXMessageInstallRuleFailure and
+              type(msg) == SDXMessageRemoveRuleComplete and
+              type(msg) == SDXMessageRemoveRuleFailure and
+              type(msg) == SDXMessageUnknownSource and
+              type(msg) == SDXMessageSwitchChangeCallback):
+            self.logger.warning("msg type %s - not valid: %s" % 
+                                (type(msg), msg))
+        
+        # All other types are something that shouldn't be seen, likely
+        # because they're from the a Message that's not currently valid
+        else:
+            self.logger.warning("msg type %s - not valid: %s" % 
+                                (type(msg), msg))
 
     def _add_switch_internal_config_to_db(self, dpid, internal_config):
         # Pushes a switch internal_config into the db.
@@ -591,7 +557,8 @@ class LocalController(AtlanticWaveModule):
             self.sdx_connection.transition_to_main_phase_LC(self.name,
                                                 self.capabilities,
                                                 self._initial_rule_install,
-                                                self._initial_rules_complete)
+                                                self._initial_rules_complete,
+                                                self.rm.get_rule_digest)
 
         except (SDXControllerConnectionTypeError,
                 SDXControllerConnectionValueError) as e:
@@ -644,10 +611,8 @@ class LocalController(AtlanticWaveModule):
 
         self.rm.add_rule(cookie, switch_id, rule, RULE_STATUS_INSTALLING)
         self.switch_connection.send_command(switch_id, rule)
-        #FIXME: This should be moved to somewhere where we have positively
-        #confirmed a rule has been installed. Right now, there is no such
-        #location as the LC/RyuTranslateInteface protocol is primitive.
-        self.rm.set_status(cookie, switch_id, RULE_STATUS_ACTIVE)
+        # The rule becomes RULE_STATUS_ACTIVE once the switch has confirmed
+        # it, see SM_BATCH_COMPLETE in switch_message_cb().
 
     def remove_all_rules_sdxmsg(self):
         ''' Removes all data plane rules. '''
@@ -758,33 +723,13 @@ class LocalController(AtlanticWaveModule):
                     return
                 bridge_ratelimit_l2mp = internal_config['corsaratelimitbridgel2mp']
 
-                tunnel_url = (internal_config['corsaurl'] + "api/v1/bridges/" +
-                                     bridge + "/tunnels/" + str(l2mp_bw_in_port))
-
-                rest_return = requests.delete(tunnel_url,
-                                       headers={'Authorization': internal_config['corsatoken']},
-                                       verify=False)  # FIXME: HARDCODED
-
-                tunnel_url = (internal_config['corsaurl'] + "api/v1/bridges/" +
-                                     bridge + "/tunnels/" + str(l2mp_bw_out_port))
-
-                rest_return = requests.delete(tunnel_url,
-                                       headers={'Authorization': internal_config['corsatoken']},
-                                       verify=False)  # FIXME: HARDCODED
-
-                tunnel_url = (internal_config['corsaurl'] + "api/v1/bridges/" +
-                              bridge_ratelimit_l2mp + "/tunnels/" + str(l2mp_bw_in_port))
-
-                rest_return = requests.delete(tunnel_url,
-                                       headers={'Authorization': internal_config['corsatoken']},
-                                       verify=False)  # FIXME: HARDCODED
-
-                tunnel_url = (internal_config['corsaurl'] + "api/v1/bridges/" +
-                              bridge_ratelimit_l2mp + "/tunnels/" + str(l2mp_bw_out_port))
-
-                rest_return = requests.delete(tunnel_url,
-                                       headers={'Authorization': internal_config['corsatoken']},
-                                       verify=False)  # FIXME: HARDCODED
+                # Deleted by the RTI, which caches the switch's tunnels.
+                tunnel_urls = [(internal_config['corsaurl'] + "api/v1/bridges/" +
+                                b + "/tunnels/" + str(p))
+                               for b in [bridge, bridge_ratelimit_l2mp]
+                               for p in [l2mp_bw_in_port, l2mp_bw_out_port]]
+                self.switch_connection.remove_corsa_tunnels(
+                    switch_id, tunnel_urls, internal_config['corsatoken'])
 
     def _initial_rule_install(self, rule):
         ''' This builds up a list of rules to be installed. 
@@ -802,7 +747,14 @@ class LocalController(AtlanticWaveModule):
         delete_list = []
         add_list = []
 
-        (delete_list, add_list) = self.rm.initial_rules_complete()
+        # If rule digests were compared, only the rules in buckets that
+        # differed were sent, so only those buckets are reconciled.
+        (buckets, cookie_range) = self.sdx_connection.get_digest_buckets()
+        if buckets == None:
+            (delete_list, add_list) = self.rm.initial_rules_complete()
+        else:
+            (delete_list, add_list) = self.rm.initial_rules_complete(
+                buckets, cookie_range)
         self.rm.clear_initial_rules()
 
         for (entry, cookie, switch_id) in add_list:
@@ -821,15 +773,26 @@ class LocalController(AtlanticWaveModule):
             dependent.
         '''
         if cmd == SM_UNKNOWN_SOURCE:
+            if not self.unknown_sources.add((cmd, opaque['switch'],
+                                             opaque['port'], opaque['src'])):
+                self.dlogger.debug("Suppressed unknown source %s" % opaque)
+                return
             # Create an SDXMessageUnknownSource and send it.
             msg = SDXMessageUnknownSource(opaque['src'], opaque['port'],
                                           opaque['switch'])
-            self.sdx_connection.send_protocol(msg)
+            self.sdx_connection.enqueue_protocol(msg)
         
         elif cmd == SM_L2MULTIPOINT_UNKNOWN_SOURCE:
+            data = opaque['data']
+            if not self.unknown_sources.add((cmd, opaque['cookie'],
+                                             data['dstswitch'],
+                                             data['dstport'],
+                                             data['dstaddress'])):
+                self.dlogger.debug("Suppressed unknown source %s" % opaque)
+                return
             # Create an SDXMessageSwitchChangeCallback and send it.
             msg = SDXMessageSwitchChangeCallback(opaque)
-            self.sdx_connection.send_protocol(msg)
+            self.sdx_connection.enqueue_protocol(msg)
 
         elif cmd == SM_INTER_RYU_FAILURE:
             # This one's different. This is a failure we have to handle.
@@ -839,6 +802,30 @@ class LocalController(AtlanticWaveModule):
                               opaque)
             self.switch_connection = None
             self._setup_switch()
+
+        elif cmd == SM_BATCH_COMPLETE:
+            # The switch has confirmed a batch of rules.
+            switch_id = opaque['switch_id']
+            failed = opaque['failed']
+            if not opaque['success']:
+                self.logger.error("Batch for %s failed, rules %s: %s" %
+                                  (switch_id, failed, opaque['errors']))
+            else:
+                self.logger.debug("Batch for %s of %d messages confirmed in %s"
+                                  % (switch_id, opaque['messages'],
+                                     opaque['latency']))
+            for cookie in opaque['installed']:
+                if cookie not in failed:
+                    self.rm.set_status(cookie, switch_id, RULE_STATUS_ACTIVE)
+            # Failed rules are forgotten, so they're not in the rule digest
+            # and are installed again by the next reconciliation with the SDX
+            # controller. Whatever part of them made it to the switch is
+            # removed first.
+            for cookie in failed:
+                if self.rm.get_rules(cookie, switch_id) == []:
+                    continue
+                self.switch_connection.remove_rule(switch_id, cookie)
+                self.rm.rm_rule(cookie, switch_id)
             
 
         #FIXME: Else?
@@ -136,6 +136,14 @@ class RyuControllerInterface(ControllerInterface):
                           (switch_id, sdxcookie))
         self.inter_cm_cxn.send_cmd(ICX_REMOVE, (switch_id, str(sdxcookie)))
 
+    def remove_corsa_tunnels(self, switch_id, tunnel_urls, token):
+        ''' Deletes tunnels on a Corsa switch. This goes through the RTI, so
+            that its cache of the switch's tunnels stays up to date. '''
+        self.logger.debug("Removing Corsa tunnels through RTI: %s:%s" %
+                          (switch_id, tunnel_urls))
+        self.inter_cm_cxn.send_cmd(ICX_CORSA_DELETE,
+                                   (switch_id, (tunnel_urls, token)))
+
     def get_ryu_process(self):
         return self.ryu_process
 
@@ -185,6 +193,8 @@ class RyuControllerInterface(ControllerInterface):
                         self.lc_callback(SM_UNKNOWN_SOURCE, data)
                     elif cmd == ICX_L2MULTIPOINT_UNKNOWN_SOURCE:
                         self.lc_callback(SM_L2MULTIPOINT_UNKNOWN_SOURCE, data)
+                    elif cmd == ICX_BATCH_COMPLETE:
+                        self.lc_callback(SM_BATCH_COMPLETE, data)
                     elif cmd == ICX_DATAPATHS:
                         self.logging.info("Received current datapaths: %s" %
                                           data)
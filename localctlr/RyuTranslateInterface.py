@@ -6,7 +6,6 @@ import logging
 import threading
 import dataset
 import cPickle as pickle
-import requests
 import json
 from time import sleep
 
@@ -17,12 +16,17 @@ from shared.LCRule import *
 from shared.ofconstants import *
 from oftables import *
 from InterRyuControllerConnectionManager import *
+from FlowProgrammingQueue import *
+from lib.Connection import select as cxnselect
+from lib.Throttle import SeenCache
+from CorsaRestClient import CorsaRestClient
 
 # Ryu libraries
 from ryu import cfg
 from ryu.base import app_manager
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, set_ev_cls
+from ryu.controller.handler import DEAD_DISPATCHER
 from ryu.ofproto import ofproto_v1_3
 from ryu.utils import hex_array
 from ryu.lib.packet import packet, ethernet, ether_types
@@ -46,6 +50,15 @@ CONF = cfg.CONF
 
 L2MULTIPOINTCORSABWDISABLED = False
 
+# Maximum number of commands from the RyuControllerInterface that are handled
+# before the flow programming queues are flushed.
+MAX_COMMANDS_PER_BATCH = 64
+
+# Seconds during which repeated packet-ins from the same unknown source on the
+# same port are dropped rather than sent on to the SDX controller. Covers the
+# time taken to install the rule that stops them.
+UNKNOWN_SOURCE_TTL = 60
+
 
 class TranslatedRuleContainer(object):
     ''' Parent class for holding both LC and Corsa rules '''
@@ -187,6 +200,17 @@ class RyuTranslateInterface(app_manager.RyuApp):
         self.datapaths = {}
         self.current_of_cookie = 0
 
+        # Flow programming queues, one per datapath. flow_batching is the
+        # thread that's handling a batch of commands, if there is one. Messages
+        # it sends are queued until the main_loop flushes them. Messages sent
+        # by anything else, such as Ryu's event handlers, are sent as soon as
+        # they're added.
+        self.flow_queues = {}
+        self.flow_batching = None
+
+        # Corsa REST calls, with kept-alive connections and cached tunnels.
+        self.corsa_client = CorsaRestClient(loggerid + '.corsa')
+
         # Spawn main_loop thread
         self.loop_thread = threading.Thread(target=self.main_loop)
         self.loop_thread.daemon = True
@@ -197,6 +221,10 @@ class RyuTranslateInterface(app_manager.RyuApp):
         # PacketIn callback structure setup
         self.packet_in_cbs = {}
 
+        # Unknown sources already sent on: datapath ID -> SeenCache of
+        # (port, source address)
+        self.seen_sources = {}
+
         # TODO: Reestablish connection? Do I have to do anything?
         self.logger.warning("%s initialized: %s" % (self.__class__.__name__,
                                                     hex(id(self))))
@@ -455,23 +483,63 @@ class RyuTranslateInterface(app_manager.RyuApp):
                                    str(self.datapaths))
 
         while True:
+            # Wait for a command before batching, so nothing is held back
+            # while there's nothing to do.
+            readable, w, x = cxnselect([self.inter_cm_cxn], [], [], 1.0)
+            if len(readable) == 0:
+                continue
 
-            # FIXME - This is static: only installing rules right now.
-            event_type, event_data = self.inter_cm_cxn.recv_cmd()
-            (switch_id, event) = event_data
-            if switch_id not in self.datapaths.keys():
-                self.logger.warning("switch_id %s does not match known switches: %s" %
-                                    (switch_id, self.datapaths.keys()))
+            # Handle every command that's already waiting, up to
+            # MAX_COMMANDS_PER_BATCH, then send everything they generated to
+            # the switches in one batch per switch.
+            self.flow_batching = threading.current_thread()
+            try:
+                count = 0
+                while count < MAX_COMMANDS_PER_BATCH:
+                    self._handle_command()
+                    count += 1
+                    readable, w, x = cxnselect([self.inter_cm_cxn], [], [], 0)
+                    if len(readable) == 0:
+                        break
+            finally:
+                self.flow_batching = None
+                self._flush_flow_queues()
+
+    def _handle_command(self):
+        ''' Receives and handles a single command from the 
+            RyuControllerInterface. '''
+        # FIXME - This is static: only installing rules right now.
+        event_type, event_data = self.inter_cm_cxn.recv_cmd()
+        (switch_id, event) = event_data
+        if event_type == ICX_CORSA_DELETE:
+            # REST calls, so the switch needn't be connected.
+            (tunnel_urls, token) = event
+            self.remove_corsa_tunnels(tunnel_urls, token)
+            return
+        if switch_id not in self.datapaths.keys():
+            self.logger.warning("switch_id %s does not match known switches: %s" %
+                                (switch_id, self.datapaths.keys()))
 
-                # FIXME - Need to update this for sending errors back
-                continue
+            # FIXME - Need to update this for sending errors back
+            return
 
-            datapath = self.datapaths[switch_id]
+        datapath = self.datapaths[switch_id]
 
+        # A command that fails mustn't take the main_loop down with it. A
+        # failed install is reported back in its batch, so that the rule isn't
+        # taken to be installed.
+        try:
             if event_type == ICX_ADD:
                 self.install_rule(datapath, event)
             elif event_type == ICX_REMOVE:
                 self.remove_rule(datapath, event)
+        except Exception as e:
+            self.logger.error("Handling %s for %s failed: %s" %
+                              (event_type, switch_id, e))
+            queue = self.flow_queues.get(datapath.id)
+            if event_type == ICX_ADD and queue != None:
+                queue.fail_cookie(event.get_cookie(),
+                                  "%s: %s" % (type(e).__name__, e))
 
             ###except Exception as e:
             ###    self.logger.error("main_loop: Caught %s" % e)
@@ -484,10 +552,28 @@ class RyuTranslateInterface(app_manager.RyuApp):
     def switch_features_handler(self, ev):
         self.logger.warning("Connection from: " + str(ev.msg.datapath.id) + " for " + str(self))
         self.datapaths[ev.msg.datapath.id] = ev.msg.datapath
+        self.flow_queues[ev.msg.datapath.id] = FlowProgrammingQueue(
+            ev.msg.datapath, self._flow_batch_complete, self.logger)
+        # The switch has lost any learned sources
+        self.seen_sources[ev.msg.datapath.id] = SeenCache(UNKNOWN_SOURCE_TTL)
 
         # Call bootstrapping for switch functions
         self._new_switch_bootstrapping(ev)
 
+    # Handles switch disconnect event
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def switch_disconnect_handler(self, ev):
+        datapath = ev.datapath
+        if datapath.id == None:
+            return
+        # Batches that the switch never confirmed have failed. Only if it's
+        # the current connection for the switch, it may have reconnected.
+        queue = self.flow_queues.get(datapath.id)
+        if queue != None and queue.datapath is datapath:
+            self.logger.warning("Disconnection from: " + str(datapath.id))
+            del self.flow_queues[datapath.id]
+            queue.fail_all("Switch %s disconnected" % datapath.id)
+
     # From the Ryu mailing list: https://sourceforge.net/p/ryu/mailman/message/33584125/
     @set_ev_cls(ofp_event.EventOFPErrorMsg,
                 [CONFIG_DISPATCHER, MAIN_DISPATCHER])
@@ -496,6 +582,47 @@ class RyuTranslateInterface(app_manager.RyuApp):
         self.logger.error('OFPErrorMsg received: type=0x%02x code=0x%02x '
                           'message=%s',
                           msg.type, msg.code, hex_array(msg.data))
+        queue = self.flow_queues.get(msg.datapath.id)
+        if queue != None:
+            queue.error(msg.xid, "type=0x%02x code=0x%02x" % (msg.type,
+                                                             msg.code))
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def barrier_reply_handler(self, ev):
+        queue = self.flow_queues.get(ev.msg.datapath.id)
+        if queue != None:
+            queue.barrier_reply(ev.msg.xid)
+
+    @set_ev_cls(ofp_event.EventOFPBundleCtrlMsg,
+                [CONFIG_DISPATCHER, MAIN_DISPATCHER])
+    def bundle_ctrl_handler(self, ev):
+        msg = ev.msg
+        ofp = msg.datapath.ofproto
+        queue = self.flow_queues.get(msg.datapath.id)
+        if queue != None and msg.type in (ofp.OFPBCT_COMMIT_REPLY,
+                                          ofp.OFPBCT_DISCARD_REPLY):
+            queue.bundle_reply(msg.bundle_id,
+                               msg.type == ofp.OFPBCT_COMMIT_REPLY)
+
+    def _flow_batch_complete(self, batch):
+        ''' Called by the FlowProgrammingQueues once the switch has confirmed
+            a batch. Passed on to the RyuControllerInterface. '''
+        self.inter_cm_cxn.send_cmd(ICX_BATCH_COMPLETE, batch.get_report())
+
+    def _flush_flow_queues(self):
+        for queue in self.flow_queues.values():
+            queue.flush()
+
+    def _send_flow_msg(self, datapath, msg):
+        ''' Sends msg through the datapath's FlowProgrammingQueue. '''
+        queue = self.flow_queues.get(datapath.id)
+        if queue == None:
+            datapath.send_msg(msg)
+            return
+        queue.add(msg)
+        if self.flow_batching != threading.current_thread():
+            queue.flush()
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def packet_in_handler(self, ev):
@@ -885,48 +1012,40 @@ class RyuTranslateInterface(app_manager.RyuApp):
             vlan = vlanrule.get_vlan_out()
             bandwidth = vlanrule.get_bandwidth()
 
-            # Find out the request_url
-            tunnel_url = (internal_config['corsaurl'] + "api/v1/bridges/" +
-                          bridge + "/tunnels?list=true")
-            print
-            "Requesting tunnels from %s" % tunnel_url
-            rest_return = requests.get(tunnel_url,
-                                       headers={'Authorization':
-                                                    internal_config['corsatoken']},
-                                       verify=False)  # FIXME: HARDCODED
-
-            print
-            "Looking for %s on ports %s" % (vlan,
-                                            internal_config['corsaratelimitports'])
-
-            for entry in rest_return.json()['list']:
-                if (entry['vlan-id'] == vlan and
-                        int(entry['port']) in internal_config['corsaratelimitports']):
-                    request_url = entry['links']['self']['href']
-                    # This implements Red/Green, per Corsa's spec. Anything over
-                    # the CIR value (and not part of a CBS burst) will be marked
-                    # red and dropped.
-                    jsonval = [{'op': 'replace',
-                                'path': '/meter/cir',
-                                'value': bandwidth},
-                               {'op': 'replace',
-                                'path': '/meter/cbs',
-                                'value': bandwidth},
-                               {'op': 'replace',
-                                'path': '/meter/eir',
-                                'value': 0},
-                               {'op': 'replace',
-                                'path': '/meter/ebs',
-                                'value': 0}]
-                    valid_responses = [204]
-
-                    print
-                    "Patching %s:%s" % (request_url, json)
-                    results.append(TranslatedCorsaRuleContainer("patch",
-                                                                request_url,
-                                                                jsonval,
-                                                                internal_config['corsatoken'],
-                                                                valid_responses))
+            # Find the tunnels, from the cached tunnel table if possible.
+            tunnels = self.corsa_client.find_tunnels(
+                internal_config['corsaurl'], bridge,
+                internal_config['corsatoken'], vlan,
+                internal_config['corsaratelimitports'])
+            self.logger.debug("Found tunnels for %s on ports %s: %s" %
+                              (vlan, internal_config['corsaratelimitports'],
+                               tunnels))
+
+            for entry in tunnels:
+                request_url = entry['links']['self']['href']
+                # This implements Red/Green, per Corsa's spec. Anything over
+                # the CIR value (and not part of a CBS burst) will be marked
+                # red and dropped.
+                jsonval = [{'op': 'replace',
+                            'path': '/meter/cir',
+                            'value': bandwidth},
+                           {'op': 'replace',
+                            'path': '/meter/cbs',
+                            'value': bandwidth},
+                           {'op': 'replace',
+                            'path': '/meter/eir',
+                            'value': 0},
+                           {'op': 'replace',
+                            'path': '/meter/ebs',
+                            'value': 0}]
+                valid_responses = [204]
+
+                self.logger.debug("Patching %s:%s" % (request_url, jsonval))
+                results.append(TranslatedCorsaRuleContainer("patch",
+                                                            request_url,
+                                                            jsonval,
+                                                            internal_config['corsatoken'],
+                                                            valid_responses))
 
         # Return results to be used.
         return results
@@ -1529,33 +1648,7 @@ class RyuTranslateInterface(app_manager.RyuApp):
 
     def corsa_rest_cmd(self, rc):
         ''' Handles sending of REST commands to Corsa Switches. '''
-        verify = False  # FIXME: Hardcoded
-        if rc.get_function() == "get":
-            response = requests.get(rc.get_url(),
-                                    json=rc.get_json(),
-                                    headers={'Authorization': rc.get_token()},
-                                    verify=verify)
-        elif rc.get_function() == "post":
-            response = requests.post(rc.get_url(),
-                                     json=rc.get_json(),
-                                     headers={'Authorization': rc.get_token()},
-                                     verify=verify)
-        elif rc.get_function() == "patch":
-            response = requests.patch(rc.get_url(),
-                                      json=rc.get_json(),
-                                      headers={'Authorization': rc.get_token()},
-                                      verify=verify)
-        else:
-            raise ValueError("Function not valid: %s:%s" %
-                             (rc.get_function(),
-                              rc.get_json()))
-
-        if response.status_code not in rc.get_valid_responses():
-            raise Exception("REST command failed %s:%s\n    %s\n    %s" %
-                            (rc.get_function(),
-                             rc.get_json(),
-                             response.status_code,
-                             response.json()))
+        self.corsa_client.send(rc)
 
     def add_flow(self, datapath, rc):
         ''' Ease-of-use wrapper for adding flows. '''
@@ -1589,7 +1682,7 @@ class RyuTranslateInterface(app_manager.RyuApp):
                                     idle_timeout=rc.get_idle_timeout(),
                                     hard_timeout=rc.get_hard_timeout())
 
-        datapath.send_msg(mod)
+        self._send_flow_msg(datapath, mod)
 
     def remove_flow(self, datapath, rc):
         # BASE ON: https://github.com/sdonovan1985/netassay-ryu/blob/672a31228ab08abe55c19e75afa52490e76cbf77/base/mcm.py#L283
@@ -1613,7 +1706,21 @@ class RyuTranslateInterface(app_manager.RyuApp):
                                 table_id=table, command=command,
                                 out_group=out_group, out_port=out_port,
                                 match=match)
-        datapath.send_msg(mod)
+        self._send_flow_msg(datapath, mod)
+
+    def remove_corsa_tunnels(self, tunnel_urls, token):
+        ''' Deletes tunnels on a Corsa switch for the LocalController. The
+            tunnels are independent, so are deleted concurrently. Failures are
+            ignored. '''
+        try:
+            self.corsa_client.dispatch(
+                [TranslatedCorsaRuleContainer("delete", url, None, token, None)
+                 for url in tunnel_urls])
+        except Exception as e:
+            self.logger.error("Deleting Corsa tunnels %s failed: %s" %
+                              (tunnel_urls, e))
+            # Not sure which were deleted.
+            self.corsa_client.invalidate()
 
     def remove_all_flows(self, datapath):
         # BASED ON: https://github.com/FlowForwarding/LINC-Switch/blob/master/scripts/ryu/remove_flows_v1_3.py
@@ -1627,7 +1734,7 @@ class RyuTranslateInterface(app_manager.RyuApp):
         mod = parser.OFPFlowMod(datapath=datapath, table_id=table,
                                 command=command, out_group=out_group,
                                 out_port=out_port)
-        datapath.send_msg(mod)
+        self._send_flow_msg(datapath, mod)
 
     def install_rule(self, datapath, sdx_rule):
         ''' The main loop calls this to handle adding a new rule.
@@ -1646,6 +1753,11 @@ class RyuTranslateInterface(app_manager.RyuApp):
         of_cookie = self._get_new_OF_cookie(sdx_rule.get_cookie(), datapath.id)
         self.logger.debug("Cookie 0x%02x used in datapath %s for %s" % (of_cookie, datapath.id, sdx_rule))
 
+        # Messages sent from here on are for this rule, see
+        # _note_installed().
+        if datapath.id in self.flow_queues:
+            self.flow_queues[datapath.id].start_rule(sdx_rule.get_cookie())
+
         # Convert rule into instructions for Ryu. Switch through the different
         # types of supported LCRules for individual translation.
         switch_rules = None
@@ -1752,10 +1864,12 @@ class RyuTranslateInterface(app_manager.RyuApp):
 
         elif isinstance(sdx_rule, ManagementLCRecoverRule):
             self._backup_port_recover(datapath, of_cookie, sdx_rule)
+            self._note_installed(datapath, sdx_rule)
             return
 
         elif isinstance(sdx_rule, ManagementSDXRecoverRule):
             self._backup_port_recover_from_sdx_msg(datapath, of_cookie, sdx_rule)
+            self._note_installed(datapath, sdx_rule)
             return
 
         if switch_rules == None or switch_table == None:
@@ -1772,15 +1886,28 @@ class RyuTranslateInterface(app_manager.RyuApp):
         self._install_rule_in_db(sdx_rule.get_cookie(), datapath.id, of_cookie,
                                  sdx_rule, switch_rules, switch_table)
 
-        # Send instructions to the switch.
+        # Send instructions to the switch. The REST commands for a rule are
+        # independent of each other, so are sent concurrently, before any of
+        # the flows that may use the tunnels they set up.
+        corsa_rules = [rule for rule in switch_rules
+                       if type(rule) == TranslatedCorsaRuleContainer]
+        for rule in corsa_rules:
+            self.logger.debug("  %s - CORSA_REST_CMD" % rule)
+        self.corsa_client.dispatch(corsa_rules)
+
         self.logger.debug("Calling add_flow on the following:")
         for rule in switch_rules:
             if type(rule) == TranslatedLCRuleContainer:
                 self.logger.debug("  %s" % rule)
                 self.add_flow(datapath, rule)
-            elif type(rule) == TranslatedCorsaRuleContainer:
-                self.logger.debug("  %s - CORSA_REST_CMD" % rule)
-                self.corsa_rest_cmd(rule)
+
+        self._note_installed(datapath, sdx_rule)
+
+    def _note_installed(self, datapath, sdx_rule):
+        ''' Called once everything for sdx_rule has been sent. Installation is
+            confirmed once the batch it's in is confirmed. '''
+        if datapath.id in self.flow_queues:
+            self.flow_queues[datapath.id].note_installed(sdx_rule.get_cookie())
 
     def remove_rule(self, datapath, sdx_cookie):
         ''' The main loop calls this to handle removing an existing rule.
@@ -1805,6 +1932,8 @@ class RyuTranslateInterface(app_manager.RyuApp):
 
         self.logger.error("RyuTranslateInterface:remove_rule(): remove a rule for sdx_cookie %s:%s" %
                               (sdx_cookie, switch_id))
+        if datapath.id in self.flow_queues:
+            self.flow_queues[datapath.id].note_removed(sdx_cookie)
         try:
             # Remove flows
             for rule in swrules:
@@ -1911,6 +2040,24 @@ class RyuTranslateInterface(app_manager.RyuApp):
         self.logger.debug("Deregistering cookie 0x%02x" % cookie_id)
         del self.packet_in_cbs[cookie_id]
 
+    def _new_unknown_source(self, dpid, port, src_address):
+        ''' Returns True if the source hasn't been seen on the port recently,
+            False if it should be suppressed. '''
+        if dpid not in self.seen_sources:
+            self.seen_sources[dpid] = SeenCache(UNKNOWN_SOURCE_TTL)
+        if self.seen_sources[dpid].add((port, src_address)):
+            return True
+        self.dlogger.debug("Suppressed unknown source %s on %s:%s" %
+                           (src_address, dpid, port))
+        return False
+
+    def get_unknown_source_counters(self):
+        ''' Returns datapath ID -> {'sources':number of sources seen,
+            'suppressed':number of repeated packet-ins dropped}. '''
+        return dict((dpid, {'sources':len(cache),
+                            'suppressed':cache.suppressed})
+                    for (dpid, cache) in self.seen_sources.items())
+
     def unknown_source_cb(self, ev):
         ''' Handles new unknown source callbacks. This does two things upon
             receipt of a packet:
@@ -1928,6 +2075,8 @@ class RyuTranslateInterface(app_manager.RyuApp):
         pkt = packet.Packet(ev.msg.data)
         eth = pkt.get_protocols(ethernet.ethernet)[0]
         src_address = eth.src
+        if not self._new_unknown_source(datapath.id, port, src_address):
+            return
 
         self.inter_cm_cxn.send_cmd(ICX_UNKNOWN_SOURCE,
                                    {"switch": switch_name,
@@ -1963,6 +2112,8 @@ class RyuTranslateInterface(app_manager.RyuApp):
         pkt = packet.Packet(ev.msg.data)
         eth = pkt.get_protocols(ethernet.ethernet)[0]
         src_address = eth.src
+        if not self._new_unknown_source(datapath.id, port, src_address):
+            return
         of_cookie = ev.msg.cookie
         sdx_cookie = self._find_sdx_cookie(of_cookie, datapath.id)
 
@@ -15,3 +15,9 @@ SM_L2MULTIPOINT_UNKNOWN_SOURCE = "L2MULTIPOINT_UNKNOWN_SOURCE"
 # Receives nothing - it's a status message.
 SM_INTER_RYU_FAILURE = "INTER_RYU_FAILURE"
 
+# Receives a dictionary describing a batch of rules the switch has confirmed:
+# {'switch_id':dpid, 'installed':[cookies], 'removed':[cookies],
+#  'messages':count, 'bundle':bool, 'latency':seconds, 'success':bool,
+#  'errors':[descriptions]}
+SM_BATCH_COMPLETE = "BATCH_COMPLETE"
+
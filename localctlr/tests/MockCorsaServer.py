@@ -0,0 +1,178 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+# A stand-in for the parts of the Corsa REST API that the Local Controller
+# uses: listing, creating, patching and deleting tunnels on bridges. Plain
+# HTTP, with keep-alive. Used by the CorsaRestClient tests and by
+# testing/benchmarks/corsa_benchmark.py.
+
+import json
+import re
+import threading
+from time import sleep
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse
+
+TUNNELS_PATH_RE = re.compile(r'^/api/v1/bridges/(?P<bridge>[^/]+)/tunnels'
+                             r'(/(?P<ofport>[^/]+))?$')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _CorsaRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Replies go out in one write, rather than a write per header, which
+    # stalls kept-alive connections on delayed ACKs.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.mock._count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = ""
+        if body != None:
+            data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.getheader('Content-Length', 0))
+        if length == 0:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _handle(self, function):
+        mock = self.server.mock
+        body = self._read_json()
+        mock._count(function)
+        if mock.latency > 0:
+            sleep(mock.latency)
+        if (mock.token != None and
+            self.headers.getheader('Authorization') != mock.token):
+            return self._reply(401, {'error':'Unauthorized'})
+
+        path = urlparse(self.path).path
+        m = TUNNELS_PATH_RE.match(path)
+        if m == None:
+            return self._reply(404, {'error':'Not found: %s' % path})
+        (status, reply) = mock._tunnels_call(function, m.group('bridge'),
+                                             m.group('ofport'), body)
+        self._reply(status, reply)
+
+    def do_GET(self):
+        self._handle('get')
+
+    def do_POST(self):
+        self._handle('post')
+
+    def do_PATCH(self):
+        self._handle('patch')
+
+    def do_DELETE(self):
+        self._handle('delete')
+
+
+class MockCorsaServer(object):
+    ''' Runs a mock Corsa REST API on localhost, on its own thread. get_url()
+        is what would be in a manifest's corsaurl. Every request waits
+        latency seconds before it is handled. If token is set, requests must
+        carry it as their Authorization header. '''
+    def __init__(self, port=0, latency=0, token=None):
+        self.latency = latency
+        self.token = token
+        self.lock = threading.Lock()
+        # bridge -> {ofport:tunnel}
+        self.bridges = {}
+        self.counters = {}
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', port),
+                                           _CorsaRequestHandler)
+        self.server.mock = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_url(self):
+        return "http://127.0.0.1:%d/" % self.port
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_tunnel(self, bridge, ofport, port, vlan, cir=0):
+        ''' Sets up a tunnel directly, as if it had been configured on the
+            switch beforehand. '''
+        with self.lock:
+            self.bridges.setdefault(bridge, {})[ofport] = \
+                self._new_tunnel(bridge, ofport, port, vlan, cir)
+
+    def get_tunnel(self, bridge, ofport):
+        with self.lock:
+            return self.bridges.get(bridge, {}).get(ofport)
+
+    def get_counters(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def _new_tunnel(self, bridge, ofport, port, vlan, cir):
+        href = "%sapi/v1/bridges/%s/tunnels/%s" % (self.get_url(), bridge,
+                                                   ofport)
+        return {'ofport':ofport,
+                'port':str(port),
+                'vlan-id':vlan,
+                'meter':{'cir':cir, 'cbs':cir, 'eir':0, 'ebs':0},
+                'links':{'self':{'href':href}}}
+
+    def _tunnels_call(self, function, bridge, ofport, body):
+        ''' Returns (status, reply body). '''
+        with self.lock:
+            tunnels = self.bridges.setdefault(bridge, {})
+            if ofport == None:
+                if function == 'get':
+                    return (200, {'list':tunnels.values()})
+                if function == 'post':
+                    ofport = int(body['ofport'])
+                    if ofport in tunnels:
+                        return (409, {'error':'ofport %s in use' % ofport})
+                    tunnel = self._new_tunnel(bridge, ofport, body['port'],
+                                              body['vlan-id'],
+                                              body.get('shaped-rate', 0))
+                    tunnels[ofport] = tunnel
+                    return (201, tunnel)
+                return (405, {'error':'Method not allowed'})
+
+            ofport = int(ofport)
+            if ofport not in tunnels:
+                return (404, {'error':'No tunnel %s' % ofport})
+            if function == 'get':
+                return (200, tunnels[ofport])
+            if function == 'delete':
+                del tunnels[ofport]
+                return (204, None)
+            if function == 'patch':
+                for op in body:
+                    path = op['path'].strip('/').split('/')
+                    entry = tunnels[ofport]
+                    for field in path[:-1]:
+                        entry = entry.setdefault(field, {})
+                    entry[path[-1]] = op['value']
+                return (204, None)
+            return (405, {'error':'Method not allowed'})
@@ -0,0 +1,130 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for localctlr.CorsaRestClient, against MockCorsaServer.
+
+import unittest
+from localctlr.CorsaRestClient import *
+from localctlr.tests.MockCorsaServer import MockCorsaServer
+
+TOKEN = "corsatoken"
+
+
+class FakeRestCmd(object):
+    ''' Same getters as TranslatedCorsaRuleContainer. '''
+    def __init__(self, function, url, json, valid_responses):
+        self.function = function
+        self.url = url
+        self.json = json
+        self.valid_responses = valid_responses
+
+    def get_function(self):
+        return self.function
+
+    def get_url(self):
+        return self.url
+
+    def get_json(self):
+        return self.json
+
+    def get_token(self):
+        return TOKEN
+
+    def get_valid_responses(self):
+        return self.valid_responses
+
+
+class CorsaRestClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockCorsaServer(token=TOKEN)
+        self.base = self.server.get_url()
+        self.server.add_tunnel('br2', 1, 30, 100)
+        self.server.add_tunnel('br2', 2, 31, 100)
+        self.server.add_tunnel('br2', 3, 30, 200)
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_find_tunnels_cached(self):
+        client = CorsaRestClient()
+        found = client.find_tunnels(self.base, 'br2', TOKEN, 100, [30, 31])
+        self.failUnlessEqual(sorted(t['ofport'] for t in found), [1, 2])
+        found = client.find_tunnels(self.base, 'br2', TOKEN, 200, [30])
+        self.failUnlessEqual([t['ofport'] for t in found], [3])
+
+        # Only one list request, over one connection.
+        counters = self.server.get_counters()
+        self.failUnlessEqual(counters['get'], 1)
+        self.failUnlessEqual(counters['connections'], 1)
+        self.failUnlessEqual(client.get_counters()['cache_hits'], 1)
+
+    def test_find_tunnels_refresh(self):
+        # Tunnels made by someone else are found, even while cached.
+        client = CorsaRestClient()
+        self.failUnlessEqual(client.find_tunnels(self.base, 'br2', TOKEN,
+                                                 300, [30]), [])
+        self.failUnlessEqual(self.server.get_counters()['get'], 1)
+        self.server.add_tunnel('br2', 4, 30, 300)
+        found = client.find_tunnels(self.base, 'br2', TOKEN, 300, [30])
+        self.failUnlessEqual([t['ofport'] for t in found], [4])
+        self.failUnlessEqual(self.server.get_counters()['get'], 2)
+
+    def test_writes_update_cache(self):
+        client = CorsaRestClient()
+        client.get_tunnels(self.base, 'br2', TOKEN)
+        url = self.base + "api/v1/bridges/br2/tunnels"
+
+        client.request('post', url, TOKEN,
+                       {'ofport':4, 'port':32, 'vlan-id':300,
+                        'shaped-rate':10}, [201])
+        client.request('delete', url + "/1", TOKEN, valid_responses=[204])
+        client.request('patch', url + "/2", TOKEN,
+                       [{'op':'replace', 'path':'/meter/cir', 'value':50}],
+                       [204])
+
+        tunnels = client.get_tunnels(self.base, 'br2', TOKEN)
+        self.failUnlessEqual(sorted(tunnels.keys()), [2, 3, 4])
+        self.failUnlessEqual(tunnels[2]['meter']['cir'], 50)
+        self.failUnlessEqual(self.server.get_tunnel('br2', 2)['meter']['cir'],
+                             50)
+        self.failUnlessEqual(self.server.get_counters()['get'], 1)
+
+        # Cache agrees with the switch.
+        refreshed = client.get_tunnels(self.base, 'br2', TOKEN, refresh=True)
+        self.failUnlessEqual(sorted(refreshed.keys()), [2, 3, 4])
+
+    def test_failure_invalidates(self):
+        client = CorsaRestClient()
+        client.get_tunnels(self.base, 'br2', TOKEN)
+        url = self.base + "api/v1/bridges/br2/tunnels/9"
+        self.failUnlessRaises(CorsaRestClientError, client.request,
+                              'delete', url, TOKEN, valid_responses=[204])
+        client.get_tunnels(self.base, 'br2', TOKEN)
+        self.failUnlessEqual(self.server.get_counters()['get'], 2)
+
+        self.failUnlessRaises(CorsaRestClientError, client.request,
+                              'get', url, "badtoken", valid_responses=[200])
+
+    def test_dispatch(self):
+        self.server.latency = 0.1
+        client = CorsaRestClient(workers=4)
+        url = self.base + "api/v1/bridges/br3/tunnels"
+        rcs = [FakeRestCmd('post', url, {'ofport':i, 'port':40,
+                                         'vlan-id':i}, [201])
+               for i in range(10, 14)]
+        responses = client.dispatch(rcs)
+        self.failUnlessEqual([r.status_code for r in responses],
+                             [201, 201, 201, 201])
+        self.failUnlessEqual(sorted(self.server.bridges['br3'].keys()),
+                             [10, 11, 12, 13])
+
+        # One duplicate fails, the others still go through
+        rcs = [FakeRestCmd('post', url, {'ofport':i, 'port':40,
+                                         'vlan-id':i}, [201])
+               for i in [13, 14]]
+        self.failUnlessRaises(CorsaRestClientError, client.dispatch, rcs)
+        self.failUnless(14 in self.server.bridges['br3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
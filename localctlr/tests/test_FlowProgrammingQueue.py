@@ -0,0 +1,276 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for localctlr.FlowProgrammingQueue module. Uses a stand-in
+# datapath, so it doesn't need a switch.
+
+import unittest
+import logging
+import threading
+from localctlr.FlowProgrammingQueue import *
+from localctlr.RyuTranslateInterface import *
+from localctlr.CorsaRestClient import CorsaRestClientError
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+
+
+class MsgStandin(object):
+    def __init__(self, datapath, name):
+        self.datapath = datapath
+        self.name = name
+        self.xid = None
+        self.buf = None
+    def serialize(self):
+        self.buf = "[%s:%d]" % (self.name, self.xid)
+
+class BundleCtrlStandin(MsgStandin):
+    def __init__(self, datapath, bundle_id, type_, flags, properties):
+        super(BundleCtrlStandin, self).__init__(datapath,
+                                                "ctrl%d-%d" % (bundle_id,
+                                                               type_))
+
+class BundleAddStandin(MsgStandin):
+    def __init__(self, datapath, bundle_id, flags, message, properties):
+        super(BundleAddStandin, self).__init__(datapath,
+                                               "add%d-%s" % (bundle_id,
+                                                             message.name))
+
+class OFProtoStandin(object):
+    OFPBF_ATOMIC = 1
+    OFPBCT_OPEN_REQUEST = 0
+    OFPBCT_COMMIT_REQUEST = 4
+
+class ParserStandin(object):
+    @staticmethod
+    def OFPBarrierRequest(datapath):
+        return MsgStandin(datapath, "barrier")
+
+class BundleParserStandin(ParserStandin):
+    OFPBundleCtrlMsg = BundleCtrlStandin
+    OFPBundleAddMsg = BundleAddStandin
+
+class DatapathStandin(object):
+    def __init__(self, parser=ParserStandin):
+        self.id = 1
+        self.ofproto = OFProtoStandin
+        self.ofproto_parser = parser
+        self.xid = 0
+        self.sent = []
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.xid = self.xid
+        return self.xid
+    def send(self, buf):
+        self.sent.append(buf)
+
+
+class FlowProgrammingQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dp = DatapathStandin()
+        self.completed = []
+        self.queue = FlowProgrammingQueue(self.dp, self.completed.append,
+                                          logging.getLogger(__name__),
+                                          max_batch_size=4)
+
+    def test_batch_with_barrier(self):
+        self.failIf(self.queue.use_bundles)
+        self.queue.note_installed(10)
+        self.queue.add(MsgStandin(self.dp, "a"))
+        self.queue.add(MsgStandin(self.dp, "b"))
+        self.failUnlessEqual(self.dp.sent, [])
+
+        batch = self.queue.flush()
+        # One write, closed by the barrier.
+        self.failUnlessEqual(self.dp.sent, ["[a:1][b:2][barrier:3]"])
+        self.failUnlessEqual(self.queue.get_outstanding_count(), 1)
+        self.failIf(self.queue.barrier_reply(2))
+        self.failUnless(self.queue.barrier_reply(3))
+        self.failUnlessEqual(self.completed, [batch])
+        self.failUnlessEqual(self.queue.get_outstanding_count(), 0)
+
+        report = batch.get_report()
+        self.failUnlessEqual(report['installed'], [10])
+        self.failUnlessEqual(report['messages'], 2)
+        self.failUnless(report['success'])
+        self.failIf(report['bundle'])
+        self.failUnless(report['latency'] >= 0)
+
+    def test_empty_flush(self):
+        self.failUnlessEqual(self.queue.flush(), None)
+        self.failUnlessEqual(self.dp.sent, [])
+
+    def test_cookie_only_batch(self):
+        # Rules without any FlowMods are still confirmed by a barrier.
+        self.queue.note_removed(11)
+        batch = self.queue.flush()
+        self.failUnlessEqual(self.dp.sent, ["[barrier:1]"])
+        self.queue.barrier_reply(1)
+        self.failUnlessEqual(self.completed[0].get_report()['removed'], [11])
+
+    def test_full_batch_flushes(self):
+        for i in range(5):
+            self.queue.add(MsgStandin(self.dp, str(i)))
+        self.failUnlessEqual(len(self.dp.sent), 1)
+        self.queue.flush()
+        self.failUnlessEqual(len(self.dp.sent), 2)
+
+    def test_error(self):
+        self.queue.add(MsgStandin(self.dp, "a"))
+        self.queue.add(MsgStandin(self.dp, "b"))
+        self.queue.flush()
+        self.failUnless(self.queue.error(2, "bad match"))
+        self.failIf(self.queue.error(20, "unrelated"))
+        self.queue.barrier_reply(3)
+        self.failIf(self.completed[0].is_successful())
+        self.failUnlessEqual(self.completed[0].get_report()['errors'],
+                             ["bad match"])
+
+    def test_bundle(self):
+        dp = DatapathStandin(BundleParserStandin)
+        queue = FlowProgrammingQueue(dp, self.completed.append,
+                                     logging.getLogger(__name__))
+        self.failUnless(queue.use_bundles)
+        queue.add(MsgStandin(dp, "a"))
+        batch = queue.flush()
+        self.failUnlessEqual(dp.sent, ["[ctrl1-0:1][add1-a:2][ctrl1-4:3]"])
+        # Barrier replies don't complete bundles
+        self.failIf(queue.barrier_reply(3))
+        self.failUnless(queue.bundle_reply(1))
+        self.failUnlessEqual(self.completed, [batch])
+        self.failUnless(batch.get_report()['bundle'])
+
+    def test_bundle_not_committed(self):
+        dp = DatapathStandin(BundleParserStandin)
+        queue = FlowProgrammingQueue(dp, self.completed.append,
+                                     logging.getLogger(__name__))
+        queue.add(MsgStandin(dp, "a"))
+        queue.flush()
+        queue.bundle_reply(1, False)
+        self.failIf(self.completed[0].is_successful())
+
+    def test_failed_cookies(self):
+        # Only the rule whose FlowMod was rejected fails.
+        self.queue.note_installed(10)
+        self.queue.add(MsgStandin(self.dp, "a"))
+        self.queue.note_installed(11)
+        self.queue.add(MsgStandin(self.dp, "b"))
+        self.queue.note_installed(12)
+        self.queue.flush()
+        self.queue.error(2, "bad match")
+        self.queue.barrier_reply(3)
+        report = self.completed[0].get_report()
+        self.failIf(report['success'])
+        self.failUnlessEqual(report['installed'], [10, 11, 12])
+        self.failUnlessEqual(report['failed'], [11])
+
+    def test_failed_bundle(self):
+        # Bundles are atomic, so every rule in one fails.
+        dp = DatapathStandin(BundleParserStandin)
+        queue = FlowProgrammingQueue(dp, self.completed.append,
+                                     logging.getLogger(__name__))
+        queue.note_installed(10)
+        queue.add(MsgStandin(dp, "a"))
+        queue.note_installed(11)
+        queue.add(MsgStandin(dp, "b"))
+        queue.flush()
+        queue.error(3, "bad match")
+        queue.bundle_reply(1, False)
+        self.failUnlessEqual(self.completed[0].get_report()['failed'],
+                             [10, 11])
+
+    def test_fail_all(self):
+        # Switch disconnects with one batch outstanding and one unsent.
+        self.queue.note_installed(10)
+        self.queue.add(MsgStandin(self.dp, "a"))
+        sent = self.queue.flush()
+        self.queue.note_installed(11)
+        self.queue.fail_all("Switch disconnected")
+        self.failUnlessEqual(self.queue.get_outstanding_count(), 0)
+        self.failUnlessEqual(len(self.completed), 2)
+        failed = []
+        for batch in self.completed:
+            self.failUnlessEqual(batch.errors, ["Switch disconnected"])
+            failed += batch.get_report()['failed']
+        self.failUnlessEqual(sorted(failed), [10, 11])
+        # Late replies are ignored
+        self.failIf(self.queue.barrier_reply(sent.closing_xid))
+        self.failUnlessEqual(len(self.completed), 2)
+
+
+class FlowBatchingTest(unittest.TestCase):
+    ''' Checks which messages the RyuTranslateInterface holds back until the
+        end of a batch of commands. '''
+    def setUp(self):
+        self.dp = DatapathStandin()
+        # Ryu apps can't be created without a Ryu manager, and only a couple
+        # of attributes are needed here.
+        self.rti = RyuTranslateInterface.__new__(RyuTranslateInterface)
+        self.rti.flow_batching = None
+        self.rti.flow_queues = {self.dp.id:FlowProgrammingQueue(
+            self.dp, lambda batch: None, logging.getLogger(__name__))}
+
+    def test_send_outside_command(self):
+        # Event handlers, such as packet-ins, aren't batched.
+        self.rti._send_flow_msg(self.dp, MsgStandin(self.dp, "a"))
+        self.failUnlessEqual(self.dp.sent, ["[a:1][barrier:2]"])
+
+    def test_send_while_batching(self):
+        # The main_loop holds its own messages, but not other threads'.
+        self.rti.flow_batching = threading.current_thread()
+        self.rti._send_flow_msg(self.dp, MsgStandin(self.dp, "a"))
+        self.failUnlessEqual(self.dp.sent, [])
+
+        handler = threading.Thread(target=self.rti._send_flow_msg,
+                                   args=(self.dp, MsgStandin(self.dp, "b")))
+        handler.start()
+        handler.join()
+        self.failUnlessEqual(self.dp.sent, ["[a:1][b:2][barrier:3]"])
+
+
+class CommandStandin(object):
+    ''' Stands in for the inter_cm_cxn, with one command to receive. '''
+    def __init__(self, cmd, data):
+        self.cmd = (cmd, data)
+    def recv_cmd(self):
+        return self.cmd
+
+class FailingCorsaClientStandin(object):
+    def dispatch(self, rcs):
+        raise CorsaRestClientError("REST command failed")
+
+class FailedCommandTest(unittest.TestCase):
+    ''' Checks that a rule that fails to install is reported as failed. '''
+    def setUp(self):
+        self.dp = DatapathStandin()
+        self.completed = []
+        self.queue = FlowProgrammingQueue(self.dp, self.completed.append,
+                                          logging.getLogger(__name__))
+        # Only the parts of the RyuTranslateInterface that come before the
+        # REST calls are stood in for.
+        self.rti = RyuTranslateInterface.__new__(RyuTranslateInterface)
+        self.rti.logger = logging.getLogger(__name__)
+        self.rti.datapaths = {self.dp.id:self.dp}
+        self.rti.flow_queues = {self.dp.id:self.queue}
+        self.rti.corsa_client = FailingCorsaClientStandin()
+        self.rti._get_new_OF_cookie = lambda sdx_cookie, switch_id: 1
+        self.rti._install_rule_in_db = lambda *args: None
+        self.rti._translate_VlanLCRule = lambda dp, table, cookie, rule: [
+            TranslatedCorsaRuleContainer("patch", "url", [], "token", [204])]
+
+    def test_dispatch_fails(self):
+        rule = VlanTunnelLCRule(self.dp.id, 1, 2, 100, 100, True, 1000)
+        rule.set_cookie(10)
+        self.rti.inter_cm_cxn = CommandStandin(ICX_ADD, (self.dp.id, rule))
+        # Doesn't raise
+        self.rti._handle_command()
+
+        batch = self.queue.flush()
+        self.queue.barrier_reply(batch.closing_xid)
+        report = self.completed[0].get_report()
+        self.failIf(report['success'])
+        self.failUnlessEqual(report['installed'], [])
+        self.failUnlessEqual(report['failed'], [10])
+        self.failUnless("REST command failed" in report['errors'][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -561,5 +561,98 @@ class InitialRulesTest(unittest.TestCase):
             (c,sw,r,s) = rule
             self.failUnlessEqual(rule2, r.data['rule'])
 
+class ReconcileTest(unittest.TestCase):
+    def test_reconcile(self):
+        m = LCRuleManager()
+        m.__init__()
+        m.add_rule(61, 10, "KEPT RULE", RULE_STATUS_ACTIVE)
+        m.add_rule(62, 10, "STALE RULE", RULE_STATUS_ACTIVE)
+        m.add_rule(62, 20, "OTHER STALE RULE", RULE_STATUS_ACTIVE)
+
+        (del_list, add_list) = m.reconcile([(61, 10, "KEPT RULE"),
+                                            (63, 10, "NEW RULE")])
+        self.failUnlessEqual(del_list, [("STALE RULE", 62, 10),
+                                        ("OTHER STALE RULE", 62, 20)])
+        self.failUnlessEqual(add_list, [("NEW RULE", 63, 10)])
+
+        # Nothing changed
+        self.failUnlessEqual(len(m._find_rules()), 3)
+
+    def test_reconcile_buckets(self):
+        m = LCRuleManager()
+        m.__init__()
+        m.add_rule(10, 1, "KEPT RULE", RULE_STATUS_ACTIVE)
+        m.add_rule(20, 1, "STALE RULE", RULE_STATUS_ACTIVE)
+        m.add_rule(300, 1, "UNCHANGED BUCKET", RULE_STATUS_ACTIVE)
+
+        # Only the (1, 0) bucket was exchanged
+        (del_list, add_list) = m.reconcile([(10, 1, "KEPT RULE"),
+                                            (30, 1, "NEW RULE")],
+                                           set([(1, 0)]), 100)
+        self.failUnlessEqual(del_list, [("STALE RULE", 20, 1)])
+        self.failUnlessEqual(add_list, [("NEW RULE", 30, 1)])
+
+    def test_digest(self):
+        m = LCRuleManager()
+        m.__init__()
+        m.add_rule(10, 1, "RULE 1", RULE_STATUS_ACTIVE)
+        m.add_rule(300, 2, "RULE 2", RULE_STATUS_ACTIVE)
+        digest = RuleDigest()
+        digest.add(10, 1, "RULE 1")
+        digest.add(300, 2, "RULE 2")
+        self.failUnlessEqual(m.get_rule_digest().diff(digest.get_summary()),
+                             [])
+        self.failUnlessEqual(len(m.get_rule_digest(100)), 2)
+
+        m.rm_rule(10, 1)
+        self.failUnlessEqual(m.get_rule_digest().diff(digest.get_summary()),
+                             [(1, 0)])
+        m.set_status(300, 2, RULE_STATUS_DELETING)
+        self.failUnlessEqual(len(m.get_rule_digest()), 1)
+
+    def test_indexes(self):
+        m = LCRuleManager()
+        m.__init__()
+        m.add_rule(64, 10, "RULE 1", RULE_STATUS_INSTALLING)
+        m.add_rule(64, 20, "RULE 2", RULE_STATUS_INSTALLING)
+        m.set_status(64, 20, RULE_STATUS_ACTIVE)
+
+        self.failUnlessEqual(m._find_rules({'status':RULE_STATUS_ACTIVE}),
+                             [(64, 20, "RULE 2", RULE_STATUS_ACTIVE)])
+        self.failUnlessEqual(m._find_rules({'cookie':64,
+                                            'status':RULE_STATUS_INSTALLING}),
+                             [(64, 10, "RULE 1", RULE_STATUS_INSTALLING)])
+        self.failUnlessEqual(len(m._find_rules({'switch_id':20})), 1)
+
+        m.rm_rule(64, 10)
+        self.failUnlessEqual(m._find_rules({'status':
+                                            RULE_STATUS_INSTALLING}), [])
+        self.failUnlessEqual(m._rule_indexes['key'].keys(), [(64, 20)])
+
+    def test_persistence(self):
+        db_filename = "lcrulemanagertest.db"
+        if os.path.exists(db_filename):
+            os.remove(db_filename)
+        try:
+            m = LCRuleManager()
+            m.__init__(db_filename=db_filename)
+            m.add_rule(65, 10, "RULE 1", RULE_STATUS_INSTALLING)
+            m.add_rule(66, 10, "RULE 2", RULE_STATUS_INSTALLING)
+            m.set_status(65, 10, RULE_STATUS_ACTIVE)
+            m.rm_rule(66, 10)
+            m.flush()
+
+            # Reload from the DB
+            m.__init__(db_filename=db_filename)
+            self.failUnlessEqual(m._find_rules(),
+                                 [(65, 10, "RULE 1", RULE_STATUS_ACTIVE)])
+            m.add_rule(67, 10, "RULE 3", RULE_STATUS_INSTALLING)
+            m.flush()
+            self.failUnlessEqual(len(m.rule_table), 2)
+        finally:
+            m.__init__()
+            os.remove(db_filename)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,7 +13,7 @@ from shared.SDXControllerConnectionManager import *
 
 from AuthenticationInspector import AuthenticationInspector
 from AuthorizationInspector import AuthorizationInspector
-from RuleManager import RuleManager
+from RuleManager import RuleManager, RuleManagerError, STRING_TO_STATE
 from TopologyManager import TopologyManager
 from UserManager import UserManager
 from RuleRegistry import RuleRegistry, RuleRegistryTypeError
@@ -50,6 +50,7 @@ import sys, os, traceback
 #datetime
 from datetime import datetime
 from dateutil.parser import parse as pd
+from werkzeug.urls import url_encode
 
 #Constants
 from shared.constants import *
@@ -74,6 +75,7 @@ EP_POLICIESSPEC = "/api/v1/policies/number/<policynumber>"
 EP_POLICIESTYPE = "/api/v1/policies/type"
 EP_POLICIESTYPESPEC = "/api/v1/policies/type/<policytype>"
 EP_POLICIESTYPESPECEXAMPLE = "/api/v1/policies/type/<policytype>/example.html"
+EP_POLICIESBULK = "/api/v1/policies/bulk"
 # - Login
 EP_LOGIN = "/api/v1/login"
 EP_LOGOUT = "/api/v1/logout"
@@ -88,6 +90,98 @@ def request_wants_json(r):
             r.accept_mimetypes['text/html'])
 
 
+# Policy listings
+# Query parameters that filter a policy listing, and the RuleManager column 
+# each filters on.
+POLICY_LISTING_FILTERS = {'user':'user',
+                          'type':'ruletype',
+                          'state':'state'}
+# Fields that can be asked for in a policy listing with the fields query 
+# parameter, and the RuleManager field each comes from. href is always there.
+POLICY_LISTING_FIELDS = {'policynumber':'hash',
+                         'user':'user',
+                         'type':'ruletype',
+                         'state':'state',
+                         'starttime':'starttime',
+                         'stoptime':'stoptime',
+                         'json':'json'}
+POLICY_LISTING_DEFAULT_FIELDS = ['policynumber', 'user', 'type']
+
+def get_policy_listing(r, policy_url, filter=None):
+    ''' Gets a page of policies, based on the query parameters of request r:
+          user, type, state - only policies matching these.
+          starttime, stoptime - only policies in effect at some point between
+            these.
+          fields - comma separated list of POLICY_LISTING_FIELDS to return.
+          limit - maximum number of policies to return.
+          after - policy number to start after, from the previous page's next.
+        filter takes precedence over the query parameters. 
+        Returns (dictionary of policies, URL of the next page or None). Raises
+        ValueError if the query parameters aren't valid. '''
+    query = {}
+    for (param, column) in POLICY_LISTING_FILTERS.items():
+        value = r.args.get(param)
+        if value == None:
+            continue
+        if column == 'state':
+            state = STRING_TO_STATE(value)
+            if state == None:
+                raise ValueError("Invalid state: %s" % value)
+            value = state
+        query[column] = value
+    if filter != None:
+        query.update(filter)
+
+    fields = POLICY_LISTING_DEFAULT_FIELDS
+    if r.args.get('fields') != None:
+        fields = [f for f in r.args.get('fields').split(',') if f != '']
+        for field in fields:
+            if field not in POLICY_LISTING_FIELDS:
+                raise ValueError("Invalid field %s, valid fields are %s" %
+                                 (field, sorted(POLICY_LISTING_FIELDS.keys())))
+
+    limit = r.args.get('limit')
+    after = r.args.get('after')
+    try:
+        if limit != None:
+            limit = int(limit)
+        if after != None:
+            after = int(after)
+    except ValueError:
+        raise ValueError("limit and after must be integers: %s, %s" %
+                         (limit, after))
+
+    try:
+        (rules, next_after) = RuleManager().get_rules_page(
+            query, after, limit,
+            r.args.get('starttime'), r.args.get('stoptime'),
+            ['hash'] + [POLICY_LISTING_FIELDS[f] for f in fields])
+    except RuleManagerError as e:
+        raise ValueError(str(e))
+
+    policies = {}
+    for rule in rules:
+        policy = {'href':policy_url + str(rule['hash'])}
+        for field in fields:
+            policy[field] = rule[POLICY_LISTING_FIELDS[field]]
+        policies['policy'+str(rule['hash'])] = policy
+
+    next_url = None
+    if next_after != None:
+        args = r.args.copy()
+        args['after'] = next_after
+        next_url = r.base_url + '?' + url_encode(args)
+    return (policies, next_url)
+
+def policy_listing_etag(r):
+    ''' ETag for a policy listing. Changes whenever any rule changes, and
+        differs between the JSON and HTML versions. '''
+    representation = 'html'
+    if request_wants_json(r):
+        representation = 'json'
+    return "%s-%s" % (RuleManager().get_rules_version(), representation)
+
+
 
 class RestAPI(AtlanticWaveModule):
     ''' The REST API will be the main interface for participants to use to push 
@@ -1015,11 +1109,24 @@ class RestAPI(AtlanticWaveModule):
       List all visible policies. Administrators are able to view all policies, 
       while regular users are only able to see their own policies. 
     Query Parameters
-      details (bool) - Default: false. Return all the details of the policies. 
-        May produce very large results.
-      FIXME
+      user, type, state (string) - Only list policies belonging to user, of 
+        type, or in state (e.g., "active").
+      starttime, stoptime (string) - Only list policies in effect at some 
+        point between starttime and stoptime. Format is "1985-04-12T23:20:50".
+      fields (string) - Comma separated list of fields to return for each 
+        policy, from policynumber, user, type, state, starttime, stoptime and 
+        json. Default: policynumber,user,type. json may produce very large 
+        results.
+      limit (int) - Return at most limit policies. If there are more, "next"
+        is the URL of the next page.
+      after (int) - Start after this policy number. Set in "next".
+    Request Headers
+      If-None-Match - ETag from a previous response. If no policies have 
+        changed since, 304 Not Modified is returned with no body.
     Status Codes
       200 OK - no error
+      304 Not Modified - no policies have changed since the If-None-Match ETag
+      400 Bad Request - invalid query parameters
 
     Example Request
       GET /api/v1/policies
@@ -1051,27 +1158,37 @@ class RestAPI(AtlanticWaveModule):
             print "Not Authenticated!"
             return make_response(jsonify({'error': 'User Not Authenticated'}),
                                  403)           
+        # Unchanged since the client last asked?
+        etag = policy_listing_etag(request)
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+
         base_url = request.base_url
         retdict = {'href': base_url, 'links':{}}
 
-        # Get all the rules:
-        rules = RuleManager().get_rules()
+        # Get the page of rules:
         policy_url = base_url + "/number/"
-
-        for rule in rules:
-            (rule_hash, jsonrule, ruletype, username, state) = rule
-            policy = {'href':policy_url + str(rule_hash),
-                      'policynumber':rule_hash,
-                      'user':username,
-                      'type':ruletype}
-            retdict['links']['policy'+str(rule_hash)] = policy
+        try:
+            (policies, next_url) = get_policy_listing(request, policy_url)
+        except ValueError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+        retdict['links'] = policies
+        if next_url != None:
+            retdict['next'] = next_url
             
         # If they requested a JSON, send back the raw JSON
         if request_wants_json(request):
-            return json.dumps(retdict)
+            response = make_response(json.dumps(retdict))
+            response.headers['Content-Type'] = 'application/json'
         # HTML output
-        return flask.render_template('policies.html',
-                                     policydict=retdict)
+        else:
+            response = make_response(flask.render_template('policies.html',
+                                                           policydict=retdict))
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept'
+        return response
 
 
     '''
@@ -1266,8 +1383,10 @@ class RestAPI(AtlanticWaveModule):
       Get the list of policies of type policytype that the user has access to. 
       This is a filtered version of the /api/v1/policies endpoint. 
     Query Parameters
-      FIXME
+      Same as /api/v1/policies
     Status Codes
+      304 Not Modified - no policies have changed since the If-None-Match ETag
+      400 Bad Request - invalid query parameters
       403 Forbidden -  if a non-local administrator or non-global administrator 
         attempts to view the internal configuration information, this is 
         returned.
@@ -1308,30 +1427,39 @@ class RestAPI(AtlanticWaveModule):
             print "Not Authenticated!"
             return make_response(jsonify({'error': 'User Not Authenticated'}),
                                  403)            
+        # Unchanged since the client last asked?
+        etag = policy_listing_etag(request)
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
 
         base_url = request.base_url
         retdict = {'href': base_url}
 
-        # Get all the rules:
-        rules = RuleManager().get_rules()
+        # Get the page of rules:
         policy_url = request.url_root[:-1] + EP_POLICIES + "/number/"
-
-        for rule in rules:
-            (rule_hash, jsonrule, ruletype, username, state) = rule
-            if ruletype == policytype:
-                policy = {'href':policy_url + str(rule_hash),
-                          'policynumber':rule_hash,
-                          'user':username,
-                          'type':ruletype}
-                retdict['policy'+str(rule_hash)] = policy
+        try:
+            (policies, next_url) = get_policy_listing(request, policy_url,
+                                                      {'ruletype':policytype})
+        except ValueError as e:
+            return make_response(jsonify({'error': str(e)}), 400)
+        retdict.update(policies)
+        if next_url != None:
+            retdict['next'] = next_url
             
         # If they requested a JSON, send back the raw JSON
         if request_wants_json(request):
-            return json.dumps(retdict)
+            response = make_response(json.dumps(retdict))
+            response.headers['Content-Type'] = 'application/json'
         # HTML output
-        return flask.render_template('policiestypespec.html',
-                                     policydict=retdict,
-                                     policytype=policytype)
+        else:
+            response = make_response(flask.render_template(
+                'policiestypespec.html', policydict=retdict,
+                policytype=policytype))
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept'
+        return response
     '''
     GET /api/v1/policies/type/<policytype>/example.html
       This endpoint returns an HTML file describing an example for creating that
@@ -1500,6 +1628,104 @@ class RestAPI(AtlanticWaveModule):
             return make_response(jsonify({"Error":str(e)}), 400)
 
 
+    '''
+    POST /api/v1/policies/bulk
+      Creates many policies, of any types, at once. Each entry in "policies" 
+      is the same JSON as would be POSTed to /api/v1/policies/type/<policytype>.
+      If "atomic" is true (the default), either all the policies are created 
+      or none are. Otherwise, each policy succeeds or fails on its own.
+    Status Codes
+      201 Created - all policies were created
+      200 OK - some policies were created, see the per-policy results
+      400 Bad Request - no policies were created
+    Example Request
+      POST /api/v1/policies/bulk
+      {
+        "atomic":true,
+        "policies":[
+          {"L2Tunnel":{...}},
+          {"L2Multipoint":{...}}]
+      }
+    Example Response
+      HTTP/1.1 201 Created
+      Content-Type: application/json
+      {
+        "policies":[
+          {"href":"http://awavesdx/api/v1/policies/number/3",
+           "policynumber":3,
+           "type":"L2Tunnel"},
+          {"href":"http://awavesdx/api/v1/policies/number/4",
+           "policynumber":4,
+           "type":"L2Multipoint"}],
+        "added":2
+      }
+    '''
+    @staticmethod
+    @login_required
+    @app.route(EP_POLICIESBULK, methods=['POST'])
+    def v1policiesbulkpost():
+        if not flask_login.current_user.is_authenticated:
+            print "Not Authenticated!"
+            return make_response(jsonify({'error': 'User Not Authenticated'}),
+                                 403)
+        base_url = request.url_root[:-1] + EP_POLICIES + "/number/"
+        userid = flask_login.current_user.id
+
+        data = request.get_json()
+        if data == None or type(data.get('policies')) != list:
+            return make_response(jsonify({"Error":"No list of policies"}),
+                                 400)
+        atomic = data.get('atomic', True)
+        RestAPI().logger.info("POST %d policies, atomic %s, user %s" %
+                              (len(data['policies']), atomic, userid))
+
+        # Build the UserPolicies. Entries that can't be parsed aren't passed
+        # to the RuleManager.
+        results = []
+        policies = []
+        for entry in data['policies']:
+            result = {}
+            results.append(result)
+            try:
+                policytype = str(entry.keys()[0])
+                result['type'] = policytype
+                policyclass = RuleRegistry().get_rule_class(policytype)
+                policyclass.check_syntax(entry)
+                policies.append((result, policyclass(userid, entry)))
+            except Exception as e:
+                result['error'] = str(e)
+
+        parse_failed = len(policies) != len(results)
+        if atomic and parse_failed:
+            for result in results:
+                if 'error' not in result:
+                    result['error'] = "Not added: another policy failed"
+            policies = []
+
+        added = 0
+        if len(policies) > 0:
+            try:
+                hashes = RuleManager().add_rules([p for (r, p) in policies],
+                                                 atomic)
+            except Exception as e:
+                RestAPI().exception_tb(e)
+                return make_response(jsonify({"Error":str(e)}), 400)
+            for ((result, policy), (hashval, error)) in zip(policies, hashes):
+                if hashval == None:
+                    result['error'] = error
+                    continue
+                result['href'] = base_url + str(hashval)
+                result['policynumber'] = hashval
+                added += 1
+
+        retdict = {'policies':results, 'added':added}
+        if added == len(results):
+            return make_response(jsonify(retdict), 201)
+        elif added > 0:
+            return make_response(jsonify(retdict), 200)
+        return make_response(jsonify(retdict), 400)
+
+
     # Login endpoint
     @staticmethod
     @app.route(EP_LOGIN, methods=['GET'])
@@ -1768,10 +1994,10 @@ class RestAPI(AtlanticWaveModule):
     @app.route('/batch_rule', methods=['POST'])
     def make_many_pipes():
         data = request.json
-        hashes = []
-        for rule in data['rules']: 
-            policy = L2TunnelPolicy(flask_login.current_user.id, rule)
-            hashes.append(RuleManager().add_rule(policy))
+        policies = [L2TunnelPolicy(flask_login.current_user.id, rule)
+                    for rule in data['rules']]
+        hashes = [h for (h, error) in
+                  RuleManager().add_rules(policies, atomic=False)]
             
         return '<pre>%s</pre><p>%s</p>'%(json.dumps(data, indent=2),str(hashes))
             
@@ -3,17 +3,24 @@
 
 
 import cPickle as pickle
+import heapq
+from bisect import bisect_right, insort
 
-from threading import Timer, Lock, Thread
+from threading import RLock, Thread, Condition
 from datetime import datetime, timedelta
+from time import time, mktime
+from sqlalchemy.types import Float
 
 from lib.AtlanticWaveManager import AtlanticWaveManager
 from AuthorizationInspector import AuthorizationInspector
 from BreakdownEngine import BreakdownEngine
 from ValidityInspector import ValidityInspector
-from TopologyManager import TopologyManager
+from TopologyManager import TopologyManager, TopologyManagerError, \
+     TopologyManagerConflictError
 
 from shared.constants import *
+from shared.UserPolicy import UserPolicyBreakdown
+from shared.RuleDigest import RuleDigest
 
 # Define different states!
 ACTIVE_RULE                 = 1
@@ -31,6 +38,35 @@ def STATE_TO_STRING(state):
     elif state == 4:
         return "INSUFFICIENT PRIVILEGES"
 
+def STRING_TO_STATE(statestr):
+    ''' Inverse of STATE_TO_STRING(). Also takes just the first word, in any
+        case, e.g., "active". Returns None if statestr isn't a state. '''
+    for state in [ACTIVE_RULE, INACTIVE_RULE, EXPIRED_RULE,
+                  INSUFFICIENT_PRIVILEGES]:
+        name = STATE_TO_STRING(state)
+        if statestr.upper() in [name, name.split(' ')[0]]:
+            return state
+    return None
+
+# Scheduled actions
+SCHEDULE_INSTALL            = 1
+SCHEDULE_REMOVE             = 2
+
+# Fields that get_rules_page() can return. 'json' is the only one that's
+# expensive to build.
+RULE_PAGE_FIELDS = ['hash', 'ruletype', 'user', 'state', 'starttime',
+                    'stoptime', 'json']
+
+# Times add_rule() breaks a rule down again if the resources it chose were 
+# taken by another rule in the meantime.
+ADD_RULE_ATTEMPTS           = 3
+
+def TIME_TO_EPOCH(timestr):
+    ''' Converts an rfc3339format time string to seconds since the epoch, in 
+        local time like datetime.now(). None stays None. '''
+    if timestr == None:
+        return None
+    return mktime(datetime.strptime(timestr, rfc3339format).timetuple())
 
 
 
@@ -54,6 +90,11 @@ class RuleManagerAuthorizationError(RuleManagerError):
     ''' When a authorization fails, raise this. '''
     pass
 
+class RuleManagerReservationError(RuleManagerError):
+    ''' When resources can't be reserved for the lifetime of a rule, raise 
+        this. '''
+    pass
+
 def TESTING_CALL(param):
     ''' RuleManager requires two parameters for proper initialization. However
         we also want for the REST API to be able to get a copy of the RuleManger
@@ -81,14 +122,14 @@ class RuleManager(AtlanticWaveManager):
         loggerid = loggeridprefix + ".rulemanager"
         super(RuleManager, self).__init__(loggerid)
         
-        # Setup timers and their associated locks.
-        # Timer code in part based on https://github.com/sdonovan1985/py-timer
-        self.install_timer = None
-        self.install_next_time = None
-        self.install_lock = Lock()
-        self.remove_timer = None
-        self.remove_next_time = None
-        self.remove_lock = Lock()
+        # Setup the scheduler for timed installation and removal of rules. A
+        # single thread works through a heap of (deadline, action, hash), with
+        # deadlines in seconds since the epoch. Entries for rules that were
+        # removed or changed state in the meantime are skipped when they come
+        # due, rather than being searched for in the heap.
+        self.schedule = []
+        self.schedule_cv = Condition()
+        self.scheduler_thread = None
 
         # Start database
         db_tuples = [('rule_table','rules'), ('config_table', 'config')]
@@ -110,6 +151,22 @@ class RuleManager(AtlanticWaveManager):
         self._valid_table_columns = ['hash', 'ruletype', 'user',
                                      'state', 'starttime', 'stoptime']
 
+        # Rule cache. The rule_table is only read here, at initialization:
+        # after this, the cache is authoritative and the rule_table is only
+        # written to, for persistence.
+        self.cache_lock = RLock()
+        self._load_rule_cache()
+
+        # Held while the resources of new rules are reserved and the rules 
+        # are added. add_rule() breaks rules down against a snapshot of the
+        # topology before taking it, so breakdowns run in parallel; 
+        # add_rules() holds it throughout, so that each rule is broken down
+        # against a topology that includes the reservations of the rules 
+        # added before it.
+        self.add_lock = RLock()
+        self._load_schedule()
+        self._load_bookings()
+
 
         # Config table setup
         # Initialize rule counter. Used to track the rules as they are installed
@@ -139,6 +196,11 @@ class RuleManager(AtlanticWaveManager):
         self.install_callbacks = []
         self.remove_callbacks = []
 
+        # Start the scheduler last, as it can call send_user_add_rule().
+        self.scheduler_thread = Thread(target=self._scheduler_thread)
+        self.scheduler_thread.daemon = True
+        self.scheduler_thread.start()
+
         self.logger.warning("%s initialized: %s" % (self.__class__.__name__,
                                                     hex(id(self))))
         
@@ -152,32 +214,152 @@ class RuleManager(AtlanticWaveManager):
         ''' Adds a rule for a particular user. Returns rule hash if successful, 
             failure message based on why the rule installation failed. Also 
             returns a reference to the rule (e.g., a tracking number) so that 
-            more details can be retrieved in the future. '''
+            more details can be retrieved in the future. 
+            The rule is broken down against a snapshot of the topology, and 
+            its resources reserved afterwards. If they were taken by another 
+            rule in the meantime, it is broken down again. '''
 
         self.logger.info("add_rule: Beging with rule: %s" % rule)
         self._update_last_modified_timestamp()
-        try:
-            breakdown = self._determine_breakdown(rule)
-        except Exception: raise
-        self.dlogger.info("add_rule: breakdowns %s" % breakdown)        
-
-        # If everything passes, set the hash, cookie, and breakdown,
-        # put into database and call install_callbacks
-        rulehash = self._get_new_rule_number()
-        rule.set_rule_hash(rulehash)
-        for entry in breakdown:
-            entry.set_cookie(rulehash)
-        rule.set_breakdown(breakdown)
-        self.dlogger.info("add_rule: hash and cookies set to %s" % rulehash)
+        for attempt in range(ADD_RULE_ATTEMPTS):
+            snapshot = TopologyManager().get_snapshot()
+            try:
+                breakdown = self._determine_breakdown(rule, snapshot)
+            except Exception: raise
+            self.dlogger.info("add_rule: breakdowns %s" % breakdown)        
+
+            with self.add_lock:
+                record = self._new_record(rule)
+                try:
+                    self._claim_record(record, snapshot.get_version())
+                except TopologyManagerConflictError as e:
+                    self.dlogger.info("add_rule: breaking down again: %s" % e)
+                    continue
 
-        rule.pre_add_callback(TopologyManager(), AuthorizationInspector())
-        self._add_rule_to_db(rule)
+                # If everything passes, set the hash, cookie, and breakdown,
+                # put into database and call install_callbacks
+                rulehash = self._get_new_rule_number()
+                self._set_rule_hash(rule, rulehash, breakdown)
+                record['hash'] = rulehash
+                self.dlogger.info("add_rule: hash and cookies set to %s" %
+                                  rulehash)
+
+                try:
+                    rule.pre_add_callback(TopologyManager(),
+                                          AuthorizationInspector())
+                    self._add_rule_to_db(record)
+                except:
+                    self._release_record(record)
+                    raise
+            break
+        else:
+            raise RuleManagerReservationError(
+                "Resources for rule kept being taken, tried %d times: %s" %
+                (ADD_RULE_ATTEMPTS, rule))
 
         self._call_install_callbacks(rule)
         self.dlogger.info("add_rule: Rule added to db: %s" % rule)
 
         return rulehash
-        
+
+    def add_rules(self, rules, atomic=True):
+        ''' Adds a list of rules in one go. Each rule is validated, broken 
+            down and has its resources reserved in turn, so later rules take 
+            account of earlier ones. All the rules are then written to the 
+            database in a single transaction, and each LC is sent a single 
+            breakdown with all of its new LCRules.
+            If atomic is True, either all the rules are added or none are: the
+            first failure undoes any reservations made for the others. If 
+            atomic is False, rules that fail are skipped.
+            Returns a list of (rule hash, error string) tuples, one per rule in
+            rules. The hash is None if the rule wasn't added, and the error is
+            None if it was. '''
+        self.logger.info("add_rules: %d rules, atomic %s" % (len(rules),
+                                                             atomic))
+        results = []
+        added = []
+        with self.add_lock:
+            first_rule_number = self.rule_number
+            for rule in rules:
+                try:
+                    breakdown = self._determine_breakdown(rule)
+                    record = self._new_record(rule)
+                    self._claim_record(record)
+                except Exception as e:
+                    self.dlogger.info("add_rules: %s failed: %s" % (rule, e))
+                    results.append((None, str(e)))
+                    if atomic:
+                        break
+                    continue
+
+                self.rule_number += 1
+                self._set_rule_hash(rule, self.rule_number, breakdown)
+                record['hash'] = self.rule_number
+                try:
+                    rule.pre_add_callback(TopologyManager(),
+                                          AuthorizationInspector())
+                except Exception as e:
+                    self.dlogger.info("add_rules: %s pre_add_callback failed: "
+                                      "%s" % (rule, e))
+                    self._release_record(record)
+                    self.rule_number -= 1
+                    results.append((None, str(e)))
+                    if atomic:
+                        break
+                    continue
+                added.append(record)
+                results.append((record['hash'], None))
+
+            if atomic and len(added) != len(rules):
+                self._abort_add_rules(added, first_rule_number)
+                failed = len(results) - 1
+                return [(None, results[failed][1]) if i == failed else
+                        (None, "Not added: rule %d failed" % failed)
+                        for i in range(len(rules))]
+
+            if len(added) == 0:
+                return results
+
+            # Update the DB in one transaction.
+            now = datetime.now().strftime(rfc3339format)
+            self.db.begin()
+            try:
+                for record in added:
+                    self.rule_table.insert(self._db_record(record))
+                self.config_table.update({'key':'rule_number',
+                                          'value':self.rule_number},
+                                         ['key'])
+                self.config_table.update({'key':'last_modified',
+                                          'value':now},
+                                         ['key'])
+                self.db.commit()
+            except:
+                self.db.rollback()
+                self._abort_add_rules(added, first_rule_number)
+                raise
+
+            add_breakdowns = []
+            for record in added:
+                self._cache_add(record)
+                if record['state'] == ACTIVE_RULE:
+                    breakdown = record['rule'].get_breakdown()
+                    self._lc_index_add(record['hash'], breakdown)
+                    add_breakdowns += breakdown
+                self._schedule_record(record)
+
+        self._send_grouped_breakdowns(add_breakdowns, self.send_user_add_rule)
+        for record in added:
+            self._call_install_callbacks(record['rule'])
+        self.logger.info("add_rules: added %d of %d rules" % (len(added),
+                                                              len(rules)))
+        return results
+
+    def _abort_add_rules(self, records, first_rule_number):
+        ''' Undoes the reservations made by add_rules() for records that
+            won't be added, and gives back their rule numbers. '''
+        for record in records:
+            self._release_record(record)
+        self.rule_number = first_rule_number
 
     def test_add_rule(self, rule):
         ''' Similar to add rule, save for actually pushing the rule to the local
@@ -185,20 +367,24 @@ class RuleManager(AtlanticWaveManager):
             expected, or to preview what rules will be pushed to the local 
             controller(s). '''
         try:
-            breakdown = self._determine_breakdown(rule)
+            breakdown = self._determine_breakdown(
+                rule, TopologyManager().get_snapshot())
         except Exception as e: raise
 
+        # Check that the resources are free for the lifetime of the rule.
+        self._book_record(self._new_record(rule), check_only=True)
+
         return breakdown
 
     def remove_rule(self, rule_hash, user):
         ''' Removes the rule that corresponds to the rule_hash that wa returned 
             either from add_rule() or found with get_rules(). If user does not 
             have removal ability, returns an error. '''
-        if self.rule_table.find_one(hash=rule_hash) == None:
+        rule = self.get_raw_rule(rule_hash)
+        if rule == None:
             raise RuleManagerError("rule_hash doesn't exist: %s" % rule_hash)
 
         self._update_last_modified_timestamp()
-        rule = pickle.loads(str(self.rule_table.find_one(hash=rule_hash)['rule']))
         authorized = None
         try:
             authorized = AuthorizationInspector().is_authorized(user, rule) #FIXME
@@ -215,12 +401,15 @@ class RuleManager(AtlanticWaveManager):
     def remove_all_rules(self, user):
         ''' Removes all rules. Just an alias for repeatedly calling 
             remove_rule() without needing to know all the hashes. '''
-        for rule in self.rule_table.find():
-            parsed_rule = pickle.loads(str(rule['rule']))
+        with self.cache_lock:
+            hashes = sorted(self._rules.keys())
+        for rule_hash in hashes:
+            parsed_rule = self.get_raw_rule(rule_hash)
             # Skip autogenerated rules
-            if parsed_rule.get_user() == AUTOGENERATED_USERNAME:
+            if (parsed_rule == None or
+                parsed_rule.get_user() == AUTOGENERATED_USERNAME):
                 continue
-            self.remove_rule(rule['hash'], user)
+            self.remove_rule(rule_hash, user)
 
     def get_rules_search_fields(self):
         ''' This returns fields that can be used in get_rules()'s filter.
@@ -250,30 +439,150 @@ class RuleManager(AtlanticWaveManager):
         #FIXME: make this more general, so that it can actually search for something like "starts between 8 and 10am".
         
         # Validate that the filter is valid.
-        if filter != None:
-            if type(filter) != dict:
-                raise RuleManagerTypeError("filter is not a dictionary: %s" % 
-                                           type(filter))
-            for key in filter.keys():
-                if key not in self._valid_table_columns:
-                    raise RuleManagerValidationError("filter column '%s' is not a valid filtering field %s" % (key, self._valid_table_columns))
+        if filter == None:
+            filter = {}
+        if type(filter) != dict:
+            raise RuleManagerTypeError("filter is not a dictionary: %s" % 
+                                       type(filter))
+        for key in filter.keys():
+            if key not in self._valid_table_columns:
+                raise RuleManagerValidationError("filter column '%s' is not a valid filtering field %s" % (key, self._valid_table_columns))
 
         # Handle ordering, if necessary.
+        reverse = False
         if ordering != None:
-            filter['order_by'] = ordering
-        
-        # Do the search on the table
-        results = self.rule_table.find(**filter)
-
+            if ordering.startswith('-'):
+                reverse = True
+                ordering = ordering[1:]
+            if ordering not in self._valid_table_columns:
+                raise RuleManagerValidationError("ordering column '%s' is not a valid ordering field %s" % (ordering, self._valid_table_columns))
+
+        # Do the search on the cache. Indexed columns narrow down the
+        # candidates, the rest are checked against each candidate.
+        with self.cache_lock:
+            hashes = None
+            for (key, value) in filter.items():
+                if key in self._rule_indexes:
+                    matched = self._rule_indexes[key].get(value, set())
+                    if hashes == None:
+                        hashes = set(matched)
+                    else:
+                        hashes &= matched
+            if hashes == None:
+                hashes = self._rules.keys()
+            results = [self._rules[h] for h in sorted(hashes)]
+        for (key, value) in filter.items():
+            if key not in self._rule_indexes:
+                results = [x for x in results if x[key] == value]
+        if ordering != None:
+            results.sort(key=lambda x: x[ordering], reverse=reverse)
 
         #FIXME: need to figure out what to send back to the caller of the rules. What does the rule look like? Should it be the JSON version? I think so.
         retval = [(x['hash'],
-                   pickle.loads(str(x['rule'])).get_json_rule(),
+                   x['rule'].get_json_rule(),
                    x['ruletype'],
-                   pickle.loads(str(x['rule'])).get_user(),
-                   STATE_TO_STRING(str(x['state']))) for x in results]
+                   x['user'],
+                   STATE_TO_STRING(x['state'])) for x in results]
         return retval
 
+    def get_rules_version(self):
+        ''' Returns a string that changes whenever any rule is added, 
+            removed, or changes state. Suitable for use as an ETag. '''
+        with self.cache_lock:
+            return "%s-%d" % (self._cache_epoch, self._cache_version)
+
+    def get_rules_page(self, filter={}, after=None, limit=None,
+                       starttime=None, stoptime=None, fields=None):
+        ''' Paged version of get_rules(), for listings. Rules are returned
+            in hash order, starting with the first hash after after, with at 
+            most limit rules per page.
+            filter is as for get_rules(). If starttime or stoptime (in 
+            rfc3339format) are given, only rules whose lifetime overlaps
+            starttime to stoptime are returned.
+            fields is a list of RULE_PAGE_FIELDS to return for each rule. By
+            default, all but 'json', which is only built if asked for.
+            Returns (list of dictionaries, next), where next is the after for
+            the next page, or None if this is the last page. '''
+        if filter == None:
+            filter = {}
+        if type(filter) != dict:
+            raise RuleManagerTypeError("filter is not a dictionary: %s" % 
+                                       type(filter))
+        for key in filter.keys():
+            if key not in self._valid_table_columns:
+                raise RuleManagerValidationError("filter column '%s' is not a valid filtering field %s" % (key, self._valid_table_columns))
+        if fields == None:
+            fields = RULE_PAGE_FIELDS[:-1]
+        for field in fields:
+            if field not in RULE_PAGE_FIELDS:
+                raise RuleManagerValidationError("field '%s' is not a valid field %s" % (field, RULE_PAGE_FIELDS))
+        if limit != None and limit < 1:
+            raise RuleManagerValidationError("limit must be positive: %s" %
+                                             limit)
+        try:
+            window_start = TIME_TO_EPOCH(starttime)
+            window_stop = TIME_TO_EPOCH(stoptime)
+        except ValueError as e:
+            raise RuleManagerValidationError("Invalid time window: %s" % e)
+
+        def _matches(record):
+            for (key, value) in filter.items():
+                if key not in self._rule_indexes and record[key] != value:
+                    return False
+            if (window_stop != None and record['starttime_epoch'] != None and
+                record['starttime_epoch'] >= window_stop):
+                return False
+            if (window_start != None and record['stoptime_epoch'] != None and
+                record['stoptime_epoch'] <= window_start):
+                return False
+            return True
+
+        results = []
+        more = False
+        with self.cache_lock:
+            # Indexed columns narrow down the candidates. If there aren't any,
+            # walk all hashes in order.
+            hashes = None
+            for (key, value) in filter.items():
+                if key in self._rule_indexes:
+                    matched = self._rule_indexes[key].get(value, set())
+                    if hashes == None:
+                        hashes = set(matched)
+                    else:
+                        hashes &= matched
+            if hashes == None:
+                ordered = self._rule_order
+            else:
+                ordered = sorted(hashes)
+            first = 0
+            if after != None:
+                first = bisect_right(ordered, after)
+
+            for i in xrange(first, len(ordered)):
+                record = self._rules[ordered[i]]
+                if not _matches(record):
+                    continue
+                if limit != None and len(results) == limit:
+                    more = True
+                    break
+                results.append(record)
+
+        retval = []
+        for record in results:
+            entry = {}
+            for field in fields:
+                if field == 'json':
+                    entry['json'] = record['rule'].get_json_rule()
+                elif field == 'state':
+                    entry['state'] = STATE_TO_STRING(record['state'])
+                else:
+                    entry[field] = record[field]
+            retval.append(entry)
+        next_after = None
+        if more:
+            next_after = results[-1]['hash']
+        return (retval, next_after)
+
     def get_breakdown_rules_by_LC(self, lc):
         ''' This gets broken down rules for a particular LC. Used at connection 
             startup by the SDXController. 
@@ -281,21 +590,24 @@ class RuleManager(AtlanticWaveManager):
         '''
         self.logger.info("get_breakdown_rules_by_LC(%s)" % lc)
         bd_list = []
-        # Get all rules
-        all_rules = self.rule_table.find()
-        # For each rule, look at each breakdown
-        for table_entry in all_rules:
-            rule = pickle.loads(str(table_entry['rule']))
-            for bd in rule.get_breakdown():
-                # If Breakdown is for this LC, add to bd_list
-                rule_lc = bd.get_lc()
-                self.logger.debug("  Rule with LC %s" % rule_lc)
-                if rule_lc == lc:
-                    self.logger.info("  Adding %s" % bd)
-                    bd_list += bd.get_list_of_rules()
+        # Installed LCRules for this LC, in rule hash order
+        with self.cache_lock:
+            lc_rules = self._lc_rules.get(lc, {})
+            for rule_hash in sorted(lc_rules.keys()):
+                bd_list += lc_rules[rule_hash]
         self.logger.info("get_breakdown_rules_by_LC(%s) - Returning %d rules" %
                          (lc, len(bd_list)))
         return bd_list
+
+    def get_rule_digest_by_LC(self, lc):
+        ''' Returns a RuleDigest of the rules get_breakdown_rules_by_LC()
+            returns for lc. Used at connection startup by the SDXController, so
+            that only the rules the LC doesn't already have are sent. '''
+        with self.cache_lock:
+            digest = self._lc_digests.get(lc)
+            if digest == None:
+                return RuleDigest()
+            return digest.copy()
     
     def get_rule_details(self, rule_hash):
         ''' This will return details of a rule, including the rule itself, the 
@@ -304,14 +616,14 @@ class RuleManager(AtlanticWaveManager):
             Returns tuple (rule_hash, json version of rule, ruletype, state, 
               user, list of text versions of breakdowns)
         '''
-        table_entry = self.rule_table.find_one(hash=rule_hash)
-        if table_entry != None:
-            rule = pickle.loads(str(table_entry['rule']))
+        record = self._get_cached_record(rule_hash)
+        if record != None:
+            rule = record['rule']
             
             # get the pieces
             jsonrule = rule.get_json_rule()
             ruletype = rule.get_ruletype()
-            state = STATE_TO_STRING(table_entry['state'])
+            state = STATE_TO_STRING(record['state'])
             user = rule.get_user()
 
             breakdowns = []
@@ -327,12 +639,128 @@ class RuleManager(AtlanticWaveManager):
 
     def get_raw_rule(self, rule_hash):
         ''' This will return the actual rule, for advanced manipulation. '''
-        table_entry = self.rule_table.find_one(hash=rule_hash)
-        if table_entry != None:
-            rule = pickle.loads(str(table_entry['rule']))
-            return rule
+        record = self._get_cached_record(rule_hash)
+        if record != None:
+            return record['rule']
         return None
 
+    def _load_rule_cache(self):
+        ''' Builds the rule cache and its indexes from the rule_table. '''
+        with self.cache_lock:
+            # hash -> record, which has the same fields as the rule_table, 
+            # but with the rule and extendedbd already unpickled.
+            self._rules = {}
+            # Secondary indexes: column -> value -> set of hashes
+            self._rule_indexes = {'user':{}, 'ruletype':{}, 'state':{}}
+            # All hashes in the cache, in order, for paging.
+            self._rule_order = []
+            # Bumped on every change to the cache. Along with the epoch, which
+            # differs between runs, this is the version from 
+            # get_rules_version().
+            self._cache_epoch = "%x" % int(time() * 1000)
+            self._cache_version = 0
+            # LC index: LC name -> rule hash -> list of LCRules installed on
+            # that LC for the rule, including extended breakdowns.
+            self._lc_rules = {}
+            # LC name -> RuleDigest of everything in the LC index for that LC
+            self._lc_digests = {}
+            for entry in self.rule_table.find():
+                record = dict(entry)
+                record['rule'] = pickle.loads(str(entry['rule']))
+                record['extendedbd'] = pickle.loads(str(entry['extendedbd']))
+                self._cache_add(record)
+                if record['state'] == ACTIVE_RULE:
+                    self._lc_index_add(record['hash'],
+                                       record['rule'].get_breakdown())
+                    if record['extendedbd'] != None:
+                        self._lc_index_add(record['hash'],
+                                           record['extendedbd'])
+
+    def _index_keys(self, record):
+        ''' Returns the (index, value) pairs that record is indexed under. '''
+        return [('user', record['user']),
+                ('ruletype', record['ruletype']),
+                ('state', record['state'])]
+
+    def _cache_add(self, record):
+        ''' Adds a record to the rule cache and indexes. '''
+        with self.cache_lock:
+            if record['hash'] not in self._rules:
+                insort(self._rule_order, record['hash'])
+            self._rules[record['hash']] = record
+            self._cache_version += 1
+            for (index, value) in self._index_keys(record):
+                self._rule_indexes[index].setdefault(value,
+                                                     set()).add(record['hash'])
+
+    def _cache_remove(self, rule_hash):
+        ''' Removes a record from the rule cache and indexes. '''
+        with self.cache_lock:
+            record = self._rules.pop(rule_hash, None)
+            if record == None:
+                return
+            del self._rule_order[bisect_right(self._rule_order, rule_hash) - 1]
+            self._cache_version += 1
+            for (index, value) in self._index_keys(record):
+                hashes = self._rule_indexes[index].get(value)
+                if hashes != None:
+                    hashes.discard(rule_hash)
+                    if len(hashes) == 0:
+                        del self._rule_indexes[index][value]
+
+    def _lc_index_add(self, rule_hash, breakdown):
+        ''' Adds the LCRules of a list of UserPolicyBreakdowns installed for
+            rule_hash to the LC index. '''
+        with self.cache_lock:
+            for bd in breakdown:
+                lc_rules = self._lc_rules.setdefault(bd.get_lc(), {})
+                lc_rules.setdefault(rule_hash, []).extend(
+                    bd.get_list_of_rules())
+                digest = self._lc_digests.setdefault(bd.get_lc(), RuleDigest())
+                for lcrule in bd.get_list_of_rules():
+                    digest.add(lcrule.get_cookie(), lcrule.get_switch_id(),
+                               lcrule)
+
+    def _lc_index_remove(self, rule_hash, breakdown):
+        ''' Removes everything installed for rule_hash on the LCs of a list of
+            UserPolicyBreakdowns from the LC index. '''
+        with self.cache_lock:
+            for bd in breakdown:
+                lc_rules = self._lc_rules.get(bd.get_lc())
+                if lc_rules == None:
+                    continue
+                digest = self._lc_digests[bd.get_lc()]
+                for lcrule in lc_rules.pop(rule_hash, []):
+                    digest.remove(lcrule.get_cookie(), lcrule.get_switch_id(),
+                                  lcrule)
+                if len(lc_rules) == 0:
+                    del self._lc_rules[bd.get_lc()]
+                    del self._lc_digests[bd.get_lc()]
+
+    def _cache_set_state(self, rule_hash, state):
+        ''' Changes the state of a cached record, keeping the state index up
+            to date. '''
+        with self.cache_lock:
+            record = self._rules[rule_hash]
+            old_hashes = self._rule_indexes['state'].get(record['state'])
+            if old_hashes != None:
+                old_hashes.discard(rule_hash)
+                if len(old_hashes) == 0:
+                    del self._rule_indexes['state'][record['state']]
+            record['state'] = state
+            self._rule_indexes['state'].setdefault(state, set()).add(rule_hash)
+            self._cache_version += 1
+
+    def _get_cached_record(self, rule_hash):
+        ''' Returns the cached record for rule_hash, or None. rule_hash may be
+            a string, as it is when it comes from a URL. '''
+        try:
+            rule_hash = int(rule_hash)
+        except (TypeError, ValueError):
+            return None
+        with self.cache_lock:
+            return self._rules.get(rule_hash)
+
     def register_for_rule_updates(self, install_callback, remove_callback):
         ''' Callback will be called when there is a rule update (install or 
             delete. 
@@ -381,11 +809,31 @@ class RuleManager(AtlanticWaveManager):
                                  ['key'])
         return self.rule_number
 
-    def _determine_breakdown(self, rule):
+    def _set_rule_hash(self, rule, rule_hash, breakdown):
+        ''' Sets the hash of a rule, the cookies of its breakdown and the
+            breakdown itself. '''
+        rule.set_rule_hash(rule_hash)
+        for entry in breakdown:
+            entry.set_cookie(rule_hash)
+        rule.set_breakdown(breakdown)
+
+    def _determine_breakdown(self, rule, snapshot=None):
         ''' This performs the bulk of the add_rule() and test_add_rule() 
             processing, including all the authorization checking. 
+            If snapshot is given, the rule is checked and broken down against
+            it rather than the live topology.
             Raises error if there are any problems.
             Returns breakdown of the rule if successful. '''
+        if snapshot == None:
+            return self._check_and_breakdown(rule)
+        TopologyManager().pin_snapshot(snapshot)
+        try:
+            return self._check_and_breakdown(rule)
+        finally:
+            TopologyManager().unpin_snapshot()
+
+    def _check_and_breakdown(self, rule):
+        ''' Body of _determine_breakdown(). '''
 
         valid = None
         breakdown = None
@@ -402,14 +850,23 @@ class RuleManager(AtlanticWaveManager):
             raise RuleManagerValidationError(
                 "Rule cannot be validated: %s" % rule)
         
-        # Get the breakdown of the rule
-        breakdown = BreakdownEngine().get_breakdown(rule)
+        start = TIME_TO_EPOCH(rule.get_start_time())
+        stop = TIME_TO_EPOCH(rule.get_stop_time())
+        if start != None and stop != None and start > stop:
+            raise RuleManagerValidationError(
+                "Rule stops before it starts: %s" % rule)
+
+        # Get the breakdown of the rule, using resources that are free for 
+        # the lifetime of the rule.
+        TopologyManager().set_reservation_window(start, stop)
         try:
             breakdown = BreakdownEngine().get_breakdown(rule)
         except Exception as e:
             self.dlogger.error("Caught Error for rule %s" % rule)
             self.exception_tb(e)
             raise
+        finally:
+            TopologyManager().clear_reservation_window()
 
         if breakdown == None:
             raise RuleManagerBreakdownError(
@@ -443,15 +900,28 @@ class RuleManager(AtlanticWaveManager):
         last_modified = last_modified_dict['value']
         return last_modified
 
-    def _add_rule_to_db(self, rule):
-        ''' Adds rule to the database, which also include handling timed 
+    def _add_rule_to_db(self, record):
+        ''' Adds a rule record from _new_record(), with its resources already
+            claimed, to the database, which also include handling timed 
             insertion of rules. '''
+        rule = record['rule']
         self.dlogger.info("_add_rule_to_db: %s:%s" % (rule,
                                                       rule.get_rule_hash()))
+        if record['state'] == ACTIVE_RULE:
+            self._install_breakdown(rule.get_breakdown(),
+                                    rule.get_rule_hash())
+
+        # Push into cache and DB.
+        self._cache_add(record)
+        self.rule_table.insert(self._db_record(record))
+        self._schedule_record(record)
+
+    def _new_record(self, rule):
+        ''' Returns the cache record for a new rule. Its state depends on 
+            whether the rule should be installed now, e.g., is the begin time 
+            before *now*? '''
         state = INACTIVE_RULE
 
-        # Should this be installed now? e.g., Is the begin time before *now*?
-        # Set state based on this question.
         # Many rules do *not* have timers associated. If so, set the 
         # install_time to now and remove_time to None. Need to handle these
         # cases below.
@@ -465,63 +935,72 @@ class RuleManager(AtlanticWaveManager):
             remove_time  = datetime.strptime(rule.get_stop_time(), 
                                              rfc3339format)
 
-#        print "Now     : %s" % now
-#        print "Install : %s" % install_time
-#        print "Remove  : %s" % remove_time
-
         if remove_time != None and now >= remove_time:
             self.dlogger.info("  EXPIRED_RULE")
             state = EXPIRED_RULE
         elif now >= install_time: # implicitly, before remove_time
             state = ACTIVE_RULE
             self.dlogger.info("  ACTIVE_RULE")
-            self._install_rule(rule)
         else:
             self.dlogger.info("  FUTURE RULE, still INACTIVE")
 
-        # Push into DB.
         # If there are any changes here, update self._valid_table_columns.
-        self.rule_table.insert({'hash':rule.get_rule_hash(), 
-                                'rule':pickle.dumps(rule),
-                                'ruletype':rule.get_ruletype(),
-                                'user':rule.get_user(),
-                                'state':state,
-                                'starttime':rule.get_start_time(),
-                                'stoptime':rule.get_stop_time(),
-                                'extendedbd':pickle.dumps(None)})
-
-        # Restart install timer if it's a rule starting the future
-        if state == INACTIVE_RULE:
+        return {'hash':rule.get_rule_hash(),
+                'rule':rule,
+                'ruletype':rule.get_ruletype(),
+                'user':rule.get_user(),
+                'state':state,
+                'starttime':rule.get_start_time(),
+                'stoptime':rule.get_stop_time(),
+                'starttime_epoch':TIME_TO_EPOCH(rule.get_start_time()),
+                'stoptime_epoch':TIME_TO_EPOCH(rule.get_stop_time()),
+                'extendedbd':None}
+
+    def _db_record(self, record):
+        ''' Returns the rule_table row for a cache record. '''
+        db_record = dict(record)
+        db_record['rule'] = pickle.dumps(record['rule'])
+        db_record['extendedbd'] = pickle.dumps(record['extendedbd'])
+        return db_record
+
+    def _schedule_record(self, record):
+        ''' Schedule installation if it's a rule starting the future, or
+            removal if it's an active rule with a stop time. '''
+        if record['state'] == INACTIVE_RULE:
             self.dlogger.info("  INACTIVE_RULE")
-            self._restart_install_timer()
+            self._schedule(record['starttime_epoch'], SCHEDULE_INSTALL,
+                           record['hash'])
+        elif (record['state'] == ACTIVE_RULE and
+              record['stoptime_epoch'] != None):
+            self._schedule(record['stoptime_epoch'], SCHEDULE_REMOVE,
+                           record['hash'])
 
 
     def _rm_rule_from_db(self, rule):
         ''' Removes rule from the database, which also includes cancelling any
             outstanding timed installations of the rule. '''
 
-        # Find rule in DB, get important information: state, start/stop time
-        record = self.rule_table.find_one(hash=rule.get_rule_hash())
+        # Find rule in cache, get important information: state
+        # Any scheduled installation or removal of the rule is skipped by the
+        # scheduler once the rule is no longer in the cache.
+        record = self._get_cached_record(rule.get_rule_hash())
         state = record['state']
-        starttime = record['starttime']
-        stoptime = record['stoptime']
+        self._cancel_record(record)
 
         if state == ACTIVE_RULE:
             self._remove_rule(rule)
+            self._cache_remove(rule.get_rule_hash())
             self.rule_table.delete(hash=rule.get_rule_hash())
-
-            if stoptime == self.remove_next_time:
-                self._restart_remove_timer()
                 
-        # If inactive, 
-        # Was it the next install timer to pop? If so, update timer.
+        # If inactive, only need to remove it.
         elif state == INACTIVE_RULE:
+            self._cache_remove(rule.get_rule_hash())
             self.rule_table.delete(hash=rule.get_rule_hash())
-            self._restart_install_timer()
 
         # If Expired:
         # Nothing specific to do right now
         elif state == EXPIRED_RULE:
+            self._cache_remove(rule.get_rule_hash())
             self.rule_table.delete(hash=rule.get_rule_hash())
             pass
             #FIXME: Recurrent rules are weird. 
@@ -532,29 +1011,99 @@ class RuleManager(AtlanticWaveManager):
             pass
 
 
-    def _install_rule(self, rule):
-        ''' Helper function that installs a rule into the switch. '''
-        try:
-            self.dlogger.debug("_install_rule: %s:%d" % (rule,
-                                                         rule.get_rule_hash()))
-            self._reserve_resources(rule.get_resources())
-            self._install_breakdown(rule.get_breakdown())
-        except Exception as e: raise
-        self._restart_remove_timer()
+    def _reserve_resources(self, resource_list, version=None):
+        ''' Helper function that reserves resources that a rule needs. If any
+            of them can't be reserved, none are. version is that of the 
+            snapshot the resources were chosen from, if any. '''
+        self.logger.debug("_reserve_resources: %s" % resource_list)
+        TopologyManager().reserve_resources(resource_list, version)
 
-    def _reserve_resources(self, resource_list):
-        ''' Helper function that reserves resources that a rule needs. '''
-        for resource in resource_list:
-            self.logger.debug("_reserve_resources: %s" % resource)
-            TopologyManager().reserve_resource(resource)
+    def _claim_record(self, record, version=None):
+        ''' Books the resources of a new rule record, and reserves them if 
+            the rule is ACTIVE. version is as for _reserve_resources(). '''
+        self._book_record(record, version=version)
+        if record['state'] == ACTIVE_RULE:
+            try:
+                self._reserve_resources(record['rule'].get_resources(),
+                                        version)
+            except:
+                self._cancel_record(record)
+                raise
+
+    def _release_record(self, record):
+        ''' Undoes _claim_record(). '''
+        if record['state'] == ACTIVE_RULE:
+            self._unreserve_resources(record['rule'].get_resources())
+        self._cancel_record(record)
         
+    def _book_record(self, record, check_only=False, version=None):
+        ''' Books the resources of an ACTIVE or INACTIVE rule in the 
+            TopologyManager's reservation calendars, from its start time until
+            its stop time, so that rules overlapping in time can't use the same
+            resources. Rules without a start time are booked from the start of
+            the epoch. If check_only is True, nothing is booked. version is as
+            for _reserve_resources(). '''
+        if not self._is_booked(record):
+            return
+        (start, stop) = self._get_booking_interval(record)
+        try:
+            if check_only:
+                TopologyManager().check_resources(
+                    record['rule'].get_resources(), start, stop)
+            else:
+                TopologyManager().book_resources(
+                    record['rule'].get_resources(), start, stop, version)
+        except TopologyManagerConflictError:
+            raise
+        except TopologyManagerError as e:
+            raise RuleManagerReservationError(
+                "Resources not available for rule %s: %s" % (record['rule'],
+                                                             e))
+
+    def _cancel_record(self, record):
+        ''' Undoes _book_record(). Must be called before record changes 
+            state. '''
+        if not self._is_booked(record):
+            return
+        (start, stop) = self._get_booking_interval(record)
+        TopologyManager().cancel_resources(record['rule'].get_resources(),
+                                           start, stop)
+
+    def _is_booked(self, record):
+        ''' Rules that never run, as they stop when they start, aren't 
+            booked. '''
+        if record['state'] not in [ACTIVE_RULE, INACTIVE_RULE]:
+            return False
+        (start, stop) = self._get_booking_interval(record)
+        return stop == None or start < stop
+
+    def _get_booking_interval(self, record):
+        start = record['starttime_epoch']
+        if start == None:
+            start = 0
+        return (start, record['stoptime_epoch'])
+
+    def _load_bookings(self):
+        ''' Books the resources of ACTIVE and INACTIVE rules in the cache. 
+            Called at initialization, after _load_schedule(). '''
+        for rule_hash in sorted(self._rules.keys()):
+            try:
+                self._book_record(self._rules[rule_hash])
+            except Exception as e:
+                self.logger.error("_load_bookings: cannot book rule %s" %
+                                  rule_hash)
+                self.exception_tb(e)
+
     def _unreserve_resources(self, resource_list):
         ''' Helper function that unreserves resources that a rule needs. '''
         for resource in resource_list:
             self.logger.debug("_unreserve_resources: %s" % resource)
             TopologyManager().unreserve_resource(resource)
 
-    def _install_breakdown(self, breakdown):
+    def _install_breakdown(self, breakdown, rule_hash):
+        ''' Sends a list of UserPolicyBreakdowns for rule_hash to the LCs, and
+            records them in the LC index. '''
+        self._lc_index_add(rule_hash, breakdown)
         try:
             for bd in breakdown:
                 self.logger.debug("Sending install breakdown: %s" % bd)
@@ -566,8 +1115,11 @@ class RuleManager(AtlanticWaveManager):
     def _remove_rule(self, rule):
         ''' Helper function that remove a rule from the switch. '''
         try:
-            table_entry = self.rule_table.find_one(hash=rule.get_rule_hash())
-            extendedbd = pickle.loads(str(table_entry['extendedbd']))
+            extendedbd = self._get_cached_record(
+                rule.get_rule_hash())['extendedbd']
+            self._lc_index_remove(rule.get_rule_hash(), rule.get_breakdown())
+            if extendedbd != None:
+                self._lc_index_remove(rule.get_rule_hash(), extendedbd)
             for bd in rule.get_breakdown():
                 self.logger.debug("Sending remove breakdown: %s" % bd)
                 self.send_user_rm_rule(bd)
@@ -578,128 +1130,163 @@ class RuleManager(AtlanticWaveManager):
             self._unreserve_resources(rule.get_resources())
         except Exception as e: raise
         
-    def _rule_install_timer_cb(self):
-        ''' This is the timer callback for rule installation. Called when the 
-            rule install timer pops. '''
-
-        # Get list of future rules ordered by install time
-        rules = self.rule_table.find(state = INACTIVE_RULE,
-                                     order_by = "starttime")
-
-        now = datetime.now()
-        next_install_time = None
-
-        # Does first rule in the list need installing? At least one should.
-        for rule in rules:
-            install_time = datetime.strptime(rule['starttime'],
-                                             rfc3339format)
-            # If this rule should be installed later, we're done with the loop
-            # thanks to rules being in order by start time. First, save off time
-            # for the next rule to be installed.
-            if now < install_time:
-                next_install_time = rule['starttime']
-                break
-
-            # Install rule and update state.
-            self.rule_table.update({'hash':rule['hash'],
-                                    'state':ACTIVE_RULE}, 
-                                   ['hash'])
-            
-            self._install_rule(pickle.loads(str(rule['rule'])))
-            
-        
-        # Set timer for next rule install, if necessary.
-        self._restart_install_timer()            
-
-    def _rule_remove_timer_cb(self):
-        ''' This is the timer callback for rule removal (expiring rules). Called
-            when the rule removal timer pops. '''
-
-        # Get the list of existing rules, ordered by expiry time.
-        rules = self.rule_table.find(state = ACTIVE_RULE,
-                                     order_by = "stoptime")
-
-        now = datetime.now()
-        next_remove_time = None
-
-        # Is the first rule in the list also expired? At least one should be.
-        for rule in rules:
-            remove_time = datetime.strptime(rule['stoptime'],
-                                            rfc3339format)
-            
-            # If this rule should be removed later, we're done with the loop
-            # thanks to rules being in order by stop time. First, save off time
-            # for the next rule to be installed.
-            if now < remove_time:
-                next_remove_time = rule['stoptime']
-                break
-
-            # Remove rule and update state.
-            self.rule_table.update({'hash':rule['hash'],
-                                    'state':EXPIRED_RULE}, 
-                                   ['hash'])
-            self._remove_rule(rule)
+    def _load_schedule(self):
+        ''' Rebuilds the schedule from the numeric time columns of the 
+            rule_table. Rows from before those columns existed are filled in
+            first. Called at initialization, after _load_rule_cache(). '''
+        for column in ['starttime', 'stoptime']:
+            epoch_column = column + '_epoch'
+            if epoch_column not in self.rule_table.columns:
+                self.rule_table.create_column(epoch_column, Float)
+            for record in self._rules.values():
+                if (record[column] != None and
+                    record.get(epoch_column) == None):
+                    record[epoch_column] = TIME_TO_EPOCH(record[column])
+                    self.rule_table.update({'hash':record['hash'],
+                                            epoch_column:record[epoch_column]},
+                                           ['hash'])
+                record.setdefault(epoch_column, None)
+            self.rule_table.create_index(['state', epoch_column])
+
+        schedule = []
+        for row in self.rule_table.find(state=INACTIVE_RULE,
+                                        order_by='starttime_epoch'):
+            if row['starttime_epoch'] != None:
+                schedule.append((row['starttime_epoch'], SCHEDULE_INSTALL,
+                                 row['hash']))
+        for row in self.rule_table.find(state=ACTIVE_RULE,
+                                        order_by='stoptime_epoch'):
+            if row['stoptime_epoch'] != None:
+                schedule.append((row['stoptime_epoch'], SCHEDULE_REMOVE,
+                                 row['hash']))
+        heapq.heapify(schedule)
+        with self.schedule_cv:
+            self.schedule = schedule
+            self.schedule_cv.notify()
+
+    def _schedule(self, deadline, action, rule_hash):
+        ''' Schedules action (SCHEDULE_INSTALL or SCHEDULE_REMOVE) for 
+            rule_hash at deadline, in seconds since the epoch. '''
+        with self.schedule_cv:
+            heapq.heappush(self.schedule, (deadline, action, rule_hash))
+            # Only need to wake the scheduler if it's the new earliest.
+            if self.schedule[0][2] == rule_hash:
+                self.schedule_cv.notify()
+
+    def _scheduler_thread(self):
+        ''' Waits for the earliest deadline in the schedule, then handles 
+            everything that is due at that point as one batch. '''
+        while True:
+            with self.schedule_cv:
+                while True:
+                    now = time()
+                    if len(self.schedule) == 0:
+                        self.schedule_cv.wait()
+                    elif self.schedule[0][0] > now:
+                        self.schedule_cv.wait(self.schedule[0][0] - now)
+                    else:
+                        break
+                due = []
+                while len(self.schedule) > 0 and self.schedule[0][0] <= now:
+                    due.append(heapq.heappop(self.schedule))
+            try:
+                self._run_scheduled(due)
+            except Exception as e:
+                self.exception_tb(e)
+
+    def _run_scheduled(self, due):
+        ''' Installs and removes a batch of scheduled rules. Removals are 
+            done first, so that their resources are available for the 
+            installs. Messages to the LCs are grouped per LC. '''
+        installs = []
+        removes = []
+        with self.cache_lock:
+            for (deadline, action, rule_hash) in due:
+                record = self._rules.get(rule_hash)
+                # Skip rules that were removed or changed in the meantime.
+                if record == None:
+                    continue
+                if (action == SCHEDULE_INSTALL and
+                    record['state'] == INACTIVE_RULE and
+                    record['starttime_epoch'] == deadline):
+                    installs.append(record)
+                elif (action == SCHEDULE_REMOVE and
+                      record['state'] == ACTIVE_RULE and
+                      record['stoptime_epoch'] == deadline):
+                    removes.append(record)
+        if len(installs) == 0 and len(removes) == 0:
+            return
+        self.logger.info("_run_scheduled: installing %d, removing %d rules" %
+                         (len(installs), len(removes)))
+
+        rm_breakdowns = []
+        for record in removes:
+            rule = record['rule']
+            rm_breakdowns += rule.get_breakdown()
+            self._lc_index_remove(record['hash'], rule.get_breakdown())
+            if record['extendedbd'] != None:
+                rm_breakdowns += record['extendedbd']
+                self._lc_index_remove(record['hash'], record['extendedbd'])
+            self._unreserve_resources(rule.get_resources())
+            self._cancel_record(record)
+            self._cache_set_state(record['hash'], EXPIRED_RULE)
             # FIXME: Recurrant rules will need to be updated on the install list potentially.
 
-        # Set timer for next rule removal, if necessary
-        self._restart_remove_timer()
-
-    def _restart_remove_timer(self):
-        ''' Internal function for starting the remove timer. ''' 
-        # Is the rule active? If so, remove it from the LCs.
-        # Was it the next remove timer to pop? If so, need to update timer.
-        with self.remove_lock:
-            # Clean up existing remove timer
-            if self.remove_timer != None:
-                self.remove_timer.cancel()
-            self.remove_timer = None
-            self.remove_next_time = None
-
-            # Pull next active rules, and reset the timer.
-            active_rules = self.rule_table.find(state=ACTIVE_RULE,
-                                                order_by="stoptime")
-            #, _limit=1)
-
-            # If there are no new active rules, this was just be skipped
-            for r in active_rules:
-                # If it's a rule that lasts forever, skip it
-                if r['stoptime'] == None:
-                    continue
-                # We only want the first one (the soonest to stop), so
-                # there's a break at the end of this loop.
-                now = datetime.now()
-                self.remove_next_time = r['stoptime']
-                delta = (datetime.strptime(self.remove_next_time,
-                                           rfc3339format) - now)
-                self.remove_timer = Timer(delta.total_seconds(),
-                                          self._rule_remove_timer_cb)
-                self.remove_timer.daemon = True
-                self.remove_timer.start()
-                break
-
-    def _restart_install_timer(self):
-        with self.install_lock:
-            # Clean up existing install timer
-            if self.install_timer != None:
-                self.install_timer.cancel()
-            self.install_timer = None
-            self.install_next_time = None
-
-            # Pull next inactive rule, and reset the timer.
-            inactive_rules = self.rule_table.find(state=INACTIVE_RULE,
-                                                  order_by="starttime", 
-                                                  _limit=1)
-
-            # If there are no new active rules, this was just be skipped
-            for r in inactive_rules:
-                now = datetime.now()
-                self.install_next_time = r['starttime']
-                delta = (datetime.strptime(self.install_next_time,
-                                           rfc3339format) - now)
-                self.install_timer = Timer(delta.total_seconds(),
-                                           self._rule_install_timer_cb)
-                self.install_timer.daemon = True
-                self.install_timer.start()
+        add_breakdowns = []
+        installed = []
+        failed = []
+        for record in installs:
+            rule = record['rule']
+            try:
+                self._reserve_resources(rule.get_resources())
+            except Exception as e:
+                # The rule will never be installed, so it expires, and its
+                # booking is freed for other rules.
+                self.logger.error("_run_scheduled: cannot install %s, expiring it" % rule)
+                self.exception_tb(e)
+                self._cancel_record(record)
+                self._cache_set_state(record['hash'], EXPIRED_RULE)
+                failed.append(record)
+                continue
+            add_breakdowns += rule.get_breakdown()
+            self._lc_index_add(record['hash'], rule.get_breakdown())
+            self._cache_set_state(record['hash'], ACTIVE_RULE)
+            installed.append(record)
+            if record['stoptime_epoch'] != None:
+                self._schedule(record['stoptime_epoch'], SCHEDULE_REMOVE,
+                               record['hash'])
+
+        # Update the DB in one transaction.
+        self.db.begin()
+        try:
+            for record in removes + failed:
+                self.rule_table.update({'hash':record['hash'],
+                                        'state':EXPIRED_RULE}, ['hash'])
+            for record in installed:
+                self.rule_table.update({'hash':record['hash'],
+                                        'state':ACTIVE_RULE}, ['hash'])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+        self._send_grouped_breakdowns(rm_breakdowns, self.send_user_rm_rule)
+        self._send_grouped_breakdowns(add_breakdowns, self.send_user_add_rule)
+
+    def _send_grouped_breakdowns(self, breakdowns, send):
+        ''' Merges breakdowns per LC, then calls send once for each LC. '''
+        lcs = []
+        merged = {}
+        for bd in breakdowns:
+            lc = bd.get_lc()
+            if lc not in merged:
+                merged[lc] = UserPolicyBreakdown(lc, [])
+                lcs.append(lc)
+            for rule in bd.get_list_of_rules():
+                merged[lc].add_to_list_of_rules(rule)
+        for lc in lcs:
+            self.logger.debug("Sending scheduled breakdown: %s" % merged[lc])
+            send(merged[lc])
                 
     def change_callback_dispatch(self, cookie, data):
         ''' This is used to handle changes callbacks. It performs four main 
@@ -711,11 +1298,11 @@ class RuleManager(AtlanticWaveManager):
               - if received breakdown, update database of installed additional 
                 breakdown.
         '''
-        table_entry = self.rule_table.find_one(hash=cookie)
-        if table_entry == None:
+        record = self._get_cached_record(cookie)
+        if record == None:
             raise RuleManagerError("rule_hash doesn't exist: %s" % cookie)
 
-        policy = pickle.loads(str(table_entry['rule']))
+        policy = record['rule']
 
         breakdown = policy.switch_change_callback(TopologyManager(),
                                                   AuthorizationInspector(),
@@ -724,16 +1311,19 @@ class RuleManager(AtlanticWaveManager):
             return
 
         self.logger.debug("_change_callback_dispatch %s"% cookie)
-        self._install_breakdown(breakdown)
-
-        extendedbd = pickle.loads(str(table_entry['extendedbd']))
-        if extendedbd == None:
-            extendedbd = breakdown
-        else:
-            for entry in breakdown:
-                extendedbd.append(entry)
-
-        self.rule_table.update({'hash':table_entry['hash'],
+        self._install_breakdown(breakdown, record['hash'])
+
+        with self.cache_lock:
+            extendedbd = record['extendedbd']
+            if extendedbd == None:
+                extendedbd = list(breakdown)
+            else:
+                for entry in breakdown:
+                    extendedbd.append(entry)
+            record['extendedbd'] = extendedbd
+            self._cache_version += 1
+
+        self.rule_table.update({'hash':record['hash'],
                                 'extendedbd':pickle.dumps(extendedbd)},
                                ['hash'])
 
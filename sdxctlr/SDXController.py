@@ -7,7 +7,8 @@ import sys
 from Queue import Queue, Empty
 
 from lib.AtlanticWaveModule import AtlanticWaveModule
-from lib.Connection import select as cxnselect
+from lib.ConnectionReactor import ConnectionReactor
+from lib.Throttle import CoalescingAdmitter
 from shared.SDXControllerConnectionManager import *
 from shared.SDXControllerConnectionManagerConnection import *
 from shared.UserPolicy import UserPolicyBreakdown
@@ -34,6 +35,12 @@ from shared.FloodTreePolicy import *
 from shared.SDXPolicy import SDXEgressPolicy, SDXIngressPolicy
 from shared.ManagementSDXRecoverPolicy import *
 
+# Learned destinations, from unknown source messages, are added at no more 
+# than DEFAULT_LEARN_RATE rules per second, and repeats of a learned 
+# destination within LEARNED_SOURCE_TTL seconds are dropped.
+DEFAULT_LEARN_RATE = 20
+LEARNED_SOURCE_TTL = 60
+
 
 class SDXControllerError(Exception):
     ''' Parent class, can be used as a catch-all for other errors '''
@@ -91,7 +98,9 @@ class SDXController(AtlanticWaveModule):
         self.ip = options.host
         self.port = options.lcport
         self.connections = {}
-        self.sdx_cm = SDXControllerConnectionManager(self.loggerid)
+        self.reactor = ConnectionReactor(self.loggerid)
+        self.sdx_cm = SDXControllerConnectionManager(self.loggerid,
+                                                     self.reactor)
         self.cm_thread = threading.Thread(target=self._cm_thread)
         self.cm_thread.daemon = True
         self.cm_thread.start()
@@ -123,6 +132,16 @@ class SDXController(AtlanticWaveModule):
                              host=options.host, port=options.sport)
 
 
+        # Learned destinations are queued, coalesced and added from their own
+        # thread, so a burst of unknown sources doesn't hold up the main loop.
+        # If this is being initialized again, the old one's thread is stopped.
+        learn_rate = getattr(options, 'learnrate', DEFAULT_LEARN_RATE)
+        if getattr(self, 'learned_admitter', None) != None:
+            self.learned_admitter.stop()
+        self.learned_admitter = CoalescingAdmitter(
+            self._add_learned_destination, learn_rate, LEARNED_SOURCE_TTL,
+            loggerid=self.loggerid)
+
         # Install any rules switches will need. 
         self._prep_switches()
 
@@ -144,6 +163,10 @@ class SDXController(AtlanticWaveModule):
         # Goes to the RuleManager to get existing rules for a particular LC
         return self.rm.get_breakdown_rules_by_LC(name)
 
+    def _get_existing_rule_digest_by_name(self, name):
+        # Digest of the rules from _get_existing_rules_by_name()
+        return self.rm.get_rule_digest_by_LC(name)
+
     def _clean_up_oustanding_cxn(self, name):
         # Check to see if there's an existing connection. If there is, close it.
         if name in self.connections.keys():
@@ -161,7 +184,8 @@ class SDXController(AtlanticWaveModule):
         # Get connection to main phase
         try:
             cxn.transition_to_main_phase_SDX(self._clean_up_oustanding_cxn,
-                                             self._get_existing_rules_by_name)
+                                             self._get_existing_rules_by_name,
+                                             self._get_existing_rule_digest_by_name)
         except (SDXControllerConnectionTypeError,
                 SDXControllerConnectionValueError) as e:
             # These error can happen, and their not the end of the world. In 
@@ -245,98 +269,66 @@ class SDXController(AtlanticWaveModule):
         self.logger.debug("Main Loop - %s" % (self.main_loop_thread))
 
     def _main_loop(self):
-        # Set up the select structures
-        rlist = self.connections.values()
-        wlist = []
-        xlist = rlist
+        # Connections that have been registered with the reactor. A closed
+        # Connection has already unregistered itself by the time its DEL_CXN
+        # is seen, so this is tracked separately.
+        active = set(self.connections.values())
+        for cxn in active:
+            self.reactor.register(cxn, self._handle_readable)
         timeout = 2.0
 
-        # Main loop - Have a ~500ms timer on the select call to handle cxn 
-        # events
+        # Main loop - the reactor is woken up whenever there are cxn events,
+        # the timeout is just a backstop.
         while True:
             # Handle event queue messages
-            try:
+            q_ele = self.sdx_cm.get_cxn_queue_element()
+            while q_ele != None:
+                (action, cxn) = q_ele
+                if action == NEW_CXN:
+                    self.logger.warning("Adding connection %s" % cxn)
+                    if cxn not in active:
+                        active.add(cxn)
+                        self.reactor.register(cxn, self._handle_readable)
+                    
+                elif action == DEL_CXN:
+                    self.logger.warning("Removing connection %s" % cxn)
+                    if cxn in active:
+                        self._handle_connection_loss(cxn)
+                        active.remove(cxn)
+                        self.reactor.unregister(cxn)
+                # Next queue element
                 q_ele = self.sdx_cm.get_cxn_queue_element()
-                while q_ele != None:
-                    (action, cxn) = q_ele
-                    if action == NEW_CXN:
-                        self.logger.warning("Adding connection %s" % cxn)
-                        if cxn in rlist:
-                            # Already there. Weird, but OK
-                            pass
-                        rlist.append(cxn)
-                        wlist = []
-                        xlist = rlist
-                        
-                    elif action == DEL_CXN:
-                        self.logger.warning("Removing connection %s" % cxn)
-                        if cxn in rlist:
-                            self._handle_connection_loss(cxn)
-                            rlist.remove(cxn)
-                            wlist = []
-                            xlist = rlist
-                    # Next queue element
-                    q_ele = self.sdx_cm.get_cxn_queue_element()
-            except:
-                raise
-                # This is raised if the cxn_q is empty of events.
-                # Normal behaviour
-                pass
                 
-            # Dispatch messages as appropriate
-            try: 
-                readable, writable, exceptional = cxnselect(rlist,
-                                                            wlist,
-                                                            xlist,
-                                                            timeout)
-            except Exception as e:
-                self.logger.warning("select returned error: %s" % e)
-                # This can happen if, say, there's a disconnection that hasn't
-                # cleaned up or occured *during* the timeout period. This is due
-                # to select failing.
-                sleep(timeout/2)
-                continue
-
-            # Loop through readable
-            for entry in readable:
-                # Get Message
-                try:
-                    msg = entry.recv_protocol()
-                except SDXMessageConnectionFailure as e:
-                    # Connection needs to be disconnected.
-                    entry.close()
-                    continue
-                except:
-                    raise
-
-                # Can return None if there was some internal message.
-                if msg == None:
-                    #self.logger.debug("Received internal message from recv_protocol %s" %
-                    #                  hex(id(entry)))
-                    continue
-                self.logger.debug("Received a %s message from %s" %
-                                  (type(msg), hex(id(entry))))
-
-                # If message is UnknownSource or L2MultipointUnknownSource,
-                # Send the appropriate handler.
-                if isinstance(msg, SDXMessageUnknownSource):
-                    self._switch_message_unknown_source(msg)
-                elif isinstance(msg, SDXMessageL2MultipointUnknownSource):
-                    self._switch_change_callback_handler(msg)
-
-                # Else: Log an error
-                else:
-                    self.logger.error("Message %s is not valid" % msg)
-
-            # Loop through writable
-            for entry in writable:
-                # Anything to do here?
-                pass
-
-            # Loop through exceptional
-            for entry in exceptional:
-                # FIXME: Handle connection failures
-                pass
+            # Dispatch messages and heartbeats as appropriate
+            self.reactor.run_once(timeout)
+
+    def _handle_readable(self, entry):
+        ''' Called by the reactor when a Local Controller connection is
+            readable. '''
+        # Get Message
+        try:
+            msg = entry.recv_protocol()
+        except SDXMessageConnectionFailure as e:
+            # Connection needs to be disconnected.
+            entry.close()
+            return
+
+        # Can return None if there was some internal message.
+        if msg == None:
+            return
+        self.logger.debug("Received a %s message from %s" %
+                          (type(msg), hex(id(entry))))
+
+        # If message is UnknownSource or L2MultipointUnknownSource,
+        # Send the appropriate handler.
+        if isinstance(msg, SDXMessageUnknownSource):
+            self._switch_message_unknown_source(msg)
+        elif isinstance(msg, SDXMessageL2MultipointUnknownSource):
+            self._switch_change_callback_handler(msg)
+
+        # Else: Log an error
+        else:
+            self.logger.error("Message %s is not valid" % msg)
 
     def _switch_message_unknown_source(self, msg):
         ''' This handles SDXMessageUnknownSource messages.
@@ -345,12 +337,26 @@ class SDXController(AtlanticWaveModule):
               {'switch':name, 'port':number, 'src':address}
         '''
         data = msg.get_data()
+        key = (data['switch'], data['port'], data['src'])
+        if not self.learned_admitter.submit(key, data):
+            self.dlogger.debug("Unknown source %s coalesced or suppressed" %
+                               data)
+
+    def _add_learned_destination(self, data):
+        ''' Called by the learned_admitter for each unknown source that is 
+            admitted. '''
         json_rule = {"learneddest":{"dstswitch":data['switch'],
                                     "dstport":data['port'],
                                     "dstaddress":data['src']}}
         ldp = LearnedDestinationPolicy(AUTOGENERATED_USERNAME, json_rule)
         self.rm.add_rule(ldp)
 
+    def get_unknown_source_counters(self):
+        ''' Returns counts of unknown source messages submitted, coalesced
+            with a pending one, suppressed as recently added, admitted, and 
+            failed, and the number pending. '''
+        return self.learned_admitter.get_counters()
+
     def _switch_change_callback_handler(self, msg):
         ''' This handles any message for switch_change_callbacks. 'data' is a 
             dictionary of the following pattern:
@@ -411,6 +417,10 @@ if __name__ == '__main__':
     parser.add_argument("-l", "--lcport", dest="lcport", default=PORT,
                         action="store", type=int,
                         help="Port number for LCs to connect to")
+    parser.add_argument("-L", "--learnrate", dest="learnrate",
+                        default=DEFAULT_LEARN_RATE, action="store",
+                        type=float,
+                        help="Learned destination rules added per second")
 
     options = parser.parse_args()
     print options
@@ -12,7 +12,8 @@ from shared.L2TunnelPolicy import L2TunnelPolicy
 from AuthenticationInspector import AuthenticationInspector
 from AuthorizationInspector import AuthorizationInspector
 from RuleManager import RuleManager, RuleManagerError
-from TopologyManager import TopologyManager, TOPO_EDGE_TYPE
+from TopologyManager import TopologyManager, TOPO_EDGE_TYPE, \
+    VLAN_BITMAP_TO_LIST
 from UserManager import UserManager
 from RuleRegistry import RuleRegistry
 
@@ -158,6 +159,18 @@ class SenseAPI(AtlanticWaveManager):
         self.topolock = Lock()
         self.userid = "SENSE"
 
+        # Model fragment caches. Each maps a port or service name to a tuple
+        # of (the inputs the fragment was generated from, the fragment). A
+        # fragment is reused as long as its inputs are unchanged. Rule and
+        # topology change callbacks drop the fragments they affect.
+        # latest_model caches the latest model dictionary, including its
+        # compressed form once it has been asked for.
+        self.port_fragments = {}
+        self.service_fragments = {}
+        self.fragment_lock = Lock()
+        self.latest_model = None
+        self.model_lock = Lock()
+
         # Start database
         db_tuples = [('delta_table','delta'),
                      ('model_table', 'model'),
@@ -401,15 +414,36 @@ class SenseAPI(AtlanticWaveManager):
     def rule_add_callback(self, rule):
         ''' Handles rules being added. '''
         print "rule_add_callback - %s" % rule
+        self._invalidate_rule_fragments(rule)
 
     def rule_rm_callback(self, rule):
         ''' Handles rules being removed. '''
         print "rule_rm_callback - %s" % rule
+        self._invalidate_rule_fragments(rule)
 
-    def topo_change_callback(self):
+    def topo_change_callback(self, change=None):
         ''' Handles topology changes. 
             FIXME: topologies don't change right now. '''
-        pass
+        with self.fragment_lock:
+            self.port_fragments = {}
+            self.service_fragments = {}
+
+    def _invalidate_rule_fragments(self, rule):
+        ''' Drops the model fragments that a rule change affects: the rule's
+            service and the ports that it has endpoints on. '''
+        ports = []
+        try:
+            for (e, f, v) in rule.get_endpoints():
+                ports += ["%s-%s" % (e, f), "%s-%s" % (f, e)]
+        except Exception:
+            # Not every rule has endpoints.
+            pass
+        with self.fragment_lock:
+            for port in ports:
+                self.port_fragments.pop(port, None)
+            for (name, (inputs, fragment)) in self.service_fragments.items():
+                if inputs[0] == rule.get_rule_hash():
+                    del self.service_fragments[name]
 
     def get_bw_available_on_egress_port(self, node):
         ''' Get the bandwidth available on a given egress port from the original
@@ -457,20 +491,21 @@ class SenseAPI(AtlanticWaveManager):
             Returns a string with the available VLANs.
         '''
 
-        # Get available VLANs
-        raw_available_vlans = self.simplified_topo.node[node]['available_vlans']
-        available_vlans = TopologyManager().get_available_vlan_list(
-            raw_available_vlans)
+        return self._vlan_bitmap_to_text(
+            self._get_vlan_bitmap_on_egress_port(node))
 
-        # Get VLANs in use
-        in_use = self.get_vlans_in_use_on_egress_port(node)
-        
-        # Get difference
-        # https://www.geeksforgeeks.org/python-intersection-two-lists/
-        diff = set(available_vlans).difference(in_use)
+    def _get_vlan_bitmap_on_egress_port(self, node):
+        ''' Get the bitmap of VLANs available for SENSE API use. '''
+        # Get VLANs that are available and not in use from the VLAN index.
+        # Swapped around, as in get_vlans_in_use_on_egress_port().
+        start_node = self.simplified_topo.node[node]['start_node']
+        end_node = self.simplified_topo.node[node]['end_node']
+        return TopologyManager().get_vlans_available_on_edge(end_node,
+                                                             start_node)
 
-        # Simplify to text
-        sortedlist = sorted(diff)
+    def _vlan_bitmap_to_text(self, free_vlans):
+        ''' Simplifies a VLAN bitmap to text, such as "1-1000,2000-2100". '''
+        sortedlist = VLAN_BITMAP_TO_LIST(free_vlans)
         index = 0
         begin = None
         current = None
@@ -592,6 +627,7 @@ class SenseAPI(AtlanticWaveManager):
             
             # - create new service dictionary
             svc_dict = {"service":service_name,
+                        "hash":rule_hash,
                         "bandwidth":bandwidth,
                         "starttime":start_time,
                         "endtime":stop_time,
@@ -642,7 +678,9 @@ class SenseAPI(AtlanticWaveManager):
                             self.simplified_topo.node[new_node]['alias'] = alias
 
     def generate_model(self):
-        ''' Generates a model of the simplified topology. '''
+        ''' Generates a model of the simplified topology. Port and service 
+            fragments are reused from earlier models when nothing they depend 
+            on has changed. '''
 
         list_of_vlan_services = []
         list_of_physical_ports = []
@@ -658,152 +696,35 @@ class SenseAPI(AtlanticWaveManager):
 
         
         # Get all endpoints and active services
-        endpoints = ""
         self.generate_simplified_topology()
         self.generate_list_of_services()
 
         #self.__DEBUG_print_lots_of_details()
-        
-        for ep in self.simplified_topo.neighbors('central'):
-            # For each endpoint:
-            #  - Get endpoint name
-            node = self.simplified_topo.node[ep]
-            epname = "%s::%s" % (fullurn, ep)
-            list_of_physical_ports.append(epname)
-            
-            #  - Definition of VLANs available on said endpoint
-            # FIXME: does this need to remove in-use VLANs?
-            vlan_name = "%s:vlan_range" % epname
-            vlan_def  = "<%s>\n" %vlan_name
-            vlan_def += "                a nml:LabelGroup, owl:NamedIndividual ;\n"
-            vlan_def += "                nml:labeltype <http://schemas.ogf.org/nml/2012/10/ethernet#vlan> ;\n"
-            vlan_def += "                nml:values \"%s\" .\n\n" % self.get_vlans_available_on_egress_port(ep)
-
-            #  - Bandwidth on a given port
-            bw_name = "%s:BandwidthService" % epname
-            available_bw = self.get_bw_available_on_egress_port(ep)
-            bw_def  = "<%s>\n" % bw_name
-            bw_def += "                a mrs:BandwidthService ;\n"
-            bw_def += "                mrs:availableCapacity \"%d\"^^xsd:long ;\n" % available_bw
-            bw_def += "                mrs:reservableCapacity \"%d\"^^xsd:long ;\n" % available_bw
-            bw_def += "                mrs:maximumCapacity \"%d\"^^xsd:long ;\n" % node["max_bw"]
-            bw_def += "                mrs:unit \"bps\" ;\n"
-            bw_def += "                nml:belongsTo <%s> .\n\n" % epname
-            
-            #  - Definition of Link structure
-            #  -- Get list of BidirectionalPorts
-            bidiports = ""
+
+        with self.fragment_lock:
+            endpoint_fragments = []
+            ports = self.simplified_topo.neighbors('central')
+            for ep in ports:
+                list_of_physical_ports.append("%s::%s" % (fullurn, ep))
+                endpoint_fragments.append(self._get_port_fragment(ep))
+
+            # Add services and all the various related bits.
+            service_fragments = []
             for s in self.list_of_services:
-                for e,f in s['endpoints']:
-                    if e == ep:
-                        bidiports += ", <%s:vlanport+%d>" % (epname, f)
-                        print "%s:vlanport+%d" % (epname, f)
-            if bidiports != "":
-                # trim off the leading ", "
-                bidiports = bidiports[2:] 
-            
-            link_def  = "<%s>\n" % epname
-            link_def += "                a nml:BidirectionalPort ;\n"
-            link_def += "                nml:belongsTo <%s::%s>, <%s> ;\n" % (fullurn, self.SVC_SENSE, fullurn)
-            link_def += "                nml:hasLabelGroup <%s> ;\n" % vlan_name
-            link_def += "                nml:hasService <%s> ;\n" % bw_name
-            if 'alias' in node.keys():
-                link_def += "                nml:isAlias <%s> ;\n" % node['alias']
-            if bidiports != "":
-                link_def += "                nml:hasBidirectionalPort %s ;\n" % bidiports
-            link_def += "                nml:name \"%s\" .\n\n" % ep
-
-            endpoints += vlan_def
-            endpoints += bw_def
-            endpoints += link_def
-
-        # Add services and all the various related bits.
-        services = ""
-        for s in self.list_of_services:
-            # - Pull out bandwidth and service name
-            bandwidth = s['bandwidth']
-            servicename = s['service']
-            starttime = s['starttime']
-            endtime = s['endtime']
-            per_service_endpoints = []
-
-            # - Loop through all service endpoints
-            for e in s['endpoints']:
-                (endpointname, vlannum) = e
-                service_str = "%s::%s:resource+links-connection_1:vlan+%d" % (
-                    fullurn, servicename, vlannum)
-                list_of_vlan_services.append(service_str)
-
-                # -- Add VLAN label for virtual port
-                services += "<%s::%s:vlanport+%d:label+%d>\n" % (
-                    fullurn, endpointname, vlannum, vlannum)
-                services += "        a nml:Label ;\n"
-                services += "        nml:belongsTo <%s::%s:vlanport+%d> ;\n" % (
-                    fullurn, endpointname, vlannum)
-                if not self._is_default_lifetime(starttime, endtime):
-                    services += "        nml:existsDuring <%s:existsDuring> ;\n" % (
-                        service_str)
-                services += "        nml:labeltype <http://schemas.ogf.org/nml/2012/10/ethernet#vlan> ;\n"
-                services += "        nml:value \"%d\" .\n\n" % vlannum
-                
-                # -- Add bandwidth on virtual port
-                if bandwidth != 0:
-                    services += "<%s::%s:vlanport+%d:service+bw>\n" % (
-                        fullurn, endpointname, vlannum)
-                    services += "        a mrs:BandwidthService ;\n"
-                    services += "        mrs:reservableCapacity \"%d\"^^xsd:long ;\n" % (bandwidth)
-                    services += "        mrs:type \"guaranteedCapped\" ;\n"
-                    services += "        mrs:unit \"bps\" ;\n"
-                    services += "        nml:belongsTo <%s::%s:vlanport+%d> ;\n" % (
-                        fullurn, endpointname, vlannum)
-                    if not self._is_default_lifetime(starttime, endtime):
-                        services += "        nml:existsDuring <%s:existsDuring> .\n\n" % (
-                            service_str)
-                
-                # -- Add service lifetime
-                if not self._is_default_lifetime(starttime, endtime):
-                    services += "<%s:existsDuring>\n" % service_str
-                    services += "        a nml:Lifetime ;\n"
-                    services += "        nml:end \"%s.000000-0000\" ;\n" % endtime
-                    services += "        nml:start \"%s.000000-0000\" .\n\n" % starttime
-                
-                # -- Add virtual port
-                services += "<%s::%s:vlanport+%d>\n" % (
-                    fullurn, endpointname, vlannum)
-                services += "        a nml:BidirectionalPort, mrs:SwitchingSubnet ;\n"
-                services += "        nml:belongsTo <%s>,<%s:%s> ;\n" % (
-                    service_str, fullurn, endpointname)
-                services += "        nml:encoding <http://schemas.ogf.org/nml/2012/10/ethernet> ;\n"
-                if not self._is_default_lifetime(starttime, endtime):
-                    services += "        nml:existsDuring <%s:existsDuring> ;\n" % (
-                        service_str)
-                services += "        nml:hasLabel <%s::%s:vlanport+%d:label+%d> ;\n" % (
-                    fullurn, endpointname, vlannum, vlannum)
-                if bandwidth != 0:
-                    services += "        nml:hasService <%s::%s:vlanport+%d:service+bw> ;\n" % (
-                        fullurn, endpointname, vlannum)
-                services += "        nml:name \"UNKNOWN\" .\n\n"
-
-                per_service_endpoints.append("%s:%s:vlanport+%d" % (
-                    fullurn, endpointname, vlannum))
-                
-            # - Add service
-            endpoints_str = ""
-            for entry in per_service_endpoints[:-1]:
-                endpoints_str += "<%s>, " % entry
-            endpoints_str += "<%s> ;" % per_service_endpoints[-1]
-            
-            services += "<%s>\n" % service_str
-            services += "        a mrs:SwitchingSubnet ;\n"
-            services += "        nml:belongsTo <%s> ;\n" % fullurn
-            services += "        nml:encoding <http://schemas.ogf.org/nml/2012/10/ethernet> ;\n"
-            if not self._is_default_lifetime(starttime, endtime):
-                services += "        nml:existsDuring <%s:existsDuring> ;\n" % (
-                    service_str)
-            services += "        nml:hasBidirectionalPort %s\n" % endpoints_str
-            services += "        nml:labelSwapping true ;\n"
-            services += "        nml:labelType <http://schemas.ogf.org/nml/2012/10/ethernet#vlan> .\n\n"
-        
+                (fragment, vlan_services) = self._get_service_fragment(s)
+                service_fragments.append(fragment)
+                list_of_vlan_services += vlan_services
+
+            # Drop fragments for ports and services that no longer exist.
+            for name in set(self.port_fragments.keys()) - set(ports):
+                del self.port_fragments[name]
+            names = set([s['service'] for s in self.list_of_services])
+            for name in set(self.service_fragments.keys()) - names:
+                del self.service_fragments[name]
+
+        endpoints = "".join(endpoint_fragments)
+        services = "".join(service_fragments)
+
         # Add topology (acts as switch)
         physical_ports_str = ""
         for entry in list_of_physical_ports[:-1]:
@@ -854,7 +775,167 @@ class SenseAPI(AtlanticWaveManager):
         return output
 
 
-    def get_latest_model(self):
+    def _get_port_fragment(self, ep):
+        ''' Returns the model fragment for an endpoint port: its VLANs, 
+            bandwidth, and link structure. Must hold fragment_lock. '''
+        node = self.simplified_topo.node[ep]
+        bidiports = []
+        for s in self.list_of_services:
+            for e,f in s['endpoints']:
+                if e == ep:
+                    bidiports.append(f)
+        inputs = (self._get_vlan_bitmap_on_egress_port(ep),
+                  self.get_bw_available_on_egress_port(ep),
+                  node['max_bw'], node.get('alias'), tuple(bidiports))
+        cached = self.port_fragments.get(ep)
+        if cached != None and cached[0] == inputs:
+            return cached[1]
+        (vlan_bitmap, available_bw, max_bw, alias, bidiports) = inputs
+
+        # For each endpoint:
+        #  - Get endpoint name
+        epname = "%s::%s" % (fullurn, ep)
+
+        #  - Definition of VLANs available on said endpoint
+        # FIXME: does this need to remove in-use VLANs?
+        vlan_name = "%s:vlan_range" % epname
+        vlan_def  = "<%s>\n" %vlan_name
+        vlan_def += "                a nml:LabelGroup, owl:NamedIndividual ;\n"
+        vlan_def += "                nml:labeltype <http://schemas.ogf.org/nml/2012/10/ethernet#vlan> ;\n"
+        vlan_def += "                nml:values \"%s\" .\n\n" % self._vlan_bitmap_to_text(vlan_bitmap)
+
+        #  - Bandwidth on a given port
+        bw_name = "%s:BandwidthService" % epname
+        bw_def  = "<%s>\n" % bw_name
+        bw_def += "                a mrs:BandwidthService ;\n"
+        bw_def += "                mrs:availableCapacity \"%d\"^^xsd:long ;\n" % available_bw
+        bw_def += "                mrs:reservableCapacity \"%d\"^^xsd:long ;\n" % available_bw
+        bw_def += "                mrs:maximumCapacity \"%d\"^^xsd:long ;\n" % max_bw
+        bw_def += "                mrs:unit \"bps\" ;\n"
+        bw_def += "                nml:belongsTo <%s> .\n\n" % epname
+
+        #  - Definition of Link structure
+        #  -- Get list of BidirectionalPorts
+        bidiports_str = ", ".join(["<%s:vlanport+%d>" % (epname, f)
+                                   for f in bidiports])
+
+        link_def  = "<%s>\n" % epname
+        link_def += "                a nml:BidirectionalPort ;\n"
+        link_def += "                nml:belongsTo <%s::%s>, <%s> ;\n" % (fullurn, self.SVC_SENSE, fullurn)
+        link_def += "                nml:hasLabelGroup <%s> ;\n" % vlan_name
+        link_def += "                nml:hasService <%s> ;\n" % bw_name
+        if alias != None:
+            link_def += "                nml:isAlias <%s> ;\n" % alias
+        if bidiports_str != "":
+            link_def += "                nml:hasBidirectionalPort %s ;\n" % bidiports_str
+        link_def += "                nml:name \"%s\" .\n\n" % ep
+
+        fragment = vlan_def + bw_def + link_def
+        self.port_fragments[ep] = (inputs, fragment)
+        return fragment
+
+    def _get_service_fragment(self, s):
+        ''' Returns a tuple of the model fragment for a service from 
+            list_of_services, and the list of VLAN services it provides. Must
+            hold fragment_lock. '''
+        inputs = (s['hash'], s['bandwidth'], s['starttime'], s['endtime'],
+                  tuple(s['endpoints']))
+        cached = self.service_fragments.get(s['service'])
+        if cached != None and cached[0] == inputs:
+            return cached[1]
+
+        # - Pull out bandwidth and service name
+        bandwidth = s['bandwidth']
+        servicename = s['service']
+        starttime = s['starttime']
+        endtime = s['endtime']
+        per_service_endpoints = []
+        list_of_vlan_services = []
+        services = ""
+
+        # - Loop through all service endpoints
+        for e in s['endpoints']:
+            (endpointname, vlannum) = e
+            service_str = "%s::%s:resource+links-connection_1:vlan+%d" % (
+                fullurn, servicename, vlannum)
+            list_of_vlan_services.append(service_str)
+
+            # -- Add VLAN label for virtual port
+            services += "<%s::%s:vlanport+%d:label+%d>\n" % (
+                fullurn, endpointname, vlannum, vlannum)
+            services += "        a nml:Label ;\n"
+            services += "        nml:belongsTo <%s::%s:vlanport+%d> ;\n" % (
+                fullurn, endpointname, vlannum)
+            if not self._is_default_lifetime(starttime, endtime):
+                services += "        nml:existsDuring <%s:existsDuring> ;\n" % (
+                    service_str)
+            services += "        nml:labeltype <http://schemas.ogf.org/nml/2012/10/ethernet#vlan> ;\n"
+            services += "        nml:value \"%d\" .\n\n" % vlannum
+
+            # -- Add bandwidth on virtual port
+            if bandwidth != 0:
+                services += "<%s::%s:vlanport+%d:service+bw>\n" % (
+                    fullurn, endpointname, vlannum)
+                services += "        a mrs:BandwidthService ;\n"
+                services += "        mrs:reservableCapacity \"%d\"^^xsd:long ;\n" % (bandwidth)
+                services += "        mrs:type \"guaranteedCapped\" ;\n"
+                services += "        mrs:unit \"bps\" ;\n"
+                services += "        nml:belongsTo <%s::%s:vlanport+%d> ;\n" % (
+                    fullurn, endpointname, vlannum)
+                if not self._is_default_lifetime(starttime, endtime):
+                    services += "        nml:existsDuring <%s:existsDuring> .\n\n" % (
+                        service_str)
+
+            # -- Add service lifetime
+            if not self._is_default_lifetime(starttime, endtime):
+                services += "<%s:existsDuring>\n" % service_str
+                services += "        a nml:Lifetime ;\n"
+                services += "        nml:end \"%s.000000-0000\" ;\n" % endtime
+                services += "        nml:start \"%s.000000-0000\" .\n\n" % starttime
+
+            # -- Add virtual port
+            services += "<%s::%s:vlanport+%d>\n" % (
+                fullurn, endpointname, vlannum)
+            services += "        a nml:BidirectionalPort, mrs:SwitchingSubnet ;\n"
+            services += "        nml:belongsTo <%s>,<%s:%s> ;\n" % (
+                service_str, fullurn, endpointname)
+            services += "        nml:encoding <http://schemas.ogf.org/nml/2012/10/ethernet> ;\n"
+            if not self._is_default_lifetime(starttime, endtime):
+                services += "        nml:existsDuring <%s:existsDuring> ;\n" % (
+                    service_str)
+            services += "        nml:hasLabel <%s::%s:vlanport+%d:label+%d> ;\n" % (
+                fullurn, endpointname, vlannum, vlannum)
+            if bandwidth != 0:
+                services += "        nml:hasService <%s::%s:vlanport+%d:service+bw> ;\n" % (
+                    fullurn, endpointname, vlannum)
+            services += "        nml:name \"UNKNOWN\" .\n\n"
+
+            per_service_endpoints.append("%s:%s:vlanport+%d" % (
+                fullurn, endpointname, vlannum))
+
+        # - Add service
+        endpoints_str = ""
+        for entry in per_service_endpoints[:-1]:
+            endpoints_str += "<%s>, " % entry
+        endpoints_str += "<%s> ;" % per_service_endpoints[-1]
+
+        services += "<%s>\n" % service_str
+        services += "        a mrs:SwitchingSubnet ;\n"
+        services += "        nml:belongsTo <%s> ;\n" % fullurn
+        services += "        nml:encoding <http://schemas.ogf.org/nml/2012/10/ethernet> ;\n"
+        if not self._is_default_lifetime(starttime, endtime):
+            services += "        nml:existsDuring <%s:existsDuring> ;\n" % (
+                service_str)
+        services += "        nml:hasBidirectionalPort %s\n" % endpoints_str
+        services += "        nml:labelSwapping true ;\n"
+        services += "        nml:labelType <http://schemas.ogf.org/nml/2012/10/ethernet#vlan> .\n\n"
+
+        self.service_fragments[servicename] = (inputs,
+                                               (services,
+                                                list_of_vlan_services))
+        return (services, list_of_vlan_services)
+
+    def get_latest_model(self, encode=False):
         ''' Gets the latest model. 
             Returns tuple of the dictionary (described below), and bool whether
             the dictionary is new or not: (dictionary, new?)
@@ -862,8 +943,21 @@ class SenseAPI(AtlanticWaveManager):
               'href': address of model,
               'creationTime': timestamp of model,
               'model': the model itself}
+            If encode is True, the model is gzipped and base64 encoded. The 
+            encoded model is cached along with the latest model.
         '''
-
+        with self.model_lock:
+            (retdict, retnew) = self._get_latest_model()
+            if encode:
+                if self.latest_model.get('encoded') == None:
+                    self.latest_model['encoded'] = self._encode_gzip_b64(
+                        self.latest_model['model'])
+                retdict = dict(retdict)
+                retdict['model'] = self.latest_model['encoded']
+            return (retdict, retnew)
+
+    def _get_latest_model(self):
+        ''' Does the work for get_latest_model(), must hold model_lock. '''
         self.dlogger.debug("get_latest_model(): start")
         # Dictionary components
         model_id = None
@@ -876,16 +970,24 @@ class SenseAPI(AtlanticWaveManager):
         retnew = False
 
         
-        # Check DB: if there is a latest one, already inserted, use it.
+        # Check the cache, then the DB: if there is a latest one, already
+        # inserted, use it.
         # The - in front of timestamp gets the latest.
-        result = self.model_table.find_one(order_by=['-timestamp'])
-
-        if result != None:
-            model_id = result['model_id']
-            href = "%s/sense-rm/api/sense/v1/models/%s" % (self.urlbase,
-                                                           model_id)
-            creation_time = result['timestamp']
-            model = result['model_data']
+        if self.latest_model == None:
+            result = self.model_table.find_one(order_by=['-timestamp'])
+            if result != None:
+                self.latest_model = {
+                    'id':result['model_id'],
+                    'href':"%s/sense-rm/api/sense/v1/models/%s" % (
+                        self.urlbase, result['model_id']),
+                    'creationTime':result['timestamp'],
+                    'model':result['model_data']}
+
+        if self.latest_model != None:
+            model_id = self.latest_model['id']
+            href = self.latest_model['href']
+            creation_time = self.latest_model['creationTime']
+            model = self.latest_model['model']
 
         # Now, do we need a new model? Two reasons for this:
         #  - There wasn't a model in the DB
@@ -926,6 +1028,12 @@ class SenseAPI(AtlanticWaveManager):
             # Insert it into the DB
             self._put_model(model_id, model, raw_model, creation_time)
             retnew = True
+            self.latest_model = {
+                'id':model_id,
+                'href':"%s/sense-rm/api/sense/v1/models/%s" % (self.urlbase,
+                                                               model_id),
+                'creationTime':creation_time,
+                'model':model}
 
         # Return the correct format
         self.dlogger.debug("get_latest_model(): Returning model %s" % model_id)
@@ -1748,7 +1856,10 @@ class ModelsAPI(SenseAPIResource):#FIXME
     def get(self):
         self.dlogger.debug("get() start")
 
-        retval = [dict(marshal(self.model, model_fields))]
+        model = self.model
+        if request.args.get('encode', 'false') == 'true':
+            model, newbool = SenseAPI().get_latest_model(encode=True)
+        retval = [dict(marshal(model, model_fields))]
         self.dlogger.debug("get() returning %s" % retval)
         self.logger.info("get() complete")
         return retval
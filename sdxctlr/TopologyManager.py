@@ -3,11 +3,14 @@
 
 
 from lib.AtlanticWaveManager import AtlanticWaveManager
-from threading import Lock
+from lib.ReservationCalendar import *
+from threading import RLock, local
+from contextlib import contextmanager
 from datetime import datetime
+from time import time
 import networkx as nx
 import json
-from lib.SteinerTree import make_steiner_tree
+from lib.SteinerTree import make_steiner_tree, steiner_tree_cost, MetricClosure
 from shared.PathResource import *
 
 from shared.constants import rfc3339format
@@ -24,6 +27,42 @@ NODE_DTN              = 5
 NODE_NETWORK          = 6
 NODE_TYPE_MAX         = 6
 
+# Number of bandwidth-pruned views of the topology, and their metric closures,
+# kept for Steiner tree computation before the cache is emptied.
+STEINER_CACHE_SIZE    = 16
+
+# Number of next hop tables, see get_next_hops(), kept before the cache is 
+# emptied.
+NEXT_HOP_CACHE_SIZE   = 256
+
+# Path search defaults: number of loop-free paths tried, shortest first, and
+# the maximum number of hops in a path (None for no limit).
+DEFAULT_PATH_K        = 16
+DEFAULT_PATH_MAX_HOPS = None
+
+# VLAN bitmaps. Bit N is set if VLAN N is set in the bitmap. VLAN searches are
+# restricted to VLAN_SEARCH_MASK, which covers VLANs 1-4088.
+VLAN_BITMAP_SIZE      = 4096
+VLAN_SEARCH_MIN       = 1
+VLAN_SEARCH_MAX       = 4088
+VLAN_SEARCH_MASK      = (((1 << (VLAN_SEARCH_MAX + 1)) - 1) ^
+                         ((1 << VLAN_SEARCH_MIN) - 1))
+
+def VLAN_BITMAP_LOWEST(bitmap):
+    ''' Returns the lowest VLAN set in bitmap, None if bitmap is empty. '''
+    if bitmap == 0:
+        return None
+    return (bitmap & -bitmap).bit_length() - 1
+
+def VLAN_BITMAP_TO_LIST(bitmap):
+    ''' Returns a sorted list of all VLANs set in bitmap. '''
+    vlans = []
+    while bitmap:
+        lowest = bitmap & -bitmap
+        vlans.append(lowest.bit_length() - 1)
+        bitmap ^= lowest
+    return vlans
+
 
 def TOPO_TYPE_TO_STRING(typenum):
     if typenum == NODE_SWITCH:
@@ -66,6 +105,31 @@ class TopologyManagerTypeError(TypeError):
 class TopologyManagerValueError(ValueError):
     pass
 
+class TopologyManagerConflictError(TopologyManagerError):
+    ''' Resources chosen from an out of date snapshot can't be reserved. '''
+    pass
+
+
+class TopologySnapshot(object):
+    ''' The topology and its reservation state as of a given version of the
+        TopologyManager. Snapshots from get_snapshot() are copies that never 
+        change, so they can be searched without holding the topolock: the 
+        graph is frozen, and the rest must be treated as read-only. '''
+    def __init__(self, version, topo, node_vlans_in_use, edge_vlans_in_use,
+                 bw_calendar, vlan_calendar):
+        self.version = version
+        self.topo = topo
+        self.node_vlans_in_use = node_vlans_in_use
+        self.edge_vlans_in_use = edge_vlans_in_use
+        self.bw_calendar = bw_calendar
+        self.vlan_calendar = vlan_calendar
+
+    def get_version(self):
+        return self.version
+
+    def get_topology(self):
+        return self.topo
+
 class TopologyManager(AtlanticWaveManager):
     ''' The TopologyManager handles the topology of the network. Initially, this
         will be very simple, as there will only be three switches, and ~100 
@@ -85,11 +149,54 @@ class TopologyManager(AtlanticWaveManager):
         self.topo = nx.Graph()
         self.lcs = []         # This probably should end up as a list of dicts.
 
-        # Initialize topology lock.
-        self.topolock = Lock()
+        # Initialize topology lock. Reentrant, so that several resources can
+        # be reserved atomically, see reserve_resources().
+        self.topolock = RLock()
+
+        # Version of the topology and reservations, incremented on every
+        # change, and the latest snapshot, see get_snapshot().
+        self.version = 0
+        self._snapshot = None
+        self._snapshot_topo = None
 
         # So we don't have to parse VLANs over an over again
         self._cached_vlans = {}
+        self._cached_vlan_bitmaps = {}
+
+        # VLAN index: bitmaps of VLANs in use on each node, and on each edge,
+        # keyed by node name and by _edge_key() respectively. This is the
+        # authoritative record of VLAN reservations; the 'vlans_in_use' lists
+        # on the topology are kept in step for reporting.
+        self._node_vlans_in_use = {}
+        self._edge_vlans_in_use = {}
+
+        # Steiner tree cache: frozenset of edges pruned for lack of bandwidth
+        # -> MetricClosure over the topology without those edges. Only valid
+        # for steiner_cache_topo, and emptied whenever the topology changes.
+        self.steiner_cache = {}
+        self.steiner_cache_topo = None
+
+        # Next hop cache: (frozenset of tree edges or None, destination) -> 
+        # next hop table, see get_next_hops(). Only valid for 
+        # next_hop_cache_topo, and emptied whenever the topology changes.
+        self.next_hop_cache = {}
+        self.next_hop_cache_topo = None
+
+        # Path search limits, see find_valid_path()
+        self.path_k = DEFAULT_PATH_K
+        self.path_max_hops = DEFAULT_PATH_MAX_HOPS
+
+        # Reservation calendars. Bandwidth is booked per edge, keyed by 
+        # _edge_key(), and VLANs per node and per edge, over the lifetime of 
+        # the rules using them. Bookings are made when rules are submitted, 
+        # so rules that start in the future can't be overbooked. What is 
+        # reserved right now is tracked separately, as above.
+        self.bw_calendar = BandwidthCalendar()
+        self.vlan_calendar = VLANCalendar()
+        # Per-thread state: the window that availability is checked over, 
+        # see set_reservation_window(), and the snapshot searched, see 
+        # pin_snapshot().
+        self._local = local()
 
         # Last modified timestamp
         now = datetime.now()
@@ -107,8 +214,76 @@ class TopologyManager(AtlanticWaveManager):
     def get_topology(self):
         ''' Returns the topology with all details. 
             This is a NetworkX graph:
-            https://networkx.readthedocs.io/en/stable/reference/index.html '''
+            https://networkx.readthedocs.io/en/stable/reference/index.html 
+            If this thread has a snapshot pinned, this is the snapshot's frozen
+            copy of the topology, otherwise it is the live topology. '''
+        snapshot = getattr(self._local, 'snapshot', None)
+        if snapshot != None:
+            return snapshot.topo
         return self.topo
+
+    def get_version(self):
+        ''' Returns the current version of the topology and reservations. '''
+        return self.version
+
+    def _changed(self):
+        ''' Called with the topolock held after any change to the topology or
+            reservations. '''
+        self.version += 1
+
+    def get_snapshot(self):
+        ''' Returns a TopologySnapshot of the current topology and 
+            reservations. Snapshots are only copied when something has changed
+            since the last one. The copies share as much as they can with the
+            live state: attribute values of the graph, which are replaced 
+            rather than changed in place, and the calendars' unchanged keys. '''
+        with self.topolock:
+            if (self._snapshot == None or
+                self._snapshot.version != self.version or
+                self._snapshot_topo is not self.topo):
+                topo = self._copy_graph(self.topo)
+                nx.freeze(topo)
+                self._snapshot = TopologySnapshot(
+                    self.version, topo,
+                    dict(self._node_vlans_in_use),
+                    dict(self._edge_vlans_in_use),
+                    self.bw_calendar.copy(),
+                    self.vlan_calendar.copy())
+                self._snapshot_topo = self.topo
+            return self._snapshot
+
+    def _copy_graph(self, graph):
+        ''' Copies graph and its attribute dictionaries, but not the values in
+            them, unlike Graph.copy()'s deepcopy. '''
+        new = graph.__class__()
+        new.graph.update(graph.graph)
+        new.add_nodes_from(graph.nodes_iter(data=True))
+        new.add_edges_from(graph.edges_iter(data=True))
+        return new
+
+    def pin_snapshot(self, snapshot):
+        ''' Until unpin_snapshot() is called, get_topology() and searches for
+            paths, trees and VLANs in this thread use snapshot, without taking
+            the topolock, rather than the live topology. Reservations are still
+            made on the live topology. '''
+        self._local.snapshot = snapshot
+
+    def unpin_snapshot(self):
+        self._local.snapshot = None
+
+    @contextmanager
+    def _read_view(self):
+        ''' Yields a TopologySnapshot to search: the pinned snapshot, or the
+            live state, with the topolock held. '''
+        snapshot = getattr(self._local, 'snapshot', None)
+        if snapshot != None:
+            yield snapshot
+            return
+        with self.topolock:
+            yield TopologySnapshot(self.version, self.topo,
+                                   self._node_vlans_in_use,
+                                   self._edge_vlans_in_use,
+                                   self.bw_calendar, self.vlan_calendar)
     
     def get_lcs(self):
         ''' Returns the list of valid LocalControllers. '''
@@ -142,10 +317,16 @@ class TopologyManager(AtlanticWaveManager):
 
     def _call_topology_update_callbacks(self, change):
         ''' FIXME: This isn't used yet. ''' 
+        self._invalidate_steiner_cache()
+        self._invalidate_next_hop_cache()
         for cb in self.topology_update_callbacks:
             cb(change)
 
     def _import_topology(self, manifest_filename):
+        self._invalidate_steiner_cache()
+        self._invalidate_next_hop_cache()
+        with self.topolock:
+            self._changed()
         with open(manifest_filename) as data_file:
             data = json.load(data_file)
 
@@ -166,6 +347,7 @@ class TopologyManager(AtlanticWaveManager):
                     self.topo.node[key][k] = str(endpoint[k])
                 # Add other required fields to the endpoitn dict
                 self.topo.node[key]['vlans_in_use'] = []
+                self._node_vlans_in_use[key] = 0
                     
 
         for key in data['localcontrollers'].keys():
@@ -227,6 +409,7 @@ class TopologyManager(AtlanticWaveManager):
 
                     # Other fields that may be of use
                     self.topo.node[name]['vlans_in_use'] = []
+                    self._node_vlans_in_use[name] = 0
 
                     self.topo.node[name]['internalconfig'] = switchinfo['internalconfig']
 
@@ -248,6 +431,8 @@ class TopologyManager(AtlanticWaveManager):
                         # Other fields that may be of use
                         self.topo.edge[name][destination]['vlans_in_use'] = []
                         self.topo.edge[name][destination]['bw_in_use'] = 0
+                        self._edge_vlans_in_use[self._edge_key(name,
+                                                    destination)] = 0
 
                         # VLANs available
                         if 'available_vlans' in port.keys():
@@ -266,19 +451,39 @@ class TopologyManager(AtlanticWaveManager):
     # -----------------
 
     def check_vlan_available(self, vlan_str, vlan):
-        if vlan_str not in self._cached_vlans.keys():
-            self._parse_available_vlans(vlan_str)
-        valid_vlans = self._cached_vlans[vlan_str]
-
-        return vlan in valid_vlans        
+        return bool((self._get_vlan_bitmap(vlan_str) >> vlan) & 1)
 
     def get_available_vlan_list(self, vlan_str):
         if vlan_str not in self._cached_vlans.keys():
-            self._parse_available_vlans(vlan_str)
+            self._cached_vlans[vlan_str] = VLAN_BITMAP_TO_LIST(
+                self._get_vlan_bitmap(vlan_str))
         return self._cached_vlans[vlan_str]
-    
+
+    def _get_vlan_bitmap(self, vlan_str):
+        ''' Returns the bitmap of VLANs described by vlan_str, such as 
+            "1-100,200". Parsed bitmaps are cached. '''
+        if vlan_str not in self._cached_vlan_bitmaps:
+            self._parse_available_vlans(vlan_str)
+        return self._cached_vlan_bitmaps[vlan_str]
+
+    def _edge_key(self, node, nextnode):
+        ''' Edges are undirected: (a,b) and (b,a) share an index entry. '''
+        if node < nextnode:
+            return (node, nextnode)
+        return (nextnode, node)
+
+    def get_vlans_available_on_edge(self, node, nextnode):
+        ''' Returns the bitmap of VLANs that are both allowed on the edge 
+            between node and nextnode and not currently reserved on it. '''
+        with self.topolock:
+            available = self._get_vlan_bitmap(
+                self.topo.edge[node][nextnode]['available_vlans'])
+            in_use = self._edge_vlans_in_use.get(self._edge_key(node,
+                                                                nextnode), 0)
+            return available & ~in_use
+
     def _parse_available_vlans(self, vlan_str):
-        valid_vlans = []
+        bitmap = 0
         ranges = vlan_str.split(",")
         for r in ranges:
             r_parts = r.split("-")
@@ -291,7 +496,7 @@ class TopologyManager(AtlanticWaveManager):
                     raise TopologyManagerValueError(
                         "Available VLAN out of range: %s" %
                         r_parts[0])
-                valid_vlans.append(int(r_parts[0]))
+                bitmap |= 1 << int(r_parts[0])
             elif len(r_parts) == 2:
                 low = int(r_parts[0])
                 high = int(r_parts[1])
@@ -316,10 +521,68 @@ class TopologyManager(AtlanticWaveManager):
                         "Available VLANs out of order: %s-%s" %
                         (low, high))
 
-                for x in range(low, high+1):
-                    valid_vlans.append(x)
-
-        self._cached_vlans[vlan_str] = valid_vlans
+                bitmap |= ((1 << (high + 1)) - 1) ^ ((1 << low) - 1)
+
+        self._cached_vlan_bitmaps[vlan_str] = bitmap
+
+    def set_reservation_window(self, start, stop):
+        ''' Until clear_reservation_window() is called, searches for paths, 
+            trees and VLANs in this thread only use resources that are free 
+            from start until stop, in seconds since the epoch, as booked in the
+            reservation calendars. start of None is now, stop of None is 
+            forever. Without a window, only what is reserved now counts. '''
+        if start == None:
+            start = time()
+        if stop == None:
+            stop = FOREVER
+        self._local.interval = (start, stop)
+
+    def clear_reservation_window(self):
+        self._local.interval = None
+
+    def _get_window(self):
+        ''' Returns (start, stop, includes now) for this thread's window, or 
+            None. '''
+        interval = getattr(self._local, 'interval', None)
+        if interval == None:
+            return None
+        (start, stop) = interval
+        return (start, stop, start <= time() < stop)
+
+    def _get_bw_in_use(self, view, node, nextnode):
+        ''' Bandwidth in use on an edge of view, from _read_view(), now or 
+            over the reservation window. '''
+        in_use = view.topo.edge[node][nextnode]['bw_in_use']
+        window = self._get_window()
+        if window == None:
+            return in_use
+        (start, stop, now) = window
+        booked = view.bw_calendar.get_reserved(self._edge_key(node, nextnode),
+                                               start, stop)
+        if now:
+            return max(in_use, booked)
+        return booked
+
+    def _get_vlans_in_use(self, view, key, in_use):
+        ''' VLAN bitmap in use on a node or _edge_key() of view, now or over
+            the reservation window. in_use is what is in use now. '''
+        window = self._get_window()
+        if window == None:
+            return in_use
+        (start, stop, now) = window
+        booked = view.vlan_calendar.get_reserved(key, start, stop)
+        if now:
+            return in_use | booked
+        return booked
+
+    def _get_node_vlans_in_use(self, view, node):
+        return self._get_vlans_in_use(view, node,
+                                      view.node_vlans_in_use.get(node, 0))
+
+    def _get_edge_vlans_in_use(self, view, node, nextnode):
+        key = self._edge_key(node, nextnode)
+        return self._get_vlans_in_use(view, key,
+                                      view.edge_vlans_in_use.get(key, 0))
 
     def reserve_bw(self, node_pairs, bw):        
         ''' Generic method for reserving bandwidth based on pairs of nodes. '''
@@ -338,6 +601,7 @@ class TopologyManager(AtlanticWaveManager):
             # Add bandwidth reservation
             for (node, nextnode) in node_pairs:
                 self.topo.edge[node][nextnode]['bw_in_use'] += bw
+            self._changed()
 
     def unreserve_bw(self, node_pairs, bw):
         ''' Generic method for removing bw reservation based on pairs of nodes. 
@@ -354,6 +618,7 @@ class TopologyManager(AtlanticWaveManager):
             # Remove bw from path
             for (node, nextnode) in node_pairs:
                 self.topo.edge[node][nextnode]['bw_in_use'] -= bw
+            self._changed()
 
     def reserve_vlan(self, nodes, node_pairs, vlan):
         ''' Generic method for reserving VLANs on given nodes and paths based on
@@ -363,45 +628,68 @@ class TopologyManager(AtlanticWaveManager):
         # FIXME: This probably has some issues with concurrency.
         self.dlogger.debug("reserve_vlan: %s, %s" % (vlan, node_pairs))
         with self.topolock:
+            vlan_bit = 1 << vlan
+            edge_keys = [self._edge_key(node, nextnode)
+                         for (node, nextnode) in node_pairs]
+
             # Make sure the path is clear -> very similar to find_vlan_on_path
             for node in nodes:
-                print "\nself.topo.node[%s]: %s\n" % (node, self.topo.node[node])
-                if vlan in self.topo.node[node]['vlans_in_use']:
+                if self._node_vlans_in_use.get(node, 0) & vlan_bit:
                     raise TopologyManagerError("VLAN %d is already reserved on node %s" % (vlan, node))
 
-            for (node, nextnode) in node_pairs:
-                if vlan in self.topo.edge[node][nextnode]['vlans_in_use']:
-                    raise TopologyManagerError("VLAN %d is already reserved on path %s:%s" % (vlan, node, nextnode))                    
+            for key in edge_keys:
+                if self._edge_vlans_in_use.get(key, 0) & vlan_bit:
+                    raise TopologyManagerError("VLAN %d is already reserved on path %s:%s" % (vlan, key[0], key[1]))
 
-            # Walk through the nodess and reserve it
+            # Walk through the nodess and reserve it. vlans_in_use lists are
+            # shared with snapshots, so they're replaced, not changed in place.
             for node in nodes:
-                self.topo.node[node]['vlans_in_use'].append(vlan)
+                self._node_vlans_in_use[node] = (
+                    self._node_vlans_in_use.get(node, 0) | vlan_bit)
+                attrs = self.topo.node[node]
+                attrs['vlans_in_use'] = attrs['vlans_in_use'] + [vlan]
 
             # Walk through the edges and reserve it
-            for (node, nextnode) in node_pairs:
-                self.topo.edge[node][nextnode]['vlans_in_use'].append(vlan)
+            for key in edge_keys:
+                self._edge_vlans_in_use[key] = (
+                    self._edge_vlans_in_use.get(key, 0) | vlan_bit)
+                attrs = self.topo.edge[key[0]][key[1]]
+                attrs['vlans_in_use'] = attrs['vlans_in_use'] + [vlan]
+            self._changed()
     
     def unreserve_vlan(self, nodes, node_pairs, vlan):
         ''' Generic method for unreserving VLANs on given nodes and paths based 
             on nodes and pairs of nodes. '''
         self.dlogger.debug("unreserve_vlan: %s, %s" % (vlan, node_pairs))
         with self.topolock:
+            vlan_bit = 1 << vlan
+            edge_keys = [self._edge_key(node, nextnode)
+                         for (node, nextnode) in node_pairs]
+
             # Make sure it's already reserved on the given path:
             for node in nodes:
-                if vlan not in self.topo.node[node]['vlans_in_use']:
+                if not self._node_vlans_in_use.get(node, 0) & vlan_bit:
                     raise TopologyManagerError("VLAN %d is not reserved on node %s" % (vlan, node))
 
-            for (node, nextnode) in node_pairs:
-                if vlan not in self.topo.edge[node][nextnode]['vlans_in_use']:
-                    raise TopologyManagerError("VLAN %d is not reserved on path %s:%s" % (vlan, node, nextnode))
+            for key in edge_keys:
+                if not self._edge_vlans_in_use.get(key, 0) & vlan_bit:
+                    raise TopologyManagerError("VLAN %d is not reserved on path %s:%s" % (vlan, key[0], key[1]))
 
-            # Walk through the nodes and unreserve it
+            # Walk through the nodes and unreserve it. Replaced, not changed
+            # in place, see reserve_vlan().
             for node in nodes:
-                self.topo.node[node]['vlans_in_use'].remove(vlan)
+                self._node_vlans_in_use[node] &= ~vlan_bit
+                attrs = self.topo.node[node]
+                attrs['vlans_in_use'] = [v for v in attrs['vlans_in_use']
+                                         if v != vlan]
 
             # Walk through the edges and unreserve it
-            for (node, nextnode) in node_pairs:
-                self.topo.edge[node][nextnode]['vlans_in_use'].remove(vlan)
+            for key in edge_keys:
+                self._edge_vlans_in_use[key] &= ~vlan_bit
+                attrs = self.topo.edge[key[0]][key[1]]
+                attrs['vlans_in_use'] = [v for v in attrs['vlans_in_use']
+                                         if v != vlan]
+            self._changed()
 
     def reserve_resource(self, resource):
         ''' Reserve the requested resource. '''
@@ -456,7 +744,150 @@ class TopologyManager(AtlanticWaveManager):
             raise TopologyManagerTypeError(
                 "%s is not a valid resource to unreserve. %s" % (
                 type(resource), resource))
+
+    def reserve_resources(self, resources, version=None):
+        ''' Reserves a list of resources atomically: if any of them can't be
+            reserved, none are, and the error is raised. version is that of 
+            the snapshot the resources were chosen from, if any. If there have
+            been changes since, the resources are still reserved if they are 
+            available, but if they aren't, a TopologyManagerConflictError is 
+            raised, as choosing them again from a new snapshot may succeed. '''
+        with self.topolock:
+            current = self.version
+            reserved = []
+            try:
+                for resource in resources:
+                    self.reserve_resource(resource)
+                    reserved.append(resource)
+            except TopologyManagerError as e:
+                for resource in reserved:
+                    self.unreserve_resource(resource)
+                self._check_conflict(version, current, e)
+                raise
+
+    def _check_conflict(self, version, current, e):
+        ''' Raises a TopologyManagerConflictError for e if version isn't
+            current. '''
+        if version != None and version != current:
+            raise TopologyManagerConflictError(
+                "Topology changed from version %d to %d: %s" %
+                (version, current, e))
                 
+    def _get_bookings(self, resource):
+        ''' Returns a list of (calendar, key, amount, capacity) for what 
+            resource needs booked. capacity is None for VLANs. '''
+        if isinstance(resource, VLANPortResource):
+            neighbor = self.get_switch_port_neighbor(resource.get_switch(),
+                                                     resource.get_port())
+            nodes = []
+            edges = []
+            if neighbor != None:
+                edges = [(resource.get_switch(), neighbor)]
+        elif isinstance(resource, VLANPathResource):
+            nodes = resource.get_path()
+            edges = zip(nodes[0:-1], nodes[1:])
+        elif isinstance(resource, VLANTreeResource):
+            nodes = resource.get_tree().nodes()
+            edges = resource.get_tree().edges()
+        elif isinstance(resource, BandwidthPortResource):
+            neighbor = self.get_switch_port_neighbor(resource.get_switch(),
+                                                     resource.get_port())
+            edges = []
+            if neighbor != None:
+                edges = [(resource.get_switch(), neighbor)]
+        elif isinstance(resource, BandwidthPathResource):
+            path = resource.get_path()
+            edges = zip(path[0:-1], path[1:])
+        elif isinstance(resource, BandwidthTreeResource):
+            edges = resource.get_tree().edges()
+        else:
+            raise TopologyManagerTypeError(
+                "%s is not a valid resource to book. %s" % (
+                type(resource), resource))
+
+        if isinstance(resource, (VLANPortResource, VLANPathResource,
+                                 VLANTreeResource)):
+            vlan_bit = 1 << resource.get_vlan()
+            return ([(self.vlan_calendar, node, vlan_bit, None)
+                     for node in nodes] +
+                    [(self.vlan_calendar, self._edge_key(node, nextnode),
+                      vlan_bit, None) for (node, nextnode) in edges])
+        bw = resource.get_bandwidth()
+        return [(self.bw_calendar, self._edge_key(node, nextnode), bw,
+                 int(self.topo.edge[node][nextnode]['weight']))
+                for (node, nextnode) in edges]
+
+    def _book(self, resources, start, stop, check_only, version=None):
+        current = self.version
+        booked = []
+        try:
+            for resource in resources:
+                for (calendar, key, amount, capacity) in \
+                        self._get_bookings(resource):
+                    reserved = calendar.get_reserved(key, start, stop)
+                    if capacity == None and reserved & amount:
+                        raise TopologyManagerError(
+                            "%s is already booked on %s between %s and %s" %
+                            (resource, key, start, stop))
+                    elif capacity != None and reserved + amount > capacity:
+                        raise TopologyManagerError(
+                            "BW booked on %s between %s and %s is %s of %s, "
+                            "cannot book %s for %s" %
+                            (key, start, stop, reserved, capacity, amount,
+                             resource))
+                    calendar.reserve(key, start, stop, amount)
+                    booked.append((calendar, key, amount))
+        except TopologyManagerError as e:
+            for (calendar, key, amount) in booked:
+                calendar.release(key, start, stop, amount)
+            self._check_conflict(version, current, e)
+            raise
+        except:
+            for (calendar, key, amount) in booked:
+                calendar.release(key, start, stop, amount)
+            raise
+        # Checks are made by booking then releasing, so that resources used 
+        # twice by the same rule are caught.
+        if check_only:
+            for (calendar, key, amount) in booked:
+                calendar.release(key, start, stop, amount)
+        elif len(booked) > 0:
+            self._changed()
+
+    def book_resources(self, resources, start, stop, version=None):
+        ''' Books a list of resources in the reservation calendars from start
+            until stop, in seconds since the epoch. stop of None is forever.
+            Raises a TopologyManagerError, and books nothing, if any of them 
+            are already booked at any time in that interval. version is as 
+            for reserve_resources(). '''
+        if stop == None:
+            stop = FOREVER
+        self.dlogger.debug("book_resources: %s-%s %s" % (start, stop,
+                                                         resources))
+        with self.topolock:
+            self._book(resources, start, stop, False, version)
+
+    def check_resources(self, resources, start, stop):
+        ''' Same as book_resources(), without booking anything. '''
+        if stop == None:
+            stop = FOREVER
+        with self.topolock:
+            self._book(resources, start, stop, True)
+
+    def cancel_resources(self, resources, start, stop):
+        ''' Releases bookings made by book_resources() with the same 
+            parameters. '''
+        if stop == None:
+            stop = FOREVER
+        self.dlogger.debug("cancel_resources: %s-%s %s" % (start, stop,
+                                                           resources))
+        with self.topolock:
+            for resource in resources:
+                for (calendar, key, amount, capacity) in \
+                        self._get_bookings(resource):
+                    calendar.release(key, start, stop, amount)
+            self._changed()
+
     # --------------
     # Path functions
     # --------------
@@ -490,89 +921,114 @@ class TopologyManager(AtlanticWaveManager):
             the submitted path.
         '''
         self.dlogger.debug("find_vlan_on_path: %s" % path)
-        selected_vlan = None
-        with self.topolock:
-            for vlan in range(1,4089):
-                # Check each point on the path
-                on_path = False
-                for point in path:
-                    if self.topo.node[point]["type"] == "switch":
-                        if vlan in self.topo.node[point]['vlans_in_use']:
-                            on_path = True
-                            break
-                if on_path:
-                    continue
-
-                # Check each edge on the path
-                for (node, nextnode) in zip(path[0:-1], path[1:]):
-                    if vlan in self.topo.edge[node][nextnode]['vlans_in_use']:
-                        on_path = True
-                        break
-                    if vlan not in self.get_available_vlan_list(
-                            self.topo.edge[node][nextnode]['available_vlans']):
-                        on_path = True
-                        break
-                    
-                if on_path:
-                    continue
+        with self._read_view() as view:
+            free = VLAN_SEARCH_MASK
+            # Remove VLANs in use on each switch on the path
+            for point in path:
+                if view.topo.node[point]["type"] == "switch":
+                    free &= ~self._get_node_vlans_in_use(view, point)
+
+            # Remove VLANs in use or not available on each edge on the path
+            for (node, nextnode) in zip(path[0:-1], path[1:]):
+                free &= ~self._get_edge_vlans_in_use(view, node, nextnode)
+                free &= self._get_vlan_bitmap(
+                    view.topo.edge[node][nextnode]['available_vlans'])
+                if free == 0:
+                    break
 
-                # If all good, set selected_vlan
-                selected_vlan = vlan
-                break
+            selected_vlan = VLAN_BITMAP_LOWEST(free)
             
         self.dlogger.debug("find_vlan_on_path returning %s" % selected_vlan)
         return selected_vlan
 
-    def find_valid_path(self, src, dst, bw=None, ignore_endpoints=False):
+    def find_valid_path(self, src, dst, bw=None, ignore_endpoints=False,
+                        k=None, max_hops=None):
         ''' Find a path that is currently valid based on a contstraint. 
-            Right now, the only constraint is bandwidth. 
+            The constraints are bandwidth, and a VLAN that's free along the 
+            whole path. Edges that fail either are pruned before searching, 
+            then up to k loop-free paths are tried, shortest (in hops) first, 
+            until one has a common free VLAN. Paths longer than max_hops are 
+            not tried. k and max_hops default to self.path_k and 
+            self.path_max_hops.
             ignore_endpoints is for ignoring the path all the way to the 
             endpoints themselves when checking constraints, and just verifying
             at all other points. Returns stripped path (all middle points). This
             is for cases when there *could* be multiple paths from a given 
-            endpoint, we don't want to artifically restrict possible paths. '''
-
-        # Get possible paths
-        #FIXME: NetworkX has multiple methods for getting paths. Shortest and
-        # all possible paths:
-        # https://networkx.readthedocs.io/en/stable/reference/generated/networkx.algorithms.shortest_paths.generic.all_shortest_paths.html
-        # https://networkx.readthedocs.io/en/stable/reference/generated/networkx.algorithms.simple_paths.all_simple_paths.html
-        # May need to use *both* algorithms. Starting with shortest paths now.
+            endpoint, we don't want to artifically restrict possible paths.
+            Returns None if there is no valid path. '''
+        if k == None:
+            k = self.path_k
+        if max_hops == None:
+            max_hops = self.path_max_hops
         self.dlogger.debug("find_valid_path: %s, %s, %s" % (bw, src, dst))
-        list_of_paths = nx.all_shortest_paths(self.topo,
-                                              source=src,
-                                              target=dst)
-
-        for path in list_of_paths:
-            # For each path, check that a VLAN is available
-            if ignore_endpoints:
-                path = path[1:-1]
-            vlan = self.find_vlan_on_path(path)
-            if vlan == None:
-                continue
-            
-            self.dlogger.debug("find_valid_path found path %s has valid VLANs" %
-                                   path)
-            enough_bw = True
-            for (node, nextnode) in zip(path[0:-1], path[1:]):
-                # For each edge on the path, check that bw is available.
-                bw_in_use = self.topo.edge[node][nextnode]['bw_in_use']
-                bw_available = int(self.topo.edge[node][nextnode]['weight'])
 
-                if (bw_in_use + bw) > bw_available:
-                    enough_bw = False
+        unconstrained = []
+        if ignore_endpoints:
+            unconstrained = [src, dst]
+        view = self._get_constrained_view(bw, unconstrained)
+
+        try:
+            count = 0
+            for path in nx.shortest_simple_paths(view, src, dst):
+                count += 1
+                if count > k or (max_hops != None and 
+                                 len(path) - 1 > max_hops):
                     break
-                
-            # If all's good, return the path to the caller
-            if enough_bw:
-                self.dlogger.debug("find_valid_path found path has bw %s" %
-                                   path)
-                return path
+                if ignore_endpoints:
+                    path = path[1:-1]
+                if self._get_path_vlans(view, path) != 0:
+                    self.dlogger.debug("find_valid_path found path %s, try %d"
+                                       % (path, count))
+                    return path
+        except nx.exception.NetworkXNoPath:
+            pass
         
         # No path return
         self.dlogger.debug("find_valid_path found no path")
         return None
 
+    def _get_constrained_view(self, bw, unconstrained):
+        ''' Returns a copy of the topology without the edges that don't have 
+            bw available, or that have no VLAN free. Edges touching nodes in 
+            unconstrained are kept regardless. Each edge and node of the copy
+            has a 'vlans' bitmap of the VLANs free on it. '''
+        view = nx.Graph()
+        with self._read_view() as topo_view:
+            topo = topo_view.topo
+            for node in topo.nodes_iter():
+                free = VLAN_SEARCH_MASK
+                if topo.node[node].get("type") == "switch":
+                    free &= ~self._get_node_vlans_in_use(topo_view, node)
+                view.add_node(node, vlans=free)
+
+            for (node, nextnode, data) in topo.edges_iter(data=True):
+                if node in unconstrained or nextnode in unconstrained:
+                    view.add_edge(node, nextnode, vlans=VLAN_SEARCH_MASK)
+                    continue
+                if (bw != None and
+                    (self._get_bw_in_use(topo_view, node, nextnode) + bw) >
+                    int(data['weight'])):
+                    continue
+                free = (self._get_vlan_bitmap(data['available_vlans']) &
+                        ~self._get_edge_vlans_in_use(topo_view, node,
+                                                     nextnode) &
+                        view.node[node]['vlans'] &
+                        view.node[nextnode]['vlans'])
+                if free == 0:
+                    continue
+                view.add_edge(node, nextnode, vlans=free)
+        return view
+
+    def _get_path_vlans(self, view, path):
+        ''' Returns the bitmap of VLANs free along all of path in view, a 
+            graph from _get_constrained_view(). '''
+        free = VLAN_SEARCH_MASK
+        for node in path:
+            free &= view.node[node]['vlans']
+        for (node, nextnode) in zip(path[0:-1], path[1:]):
+            free &= view.edge[node][nextnode]['vlans']
+        return free
+
     
     # --------------
     # Tree functions
@@ -604,97 +1060,147 @@ class TopologyManager(AtlanticWaveManager):
             used at the moment on a provivded path. Returns an available VLAN if
             possible, None if none are available on the submitted tree. '''
         self.dlogger.debug("find_vlan_on_tree: %s" % tree.nodes()) 
-        selected_vlan = None
-        with self.topolock:
-            for vlan in range(1,4089):
-                # Check each point on the path
-                on_path = False
-                for node in tree.nodes():
-                    if self.topo.node[node]["type"] == "switch":
-                        if vlan in self.topo.node[node]['vlans_in_use']:
-                            on_path = True
-                            break
-                    
-                if on_path:
-                    continue
-
-                # Check each edge on the path
-                for (node, nextnode) in tree.edges():
-                    if vlan in self.topo.edge[node][nextnode]['vlans_in_use']:
-                        on_path = True
-                        break
-                    
-                if on_path:
-                    continue
+        with self._read_view() as view:
+            free = VLAN_SEARCH_MASK
+            # Remove VLANs in use on each switch on the tree
+            for node in tree.nodes():
+                if view.topo.node[node]["type"] == "switch":
+                    free &= ~self._get_node_vlans_in_use(view, node)
+
+            # Remove VLANs in use on each edge on the tree
+            for (node, nextnode) in tree.edges():
+                free &= ~self._get_edge_vlans_in_use(view, node, nextnode)
 
-                # If all good, set selected_vlan
-                selected_vlan = vlan
-                break
+            selected_vlan = VLAN_BITMAP_LOWEST(free)
 
         self.dlogger.debug("find_vlan_on_tree returning %s" % selected_vlan)
         return selected_vlan
 
+    def _invalidate_steiner_cache(self):
+        ''' Drops all cached metric closures. Called on topology changes. '''
+        self.steiner_cache = {}
+        self.steiner_cache_topo = None
+
+    def _get_steiner_closure(self, bw):
+        ''' Returns a MetricClosure over a view of the topology without the 
+            edges that don't have bw available, and whether it was cached. 
+            The view is a separate graph: the topology is never modified. 
+            Snapshots have the same edge weights as the live topology, so the
+            cache is shared by both. '''
+        with self._read_view() as topo_view:
+            topo = topo_view.topo
+            pruned = []
+            if bw is not None:
+                for (node, nextnode, data) in topo.edges_iter(data=True):
+                    if ((self._get_bw_in_use(topo_view, node, nextnode) + bw) >
+                        int(data['weight'])):
+                        pruned.append(self._edge_key(node, nextnode))
+            pruned = frozenset(pruned)
+
+        with self.topolock:
+            # Tests, and topology imports, may replace self.topo outright.
+            if self.steiner_cache_topo is not self.topo:
+                self._invalidate_steiner_cache()
+                self.steiner_cache_topo = self.topo
+
+            if pruned in self.steiner_cache:
+                return self.steiner_cache[pruned], True
+
+            if len(pruned) == 0:
+                view = topo
+            else:
+                view = nx.Graph()
+                view.add_nodes_from(topo)
+                for (node, nextnode, data) in topo.edges_iter(data=True):
+                    if self._edge_key(node, nextnode) not in pruned:
+                        view.add_edge(node, nextnode, weight=data['weight'])
+
+            if len(self.steiner_cache) >= STEINER_CACHE_SIZE:
+                self.steiner_cache = {}
+            closure = MetricClosure(view)
+            self.steiner_cache[pruned] = closure
+            return closure, False
+
     def find_valid_steiner_tree(self, nodes, bw=None):
         ''' Finds a Steiner tree connecting all the nodes in 'nodes' together. 
-            Uses a library containing Kou's algorithm to find one. 
+            Uses a library containing Kou's algorithm to find one. Edges 
+            without bw available are left out of the search, without touching
+            the topology itself, and shortest paths between nodes are reused
+            between calls until the topology changes.
             Returns a graph, from with .nodes() and .edges() can be used
-            to call other functions. '''
-
-        #FIXME: need to accomodate inability to find appropriate amount of
-        #bandwidth. Take existing topology, copy it, and delete the edge with
-        #a problem, then rerun Kou's algorithm.
-
+            to call other functions. The tree's 'cost' and 'time' graph 
+            attributes hold its total weight and the seconds taken to find it.
+            Returns None if there is no such tree. '''
         self.dlogger.debug("find_valid_steiner_tree: %s, %s" % (bw, nodes))
-        # Prime the topology to use
-        topo = self.topo
-        # Loop through, trying to make a valid Steiner tree that has available
-        # bandwidth. This will either return something valid, or will blow up
-        # due to a path not existing and will return nothing.
-        # timeout is a just-in-case measure
-        timeout = len(topo.edges())
-        while(timeout > 0):
-            timeout -= 1
+        start = time()
+        (closure, cached) = self._get_steiner_closure(bw)
+
+        try:
+            tree = make_steiner_tree(closure.G, nodes, closure=closure)
+        except ValueError:
+            raise
+        except nx.exception.NetworkXNoPath:
+            self.dlogger.debug("find_valid_steiner_tree: no tree with bw %s" %
+                               bw)
+            return None
+
+        tree.graph['cost'] = steiner_tree_cost(tree)
+        tree.graph['time'] = time() - start
+
+        # Check if VLAN is available
+        selected_vlan = self.find_vlan_on_tree(tree)
+        if selected_vlan == None:
+            #FIXME: how to handle this?
+            self.logger.error("find_valid_steiner_tree: Could not find VLAN, unhandled!")
+
+        # Has BW and VLAN available, return it.
+        self.dlogger.debug("find_valid_steiner_tree: Successful %s, cost %s, %f seconds, cached %s" %
+                           (tree.edges(), tree.graph['cost'],
+                            tree.graph['time'], cached))
+        return tree
             
-            try:
-                tree = make_steiner_tree(self.topo, nodes)
-                self.dlogger.debug("find_valid_steiner_tree: found %s" %
-                                   (tree.edges()))
+    # --------------------
+    # Forwarding functions
+    # --------------------
+
+    def _invalidate_next_hop_cache(self):
+        ''' Drops all cached next hop tables. Called on topology changes. '''
+        self.next_hop_cache = {}
+        self.next_hop_cache_topo = None
+
+    def get_next_hops(self, dst, tree=None):
+        ''' Returns a dictionary of node -> next node on a shortest path, in 
+            hops, from node to dst, for every node that can reach dst other 
+            than dst itself. If tree is given, only the tree's edges are used,
+            otherwise the whole topology is. The table is found with a single
+            breadth-first search from dst, so forwarding towards dst can be 
+            set up for every switch in one pass, and is cached until the 
+            topology changes. It is shared between callers: don't modify it. 
+        '''
+        if tree == None:
+            key = (None, dst)
+        else:
+            key = (frozenset(self._edge_key(node, nextnode)
+                             for (node, nextnode) in tree.edges()), dst)
 
-            except ValueError:
-                raise
-            except nx.exception.NetworkXNoPath:
-                #FIXME: log something here.
-                return None
+        with self.topolock:
+            # Tests, and topology imports, may replace self.topo outright.
+            if self.next_hop_cache_topo is not self.topo:
+                self._invalidate_next_hop_cache()
+                self.next_hop_cache_topo = self.topo
+            if key in self.next_hop_cache:
+                return self.next_hop_cache[key]
 
-            # Check if enough bandwidth is available
-            enough_bw = True
-            for (node, nextnode) in tree.edges():
-                # For each edge on the path, check that bw is available.
-                bw_in_use = self.topo.edge[node][nextnode]['bw_in_use']
-                bw_available = int(self.topo.edge[node][nextnode]['weight'])
+        if tree == None:
+            tree = self.get_topology()
+        next_hops = dict(nx.bfs_predecessors(tree, dst))
 
-                if bw is not None and (bw_in_use + bw) > bw_available:
-                    enough_bw = False
-                    # Remove the edge that doesn't have enough bw and try again
-                    topo.remove_edge(node, nextnode)
-                    break
-            if not enough_bw:
-                continue
-                
+        with self.topolock:
+            if len(self.next_hop_cache) >= NEXT_HOP_CACHE_SIZE:
+                self.next_hop_cache = {}
+            self.next_hop_cache[key] = next_hops
+        return next_hops
 
-            # Check if VLAN is available
-            selected_vlan = self.find_vlan_on_tree(tree)
-            if selected_vlan == None:
-                #FIXME: how to handle this?
-                self.logger.error("find_valid_steiner_tree: Could not find VLAN, unhandled!")
-                pass
- 
-
-            # Has BW and VLAN available, return it.
-            self.dlogger.debug("find_valid_steiner_tree: Successful %s" %
-                               tree.edges())
-            return tree
-            
     # -------------------
     # Port-only functions
     # -------------------
@@ -704,9 +1210,10 @@ class TopologyManager(AtlanticWaveManager):
             returns name of neighbor if exists, None if it doesn't.
         '''
         # Check if port is in use: loop through neighbors
-        for neighbor in self.topo[switchname].keys():
+        topo = self.get_topology()
+        for neighbor in topo[switchname].keys():
             # - if neighbor is using that port, good, we have a match
-            if self.topo[switchname][neighbor][switchname] == portnum:
+            if topo[switchname][neighbor][switchname] == portnum:
                 # --return neighbor name
                 return neighbor
         return None
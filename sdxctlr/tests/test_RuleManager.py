@@ -9,9 +9,12 @@ import threading
 import networkx as nx
 #import mock
 import dataset
+from time import sleep
+from datetime import datetime, timedelta
 
 from sdxctlr.RuleManager import *
 from shared.UserPolicy import *
+from shared.PathResource import *
 from sdxctlr.TopologyManager import TopologyManager
 
 
@@ -26,10 +29,15 @@ def rmhappy(param):
 class RuleStandin(object):
     def __init__(self, name):
         self.name = name
+        self.cookie = None
     def __str__(self):
         return "RuleStandin %s" % self.name
     def set_cookie(self, cookie):
-        return
+        self.cookie = cookie
+    def get_cookie(self):
+        return self.cookie
+    def get_switch_id(self):
+        return 1
 
 class UserPolicyStandin(UserPolicy):
     # Use the username as a return value for checking validity.
@@ -56,6 +64,10 @@ class UserPolicyStandin(UserPolicy):
                                         [RuleStandin("rule1"),
                                          RuleStandin("rule2")])]
         raise Exception("NO BREAKDOWN")
+
+    def switch_change_callback(self, tm, ai, data):
+        # data is the LC to send an extended breakdown to
+        return [UserPolicyBreakdown(data, [RuleStandin("extended")])]
     
     def _parse_json(self, json_rule):
         return
@@ -143,6 +155,68 @@ class GetRules(unittest.TestCase):
         self.failUnless(man.get_rules() != [])
 
 
+class AddRulesTest(unittest.TestCase):
+    def setUp(self):
+        self.topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        self.man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        self.added = []
+        self.man.set_send_add_rule(self.added.append)
+
+    def tearDown(self):
+        self.man.set_send_add_rule(rmhappy)
+
+    def test_best_effort(self):
+        before = len(self.man.get_rules())
+        rules = [UserPolicyStandin(True, True),
+                 UserPolicyStandin(False, True),
+                 UserPolicyStandin(True, True)]
+        results = self.man.add_rules(rules, atomic=False)
+
+        self.failUnlessEqual(len(results), 3)
+        self.failUnlessEqual(results[1][0], None)
+        self.failIfEqual(results[1][1], None)
+        for (hash, error) in [results[0], results[2]]:
+            self.failUnlessEqual(error, None)
+            self.failUnlessEqual(self.man.get_rules({'hash':hash})[0][4],
+                                 STATE_TO_STRING(ACTIVE_RULE))
+        self.failUnlessEqual(len(self.man.get_rules()), before + 2)
+
+        # One breakdown for the LC, with the LCRules of both rules
+        self.failUnlessEqual(len(self.added), 1)
+        self.failUnlessEqual(len(self.added[0].get_list_of_rules()), 4)
+
+        # Persisted
+        self.man._load_rule_cache()
+        self.failUnlessEqual(len(self.man.get_rules()), before + 2)
+        for (hash, error) in [results[0], results[2]]:
+            self.man.remove_rule(hash, "dummy_user")
+
+    def test_atomic(self):
+        before = len(self.man.get_rules())
+        rule_number = self.man.rule_number
+        rules = [UserPolicyStandin(True, True),
+                 UserPolicyStandin(True, False),
+                 UserPolicyStandin(True, True)]
+        results = self.man.add_rules(rules)
+
+        self.failUnlessEqual([h for (h, e) in results], [None, None, None])
+        self.failUnless("not broken down" in results[1][1])
+        self.failUnlessEqual(len(self.man.get_rules()), before)
+        self.failUnlessEqual(self.man.rule_number, rule_number)
+        self.failUnlessEqual(self.added, [])
+
+        # All good
+        results = self.man.add_rules([UserPolicyStandin(True, True),
+                                      UserPolicyStandin(True, True)])
+        self.failUnlessEqual([h for (h, e) in results],
+                             [rule_number + 1, rule_number + 2])
+        self.failUnlessEqual(
+            self.man.config_table.find_one(key='rule_number')['value'],
+            rule_number + 2)
+        for (hash, error) in results:
+            self.man.remove_rule(hash, "dummy_user")
+
+
 class RemoveAllRules(unittest.TestCase):
     def test_remove_all_rules(self):
         topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
@@ -159,6 +233,377 @@ class RemoveAllRules(unittest.TestCase):
         rules = man.get_rules()
         self.failUnless(man.get_rules() == [])
 
-        
+
+class RuleCacheTest(unittest.TestCase):
+    def test_indexes(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        valid_rule = UserPolicyStandin(True, True)
+
+        before = len(man.get_rules({'user':True}))
+        bd_before = len(man.get_breakdown_rules_by_LC("1.2.3.4"))
+        hash = man.add_rule(valid_rule)
+
+        rules = man.get_rules({'user':True, 'state':ACTIVE_RULE})
+        self.failUnless(hash in [r[0] for r in rules])
+        self.failUnlessEqual(len(man.get_rules({'user':True})), before + 1)
+        self.failUnlessEqual(man.get_rules({'hash':hash})[0][4],
+                             STATE_TO_STRING(ACTIVE_RULE))
+        self.failUnlessEqual(man.get_rules({'user':'nobody'}), [])
+        self.failUnlessEqual(len(man.get_breakdown_rules_by_LC("1.2.3.4")),
+                             bd_before + 2)
+        self.failUnlessEqual(man.get_breakdown_rules_by_LC("nolc"), [])
+        self.failUnlessEqual(len(man.get_rule_digest_by_LC("1.2.3.4")),
+                             bd_before + 2)
+        self.failUnlessEqual(len(man.get_rule_digest_by_LC("nolc")), 0)
+        self.failUnless(man.get_raw_rule(hash) is valid_rule)
+        # Hashes from URLs are strings
+        self.failUnless(man.get_raw_rule(str(hash)) is valid_rule)
+        self.failUnlessEqual(man.get_raw_rule("nope"), None)
+
+        man.remove_rule(hash, "dummy_user")
+        self.failUnlessEqual(len(man.get_rules({'user':True})), before)
+        self.failUnlessEqual(man.get_rules({'hash':hash}), [])
+        self.failUnlessEqual(len(man.get_breakdown_rules_by_LC("1.2.3.4")),
+                             bd_before)
+        self.failUnlessEqual(len(man.get_rule_digest_by_LC("1.2.3.4")),
+                             bd_before)
+
+    def test_ordering(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        man.add_rule(UserPolicyStandin(True, True))
+        man.add_rule(UserPolicyStandin(True, True))
+
+        hashes = [r[0] for r in man.get_rules(ordering='hash')]
+        self.failUnlessEqual(hashes, sorted(hashes))
+        hashes = [r[0] for r in man.get_rules(ordering='-hash')]
+        self.failUnlessEqual(hashes, sorted(hashes, reverse=True))
+        self.failUnlessRaises(RuleManagerValidationError,
+                              man.get_rules, {}, 'rule')
+        self.failUnlessRaises(RuleManagerValidationError,
+                              man.get_rules, {'rule':1})
+
+    def test_reload_from_db(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        man.add_rule(UserPolicyStandin(True, True))
+
+        rules = man.get_rules()
+        lc_rules = man.get_breakdown_rules_by_LC("1.2.3.4")
+        man._load_rule_cache()
+        self.failUnlessEqual([r[0] for r in man.get_rules()],
+                             [r[0] for r in rules])
+        self.failUnlessEqual(len(man.get_breakdown_rules_by_LC("1.2.3.4")),
+                             len(lc_rules))
+
+    def test_extended_breakdown(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        hash = man.add_rule(UserPolicyStandin(True, True))
+
+        man.change_callback_dispatch(hash, "5.6.7.8")
+        lc_rules = man.get_breakdown_rules_by_LC("5.6.7.8")
+        self.failUnlessEqual([str(r) for r in lc_rules],
+                             ["RuleStandin extended"])
+
+        # Extended breakdowns survive a reload
+        man._load_rule_cache()
+        self.failUnlessEqual(len(man.get_breakdown_rules_by_LC("5.6.7.8")), 1)
+
+        man.remove_rule(hash, "dummy_user")
+        self.failUnlessEqual(man.get_breakdown_rules_by_LC("5.6.7.8"), [])
+
+    def test_page(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        hashes = [man.add_rule(UserPolicyStandin(True, True))
+                  for i in range(5)]
+        after = hashes[0] - 1
+
+        (page, next) = man.get_rules_page(after=after, limit=2)
+        self.failUnlessEqual([r['hash'] for r in page], hashes[0:2])
+        self.failUnlessEqual(next, hashes[1])
+        self.failIf('json' in page[0])
+        self.failUnlessEqual(page[0]['state'], STATE_TO_STRING(ACTIVE_RULE))
+        (page, next) = man.get_rules_page(after=next, limit=2)
+        self.failUnlessEqual([r['hash'] for r in page], hashes[2:4])
+        (page, next) = man.get_rules_page(after=next, limit=2)
+        self.failUnlessEqual([r['hash'] for r in page], hashes[4:])
+        self.failUnlessEqual(next, None)
+
+        # Filtered and projected
+        man.remove_rule(hashes[1], "dummy_user")
+        (page, next) = man.get_rules_page({'user':True,
+                                           'state':ACTIVE_RULE},
+                                          after=after, limit=2,
+                                          fields=['hash', 'json'])
+        self.failUnlessEqual(page, [{'hash':hashes[0], 'json':True},
+                                    {'hash':hashes[2], 'json':True}])
+        (page, next) = man.get_rules_page({'user':'nobody'})
+        self.failUnlessEqual((page, next), ([], None))
+
+        self.failUnlessRaises(RuleManagerValidationError,
+                              man.get_rules_page, fields=['rule'])
+        self.failUnlessRaises(RuleManagerValidationError,
+                              man.get_rules_page, limit=0)
+        self.failUnlessRaises(RuleManagerValidationError,
+                              man.get_rules_page, starttime="yesterday")
+
+    def test_page_time_window(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        now = datetime.now()
+        def at(hours):
+            return (now + timedelta(hours=hours)).strftime(rfc3339format)
+        rule = UserPolicyStandin(True, True)
+        rule.start_time = at(10)
+        rule.stop_time = at(20)
+        hash = man.add_rule(rule)
+
+        def found(start, stop):
+            (page, next) = man.get_rules_page(after=hash - 1,
+                                              starttime=start, stoptime=stop)
+            return [r['hash'] for r in page] == [hash]
+        self.failUnless(found(at(15), at(16)))
+        self.failUnless(found(at(5), at(11)))
+        self.failUnless(found(None, at(11)))
+        self.failIf(found(at(1), at(10)))
+        self.failIf(found(at(20), None))
+        man.remove_rule(hash, "dummy_user")
+
+    def test_version(self):
+        topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        v1 = man.get_rules_version()
+        self.failUnlessEqual(man.get_rules_version(), v1)
+        hash = man.add_rule(UserPolicyStandin(True, True))
+        v2 = man.get_rules_version()
+        self.failIfEqual(v1, v2)
+        man.get_rules_page()
+        self.failUnlessEqual(man.get_rules_version(), v2)
+        man.remove_rule(hash, "dummy_user")
+        self.failIfEqual(man.get_rules_version(), v2)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        self.man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+        self.added = []
+        self.removed = []
+        self.man.set_send_add_rule(self.added.append)
+        self.man.set_send_rm_rule(self.removed.append)
+
+    def tearDown(self):
+        self.man.set_send_add_rule(rmhappy)
+        self.man.set_send_rm_rule(rmhappy)
+
+    def timed_rule(self, start, stop, now=None):
+        rule = UserPolicyStandin(True, True)
+        if now == None:
+            now = datetime.now()
+        rule.start_time = (now + timedelta(seconds=start)).strftime(
+            rfc3339format)
+        rule.stop_time = (now + timedelta(seconds=stop)).strftime(
+            rfc3339format)
+        return rule
+
+    def wait_for(self, test, timeout=5.0):
+        while not test() and timeout > 0:
+            sleep(0.1)
+            timeout -= 0.1
+
+    def test_install_and_remove(self):
+        bd_before = len(self.man.get_breakdown_rules_by_LC("1.2.3.4"))
+        hash = self.man.add_rule(self.timed_rule(2, 3))
+        self.failUnlessEqual(self.man.get_rules({'hash':hash})[0][4],
+                             STATE_TO_STRING(INACTIVE_RULE))
+        self.failUnlessEqual(self.added, [])
+        # Rules that aren't installed aren't sent to reconnecting LCs
+        self.failUnlessEqual(
+            len(self.man.get_breakdown_rules_by_LC("1.2.3.4")), bd_before)
+
+        self.wait_for(lambda: len(self.added) > 0)
+        self.failUnlessEqual(self.man.get_rules({'hash':hash})[0][4],
+                             STATE_TO_STRING(ACTIVE_RULE))
+        self.failUnlessEqual(len(self.added), 1)
+        self.failUnlessEqual(
+            len(self.man.get_breakdown_rules_by_LC("1.2.3.4")), bd_before + 2)
+
+        self.wait_for(lambda: len(self.removed) > 0)
+        self.failUnlessEqual(self.man.get_rules({'hash':hash})[0][4],
+                             STATE_TO_STRING(EXPIRED_RULE))
+        self.failUnlessEqual(len(self.removed), 1)
+        self.failUnlessEqual(
+            len(self.man.get_breakdown_rules_by_LC("1.2.3.4")), bd_before)
+        self.man.remove_rule(hash, "dummy_user")
+
+    def test_batch_grouped_per_lc(self):
+        # Rules that start together are sent to each LC together.
+        now = datetime.now()
+        hashes = [self.man.add_rule(self.timed_rule(2, 100, now))
+                  for i in range(3)]
+        self.wait_for(lambda: len(self.added) > 0)
+        sleep(0.2)
+        self.failUnlessEqual(len(self.added), 1)
+        self.failUnlessEqual(self.added[0].get_lc(), "1.2.3.4")
+        self.failUnlessEqual(len(self.added[0].get_list_of_rules()), 6)
+        for hash in hashes:
+            self.man.remove_rule(hash, "dummy_user")
+        self.failUnlessEqual(len(self.removed), 3)
+
+    def test_removed_before_start(self):
+        hash = self.man.add_rule(self.timed_rule(1, 100))
+        self.man.remove_rule(hash, "dummy_user")
+        sleep(2.0)
+        self.failUnlessEqual(self.added, [])
+
+    def test_reload_schedule(self):
+        hash = self.man.add_rule(self.timed_rule(100, 200))
+        self.man._load_schedule()
+        self.failUnless((TIME_TO_EPOCH(self.man.get_raw_rule(hash).start_time),
+                         SCHEDULE_INSTALL, hash) in self.man.schedule)
+        self.man.remove_rule(hash, "dummy_user")
+
+
+class ReservedPolicyStandin(UserPolicyStandin):
+    # Reserves VLAN 100 between br1 and br2 from now + start until now + stop.
+    def __init__(self, start, stop):
+        super(ReservedPolicyStandin, self).__init__(True, True)
+        now = datetime.now()
+        self.start_time = (now + timedelta(seconds=start)).strftime(
+            rfc3339format)
+        self.stop_time = (now + timedelta(seconds=stop)).strftime(
+            rfc3339format)
+
+    def breakdown_rule(self, topology, authorization_func):
+        self.resources = [VLANPathResource(['br1', 'br2'], 100)]
+        return super(ReservedPolicyStandin, self).breakdown_rule(
+            topology, authorization_func)
+
+class CallbackFailsPolicyStandin(UserPolicyStandin):
+    def __init__(self):
+        super(CallbackFailsPolicyStandin, self).__init__(True, True)
+
+    def pre_add_callback(self, tm, ai):
+        raise Exception("CALLBACK FAILED")
+
+class ReservationTest(unittest.TestCase):
+    def setUp(self):
+        self.topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        self.man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+
+    def test_future_conflict(self):
+        hash = self.man.add_rule(ReservedPolicyStandin(100, 200))
+
+        self.failUnlessRaises(RuleManagerReservationError,
+                              self.man.test_add_rule,
+                              ReservedPolicyStandin(150, 250))
+        self.failUnlessRaises(RuleManagerReservationError,
+                              self.man.add_rule,
+                              ReservedPolicyStandin(150, 250))
+        results = self.man.add_rules([ReservedPolicyStandin(0, 50),
+                                      ReservedPolicyStandin(150, 250)],
+                                     atomic=False)
+        self.failUnlessEqual(results[1][0], None)
+        self.man.remove_rule(results[0][0], "dummy_user")
+
+        # No overlap
+        self.man.test_add_rule(ReservedPolicyStandin(200, 300))
+        self.man.test_add_rule(ReservedPolicyStandin(0, 100))
+
+        # Once removed, the resources are free
+        self.man.remove_rule(hash, "dummy_user")
+        hash = self.man.add_rule(ReservedPolicyStandin(150, 250))
+        self.man.remove_rule(hash, "dummy_user")
+        self.failUnlessEqual(self.topo.vlan_calendar.get_keys(), [])
+
+    def test_stops_before_start(self):
+        self.failUnlessRaises(RuleManagerValidationError,
+                              self.man.test_add_rule,
+                              ReservedPolicyStandin(200, 100))
+
+    def test_install_fails(self):
+        # Something else has the VLAN when the rule is due to be installed.
+        added = []
+        self.man.set_send_add_rule(added.append)
+        hash = self.man.add_rule(ReservedPolicyStandin(1, 100))
+        self.topo.reserve_vlan_on_path(['br1', 'br2'], 100)
+        try:
+            sleep(2.5)
+            self.failUnlessEqual(added, [])
+            self.failUnlessEqual(self.man.get_rules({'hash':hash})[0][4],
+                                 STATE_TO_STRING(EXPIRED_RULE))
+            # Its booking was freed.
+            self.failUnlessEqual(self.topo.vlan_calendar.get_keys(), [])
+            self.failIf(hash in [h for (d, a, h) in self.man.schedule])
+        finally:
+            self.topo.unreserve_vlan_on_path(['br1', 'br2'], 100)
+            self.man.set_send_add_rule(rmhappy)
+            self.man.remove_rule(hash, "dummy_user")
+
+    def test_add_rules_callback_fails(self):
+        # The earlier rule's reservation is undone.
+        rule_number = self.man.rule_number
+        results = self.man.add_rules([ReservedPolicyStandin(100, 200),
+                                      CallbackFailsPolicyStandin()])
+        self.failUnlessEqual([h for (h, e) in results], [None, None])
+        self.failUnless("CALLBACK FAILED" in results[1][1])
+        self.failUnlessEqual(self.topo.vlan_calendar.get_keys(), [])
+        self.failUnlessEqual(self.man.rule_number, rule_number)
+
+        # Not atomic, the other rule is still added.
+        results = self.man.add_rules([CallbackFailsPolicyStandin(),
+                                      ReservedPolicyStandin(100, 200)],
+                                     atomic=False)
+        self.failUnlessEqual(results[0][0], None)
+        self.failUnlessEqual(results[1][0], rule_number + 1)
+        self.man.remove_rule(results[1][0], "dummy_user")
+        self.failUnlessEqual(self.topo.vlan_calendar.get_keys(), [])
+
+    def test_reload_bookings(self):
+        hash = self.man.add_rule(ReservedPolicyStandin(100, 200))
+        self.topo.vlan_calendar.clear()
+        self.man._load_bookings()
+        self.failUnlessRaises(RuleManagerReservationError,
+                              self.man.test_add_rule,
+                              ReservedPolicyStandin(150, 250))
+        self.man.remove_rule(hash, "dummy_user")
+
+class RacingPolicyStandin(UserPolicyStandin):
+    # Picks a VLAN between br3 and br4. The first time it's broken down, 
+    # another rule takes that VLAN before it is reserved.
+    def __init__(self):
+        super(RacingPolicyStandin, self).__init__(True, True)
+        self.raced = None
+
+    def breakdown_rule(self, topology, authorization_func):
+        vlan = topology.find_vlan_on_path(['br3', 'br4'])
+        self.resources = [VLANPathResource(['br3', 'br4'], vlan)]
+        if self.raced == None:
+            self.raced = vlan
+            topology.reserve_vlan_on_path(['br3', 'br4'], vlan)
+        return super(RacingPolicyStandin, self).breakdown_rule(
+            topology, authorization_func)
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.topo = TopologyManager(topology_file=TOPO_CONFIG_FILE)
+        self.man = RuleManager(db, 'sdxcontroller', rmhappy, rmhappy)
+
+    def test_broken_down_again(self):
+        rule = RacingPolicyStandin()
+        hash = self.man.add_rule(rule)
+        vlan = rule.get_resources()[0].get_vlan()
+        self.failIfEqual(vlan, rule.raced)
+        self.failUnlessEqual(sorted(self.topo.topo.node['br4']
+                                    ['vlans_in_use']),
+                             sorted([vlan, rule.raced]))
+
+        self.man.remove_rule(hash, "dummy_user")
+        self.topo.unreserve_vlan_on_path(['br3', 'br4'], rule.raced)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -8,6 +8,7 @@ import unittest
 import threading
 import networkx as nx
 import mock
+from time import sleep
 
 from shared.UserPolicy import *
 from sdxctlr.BreakdownEngine import *
@@ -26,10 +27,15 @@ JSON_POLICY_FILE = 'tests/test_manifests/example_config.json'
 class RuleStandin(object):
     def __init__(self, name):
         self.name = name
+        self.cookie = None
     def __str__(self):
         return "RuleStandin %s" % self.name
     def set_cookie(self, cookie):
-        return
+        self.cookie = cookie
+    def get_cookie(self):
+        return self.cookie
+    def get_switch_id(self):
+        return 1
     
 class UserPolicyStandin(UserPolicy):
     # Use the username as a return value for checking validity.
@@ -124,6 +130,53 @@ class AddRuleTest(unittest.TestCase):
         man.remove_rule(rule_num, 'sdonovan')
         
 
+class MessageStandin(object):
+    def __init__(self, data):
+        self.data = data
+    def get_data(self):
+        return self.data
+
+class UnknownSourceTest(unittest.TestCase):
+    @mock.patch('sdxctlr.SDXController.SDXControllerConnectionManager', autospec=True)
+    @mock.patch('sdxctlr.SDXController.RestAPI', autospec=True)
+    def test_coalesced(self, restapi, cxm):
+        sdxctlr = SDXController(False, no_loop_options)
+        handled = []
+        release = threading.Event()
+        def handler(data):
+            release.wait()
+            handled.append(data)
+        sdxctlr.learned_admitter.handler = handler
+        before = sdxctlr.get_unknown_source_counters()
+
+        first = {'switch':'br1', 'port':1, 'src':'00:00:00:00:00:01'}
+        second = {'switch':'br1', 'port':1, 'src':'00:00:00:00:00:02'}
+        for data in [first, first, second, second, second]:
+            sdxctlr._switch_message_unknown_source(MessageStandin(data))
+        release.set()
+        sleep(0.2)
+        # Sent again after being added
+        sdxctlr._switch_message_unknown_source(MessageStandin(first))
+
+        self.failUnlessEqual(handled, [first, second])
+        after = sdxctlr.get_unknown_source_counters()
+        self.failUnlessEqual(after['admitted'] - before['admitted'], 2)
+        self.failUnlessEqual(after['coalesced'] + after['suppressed'] -
+                             before['coalesced'] - before['suppressed'], 4)
+        sdxctlr.learned_admitter.handler = sdxctlr._add_learned_destination
+
+    @mock.patch('sdxctlr.SDXController.SDXControllerConnectionManager', autospec=True)
+    @mock.patch('sdxctlr.SDXController.RestAPI', autospec=True)
+    def test_reinit_stops_old_admitter(self, restapi, cxm):
+        sdxctlr = SDXController(False, no_loop_options)
+        old_admitter = sdxctlr.learned_admitter
+        sdxctlr.__init__(False, no_loop_options)
+
+        old_admitter.thread.join(1)
+        self.failIf(old_admitter.thread.is_alive())
+        self.failIf(sdxctlr.learned_admitter is old_admitter)
+        self.failUnless(sdxctlr.learned_admitter.thread.is_alive())
+
 class JsonUploadTest(unittest.TestCase):
     
     @mock.patch('sdxctlr.SDXController.SDXControllerConnectionManager', autospec=True)
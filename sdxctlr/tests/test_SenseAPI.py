@@ -288,6 +288,56 @@ class ModelTest(unittest.TestCase):
         #    data=True), sort_keys=True, indent=4)
 #FIXME: What else? - This should definitely be enhanced.
 
+    def test_generate_model_fragments(self):
+        tm = TopologyManager(topology_file=BASIC_MANIFEST_FILE)
+        rm = RuleManager(DB_FILE,
+                         send_user_rule_breakdown_add=add_rule,
+                         send_user_rule_breakdown_remove=rm_rule)
+
+        api = SenseAPI(DB_FILE)
+
+        model = api.generate_model()
+        fragments = dict(api.port_fragments)
+        self.failUnless(len(fragments) > 0)
+
+        # Nothing changed, so the same fragments are reused
+        second = api.generate_model()
+        for (name, fragment) in fragments.items():
+            self.failUnless(api.port_fragments[name] is fragment)
+
+        # Rule changes drop the fragments of the ports they use
+        rule = mock.Mock()
+        rule.get_endpoints.return_value = [("br1", "atldtn", 100)]
+        rule.get_rule_hash.return_value = 1
+        api.rule_add_callback(rule)
+        self.failIf("br1-atldtn" in api.port_fragments)
+        self.failIf("atldtn-br1" in api.port_fragments)
+
+        # Topology changes drop everything, and the model is regenerated
+        # without any differences
+        api.topo_change_callback()
+        self.failUnlessEqual(api.port_fragments, {})
+        third = api.generate_model()
+        self.failUnlessEqual(model.splitlines()[1:], third.splitlines()[1:])
+
+    def test_get_latest_model_encoded(self):
+        tm = TopologyManager(topology_file=BASIC_MANIFEST_FILE)
+        rm = RuleManager(DB_FILE,
+                         send_user_rule_breakdown_add=add_rule,
+                         send_user_rule_breakdown_remove=rm_rule)
+
+        api = SenseAPI(DB_FILE)
+
+        (model, new) = api.get_latest_model()
+        (encoded, new) = api.get_latest_model(encode=True)
+        self.failIf(new)
+        self.failUnlessEqual(model['id'], encoded['id'])
+        self.failUnlessEqual(api._decode_b64_gunzip(encoded['model']),
+                             model['model'])
+        # The encoded model is cached with the latest model
+        (again, new) = api.get_latest_model(encode=True)
+        self.failUnless(again['model'] is encoded['model'])
+
 class DeltaTest(unittest.TestCase):
     def setup(self):
         pass
@@ -108,12 +108,12 @@ class VLANTopoTest(unittest.TestCase):
         self.assertEqual(vlan, 1)
 
         # Add VLAN 1 to one of the points on the path
-        man.topo.node["br4"]['vlans_in_use'].append(1)
+        man.reserve_vlan(["br4"], [], 1)
         
         # Should return 2
         vlan = man.find_vlan_on_path(path)
         self.assertEqual(vlan, 2)
-        man.topo.node["br4"]['vlans_in_use'].remove(1)
+        man.unreserve_vlan(["br4"], [], 1)
 
     def test_path_with_edge_set(self):
         man = TopologyManager(topology_file=CONFIG_FILE)
@@ -127,14 +127,12 @@ class VLANTopoTest(unittest.TestCase):
         self.assertEqual(vlan, 1)
         
         # Add VLAN 1 to one of the points on the path
-        print "\n%s" % man.topo.edge['br3']['br4']
-        man.topo.edge["br3"]["br4"]['vlans_in_use'].append(1)
-        print man.topo.edge['br3']['br4']
+        man.reserve_vlan([], [("br3", "br4")], 1)
         
         # Should return 2
         vlan = man.find_vlan_on_path(path)
         self.assertEqual(vlan, 2)
-        man.topo.edge["br3"]["br4"]['vlans_in_use'].remove(1)
+        man.unreserve_vlan([], [("br3", "br4")], 1)
 
     def test_path_node_filled(self):
         man = TopologyManager(topology_file=CONFIG_FILE)
@@ -148,12 +146,14 @@ class VLANTopoTest(unittest.TestCase):
         self.failUnlessEqual(vlan, 1)
         
         # Add VLANs 1-4090 to one of the points on the path        
-        man.topo.node["br4"]['vlans_in_use'] = range(1,4090)
+        for v in range(1,4090):
+            man.reserve_vlan(["br4"], [], v)
         
         # Should return None
         vlan = man.find_vlan_on_path(path)
         self.failUnlessEqual(vlan, None)
-        man.topo.node["br4"]['vlans_in_use'] = []
+        for v in range(1,4090):
+            man.unreserve_vlan(["br4"], [], v)
 
 
     def test_path_edge_filled(self):
@@ -168,11 +168,13 @@ class VLANTopoTest(unittest.TestCase):
         self.failUnlessEqual(vlan, 1)
         
         # Add VLANs 1-4090 to one of the points on the path        
-        man.topo.edge["br4"]["br3"]['vlans_in_use'] = range(1,4090)
+        for v in range(1,4090):
+            man.reserve_vlan([], [("br4", "br3")], v)
         # Should return None
         vlan = man.find_vlan_on_path(path)
         self.failUnlessEqual(vlan, None)
-        man.topo.edge["br4"]["br3"]['vlans_in_use'] = []
+        for v in range(1,4090):
+            man.unreserve_vlan([], [("br4", "br3")], v)
 
     def test_reserve_on_empty(self):
         man = TopologyManager(topology_file=CONFIG_FILE)
@@ -194,7 +196,7 @@ class VLANTopoTest(unittest.TestCase):
         path = nx.shortest_path(topo, source="br4", target="br1")
         
         # set VLAN 1 on one of the points on the path
-        man.topo.edge["br4"]["br3"]['vlans_in_use'].append(1)
+        man.reserve_vlan([], [("br4", "br3")], 1)
 
         # Reserve path on VLAN 1
         self.failUnlessRaises(Exception, man.reserve_vlan_on_path, path, 1)
@@ -221,6 +223,45 @@ class VLANTopoTest(unittest.TestCase):
         # This should pass:
         man.reserve_vlan_on_path(path, 100)
 
+    def test_path_edge_unavailable(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        topo = man.get_topology()
+
+        # Get a path
+        path = nx.shortest_path(topo, source="br2", target="br4")
+
+        # Restrict one edge on the path to VLANs 100-200 and 300
+        man.topo.edge["br3"]["br4"]['available_vlans'] = "100-200,300"
+        vlan = man.find_vlan_on_path(path)
+        self.assertEqual(vlan, 100)
+
+        # Reservations on either direction of the edge are seen.
+        man.reserve_vlan([], [("br4", "br3")], 100)
+        vlan = man.find_vlan_on_path(path)
+        self.assertEqual(vlan, 101)
+        man.unreserve_vlan([], [("br3", "br4")], 100)
+
+    def test_vlan_index_lists(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+
+        self.assertEqual(man.get_available_vlan_list("1-3,7,10-11"),
+                         [1, 2, 3, 7, 10, 11])
+        self.assertTrue(man.check_vlan_available("1-3,7,10-11", 7))
+        self.assertFalse(man.check_vlan_available("1-3,7,10-11", 8))
+        self.assertEqual(VLAN_BITMAP_TO_LIST(
+            man.get_vlans_available_on_edge("br3", "br4")),
+                         range(0,4096))
+
+        man.reserve_vlan(["br3", "br4"], [("br3", "br4")], 5)
+        self.assertEqual(man.topo.node["br4"]['vlans_in_use'], [5])
+        self.assertEqual(man.topo.edge["br4"]["br3"]['vlans_in_use'], [5])
+        self.assertFalse(man.get_vlans_available_on_edge("br4", "br3") &
+                         (1 << 5))
+        man.unreserve_vlan(["br3", "br4"], [("br4", "br3")], 5)
+        self.assertEqual(man.topo.node["br4"]['vlans_in_use'], [])
+        self.assertTrue(man.get_vlans_available_on_edge("br3", "br4") &
+                        (1 << 5))
+
 
 class BWTopoTest(unittest.TestCase):
     def setUp(self):
@@ -522,7 +563,313 @@ class SteinerTreeWithLoopTest(unittest.TestCase):
         for node in expected_tree_nodes:
             self.failUnless(node in returned_tree_nodes)
 
+    def test_steiner_tree_bandwidth_shortfall(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        topo = man.get_topology()
+        speed = 80000000000
+
+        # Direct link
+        tree = man.find_valid_steiner_tree(['sw5', 'sw7'], 100)
+        self.failUnlessEqual(sorted(tree.nodes()), ['sw5', 'sw7'])
+        self.failUnlessEqual(tree.graph['cost'], speed)
+        self.failUnless(tree.graph['time'] >= 0)
+
+        # sw5-sw7 is full, so go around through sw4 and sw6
+        man.reserve_bw_on_path(['sw5', 'sw7'], speed)
+        tree = man.find_valid_steiner_tree(['sw5', 'sw7'], 100)
+        self.failUnlessEqual(sorted(tree.nodes()),
+                             ['sw4', 'sw5', 'sw6', 'sw7'])
+        self.failUnlessEqual(tree.graph['cost'], 3 * speed)
+
+        # Topology is untouched, and without a bandwidth the link is usable
+        self.failUnless(topo.has_edge('sw5', 'sw7'))
+        tree = man.find_valid_steiner_tree(['sw5', 'sw7'])
+        self.failUnlessEqual(sorted(tree.nodes()), ['sw5', 'sw7'])
+
+        man.unreserve_bw_on_path(['sw5', 'sw7'], speed)
+        tree = man.find_valid_steiner_tree(['sw5', 'sw7'], 100)
+        self.failUnlessEqual(sorted(tree.nodes()), ['sw5', 'sw7'])
+
+    def test_steiner_tree_no_bandwidth(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        topo = man.get_topology()
+        speed = 80000000000
+
+        # sw1 only connects to sw2.
+        man.reserve_bw_on_path(['sw1', 'sw2'], speed)
+        self.failUnlessEqual(man.find_valid_steiner_tree(['sw1', 'sw7'], 100),
+                             None)
+        self.failUnless(topo.has_edge('sw1', 'sw2'))
+        man.unreserve_bw_on_path(['sw1', 'sw2'], speed)
+
+    def test_steiner_cache(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+
+        man.find_valid_steiner_tree(['sw1', 'sw4', 'sw7'], 100)
+        self.failUnlessEqual(len(man.steiner_cache), 1)
+        closure = man.steiner_cache.values()[0]
+        self.failUnlessEqual(len(closure), 2)
+
+        # Same bandwidth view, more terminals: the closure is extended.
+        man.find_valid_steiner_tree(['sw1', 'sw3', 'sw6', 'sw8'], 200)
+        self.failUnlessEqual(len(man.steiner_cache), 1)
+        self.failUnless(man.steiner_cache.values()[0] is closure)
+        self.failUnlessEqual(len(closure), 4)
+
+        # Topology changes empty the cache
+        man._call_topology_update_callbacks(None)
+        self.failUnlessEqual(len(man.steiner_cache), 0)
+
+class ConstrainedPathTest(unittest.TestCase):
+    ''' Same topology as SteinerTreeWithLoopTest. '''
+    def setUp(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        man.topo = nx.Graph()
+        man._import_topology(STEINER_LOOP_CONFIG_FILE)
+        self.speed = 80000000000
+
+    def test_shortest(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100),
+                             ['sw5', 'sw7'])
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7'),
+                             ['sw5', 'sw7'])
+        self.failUnlessEqual(man.find_valid_path('sw5h', 'sw7h', 100, True),
+                             ['sw5', 'sw7'])
+
+    def test_bandwidth_pruned(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        man.reserve_bw_on_path(['sw5', 'sw7'], self.speed)
+
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100, k=1),
+                             ['sw5', 'sw4', 'sw6', 'sw7'])
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100,
+                                                 max_hops=2), None)
+        # The endpoint links aren't constrained
+        self.failUnlessEqual(man.find_valid_path('sw7', 'sw5', 100, True),
+                             [])
+        man.unreserve_bw_on_path(['sw5', 'sw7'], self.speed)
+
+    def test_common_vlan(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        topo = man.get_topology()
+        man.reserve_bw_on_path(['sw5', 'sw7'], self.speed)
+
+        # Both links through sw4 have a VLAN free, but not the same one.
+        topo.edge['sw5']['sw4']['available_vlans'] = "10"
+        topo.edge['sw4']['sw6']['available_vlans'] = "20"
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100, k=1),
+                             None)
+        path = man.find_valid_path('sw5', 'sw7', 100)
+        self.failUnlessEqual(path, ['sw5', 'sw2', 'sw3', 'sw8', 'sw7'])
+        self.failUnlessEqual(man.find_vlan_on_path(path), 1)
+
+        # With a common VLAN, the shorter path is found again
+        topo.edge['sw4']['sw6']['available_vlans'] = "10-20"
+        path = man.find_valid_path('sw5', 'sw7', 100)
+        self.failUnlessEqual(path, ['sw5', 'sw4', 'sw6', 'sw7'])
+        self.failUnlessEqual(man.find_vlan_on_path(path), 10)
+
+        # VLANs in use are taken into account
+        man.reserve_vlan_on_path(['sw5', 'sw4'], 10)
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100),
+                             ['sw5', 'sw2', 'sw3', 'sw8', 'sw7'])
+        man.unreserve_vlan_on_path(['sw5', 'sw4'], 10)
+        man.unreserve_bw_on_path(['sw5', 'sw7'], self.speed)
+
+class ReservationCalendarTest(unittest.TestCase):
+    ''' Same topology as SteinerTreeWithLoopTest. '''
+    def setUp(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        man.topo = nx.Graph()
+        man._import_topology(STEINER_LOOP_CONFIG_FILE)
+        man.bw_calendar.clear()
+        man.vlan_calendar.clear()
+        self.speed = 80000000000
+
+    def tearDown(self):
+        TopologyManager().clear_reservation_window()
+
+    def test_book_bandwidth(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        resources = [BandwidthPathResource(['sw5', 'sw7'], self.speed)]
+        man.book_resources(resources, 1000, 2000)
+
+        # Overlapping times
+        self.failUnlessRaises(TopologyManagerError, man.check_resources,
+                              resources, 1500, None)
+        self.failUnlessRaises(TopologyManagerError, man.book_resources,
+                              resources, 0, 1001)
+        # Back to back
+        man.check_resources(resources, 2000, 3000)
+        man.check_resources(resources, 0, 1000)
+
+        # Searches only avoid the link during the window
+        man.set_reservation_window(1500, 1600)
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100),
+                             ['sw5', 'sw4', 'sw6', 'sw7'])
+        man.set_reservation_window(3000, 4000)
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100),
+                             ['sw5', 'sw7'])
+        man.clear_reservation_window()
+        self.failUnlessEqual(man.find_valid_path('sw5', 'sw7', 100),
+                             ['sw5', 'sw7'])
+
+        man.cancel_resources(resources, 1000, 2000)
+        man.check_resources(resources, 1500, None)
+
+    def test_book_vlan(self):
+        man = TopologyManager(topology_file=STEINER_LOOP_CONFIG_FILE)
+        path = ['sw5', 'sw4', 'sw6']
+        man.book_resources([VLANPathResource(path, 1)], 1000, None)
+
+        self.failUnlessRaises(TopologyManagerError, man.check_resources,
+                              [VLANPortResource('sw4', 2, 1)], 5000, 6000)
+        man.check_resources([VLANPathResource(path, 2)], 5000, 6000)
+        # The same VLAN twice in one request is caught
+        self.failUnlessRaises(TopologyManagerError, man.check_resources,
+                              [VLANPathResource(['sw7', 'sw6'], 5),
+                               VLANPathResource(['sw6', 'sw7'], 5)],
+                              0, 10)
+
+        man.set_reservation_window(5000, 6000)
+        self.failUnlessEqual(man.find_vlan_on_path(path), 2)
+        man.set_reservation_window(0, 1000)
+        self.failUnlessEqual(man.find_vlan_on_path(path), 1)
+        man.clear_reservation_window()
+
+        # A failed booking books nothing
+        self.failUnlessRaises(TopologyManagerError, man.book_resources,
+                              [VLANPathResource(['sw7', 'sw6'], 3),
+                               VLANPathResource(path, 1)], 1000, 1010)
+        man.check_resources([VLANPathResource(['sw7', 'sw6'], 3)],
+                            1000, 1010)
+
+        man.cancel_resources([VLANPathResource(path, 1)], 1000, None)
+        self.failUnlessEqual(man.vlan_calendar.get_keys(), [])
+
+class NextHopTest(unittest.TestCase):
+    def setUp(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        man.topo = nx.Graph()
+        man._import_topology(CONFIG_FILE)
+
+    def test_topology(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        next_hops = man.get_next_hops('br4')
+        self.failUnlessEqual(next_hops['br3'], 'br4')
+        self.failUnlessEqual(next_hops['br1'], 'br3')
+        self.failUnlessEqual(next_hops['br2'], 'br3')
+        self.failUnlessEqual(next_hops['br1dtn1'], 'br1')
+        self.failIf('br4' in next_hops)
+        self.failUnless(man.get_next_hops('br4') is next_hops)
+
+        man._import_topology(CONFIG_FILE)
+        self.failIf(man.get_next_hops('br4') is next_hops)
 
+    def test_tree(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        tree = nx.Graph()
+        tree.add_path(['br1', 'br2', 'br3', 'br4'])
+        next_hops = man.get_next_hops('br4', tree)
+        self.failUnlessEqual(next_hops, {'br1':'br2', 'br2':'br3',
+                                         'br3':'br4'})
+        self.failUnlessEqual(man.get_next_hops('br4')['br1'], 'br3')
+
+        # Same edges, different graph
+        other = nx.Graph()
+        other.add_path(['br4', 'br3', 'br2', 'br1'])
+        self.failUnless(man.get_next_hops('br4', other) is next_hops)
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        man.topo = nx.Graph()
+        man._import_topology(CONFIG_FILE)
+
+    def tearDown(self):
+        TopologyManager().unpin_snapshot()
+
+    def test_versions(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        snapshot = man.get_snapshot()
+        self.failUnless(man.get_snapshot() is snapshot)
+        self.failUnlessEqual(snapshot.get_version(), man.get_version())
+
+        man.reserve_vlan_on_path(['br3', 'br4'], 1)
+        self.failUnless(man.get_snapshot() is not snapshot)
+        self.failUnless(man.get_version() > snapshot.get_version())
+        # The snapshot is unchanged, and read-only
+        self.failUnlessEqual(snapshot.get_topology().node['br4']
+                             ['vlans_in_use'], [])
+        self.failUnlessEqual(snapshot.get_topology().edge['br3']['br4']
+                             ['vlans_in_use'], [])
+        self.failUnlessRaises(nx.NetworkXError,
+                              snapshot.get_topology().add_node, 'br5')
+        man.unreserve_vlan_on_path(['br3', 'br4'], 1)
+        self.failUnlessEqual(man.get_snapshot().get_topology().node['br4']
+                             ['vlans_in_use'], [])
+
+    def test_bookings(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        resources = [VLANPathResource(['br3', 'br4'], 1)]
+        man.book_resources(resources, 1000, 2000)
+        snapshot = man.get_snapshot()
+        try:
+            man.cancel_resources(resources, 1000, 2000)
+            man.book_resources(resources, 3000, 4000)
+            # The snapshot's calendar is unchanged
+            self.failIfEqual(
+                snapshot.vlan_calendar.get_reserved(('br3', 'br4'), 1000,
+                                                    2000), 0)
+            self.failUnlessEqual(
+                snapshot.vlan_calendar.get_reserved(('br3', 'br4'), 3000,
+                                                    4000), 0)
+            self.failUnlessEqual(
+                man.get_snapshot().vlan_calendar.get_reserved(
+                    ('br3', 'br4'), 1000, 2000), 0)
+        finally:
+            man.cancel_resources(resources, 3000, 4000)
+
+    def test_pinned(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        snapshot = man.get_snapshot()
+        man.reserve_vlan_on_path(['br3', 'br4'], 1)
+
+        man.pin_snapshot(snapshot)
+        self.failUnless(man.get_topology() is snapshot.get_topology())
+        self.failUnlessEqual(man.find_vlan_on_path(['br3', 'br4']), 1)
+        self.failUnlessEqual(man.find_valid_path('br3', 'br4'), ['br3', 'br4'])
+        man.unpin_snapshot()
+        self.failUnless(man.get_topology() is man.topo)
+        self.failUnlessEqual(man.find_vlan_on_path(['br3', 'br4']), 2)
+        man.unreserve_vlan_on_path(['br3', 'br4'], 1)
+
+    def test_reserve_resources(self):
+        man = TopologyManager(topology_file=CONFIG_FILE)
+        version = man.get_snapshot().get_version()
+        resources = [VLANPathResource(['br3', 'br4'], 1),
+                     BandwidthPathResource(['br3', 'br4'], 100)]
+        man.reserve_resources(resources, version)
+
+        # Nothing is reserved if anything can't be
+        self.failUnlessRaises(TopologyManagerError, man.reserve_resources,
+                              [VLANPathResource(['br1', 'br3'], 1),
+                               VLANPathResource(['br3', 'br4'], 1)])
+        self.failUnlessEqual(man.topo.node['br1']['vlans_in_use'], [])
+        # Chosen from an old snapshot
+        self.failUnlessRaises(TopologyManagerConflictError,
+                              man.reserve_resources, resources, version)
+        # Not a conflict when the snapshot was up to date
+        try:
+            man.reserve_resources(resources, man.get_version())
+        except TopologyManagerConflictError:
+            self.fail("Conflict with current version")
+        except TopologyManagerError:
+            pass
+
+        man.unreserve_resource(resources[0])
+        man.unreserve_resource(resources[1])
 
 
 if __name__ == '__main__':
@@ -56,7 +56,7 @@ class FloodTreePolicy(UserPolicy):
         switches = []
         for (name, data) in topology.nodes(data=True):
             if data['type'] == "switch":
-                switch = data
+                switch = dict(data)
                 switch['name'] = name
                 switches.append(switch)
         
@@ -311,11 +311,12 @@ class L2MultipointPolicy(UserPolicy):
         for name in tree.nodes():
             data = topology.node[name]
             if data['type'] == "switch":
-                switch = data
+                switch = dict(data)
                 switch['name'] = name
                 switches.append(switch)
         covered = []
         breakdowns = []
+        next_hops = tm.get_next_hops(dst_switch, tree)
 
         for sw in switches:
             node = sw['name']
@@ -341,10 +342,10 @@ class L2MultipointPolicy(UserPolicy):
                 continue
 
             # All other switches
-            path = nx.shortest_path(tree,
-                                    source=node,
-                                    target=dst_switch)
-            next_node = path[1]
+            if node not in next_hops:
+                raise nx.NetworkXNoPath("No path from %s to %s" %
+                                        (node, dst_switch))
+            next_node = next_hops[node]
 
             out_port = tree.edge[node][next_node][node]
             ldr = L2MultipointLearnedDestinationLCRule(switch_id,
@@ -100,10 +100,11 @@ class LearnedDestinationPolicy(UserPolicy):
         switches = []
         for (name, data) in topology.nodes(data=True):
             if data['type'] == "switch":
-                switch = data
+                switch = dict(data)
                 switch['name'] = name
                 switches.append(switch)
         covered = []
+        next_hops = tm.get_next_hops(self.dst_switch)
 
         for sw in switches:
             node = sw['name']
@@ -122,10 +123,10 @@ class LearnedDestinationPolicy(UserPolicy):
                 continue
 
             # All other switches
-            path = nx.shortest_path(topology,
-                                    source=node,
-                                    target=self.dst_switch)
-            next_node = path[1]
+            if node not in next_hops:
+                raise nx.NetworkXNoPath("No path from %s to %s" %
+                                        (node, self.dst_switch))
+            next_node = next_hops[node]
 
             out_port = topology.edge[node][next_node][node]
             lcr = LearnedDestinationLCRule(switch_id,
@@ -0,0 +1,169 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+# Hierarchical digest of a set of LCRules, used to work out which rules need
+# to be exchanged when an LC reconnects to the SDX controller. Rules are put
+# into buckets by switch and by cookie range; each bucket has a digest, each
+# switch has a digest of its buckets, and there is a single digest of
+# everything. If two digests match at any level, everything under that level
+# matches, so comparing them only needs to look at the buckets that changed.
+#
+# Bucket digests are sums of per-rule hashes, so rules can be added and
+# removed without rehashing the rest of the bucket, and the order rules were
+# added in doesn't matter.
+
+from hashlib import sha1
+from zlib import crc32
+
+# Cookies are policy hashes on the SDX, which are handed out in order, so
+# consecutive policies end up in the same bucket.
+DEFAULT_COOKIE_RANGE = 256
+
+DIGEST_BITS = 160
+DIGEST_MODULUS = 2 ** DIGEST_BITS
+
+
+class RuleDigestValueError(ValueError):
+    pass
+
+
+def rule_bucket(cookie, switch_id, cookie_range=DEFAULT_COOKIE_RANGE):
+    ''' Returns the (switch_id, cookie range) bucket that a rule falls in.
+        Cookies that aren't numbers are spread over buckets by their CRC. '''
+    if not isinstance(cookie, (int, long)):
+        cookie = crc32(str(cookie)) & 0xffffffff
+    return (switch_id, cookie // cookie_range)
+
+def _canonical(value):
+    ''' Stable text for value, which is the same for equal rules in different
+        processes: dictionaries and sets are sorted, and objects are
+        described by their class and attributes rather than by their
+        address. '''
+    if isinstance(value, dict):
+        return "{%s}" % ", ".join(sorted("%s: %s" % (_canonical(k),
+                                                      _canonical(v))
+                                          for (k, v) in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return "set([%s])" % ", ".join(sorted(_canonical(v) for v in value))
+    if isinstance(value, list):
+        return "[%s]" % ", ".join(_canonical(v) for v in value)
+    if isinstance(value, tuple):
+        return "(%s)" % ", ".join(_canonical(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return "%s(%s)" % (value.__class__.__name__, _canonical(vars(value)))
+    return repr(value)
+
+def rule_hash(cookie, switch_id, rule):
+    ''' Hash of a single rule, as an integer. '''
+    text = "%r:%r:%s" % (cookie, switch_id, _canonical(rule))
+    return int(sha1(text).hexdigest(), 16)
+
+
+class RuleDigest(object):
+    ''' Digest of a set of rules, each identified by cookie and switch_id.
+        Not thread safe: users are expected to hold their own locks. '''
+    def __init__(self, cookie_range=DEFAULT_COOKIE_RANGE):
+        if cookie_range < 1:
+            raise RuleDigestValueError("cookie_range must be positive: %s" %
+                                       cookie_range)
+        self.cookie_range = cookie_range
+        # switch_id -> cookie range -> [sum of rule hashes, number of rules]
+        self._buckets = {}
+
+    def __len__(self):
+        return sum(count for ranges in self._buckets.values()
+                   for (total, count) in ranges.values())
+
+    def copy(self):
+        digest = RuleDigest(self.cookie_range)
+        for (switch_id, ranges) in self._buckets.items():
+            digest._buckets[switch_id] = dict((r, list(leaf)) for
+                                              (r, leaf) in ranges.items())
+        return digest
+
+    def bucket(self, cookie, switch_id):
+        return rule_bucket(cookie, switch_id, self.cookie_range)
+
+    def add(self, cookie, switch_id, rule):
+        (switch_id, r) = self.bucket(cookie, switch_id)
+        leaf = self._buckets.setdefault(switch_id, {}).setdefault(r, [0, 0])
+        leaf[0] = (leaf[0] + rule_hash(cookie, switch_id, rule)) % \
+                  DIGEST_MODULUS
+        leaf[1] += 1
+
+    def remove(self, cookie, switch_id, rule):
+        ''' Removes a rule that was previously added. '''
+        (switch_id, r) = self.bucket(cookie, switch_id)
+        ranges = self._buckets.get(switch_id, {})
+        if r not in ranges:
+            raise RuleDigestValueError("No rules in bucket %s:%s for %s" %
+                                       (switch_id, r, cookie))
+        leaf = ranges[r]
+        leaf[0] = (leaf[0] - rule_hash(cookie, switch_id, rule)) % \
+                  DIGEST_MODULUS
+        leaf[1] -= 1
+        if leaf[1] <= 0:
+            del ranges[r]
+            if len(ranges) == 0:
+                del self._buckets[switch_id]
+
+    def get_buckets(self, switch_id):
+        ''' Returns {cookie range:digest} for switch_id. '''
+        return dict((r, self._format(total, count)) for (r, (total, count))
+                    in self._buckets.get(switch_id, {}).items())
+
+    def get_switches(self):
+        ''' Returns {switch_id:digest}. '''
+        retval = {}
+        for (switch_id, ranges) in self._buckets.items():
+            total = sum(t for (t, c) in ranges.values()) % DIGEST_MODULUS
+            count = sum(c for (t, c) in ranges.values())
+            retval[switch_id] = self._format(total, count)
+        return retval
+
+    def get_root(self):
+        ''' Returns the digest of every rule. '''
+        total = 0
+        count = 0
+        for ranges in self._buckets.values():
+            for (t, c) in ranges.values():
+                total += t
+                count += c
+        return self._format(total % DIGEST_MODULUS, count)
+
+    def get_summary(self):
+        ''' Everything needed to call diff() on the other side of a
+            connection. '''
+        return {'cookie_range':self.cookie_range,
+                'root':self.get_root(),
+                'switches':self.get_switches(),
+                'buckets':dict((switch_id, self.get_buckets(switch_id))
+                               for switch_id in self._buckets.keys())}
+
+    def diff(self, summary):
+        ''' Compares against the get_summary() of another digest. Returns a
+            sorted list of the (switch_id, cookie range) buckets that differ,
+            including buckets that only one side has. '''
+        if summary['cookie_range'] != self.cookie_range:
+            raise RuleDigestValueError("Cookie ranges differ: %s, %s" %
+                                       (summary['cookie_range'],
+                                        self.cookie_range))
+        if summary['root'] == self.get_root():
+            return []
+
+        differ = []
+        mine = self.get_switches()
+        theirs = summary['switches']
+        for switch_id in set(mine.keys()) | set(theirs.keys()):
+            if mine.get(switch_id) == theirs.get(switch_id):
+                continue
+            my_buckets = self.get_buckets(switch_id)
+            their_buckets = summary['buckets'].get(switch_id, {})
+            for r in set(my_buckets.keys()) | set(their_buckets.keys()):
+                if my_buckets.get(r) != their_buckets.get(r):
+                    differ.append((switch_id, r))
+        return sorted(differ)
+
+    def _format(self, total, count):
+        return "%040x:%d" % (total, count)
@@ -35,10 +35,10 @@ class SDXControllerConnectionManagerNotConnectedError(ConnectionManagerValueErro
 class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
     ''' Used to manage the connection with the SDX Controller. '''
 
-    def __init__(self, loggeridprefix):
+    def __init__(self, loggeridprefix, reactor=None):
         loggerid = loggeridprefix + '.sdxctlrcxnmgr'
         super(SDXControllerConnectionManager, self).__init__(
-            loggerid, SDXControllerConnection, loggerid)
+            loggerid, SDXControllerConnection, loggerid, reactor)
         # associations are for easy lookup of connections based on the name of
         # the Local Controller.
         
@@ -54,7 +54,9 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
 
     def send_breakdown_rule_add(self, bd):
         ''' This takes in a UserPolicyBreakdown and send it to the Local
-            Controller that it has a connection to in order to add rules. '''
+            Controller that it has a connection to in order to add rules. 
+            Rules are queued on the connection, so this doesn't wait for the
+            Local Controller. '''
         try:
             # Find the correct client
             lc_cxn = self._find_lc_cxn(bd)
@@ -63,11 +65,16 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
             for rule in bd.get_list_of_rules():
                 switch_id = rule.get_switch_id()
                 msg = SDXMessageInstallRule(rule, switch_id)
-                lc_cxn.send_protocol(msg)
+                lc_cxn.enqueue_protocol(msg)
 
         except SDXControllerConnectionManagerNotConnectedError as e:
             # Connection doesn't yet exist. Nothing to do.
             pass
+        except SDXMessageConnectionFailure as e:
+            # Connection has failed, or the LC fell too far behind. The rules
+            # will be sent as initial rules when it reconnects.
+            self.logger.error("send_breakdown_rule_add to %s failed: %s" %
+                              (bd.get_lc(), e))
         
         except Exception as e: raise
 
@@ -84,7 +91,7 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
                 switch_id = rule.get_switch_id()
                 rule_cookie = rule.get_cookie()
                 msg = SDXMessageRemoveRule(rule_cookie, switch_id)
-                lc_cxn.send_protocol(msg)
+                lc_cxn.enqueue_protocol(msg)
 
         except SDXControllerConnectionManagerNotConnectedError as e:
             # Connection doesn't yet exist. Nothing to do.
@@ -96,6 +103,18 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
             
         except Exception as e: raise
 
+    def get_outbound_stats(self):
+        ''' Returns {LC name:outbound queue statistics} for every connected
+            LC. See SDXControllerConnection.get_outbound_stats(). '''
+        return dict((name, cxn.get_outbound_stats()) for (name, cxn) in
+                    self.associations.items())
+
+    def get_compression_stats(self):
+        ''' Returns {LC name:compression statistics} for every connected LC.
+            See SDXControllerConnection.get_compression_stats(). '''
+        return dict((name, cxn.get_compression_stats()) for (name, cxn) in
+                    self.associations.items())
+
     def _find_lc_cxn(self, bd):
         lc = bd.get_lc()
         lc_cxn = None
@@ -145,10 +164,14 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
         ''' Used by Connections to add themselves to the queue. '''
         self.logger.debug("ADDING NEW CXN %s" % cxn)
         self.cxn_q.put((NEW_CXN, cxn))
+        if self.reactor != None:
+            self.reactor.wakeup()
     
     def add_del_cxn_to_queue(self, cxn):
         ''' Used by Connections when they are closing. '''
         self.cxn_q.put((DEL_CXN, cxn))
+        if self.reactor != None:
+            self.reactor.wakeup()
     
     def _internal_new_connection(self, sock, address):
         ''' This is a rewrite of ConnectionManager._internal_new_connection()
@@ -164,6 +187,9 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
                 client_ip, client_port, sock)
         client_connection.set_delete_callback(self.add_del_cxn_to_queue)
         client_connection.set_new_callback(self.add_new_cxn_to_queue)
+        if self.reactor != None:
+            # Heartbeats are run from the reactor once in MAIN_PHASE.
+            client_connection.set_reactor(self.reactor)
         self.listening_callback(client_connection)
 
     def open_outbound_connection(self, ip, port):
@@ -174,5 +200,7 @@ class SDXControllerConnectionManager(AtlanticWaveConnectionManager):
                     self).open_outbound_connection(ip, port)
         cxn.set_delete_callback(self.add_del_cxn_to_queue)
         cxn.set_new_callback(self.add_new_cxn_to_queue)
+        if self.reactor != None:
+            cxn.set_reactor(self.reactor)
         return cxn
 
@@ -2,12 +2,25 @@
 # AtlanticWave/SDX Project
 
 
-from lib.Connection import Connection
+from lib.Connection import (Connection, ConnectionClosedError,
+                            ConnectionValueError)
+from shared.SDXMessageCodec import (encode_message, decode_message,
+                                   is_binary_message, SDXCodecTypeError,
+                                   SDXCodecValueError,
+                                   SUPPORTED_CODEC_VERSIONS)
+from shared.RuleDigest import RuleDigestValueError
+from shared.ManagementLCRecoverRule import ManagementLCRecoverRule
+from shared.ManagementSDXRecoverRule import ManagementSDXRecoverRule
+from shared.LearnedDestinationLCRule import LearnedDestinationLCRule
+from shared.L2MultipointLearnedDestinationLCRule import \
+     L2MultipointLearnedDestinationLCRule
 import cPickle as pickle
 import struct
+import zlib
 import threading
 import socket
-from time import sleep
+from time import sleep, time
+from collections import deque
 
 
 # This list of state machien states is primarily a point of reference.
@@ -17,6 +30,50 @@ STATE_MACHINE_STAGES = [ 'UNCONNECTED',
                          'INITIAL_RULES',
                          'INITIAL_RULES_COMPLETE',
                          'MAIN_PHASE' ]
+
+# Capabilities that can be negotiated during the CAPABILITIES phase. The SDX
+# offers capabilities in the CapabilitiesRequest, and the LC responds with the
+# subset it accepts in the CapabilitiesResponse.
+CAPABILITY_BULK_INITIAL_RULES = 'bulk_initial_rules'
+CAPABILITY_BINARY_CODEC = 'binary_codec'
+CAPABILITY_RULE_DIGEST = 'rule_digest'
+CAPABILITY_COMPRESSION = 'compression'
+
+# Defaults for bulk initial rules: number of rules per INITRB message and the
+# number of INITRB messages that can be unacknowledged at any time.
+DEFAULT_INITIAL_RULES_BATCH_SIZE = 256
+DEFAULT_INITIAL_RULES_WINDOW = 8
+
+# Defaults for the outbound queue: the number of messages that can be waiting
+# to be sent, and how many bytes of queued messages are sent in a single write.
+DEFAULT_OUTBOUND_QUEUE_SIZE = 4096
+DEFAULT_OUTBOUND_COALESCE_BYTES = 65536
+# Seconds a message can wait behind higher priority lanes before its lane is
+# sent from first, so that low priority lanes can't be starved.
+DEFAULT_OUTBOUND_MAX_WAIT = 1.0
+
+# Defaults for compression: messages smaller than the threshold, in bytes, are
+# never compressed, and the zlib compression level. Higher levels cost several
+# times the CPU for little further reduction on SDX messages.
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+DEFAULT_COMPRESSION_LEVEL = 1
+COMPRESSION_ALGORITHMS = ['zlib']
+
+# Flag in the size field of the frame header, set if the message is
+# compressed.
+FRAME_COMPRESSED = 0x40000000
+
+# Priority classes for queued messages, highest priority first. See
+# message_priority().
+PRIORITY_CONTROL = 0
+PRIORITY_RECOVERY = 1
+PRIORITY_USER = 2
+PRIORITY_LEARNED = 3
+PRIORITY_NAMES = {PRIORITY_CONTROL:'control',
+                  PRIORITY_RECOVERY:'recovery',
+                  PRIORITY_USER:'user',
+                  PRIORITY_LEARNED:'learned'}
+
 class SDXMessageValueError(ValueError):
     pass
 
@@ -26,6 +83,9 @@ class SDXMessageTypeError(TypeError):
 class SDXMessageConnectionFailure(EnvironmentError):
     pass
 
+class SDXOutboundQueueFullError(SDXMessageConnectionFailure):
+    pass
+
 class SDXMessage(object):
     ''' Used to simplfy sending/receiving messages between SDX Controller and 
         Local Controllers. '''
@@ -149,10 +209,12 @@ class SDXMessageHeartbeatResponse(SDXMessage):
 class SDXMessageCapabilitiesRequest(SDXMessage):
     ''' Request from SDX controller for LC's capabilities
         Valid during capabilities
-        Contains no data '''
-    def __init__(self, json_msg=None):
-        data_json_name = None
+        Contains the capabilities offered by the SDX controller, if any. '''
+    def __init__(self, capabilities=None, json_msg=None):
+        data_json_name = ['capabilities']
         data = None
+        if capabilities != None:
+            data = {'capabilities':capabilities}
         validity = ['CAPABILITIES']
         if json_msg != None:
             super(SDXMessageCapabilitiesRequest, self).__init__('CAPREQ',
@@ -246,6 +308,49 @@ class SDXMessageInitialRulesComplete(SDXMessage):
                                                              validity,
                                                              data)
 
+class SDXMessageInitialRuleBatch(SDXMessage):
+    ''' SDX sending a batch of initial rules to an LC. Only used if
+        CAPABILITY_BULK_INITIAL_RULES was negotiated.
+        Valid during Initial Rule phase
+        Contains the index of the first rule in the batch and a list of
+        (rule, switch_id) tuples.
+    '''
+    def __init__(self, first=None, rules=None, json_msg=None):
+        data_json_name = ['first', 'rules']
+        data = {'first':first, 'rules':rules}
+        validity = ['INITIAL_RULES']
+        if json_msg != None:
+            super(SDXMessageInitialRuleBatch, self).__init__('INITRB',
+                                                        data_json_name,
+                                                        validity,
+                                                        data_json=json_msg)
+        else:
+            super(SDXMessageInitialRuleBatch, self).__init__('INITRB',
+                                                        data_json_name,
+                                                        validity,
+                                                        data)
+
+class SDXMessageInitialRuleAck(SDXMessage):
+    ''' LC acknowledging a range of initial rules received through
+        InitialRuleBatch messages.
+        Valid during Initial Rule phase
+        Contains the index of the first and last rules acknowledged.
+    '''
+    def __init__(self, first=None, last=None, json_msg=None):
+        data_json_name = ['first', 'last']
+        data = {'first':first, 'last':last}
+        validity = ['INITIAL_RULES']
+        if json_msg != None:
+            super(SDXMessageInitialRuleAck, self).__init__('INITRACK',
+                                                        data_json_name,
+                                                        validity,
+                                                        data_json=json_msg)
+        else:
+            super(SDXMessageInitialRuleAck, self).__init__('INITRACK',
+                                                        data_json_name,
+                                                        validity,
+                                                        data)
+
 class SDXMessageTransitionToMainPhase(SDXMessage):
     ''' Notification from SDX to LC to move to Main Phase
         Valid during Initial Rules Complete
@@ -450,6 +555,8 @@ SDX_MESSAGE_NAME_TO_CLASS = {'HELLO': SDXMessageHello,
                              'INITRC': SDXMessageInitialRuleCount,
                              'INITRREQ': SDXMessageInitialRuleRequest,
                              'INITCOMP': SDXMessageInitialRulesComplete,
+                             'INITRB': SDXMessageInitialRuleBatch,
+                             'INITRACK': SDXMessageInitialRuleAck,
                              'TRANSMP': SDXMessageTransitionToMainPhase,
                              'INSTALL': SDXMessageInstallRule,
                              'INSTCOMP': SDXMessageInstallRuleComplete,
@@ -461,6 +568,41 @@ SDX_MESSAGE_NAME_TO_CLASS = {'HELLO': SDXMessageHello,
                              'CALLBACK': SDXMessageSwitchChangeCallback,
                              }
 
+RECOVERY_RULE_TYPES = (ManagementLCRecoverRule, ManagementSDXRecoverRule)
+LEARNED_RULE_TYPES = (LearnedDestinationLCRule,
+                      L2MultipointLearnedDestinationLCRule)
+
+def message_priority(sdx_message):
+    ''' Returns the priority class of a message:
+          - PRIORITY_RECOVERY for installing management recovery rules
+          - PRIORITY_USER for installing any other rules, and for removing
+            rules, so that removals and user installs are sent in order.
+          - PRIORITY_LEARNED for installing learned destination rules, and 
+            for UnknownSource and SwitchChangeCallback messages.
+          - PRIORITY_CONTROL for everything else: heartbeats, 
+            acknowledgements and the like.
+        Removals are also never sent before anything queued ahead of them in
+        another lane, see is_ordered_message(). '''
+    if isinstance(sdx_message, SDXMessageInstallRule):
+        rule = sdx_message.get_data()['rule']
+        if isinstance(rule, RECOVERY_RULE_TYPES):
+            return PRIORITY_RECOVERY
+        if isinstance(rule, LEARNED_RULE_TYPES):
+            return PRIORITY_LEARNED
+        return PRIORITY_USER
+    if isinstance(sdx_message, SDXMessageRemoveRule):
+        return PRIORITY_USER
+    if isinstance(sdx_message, (SDXMessageUnknownSource,
+                                SDXMessageSwitchChangeCallback)):
+        return PRIORITY_LEARNED
+    return PRIORITY_CONTROL
+
+def is_ordered_message(sdx_message):
+    ''' Returns True if sdx_message must wait for everything queued before it,
+        in every lane. Removals do, so that they can never overtake the 
+        install of a rule they're removing. '''
+    return isinstance(sdx_message, SDXMessageRemoveRule)
+
 class SDXControllerConnectionValueError(ValueError):
     pass
 
@@ -476,6 +618,8 @@ class SDXControllerConnection(Connection):
           - Size of Message
           - Message data
     '''
+    FRAME_HEADER = '>iii'
+    FRAME_FLAGS = FRAME_COMPRESSED
 
     def __init__(self, address, port, sock, loggerid):
         self.msg_num = 0
@@ -486,13 +630,88 @@ class SDXControllerConnection(Connection):
         self.name = None
         self.capabilites = None
 
+        # Capability negotiation. bulk_initial_rules can be set to False to
+        # force the one-rule-per-request initial rules exchange.
+        self.bulk_initial_rules = True
+        self.initial_rules_batch_size = DEFAULT_INITIAL_RULES_BATCH_SIZE
+        self.initial_rules_window = DEFAULT_INITIAL_RULES_WINDOW
+        self.negotiated_capabilities = {}
+
+        # Wire encoding. binary_codec can be set to False to keep using
+        # pickle. codec_version is None until the binary codec is negotiated.
+        # After that, messages with values the codec can't encode are pickled
+        # unless pickle_fallback is False, in which case sending them is an
+        # error and pickled messages are no longer accepted.
+        self.binary_codec = True
+        self.codec_version = None
+        self.pickle_fallback = True
+
+        # Rule digests. rule_digest can be set to False to always exchange
+        # every initial rule. digest_buckets is None unless digests were
+        # compared, in which case it's the set of (switch_id, cookie range)
+        # buckets that differed, and the only ones exchanged as initial rules.
+        self.rule_digest = True
+        self.digest_buckets = None
+        self.digest_cookie_range = None
+
+        # Compression. compression can be set to False to neither offer nor
+        # accept it. compression_algorithm is None until compression is
+        # negotiated. After that, messages at least compression_threshold
+        # bytes long, the larger of the two sides' thresholds, are compressed
+        # if that makes them smaller.
+        self.compression = True
+        self.compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+        self.compression_level = DEFAULT_COMPRESSION_LEVEL
+        self.compression_algorithm = None
+        self._compression_lock = threading.Lock()
+        self._compression_stats = {'compressed':0,
+                                   'incompressible':0,
+                                   'bytes_in':0,
+                                   'bytes_out':0,
+                                   'compress_seconds':0.0,
+                                   'decompressed':0,
+                                   'decompress_seconds':0.0}
+
         # Heartbeat tracking
         self.outstanding_hb = False
         self.hb_thread = None
+        self.hb_timer = None
         self.heartbeat_sleep_time = 10
         self._heartbeat_request_sent = 0
         self._heartbeat_response_sent = 0
 
+        # Outbound queue, see enqueue_protocol(). Messages are written by a
+        # writer thread, which is started when the first one is queued. The
+        # send lock keeps frames from different threads from interleaving.
+        # There's a lane per priority class. priority_lanes can be set to
+        # False to queue everything in order, in a single lane. Each queued
+        # message is (sequence number, time queued, data, ordered).
+        self.outbound_queue_size = DEFAULT_OUTBOUND_QUEUE_SIZE
+        self.outbound_coalesce_bytes = DEFAULT_OUTBOUND_COALESCE_BYTES
+        self.outbound_max_wait = DEFAULT_OUTBOUND_MAX_WAIT
+        self.priority_lanes = True
+        self._send_lock = threading.Lock()
+        self._outbound = dict((p, deque()) for p in PRIORITY_NAMES.keys())
+        self._outbound_seq = 0
+        self._outbound_depth = 0
+        self._outbound_cv = threading.Condition()
+        self._outbound_in_flight = 0
+        self._outbound_failed = None
+        self._writer_thread = None
+        self._outbound_stats = {'queued':0,
+                                'sent':0,
+                                'writes':0,
+                                'bytes':0,
+                                'dropped':0,
+                                'max_depth':0,
+                                'drain_latency_total':0.0,
+                                'drain_latency_max':0.0}
+        self._lane_stats = dict((p, {'queued':0,
+                                     'sent':0,
+                                     'drain_latency_total':0.0,
+                                     'drain_latency_max':0.0})
+                                for p in PRIORITY_NAMES.keys())
+
         # Callbacks
         self._del_callback = None
         self._new_callback = None
@@ -528,36 +747,22 @@ class SDXControllerConnection(Connection):
             raise SDXMessageConnectionFailure("sock == None - %s" % self)
             
         try:
-            sock_data = ''
-            meta_data = ''
-            meta_tries = 0
-            while (len(meta_data) < 12 and
-                   meta_tries < 10):
-                sock_data = self.sock.recv(12-len(meta_data))
-                meta_data += sock_data
-                if len(meta_data) == 12:
-                    (msg_num, msg_ack, size) = struct.unpack('>iii',
-                                                                  meta_data)
-                meta_tries += 1
-            # So we don't just keep spinning when there's actually nothing there
-            if meta_tries == 10:
-                return None
-            total_len = 0
-            total_data = []
-            recv_size = size
-            if recv_size > 524388:
-                recv_size = 524288
-            while total_len < size:
-                sock_data = self.sock.recv(recv_size)
-                total_data.append(sock_data)
-                total_len = sum([len(i) for i in total_data])
-                recv_size = size - total_len
-                if recv_size > 524388:
-                    recv_size = 524288
-            data_raw = ''.join(total_data)
-
-            # Unpickle!
-            data = pickle.loads(data_raw)
+            try:
+                ((msg_num, msg_ack, size), data_raw) = \
+                    self.frame_reader.read_frame(self.sock)
+            except ConnectionClosedError:
+                # Orderly shutdown by the peer. Otherwise, a closed socket
+                # stays readable forever.
+                self.close()
+                self._del_callback(self)
+                raise SDXMessageConnectionFailure("Connection closed by peer - %s"
+                                                  % self)
+            except ConnectionValueError as e:
+                raise SDXMessageValueError("Invalid frame: %s - %s" % (e, self))
+            if size & FRAME_COMPRESSED:
+                data_raw = self._decompress(data_raw)
+
+            data = self._decode(data_raw)
 
             # Check/update msg_num and msg_ack
             if msg_ack > self.msg_num:
@@ -638,13 +843,8 @@ class SDXControllerConnection(Connection):
             # These are handy logs when needing to look at *everything*
             #print ">>>> SENDING %s" % sdx_message
             #print ">>>>    JSON %s\n\n" % sdx_message.get_json()
-            data_raw = pickle.dumps(data)
-            self.sock.sendall(struct.pack('>iii',
-                                          self.msg_num,
-                                          self.msg_ack,
-                                          len(data_raw)) + data_raw)
-            # Update msg_num
-            self.msg_num += 1
+            data_raw = self._encode(data)
+            self._send_frames([data_raw])
 
         except socket.error as e:
             if (e.errno == 104 or  # Connection reset by peer 
@@ -665,9 +865,228 @@ class SDXControllerConnection(Connection):
         except:
             raise
 
+    def _send_frames(self, payloads):
+        ''' Writes encoded messages to the socket, in a single write. They're
+            compressed first, if compression was negotiated. '''
+        payloads = [self._compress(data_raw) for data_raw in payloads]
+        with self._send_lock:
+            frames = []
+            for (data_raw, flags) in payloads:
+                frames.append(struct.pack('>iii', self.msg_num, self.msg_ack,
+                                          len(data_raw) | flags))
+                frames.append(data_raw)
+                # Update msg_num
+                self.msg_num += 1
+            self.sock.sendall(''.join(frames))
+
+    def enqueue_protocol(self, sdx_message, priority=None):
+        ''' Queues sdx_message to be sent by the writer thread, and returns
+            without waiting for it to be sent. Each priority class has its own
+            lane: the writer sends from the highest priority lane that has
+            anything queued, unless a lower priority lane's oldest message has
+            waited longer than outbound_max_wait. Control messages always go
+            first. Messages within a lane are sent in order, and ordered
+            messages, see is_ordered_message(), after everything queued before
+            them. priority defaults to message_priority(sdx_message). Small
+            messages are combined into larger writes.
+            If the queue is full, the peer isn't keeping up: the connection is
+            shut down, and SDXOutboundQueueFullError is raised. Anything that
+            was lost is sent again as initial rules when the LC reconnects.
+            Once the connection has failed, raises
+            SDXMessageConnectionFailure. '''
+        if priority == None:
+            priority = message_priority(sdx_message)
+        if priority not in PRIORITY_NAMES:
+            raise SDXMessageValueError("Invalid priority %s for %s" %
+                                       (priority, sdx_message.name))
+        if not self.priority_lanes:
+            priority = PRIORITY_USER
+        data_raw = self._encode(sdx_message.get_json())
+        with self._outbound_cv:
+            if self._outbound_failed != None:
+                raise SDXMessageConnectionFailure("Cannot queue %s: %s - %s" %
+                                                  (sdx_message.name,
+                                                   self._outbound_failed,
+                                                   self))
+            if self._outbound_depth >= self.outbound_queue_size:
+                self._outbound_stats['dropped'] += 1
+                reason = ("Outbound queue full, %d messages" %
+                          self._outbound_depth)
+                self._fail_outbound(reason)
+                raise SDXOutboundQueueFullError("Cannot queue %s: %s - %s" %
+                                                (sdx_message.name, reason,
+                                                 self))
+            self._outbound[priority].append((self._outbound_seq, time(),
+                                             data_raw,
+                                             is_ordered_message(sdx_message)))
+            self._outbound_seq += 1
+            self._outbound_depth += 1
+            self._outbound_stats['queued'] += 1
+            self._outbound_stats['max_depth'] = max(
+                self._outbound_stats['max_depth'], self._outbound_depth)
+            self._lane_stats[priority]['queued'] += 1
+            if self._writer_thread == None:
+                self._writer_thread = threading.Thread(
+                    target=self._outbound_writer_thread)
+                self._writer_thread.daemon = True
+                self._writer_thread.start()
+            self._outbound_cv.notify_all()
+
+    def flush_outbound(self, timeout=None):
+        ''' Waits until everything queued has been written, or the connection
+            has failed. Returns True if the queue was drained. '''
+        end = None
+        if timeout != None:
+            end = time() + timeout
+        with self._outbound_cv:
+            while ((self._outbound_depth > 0 or self._outbound_in_flight > 0)
+                   and self._outbound_failed == None):
+                if end == None:
+                    self._outbound_cv.wait()
+                elif time() >= end:
+                    return False
+                else:
+                    self._outbound_cv.wait(end - time())
+            return self._outbound_failed == None
+
+    def get_outbound_stats(self):
+        ''' Returns a dictionary of outbound queue statistics: current and 
+            maximum depth, and how long queued messages took to be written,
+            on average and at worst, in seconds. 'lanes' has the depth, 
+            counts and drain latencies for each priority class, by name. '''
+        with self._outbound_cv:
+            stats = dict(self._outbound_stats)
+            stats['depth'] = self._outbound_depth
+            stats['lanes'] = {}
+            for (priority, name) in PRIORITY_NAMES.items():
+                lane = dict(self._lane_stats[priority])
+                lane['depth'] = len(self._outbound[priority])
+                stats['lanes'][name] = lane
+        for entry in [stats] + stats['lanes'].values():
+            entry['drain_latency_avg'] = 0.0
+            if entry['sent'] > 0:
+                entry['drain_latency_avg'] = (entry['drain_latency_total'] /
+                                              entry['sent'])
+            del entry['drain_latency_total']
+        return stats
+
+    def get_inbound_stats(self):
+        ''' Returns a dictionary of receive statistics: frames and bytes
+            received, recv calls made, and the size of the receive buffer.
+            See FrameReader.get_stats(). '''
+        return self.frame_reader.get_stats()
+
+    def _outbound_writer_thread(self):
+        while True:
+            with self._outbound_cv:
+                while (self._outbound_depth == 0 and
+                       self._outbound_failed == None):
+                    self._outbound_cv.wait()
+                if self._outbound_failed != None:
+                    return
+                batch = self._take_outbound_batch()
+                size = sum([len(data_raw) for (priority, queued, data_raw)
+                            in batch])
+                self._outbound_depth -= len(batch)
+                self._outbound_in_flight = len(batch)
+
+            try:
+                self._send_frames([data_raw for (priority, queued, data_raw)
+                                   in batch])
+            except (socket.error, AttributeError) as e:
+                self.logger.error("%s - %s - Outbound write failed: %s" % (
+                    id(self), self.connection_state, e))
+                with self._outbound_cv:
+                    self._outbound_in_flight = 0
+                    self._fail_outbound("Write failed: %s" % e)
+                return
+
+            now = time()
+            with self._outbound_cv:
+                self._outbound_in_flight = 0
+                self._outbound_stats['writes'] += 1
+                self._outbound_stats['bytes'] += size + 12 * len(batch)
+                for (priority, queued, data_raw) in batch:
+                    for stats in [self._outbound_stats,
+                                  self._lane_stats[priority]]:
+                        stats['sent'] += 1
+                        stats['drain_latency_total'] += now - queued
+                        stats['drain_latency_max'] = max(
+                            stats['drain_latency_max'], now - queued)
+                self._outbound_cv.notify_all()
+
+    def _take_outbound_batch(self):
+        ''' Takes as many queued messages as fit in one write, but always at
+            least one. Control messages go first, then lanes whose oldest
+            message has waited too long, then the rest, highest priority
+            first. An ordered message stops its lane until everything queued
+            before it, in the other lanes, has been taken. Called with
+            _outbound_cv held. '''
+        too_old = time() - self.outbound_max_wait
+        lanes = sorted(self._outbound.keys(),
+                       key=lambda p: (p != PRIORITY_CONTROL and
+                                      (len(self._outbound[p]) == 0 or
+                                       self._outbound[p][0][1] > too_old), p))
+        batch = []
+        size = 0
+        # Sequence number of the first ordered message that had to wait.
+        # Nothing queued after it is taken.
+        barrier = None
+        for priority in lanes:
+            lane = self._outbound[priority]
+            while (len(lane) > 0 and
+                   (len(batch) == 0 or
+                    (size + len(lane[0][2]) <=
+                     self.outbound_coalesce_bytes))):
+                (seq, queued, data_raw, ordered) = lane[0]
+                if barrier != None and seq > barrier:
+                    break
+                if ordered and [p for p in self._outbound
+                                if (p != priority and
+                                    len(self._outbound[p]) > 0 and
+                                    self._outbound[p][0][0] < seq)]:
+                    barrier = seq if barrier == None else min(barrier, seq)
+                    break
+                lane.popleft()
+                batch.append((priority, queued, data_raw))
+                size += len(data_raw)
+        return batch
+
+    def _fail_outbound(self, reason, shutdown=True):
+        ''' Stops the writer thread and drops everything queued. If shutdown
+            is set, the socket is shut down, so that the receiving side sees
+            the connection go away and cleans it up as usual. '''
+        with self._outbound_cv:
+            if self._outbound_failed != None:
+                return
+            self._outbound_failed = reason
+            self._outbound_stats['dropped'] += self._outbound_depth
+            for lane in self._outbound.values():
+                lane.clear()
+            self._outbound_depth = 0
+            self._outbound_cv.notify_all()
+        if shutdown:
+            self.logger.error("%s - %s - Shutting down connection: %s" % (
+                id(self), self.connection_state, reason))
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError):
+                pass
+
+    def get_digest_buckets(self):
+        ''' Returns (buckets, cookie_range). buckets is None if all initial
+            rules were exchanged, otherwise it's the set of (switch_id, cookie
+            range) buckets that initial rules were exchanged for: rules in
+            any other bucket were the same on both sides. '''
+        return (self.digest_buckets, self.digest_cookie_range)
+
     def transition_to_main_phase_LC(self, name, capabilities,
                                     install_rule_callback,
-                                    initial_rules_complete_callback=None):
+                                    initial_rules_complete_callback=None,
+                                    rule_digest_callback=None):
+        ''' rule_digest_callback, if given, is called with a cookie range and
+            returns a RuleDigest of the rules the LC has installed. It's used
+            to skip initial rules that are already installed. '''
         #FIXME: These messages should check state.
         # Transition to Initializing
         self.logger.warning("%s - %s - Initializing" % (id(self), self.connection_state))
@@ -691,11 +1110,17 @@ class SDXControllerConnection(Connection):
             id(self), self.connection_state))
 
         # Send Capabilities, transition to Initial Rules
-        #FIXME: DOESN'T EXIST RIGHT NOW. Don't need to fill it out
-        respcap = SDXMessageCapabilitiesResponse()
+        offered = {}
+        if reqcap.get_data() != None:
+            offered = reqcap.get_data()['capabilities']
+        self.negotiated_capabilities = self._accept_capabilities(
+            offered, rule_digest_callback)
+        respcap = SDXMessageCapabilitiesResponse(self.negotiated_capabilities)
         self.send_protocol(respcap)
-        self.logger.warning("%s - %s - Sent Capabilities, transition to INITIAL_RULES" % (
-            id(self), self.connection_state))
+        self._use_negotiated_codec()
+        self._use_negotiated_compression()
+        self.logger.warning("%s - %s - Sent Capabilities %s, transition to INITIAL_RULES" % (
+            id(self), self.connection_state, self.negotiated_capabilities))
         self.connection_state = 'INITIAL_RULES'
 
         # Wait for Initial Rule count
@@ -707,6 +1132,11 @@ class SDXControllerConnection(Connection):
         self.logger.warning("%s - %s - Received Initial Rules Count %s" % (
             id(self), self.connection_state, rule_count_left))
 
+        if CAPABILITY_BULK_INITIAL_RULES in self.negotiated_capabilities:
+            self._recv_initial_rules_bulk(rule_count_left,
+                                          install_rule_callback)
+            rule_count_left = 0
+
         # Loop through initial rules:
         # - Request rule
         # - Receive rule
@@ -747,21 +1177,19 @@ class SDXControllerConnection(Connection):
 
         # Transition to main phase and start the heartbeat thread
         self.connection_state = 'MAIN_PHASE'
-        self.hb_thread = threading.Thread(target=_LC_heartbeat_thread,
-                                          args=(self,))
-        self.hb_thread.daemon = True
-        self.logger.warning("%s - %s - Starting heartbeat thread, going to MAIN_PHASE" % (
-            id(self), self.connection_state))
-        print("%s Starting heartbeat thread LC" % 
-              (threading.current_thread().ident))
-        self.hb_thread.start()
+        self._start_heartbeat('LC', _LC_heartbeat_thread)
 
         # Add connection!
         self._new_callback(self)
         self.sock.setblocking(0)
 
     def transition_to_main_phase_SDX(self, set_name_callback,
-                                     get_initial_rule_callback):
+                                     get_initial_rule_callback,
+                                     get_rule_digest_callback=None):
+        ''' get_rule_digest_callback, if given, is called with the LC's name
+            and returns a RuleDigest of the rules from 
+            get_initial_rule_callback. If the LC also has a digest, only
+            rules in buckets that differ are sent. '''
         # Transition to Initializing
         self.logger.warning("%s - %s - Initializing" % (id(self), self.connection_state))
         self.connection_state = 'INITIALIZING'
@@ -778,21 +1206,45 @@ class SDXControllerConnection(Connection):
         self.logger.warning("%s - %s - Getting initial rules for %s" % (
             id(self), self.connection_state, self.name))
         initial_rules = get_initial_rule_callback(self.name)
+        digest = None
+        if get_rule_digest_callback != None:
+            digest = get_rule_digest_callback(self.name)
 
         # Transition to Capabilities, send request capabilities
         self.connection_state = 'CAPABILITIES'
-        reqcap = SDXMessageCapabilitiesRequest()
+        reqcap = SDXMessageCapabilitiesRequest(
+            self._offer_capabilities(digest))
         self.send_protocol(reqcap)
         self.logger.warning("%s - %s - Sent request capabilities" % (
             id(self), self.connection_state))
 
-        # Wait for capabilities
-        #FIXME: NOTHING REALLY TO DO WITH THIS YET.
+        # Wait for capabilities. An LC that doesn't know about a capability
+        # won't include it in its response.
         respcap = self.recv_protocol()
         if not isinstance(respcap, SDXMessageCapabilitiesResponse):
             raise SDXControllerConnectionTypeError("SDXMessageCapabilitiesResponse not received: %s, %s" % (type(respcap), respcap))
-        self.logger.warning("%s - %s - Received capabilities, transitioning to INITIAL_RULES" % (
-            id(self), self.connection_state))
+        self.negotiated_capabilities = {}
+        if (respcap.get_data() != None and
+            isinstance(respcap.get_data()['capabilities'], dict)):
+            self.negotiated_capabilities = respcap.get_data()['capabilities']
+        self._use_negotiated_codec()
+        self._use_negotiated_compression()
+        self.logger.warning("%s - %s - Received capabilities %s, transitioning to INITIAL_RULES" % (
+            id(self), self.connection_state, self.negotiated_capabilities))
+
+        # Only send the rules in buckets that differ.
+        if (digest != None and
+            CAPABILITY_RULE_DIGEST in self.negotiated_capabilities):
+            params = self.negotiated_capabilities[CAPABILITY_RULE_DIGEST]
+            self.digest_buckets = set(tuple(b) for b in params['buckets'])
+            self.digest_cookie_range = digest.cookie_range
+            total = len(initial_rules)
+            initial_rules = [r for r in initial_rules if
+                             digest.bucket(r.get_cookie(), r.get_switch_id())
+                             in self.digest_buckets]
+            self.logger.warning("%s - %s - %d rule digest buckets differ, sending %d of %d initial rules" % (
+                id(self), self.connection_state, len(self.digest_buckets),
+                len(initial_rules), total))
 
         # Transition to Initial Rules, send Initial Rule count
         self.connection_state = 'INITIAL_RULES'
@@ -800,6 +1252,10 @@ class SDXControllerConnection(Connection):
         self.send_protocol(irc)
         self.logger.warning("%s - %s - Sent Initial Rule Count, count %s" % (
             id(self), self.connection_state, len(initial_rules)))
+
+        if CAPABILITY_BULK_INITIAL_RULES in self.negotiated_capabilities:
+            self._send_initial_rules_bulk(initial_rules)
+            initial_rules = []
         
         # Loop thorugh initial rules:
         # - Wait for request rule or Initial Rules Complete
@@ -845,19 +1301,285 @@ class SDXControllerConnection(Connection):
                     id(self), self.connection_state))
 
         self.connection_state = 'MAIN_PHASE'
-        self.hb_thread = threading.Thread(target=_SDX_heartbeat_thread,
+        self._start_heartbeat('SDX', _SDX_heartbeat_thread)
+
+        # Add connection!
+        self._new_callback(self)
+        self.sock.setblocking(0)
+
+    def _offer_capabilities(self, digest=None):
+        ''' Capabilities offered by the SDX in the CapabilitiesRequest.
+            digest is the RuleDigest of the initial rules, if there is one. '''
+        offered = {}
+        if self.bulk_initial_rules:
+            offered[CAPABILITY_BULK_INITIAL_RULES] = {
+                'batch_size':self.initial_rules_batch_size,
+                'window':self.initial_rules_window}
+        if self.binary_codec:
+            offered[CAPABILITY_BINARY_CODEC] = {
+                'versions':SUPPORTED_CODEC_VERSIONS}
+        if self.rule_digest and digest != None:
+            offered[CAPABILITY_RULE_DIGEST] = digest.get_summary()
+        if self.compression:
+            offered[CAPABILITY_COMPRESSION] = {
+                'algorithms':COMPRESSION_ALGORITHMS,
+                'threshold':self.compression_threshold}
+        return offered
+
+    def _accept_capabilities(self, offered, rule_digest_callback=None):
+        ''' Used by the LC to pick which of the offered capabilities to use.
+            Returns the dictionary of accepted capabilities, which is sent back
+            in the CapabilitiesResponse. '''
+        accepted = {}
+        if offered == None:
+            return accepted
+        if (self.bulk_initial_rules and
+            CAPABILITY_BULK_INITIAL_RULES in offered):
+            params = offered[CAPABILITY_BULK_INITIAL_RULES]
+            accepted[CAPABILITY_BULK_INITIAL_RULES] = {
+                'batch_size':min(params['batch_size'],
+                                 self.initial_rules_batch_size),
+                'window':min(params['window'], self.initial_rules_window)}
+        if (self.binary_codec and
+            CAPABILITY_BINARY_CODEC in offered):
+            versions = [v for v in offered[CAPABILITY_BINARY_CODEC]['versions']
+                        if v in SUPPORTED_CODEC_VERSIONS]
+            if len(versions) > 0:
+                accepted[CAPABILITY_BINARY_CODEC] = {'version':max(versions)}
+        if (self.rule_digest and rule_digest_callback != None and
+            CAPABILITY_RULE_DIGEST in offered):
+            summary = offered[CAPABILITY_RULE_DIGEST]
+            try:
+                buckets = rule_digest_callback(
+                    summary['cookie_range']).diff(summary)
+            except (RuleDigestValueError, KeyError, TypeError) as e:
+                # Fall back to exchanging all initial rules.
+                self.logger.error("%s - %s - Cannot compare rule digests: %s" %
+                                  (id(self), self.connection_state, e))
+            else:
+                accepted[CAPABILITY_RULE_DIGEST] = {'buckets':buckets}
+                self.digest_buckets = set(buckets)
+                self.digest_cookie_range = summary['cookie_range']
+        if (self.compression and
+            CAPABILITY_COMPRESSION in offered):
+            params = offered[CAPABILITY_COMPRESSION]
+            algorithms = [a for a in params['algorithms']
+                          if a in COMPRESSION_ALGORITHMS]
+            if len(algorithms) > 0:
+                accepted[CAPABILITY_COMPRESSION] = {
+                    'algorithm':algorithms[0],
+                    'threshold':max(params['threshold'],
+                                    self.compression_threshold)}
+        return accepted
+
+    def _use_negotiated_codec(self):
+        ''' Switches to the binary codec if it was negotiated. Both sides
+            switch right after the CapabilitiesResponse. '''
+        if CAPABILITY_BINARY_CODEC in self.negotiated_capabilities:
+            self.codec_version = self.negotiated_capabilities[
+                CAPABILITY_BINARY_CODEC]['version']
+            self.logger.warning("%s - %s - Using binary codec version %s" % (
+                id(self), self.connection_state, self.codec_version))
+
+    def _use_negotiated_compression(self):
+        ''' Starts compressing large messages if compression was negotiated.
+            Like the codec, both sides switch right after the
+            CapabilitiesResponse. '''
+        if CAPABILITY_COMPRESSION in self.negotiated_capabilities:
+            params = self.negotiated_capabilities[CAPABILITY_COMPRESSION]
+            self.compression_algorithm = params['algorithm']
+            self.compression_threshold = params['threshold']
+            self.logger.warning("%s - %s - Using %s compression above %d bytes" % (
+                id(self), self.connection_state, self.compression_algorithm,
+                self.compression_threshold))
+
+    def get_compression_stats(self):
+        ''' Returns a dictionary of compression statistics: messages
+            compressed, and left uncompressed because compressing them didn't
+            make them smaller; bytes before and after compression and their
+            ratio; messages decompressed; and seconds spent compressing and
+            decompressing. '''
+        with self._compression_lock:
+            stats = dict(self._compression_stats)
+        stats['algorithm'] = self.compression_algorithm
+        stats['threshold'] = self.compression_threshold
+        stats['ratio'] = 1.0
+        if stats['bytes_out'] > 0:
+            stats['ratio'] = float(stats['bytes_in']) / stats['bytes_out']
+        return stats
+
+    def _compress(self, data_raw):
+        ''' Returns (payload, frame flags) for an encoded message. '''
+        if len(data_raw) >= FRAME_COMPRESSED:
+            raise SDXMessageValueError("Message too large: %d bytes" %
+                                       len(data_raw))
+        if (self.compression_algorithm == None or
+            len(data_raw) < self.compression_threshold):
+            return (data_raw, 0)
+        start = time()
+        compressed = zlib.compress(data_raw, self.compression_level)
+        elapsed = time() - start
+        with self._compression_lock:
+            stats = self._compression_stats
+            stats['compress_seconds'] += elapsed
+            if len(compressed) >= len(data_raw):
+                stats['incompressible'] += 1
+                return (data_raw, 0)
+            stats['compressed'] += 1
+            stats['bytes_in'] += len(data_raw)
+            stats['bytes_out'] += len(compressed)
+        return (compressed, FRAME_COMPRESSED)
+
+    def _decompress(self, data_raw):
+        if self.compression_algorithm == None:
+            raise SDXMessageValueError("Compressed message received, but compression was not negotiated - %s" % self)
+        start = time()
+        try:
+            data_raw = zlib.decompress(data_raw)
+        except zlib.error as e:
+            raise SDXMessageValueError("Cannot decompress message: %s - %s" %
+                                       (e, self))
+        elapsed = time() - start
+        with self._compression_lock:
+            self._compression_stats['decompressed'] += 1
+            self._compression_stats['decompress_seconds'] += elapsed
+        return data_raw
+
+    def _encode(self, data):
+        if self.codec_version != None:
+            try:
+                return encode_message(data, self.codec_version)
+            except (SDXCodecTypeError, SDXCodecValueError) as e:
+                if not self.pickle_fallback:
+                    raise SDXMessageTypeError("Cannot encode %s: %s" %
+                                              (data.keys(), e))
+                self.logger.warning("%s - %s - Pickling %s: %s" % (
+                    id(self), self.connection_state, data.keys(), e))
+        return pickle.dumps(data)
+
+    def _decode(self, data_raw):
+        if is_binary_message(data_raw):
+            try:
+                return decode_message(data_raw)
+            except SDXCodecValueError as e:
+                raise SDXMessageValueError("Invalid message: %s" % e)
+        if self.codec_version != None and not self.pickle_fallback:
+            raise SDXMessageValueError("Pickled message received after binary codec version %s was negotiated - %s" % (self.codec_version, self))
+        # Unpickle!
+        return pickle.loads(data_raw)
+
+    def _send_initial_rules_bulk(self, initial_rules):
+        ''' SDX side of the bulk initial rules exchange. Streams rules in
+            InitialRuleBatch messages, keeping at most 'window' batches
+            unacknowledged, and waits for the LC to acknowledge them in
+            ranges. '''
+        params = self.negotiated_capabilities[CAPABILITY_BULK_INITIAL_RULES]
+        batch_size = params['batch_size']
+        window = params['window']
+        if batch_size < 1 or window < 1:
+            raise SDXControllerConnectionValueError("Invalid bulk initial rule parameters: %s" % params)
+
+        next_index = 0
+        outstanding = deque()
+        while next_index < len(initial_rules) or len(outstanding) > 0:
+            # Fill the window
+            while (next_index < len(initial_rules) and
+                   len(outstanding) < window):
+                batch = initial_rules[next_index:next_index + batch_size]
+                msg = SDXMessageInitialRuleBatch(
+                    next_index, [(r, r.get_switch_id()) for r in batch])
+                self.send_protocol(msg)
+                outstanding.append((next_index, next_index + len(batch) - 1))
+                next_index += len(batch)
+
+            # Wait for the oldest batch to be acknowledged
+            ack = self.recv_protocol()
+            if not isinstance(ack, SDXMessageInitialRuleAck):
+                raise SDXControllerConnectionTypeError("SDXMessageInitialRuleAck not received: %s, %s" % (type(ack), ack))
+            acked = (ack.get_data()['first'], ack.get_data()['last'])
+            if acked != outstanding[0]:
+                raise SDXControllerConnectionValueError("Initial rule ack %s does not match outstanding batch %s" % (acked, outstanding[0]))
+            outstanding.popleft()
+
+        self.logger.warning("%s - %s - Sent %d initial rules in bulk" % (
+            id(self), self.connection_state, len(initial_rules)))
+
+    def _recv_initial_rules_bulk(self, rule_count, install_rule_callback):
+        ''' LC side of the bulk initial rules exchange. Each batch is
+            acknowledged as soon as it's received, then each rule is passed to
+            install_rule_callback as an SDXMessageInstallRule, same as in the
+            one-rule-per-request exchange. '''
+        received = 0
+        while received < rule_count:
+            batch = self.recv_protocol()
+            if not isinstance(batch, SDXMessageInitialRuleBatch):
+                raise SDXControllerConnectionTypeError("SDXMessageInitialRuleBatch not received: %s, %s" % (type(batch), batch))
+            first = batch.get_data()['first']
+            rules = batch.get_data()['rules']
+            if first != received or len(rules) == 0:
+                raise SDXControllerConnectionValueError("Initial rule batch starting at %s with %d rules, expected start %d" % (first, len(rules), received))
+            if received + len(rules) > rule_count:
+                raise SDXControllerConnectionValueError("Received %d initial rules, only expected %d" % (received + len(rules), rule_count))
+
+            received += len(rules)
+            self.send_protocol(SDXMessageInitialRuleAck(first, received - 1))
+
+            for (rule, switch_id) in rules:
+                install_rule_callback(SDXMessageInstallRule(rule, switch_id))
+            self.logger.warning("%s - %s - Received initial rules %d-%d, Initial Rules to go %s" % (
+                id(self), self.connection_state, first, received - 1,
+                rule_count - received))
+
+    def _start_heartbeat(self, side, thread_target):
+        ''' If the connection has a reactor, heartbeats are sent from a
+            reactor timer, otherwise from a heartbeat thread. '''
+        if self.reactor != None:
+            self.logger.warning("%s - %s - Starting heartbeat timer, going to MAIN_PHASE" % (
+                id(self), self.connection_state))
+            self.hb_timer = self.reactor.call_every(self.heartbeat_sleep_time,
+                                                    self._send_heartbeat, side)
+            return
+
+        self.hb_thread = threading.Thread(target=thread_target,
                                           args=(self,))
-        
         self.hb_thread.daemon = True
         self.logger.warning("%s - %s - Starting heartbeat thread, going to MAIN_PHASE" % (
             id(self), self.connection_state))
-        print("%s Starting heartbeat thread SDX" % 
-              (threading.current_thread().ident))
+        print("%s Starting heartbeat thread %s" % 
+              (threading.current_thread().ident, side))
         self.hb_thread.start()
 
-        # Add connection!
-        self._new_callback(self)
-        self.sock.setblocking(0)
+    def _send_heartbeat(self, side):
+        ''' Sends a single HeartbeatRequest. Returns False, after closing the
+            connection, if the previous one was never answered or if sending
+            fails. '''
+        # Check to see if there's an outstanding HB - there shouldn't be
+        try:
+            if self.outstanding_hb == True:
+                print "%s Closing: Missing a heartbeat on %s" % (side,
+                                                                 hex(id(self)))
+                raise SDXMessageConnectionFailure("%s Missing heartbeat on %s" %
+                                                  (side, hex(id(self))))
+            # Send a heartbeat request over
+            req = SDXMessageHeartbeatRequest()
+            self.outstanding_hb = True
+            self.enqueue_protocol(req)
+            self._heartbeat_request_sent += 1
+            return True
+        except:
+            # Need to signal that the cxn is closed.
+            print "%s Heartbeat Closing due to error on %s" % (side,
+                                                               hex(id(self)))
+            self.close()
+            self._del_callback(self)
+            return False
+
+    def close(self):
+        self._fail_outbound("Connection closed", shutdown=False)
+        if self.hb_timer != None:
+            self.reactor.cancel(self.hb_timer)
+            self.hb_timer = None
+        super(SDXControllerConnection, self).close()
 
     def _heartbeat_response_handler(self, hbresp):
         ''' Handles incoming HeartbeatResponses. '''
@@ -872,62 +1594,16 @@ class SDXControllerConnection(Connection):
         print "%s hb_request_handler: %s" % (threading.current_thread().ident,
                                              hbreq)
         resp = SDXMessageHeartbeatResponse()
-        self.send_protocol(resp)
+        self.enqueue_protocol(resp)
         self._heartbeat_response_sent += 1
 
 
 def _SDX_heartbeat_thread(inst):
     ''' Handles automatically sending Heartbeats consistently. '''
-    # Get set up
-    
-    # Loop
-    while(True):
-        # Check to see if there's an outstanding HB - there shouldn't be
-        try:
-            if inst.outstanding_hb == True:
-                print "SDX Closing: Missing a heartbeat on %s" % hex(id(inst))
-                raise SDXMessageConnectionFailure("SDX Missing heartbeat on %s" % 
-                                                  hex(id(inst)))
-            # Send a heartbeat request over
-            req = SDXMessageHeartbeatRequest()
-            inst.outstanding_hb = True
-            #print "SDX Send HBREQ"
-            inst.send_protocol(req)
-            inst._heartbeat_request_sent += 1
-        
-            # Sleep
-            sleep(inst.heartbeat_sleep_time)
-        except:
-            # Need to signal that the cxn is closed.
-            print "SDX Heartbeat Closing due to error on %s" % hex(id(inst))
-            inst.close()
-            inst._del_callback(inst)
-            return
+    while inst._send_heartbeat('SDX'):
+        sleep(inst.heartbeat_sleep_time)
         
 def _LC_heartbeat_thread(inst):
     ''' Handles automatically sending Heartbeats consistently. '''
-    # Get set up
-    
-    # Loop
-    while(True):
-        # Check to see if there's an outstanding HB - there shouldn't be
-        try:
-            if inst.outstanding_hb == True:
-                print "LC Closing: Missing a heartbeat on %s" % hex(id(inst))
-                raise SDXMessageConnectionFailure("LC Missing heartbeat on %s" % 
-                                                  hex(id(inst)))
-            # Send a heartbeat request over
-            req = SDXMessageHeartbeatRequest()
-            inst.outstanding_hb = True
-            #print "LC Send HBREQ"
-            inst.send_protocol(req)
-            inst._heartbeat_request_sent += 1
-        
-            # Sleep
-            sleep(inst.heartbeat_sleep_time)
-        except:
-            # Need to signal that the cxn is closed.
-            print "LC Heartbeat Closing due to error on %s" % hex(id(inst))
-            inst.close()
-            inst._del_callback(inst)
-            return
+    while inst._send_heartbeat('LC'):
+        sleep(inst.heartbeat_sleep_time)
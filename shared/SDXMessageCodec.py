@@ -0,0 +1,421 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+
+# Schema-based binary encoding for the SDX-LC wire protocol. This replaces
+# pickle once it's been negotiated during the CAPABILITIES phase (see
+# CAPABILITY_BINARY_CODEC in SDXControllerConnectionManagerConnection.py).
+#
+# An encoded message is:
+#   - CODEC_MAGIC, a single byte that can't start a pickle
+#   - Codec version, a single byte
+#   - Message type ID, from MESSAGE_SCHEMAS
+#   - 0 if the message data is None, 1 otherwise, followed by a value for each
+#     key of that message type, in schema order.
+# Values are a one byte tag followed by the value. Integers 0-127 are encoded
+# in the tag itself. Objects are tagged with an ID from OBJECT_SCHEMAS and
+# carry only the attributes listed there; everything else comes from a
+# template instance of the class. Field and key names never go on the wire.
+#
+# Message types, objects, and their attributes are only ever appended to:
+# changing or reordering them requires a new CODEC_VERSION.
+
+import struct
+
+from shared.LCFields import *
+from shared.LCAction import *
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+from shared.MatchActionLCRule import MatchActionLCRule
+from shared.EdgePortLCRule import EdgePortLCRule
+from shared.FloodTreeLCRule import FloodTreeLCRule
+from shared.L2MultipointEndpointLCRule import L2MultipointEndpointLCRule
+from shared.L2MultipointFloodLCRule import L2MultipointFloodLCRule
+from shared.L2MultipointLearnedDestinationLCRule import L2MultipointLearnedDestinationLCRule
+from shared.LearnedDestinationLCRule import LearnedDestinationLCRule
+from shared.ManagementLCRecoverRule import ManagementLCRecoverRule
+from shared.ManagementSDXRecoverRule import ManagementSDXRecoverRule
+from shared.ManagementVLANLCRule import ManagementVLANLCRule
+
+
+class SDXCodecTypeError(TypeError):
+    pass
+
+class SDXCodecValueError(ValueError):
+    pass
+
+
+CODEC_MAGIC = '\xb5'
+CODEC_VERSION = 1
+SUPPORTED_CODEC_VERSIONS = [1]
+
+# (ID, message name, keys). Keys must match the message's data_json_name.
+MESSAGE_SCHEMAS = [
+    (1, 'HELLO', ['name']),
+    (2, 'HBREQ', []),
+    (3, 'HBRESP', []),
+    (4, 'CAPREQ', ['capabilities']),
+    (5, 'CAPRESP', ['capabilities']),
+    (6, 'INITRC', ['initial_rule_count']),
+    (7, 'INITRREQ', ['rules_to_go']),
+    (8, 'INITCOMP', []),
+    (9, 'INITRB', ['first', 'rules']),
+    (10, 'INITRACK', ['first', 'last']),
+    (11, 'TRANSMP', []),
+    (12, 'INSTALL', ['rule', 'switch_id']),
+    (13, 'INSTCOMP', ['cookie']),
+    (14, 'INSTFAIL', ['cookie', 'failure_reason']),
+    (15, 'REMOVE', ['cookie', 'switch_id']),
+    (16, 'RMCOMP', ['cookie']),
+    (17, 'RMFAIL', ['cookie', 'failure_reason']),
+    (18, 'UNKNOWN', ['mac_address', 'port', 'switch']),
+    (19, 'CALLBACK', ['cookie', 'data']),
+]
+
+# (ID, class, attributes sent, template constructor arguments). Attributes not
+# listed are copied from a template instance built with the constructor
+# arguments; None means there are no such attributes.
+OBJECT_SCHEMAS = [
+    # LCRules
+    (1, VlanTunnelLCRule, ['switch_id', 'cookie', 'inport', 'outport',
+                           'vlan_in', 'vlan_out', 'bidirectional',
+                           'bandwidth'], None),
+    (2, MatchActionLCRule, ['switch_id', 'cookie', 'matches', 'actions',
+                            'ingress'], None),
+    (3, EdgePortLCRule, ['switch_id', 'cookie', 'edgeport'], None),
+    (4, FloodTreeLCRule, ['switch_id', 'cookie', 'ports'], None),
+    (5, L2MultipointEndpointLCRule, ['switch_id', 'cookie', 'flooding_ports',
+                                     'endpoint_ports_and_vlans',
+                                     'intermediate_vlan', 'bandwidth'], None),
+    (6, L2MultipointFloodLCRule, ['switch_id', 'cookie', 'flooding_ports',
+                                  'intermediate_vlan'], None),
+    (7, L2MultipointLearnedDestinationLCRule, ['switch_id', 'cookie',
+                                               'dst_address', 'outport',
+                                               'intermediate_vlan',
+                                               'out_vlan'], None),
+    (8, LearnedDestinationLCRule, ['switch_id', 'cookie', 'dst_address',
+                                   'outport'], None),
+    (9, ManagementLCRecoverRule, ['switch_id', 'cookie'], None),
+    (10, ManagementSDXRecoverRule, ['switch_id', 'cookie'], None),
+    (11, ManagementVLANLCRule, ['switch_id', 'cookie', 'mgmt_vlan',
+                                'mgmt_vlan_ports', 'untagged_mgmt_vlan_ports'],
+     None),
+
+    # LCFields
+    (32, IN_PORT, ['value', 'mask'], (1,)),
+    (33, ETH_DST, ['value', 'mask'], ('00:00:00:00:00:00',)),
+    (34, ETH_SRC, ['value', 'mask'], ('00:00:00:00:00:00',)),
+    (35, ETH_TYPE, ['value', 'mask'], (0,)),
+    (36, IP_PROTO, ['value', 'mask'], (0,)),
+    (37, IPV4_SRC, ['value', 'mask'], ('0.0.0.0',)),
+    (38, IPV4_DST, ['value', 'mask'], ('0.0.0.0',)),
+    (39, TCP_SRC, ['value', 'mask'], (0,)),
+    (40, TCP_DST, ['value', 'mask'], (0,)),
+    (41, UDP_SRC, ['value', 'mask'], (0,)),
+    (42, UDP_DST, ['value', 'mask'], (0,)),
+    (43, VLAN_VID, ['value', 'mask', 'cfi'], (0,)),
+    (44, METADATA, ['value', 'mask'], (0,)),
+
+    # LCActions
+    (64, Forward, ['port'], (1,)),
+    (65, SetField, ['field'], (None,)),
+    (66, WriteMetadata, ['value', 'mask'], (0,)),
+    (67, PushVLAN, [], ()),
+    (68, PopVLAN, [], ()),
+    (69, Continue, [], ()),
+    (70, Drop, [], ()),
+]
+
+
+# Value tags. Tags with the high bit set are the integers 0-127.
+_TAG_NONE = 0x00
+_TAG_TRUE = 0x01
+_TAG_FALSE = 0x02
+_TAG_INT = 0x03
+_TAG_LONG = 0x04
+_TAG_STR = 0x05
+_TAG_UNICODE = 0x06
+_TAG_FLOAT = 0x07
+_TAG_LIST = 0x08
+_TAG_TUPLE = 0x09
+_TAG_DICT = 0x0a
+_TAG_OBJECT = 0x0b
+_TAG_ABSENT = 0x0c
+_TAG_SMALLINT = 0x80
+
+_BYTES = [chr(i) for i in range(256)]
+_FLOAT = struct.Struct('>d')
+
+# Marks a missing attribute or message key.
+_ABSENT = object()
+
+# Values that are entirely contained in their tag, indexed by tag. Used to
+# skip a call to _decode_value() for the most common values.
+_NOT_IMMEDIATE = object()
+_IMMEDIATE = [_NOT_IMMEDIATE] * 256
+_IMMEDIATE[_TAG_NONE] = None
+_IMMEDIATE[_TAG_TRUE] = True
+_IMMEDIATE[_TAG_FALSE] = False
+_IMMEDIATE[_TAG_ABSENT] = _ABSENT
+for _i in range(128):
+    _IMMEDIATE[_TAG_SMALLINT | _i] = _i
+
+
+def _build_schemas():
+    by_name = {}
+    by_id = {}
+    for (msg_id, name, keys) in MESSAGE_SCHEMAS:
+        by_name[name] = (_BYTES[msg_id], keys, frozenset(keys))
+        by_id[msg_id] = (name, keys)
+
+    by_class = {}
+    obj_by_id = {}
+    for (obj_id, cls, attrs, template_args) in OBJECT_SCHEMAS:
+        fixed = {}
+        if template_args != None:
+            fixed = dict(cls(*template_args).__dict__)
+            for attr in attrs:
+                fixed.pop(attr, None)
+        by_class[cls] = (_encode_varint_str(obj_id), attrs)
+        obj_by_id[obj_id] = (cls, attrs, fixed)
+    return (by_name, by_id, by_class, obj_by_id)
+
+
+def _encode_varint(n, append):
+    while n > 0x7f:
+        append(_BYTES[(n & 0x7f) | 0x80])
+        n >>= 7
+    append(_BYTES[n])
+
+def _encode_varint_str(n):
+    chunks = []
+    _encode_varint(n, chunks.append)
+    return ''.join(chunks)
+
+def _decode_varint(buf, pos):
+    b = ord(buf[pos])
+    pos += 1
+    if b < 0x80:
+        return (b, pos)
+    result = b & 0x7f
+    shift = 7
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (result, pos)
+        shift += 7
+
+
+def _encode_value(value, append):
+    t = type(value)
+    if t is int:
+        if 0 <= value < 128:
+            append(_BYTES[_TAG_SMALLINT | value])
+            return
+        append(_BYTES[_TAG_INT])
+        _encode_varint(value << 1 if value >= 0 else (-value << 1) - 1,
+                       append)
+    elif t is str:
+        append(_BYTES[_TAG_STR])
+        _encode_varint(len(value), append)
+        append(value)
+    elif value is None:
+        append(_BYTES[_TAG_NONE])
+    elif t is bool:
+        append(_BYTES[_TAG_TRUE] if value else _BYTES[_TAG_FALSE])
+    elif t is list or t is tuple:
+        append(_BYTES[_TAG_LIST] if t is list else _BYTES[_TAG_TUPLE])
+        _encode_varint(len(value), append)
+        for entry in value:
+            _encode_value(entry, append)
+    elif t is dict:
+        append(_BYTES[_TAG_DICT])
+        _encode_varint(len(value), append)
+        for (k, v) in value.iteritems():
+            _encode_value(k, append)
+            _encode_value(v, append)
+    elif t in _OBJECTS_BY_CLASS:
+        (obj_id, attrs) = _OBJECTS_BY_CLASS[t]
+        append(_BYTES[_TAG_OBJECT])
+        append(obj_id)
+        d = value.__dict__
+        for attr in attrs:
+            v = d.get(attr, _ABSENT)
+            if type(v) is int and 0 <= v < 128:
+                append(_BYTES[_TAG_SMALLINT | v])
+            elif v is _ABSENT:
+                append(_BYTES[_TAG_ABSENT])
+            else:
+                _encode_value(v, append)
+    elif t is long:
+        append(_BYTES[_TAG_LONG])
+        _encode_varint(value << 1 if value >= 0 else (-value << 1) - 1,
+                       append)
+    elif t is unicode:
+        value = value.encode('utf-8')
+        append(_BYTES[_TAG_UNICODE])
+        _encode_varint(len(value), append)
+        append(value)
+    elif t is float:
+        append(_BYTES[_TAG_FLOAT])
+        append(_FLOAT.pack(value))
+    else:
+        raise SDXCodecTypeError("Cannot encode %s: %s" % (t, value))
+
+
+def _decode_value(buf, pos):
+    tag = ord(buf[pos])
+    pos += 1
+    if tag & _TAG_SMALLINT:
+        return (tag & 0x7f, pos)
+    if tag == _TAG_STR or tag == _TAG_UNICODE:
+        (length, pos) = _decode_varint(buf, pos)
+        end = pos + length
+        if end > len(buf):
+            raise SDXCodecValueError("String runs past end of message")
+        if tag == _TAG_UNICODE:
+            return (buf[pos:end].decode('utf-8'), end)
+        return (buf[pos:end], end)
+    if tag == _TAG_OBJECT:
+        (obj_id, pos) = _decode_varint(buf, pos)
+        if obj_id not in _OBJECTS_BY_ID:
+            raise SDXCodecValueError("Unknown object ID %d" % obj_id)
+        (cls, attrs, fixed) = _OBJECTS_BY_ID[obj_id]
+        obj = cls.__new__(cls)
+        d = obj.__dict__
+        d.update(fixed)
+        for attr in attrs:
+            value = _IMMEDIATE[ord(buf[pos])]
+            if value is _NOT_IMMEDIATE:
+                (value, pos) = _decode_value(buf, pos)
+            else:
+                pos += 1
+            if value is not _ABSENT:
+                d[attr] = value
+        return (obj, pos)
+    if tag == _TAG_LIST or tag == _TAG_TUPLE:
+        (length, pos) = _decode_varint(buf, pos)
+        retval = []
+        for i in xrange(length):
+            value = _IMMEDIATE[ord(buf[pos])]
+            if value is _NOT_IMMEDIATE:
+                (value, pos) = _decode_value(buf, pos)
+            else:
+                pos += 1
+            retval.append(value)
+        if tag == _TAG_TUPLE:
+            return (tuple(retval), pos)
+        return (retval, pos)
+    if tag == _TAG_NONE:
+        return (None, pos)
+    if tag == _TAG_TRUE:
+        return (True, pos)
+    if tag == _TAG_FALSE:
+        return (False, pos)
+    if tag == _TAG_INT or tag == _TAG_LONG:
+        (z, pos) = _decode_varint(buf, pos)
+        value = (z >> 1) if not (z & 1) else -((z + 1) >> 1)
+        if tag == _TAG_LONG:
+            return (long(value), pos)
+        return (int(value), pos)
+    if tag == _TAG_DICT:
+        (length, pos) = _decode_varint(buf, pos)
+        retval = {}
+        for i in xrange(length):
+            (k, pos) = _decode_value(buf, pos)
+            (v, pos) = _decode_value(buf, pos)
+            retval[k] = v
+        return (retval, pos)
+    if tag == _TAG_FLOAT:
+        return (_FLOAT.unpack_from(buf, pos)[0], pos + 8)
+    if tag == _TAG_ABSENT:
+        return (_ABSENT, pos)
+    raise SDXCodecValueError("Unknown tag 0x%02x at %d" % (tag, pos - 1))
+
+
+(_MESSAGES_BY_NAME, _MESSAGES_BY_ID,
+ _OBJECTS_BY_CLASS, _OBJECTS_BY_ID) = _build_schemas()
+
+
+def is_binary_message(raw):
+    ''' Returns True if raw was encoded by encode_message(). '''
+    return len(raw) > 0 and raw[0] == CODEC_MAGIC
+
+def encode_message(json_msg, version=CODEC_VERSION):
+    ''' Encodes the output of SDXMessage.get_json(), {name:data}. '''
+    if version not in SUPPORTED_CODEC_VERSIONS:
+        raise SDXCodecValueError("Unsupported codec version %s" % version)
+    if len(json_msg) != 1:
+        raise SDXCodecValueError("Message must have a single name: %s" %
+                                 json_msg.keys())
+    (name, data) = json_msg.items()[0]
+    if name not in _MESSAGES_BY_NAME:
+        raise SDXCodecValueError("Unknown message %s" % name)
+    (msg_id, keys, keyset) = _MESSAGES_BY_NAME[name]
+
+    chunks = [CODEC_MAGIC, _BYTES[version], msg_id]
+    append = chunks.append
+    if data == None:
+        append(_BYTES[0])
+        return ''.join(chunks)
+
+    for key in data:
+        if key not in keyset:
+            raise SDXCodecValueError("%s is not a key of %s: %s" %
+                                     (key, name, keys))
+    append(_BYTES[1])
+    for key in keys:
+        if key in data:
+            _encode_value(data[key], append)
+        else:
+            append(_BYTES[_TAG_ABSENT])
+    return ''.join(chunks)
+
+def decode_message(raw):
+    ''' Decodes a message created by encode_message(), returning {name:data},
+        which can be passed to the SDXMessage constructors as json_msg. '''
+    if not is_binary_message(raw):
+        raise SDXCodecValueError("Not a binary message")
+    try:
+        version = ord(raw[1])
+        if version not in SUPPORTED_CODEC_VERSIONS:
+            raise SDXCodecValueError("Unsupported codec version %d" % version)
+        msg_id = ord(raw[2])
+        if msg_id not in _MESSAGES_BY_ID:
+            raise SDXCodecValueError("Unknown message ID %d" % msg_id)
+        (name, keys) = _MESSAGES_BY_ID[msg_id]
+
+        pos = 4
+        if raw[3] == _BYTES[0]:
+            data = None
+        else:
+            data = {}
+            for key in keys:
+                (value, pos) = _decode_value(raw, pos)
+                if value is not _ABSENT:
+                    data[key] = value
+        if pos != len(raw):
+            raise SDXCodecValueError("%d extra bytes after %s" %
+                                     (len(raw) - pos, name))
+        return {name:data}
+    except IndexError:
+        raise SDXCodecValueError("Message truncated")
+
+def encode_value(value):
+    ''' Encodes a single value: None, bool, int, long, float, str, unicode,
+        list, tuple, dict, or any object in OBJECT_SCHEMAS. '''
+    chunks = []
+    _encode_value(value, chunks.append)
+    return ''.join(chunks)
+
+def decode_value(raw):
+    ''' Decodes a value encoded by encode_value(). '''
+    try:
+        (value, pos) = _decode_value(raw, 0)
+    except IndexError:
+        raise SDXCodecValueError("Value truncated")
+    if pos != len(raw):
+        raise SDXCodecValueError("%d extra bytes after value" %
+                                 (len(raw) - pos))
+    return value
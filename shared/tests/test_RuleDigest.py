@@ -0,0 +1,82 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for shared.RuleDigest module.
+import unittest
+import cPickle as pickle
+from shared.RuleDigest import *
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+
+
+def vlan_rule(switch_id, cookie, vlan):
+    rule = VlanTunnelLCRule(switch_id, 1, 2, vlan, vlan + 1000)
+    rule.set_cookie(cookie)
+    return rule
+
+def make_digest(rules, cookie_range=DEFAULT_COOKIE_RANGE):
+    digest = RuleDigest(cookie_range)
+    for rule in rules:
+        digest.add(rule.get_cookie(), rule.get_switch_id(), rule)
+    return digest
+
+
+class RuleDigestTest(unittest.TestCase):
+    def setUp(self):
+        self.rules = [vlan_rule(s, c, c + 100)
+                      for s in [1, 2] for c in range(0, 1000, 10)]
+
+    def test_order_independent(self):
+        digest = make_digest(self.rules)
+        self.failUnlessEqual(len(digest), len(self.rules))
+        reverse = make_digest(reversed(self.rules))
+        self.failUnlessEqual(digest.get_summary(), reverse.get_summary())
+
+        # Rules that have been pickled and unpickled, as on an LC.
+        copies = make_digest([pickle.loads(pickle.dumps(r))
+                              for r in self.rules])
+        self.failUnlessEqual(digest.get_root(), copies.get_root())
+
+    def test_add_remove(self):
+        digest = make_digest(self.rules)
+        root = digest.get_root()
+        extra = vlan_rule(1, 5, 999)
+        digest.add(5, 1, extra)
+        self.failIfEqual(digest.get_root(), root)
+        digest.remove(5, 1, extra)
+        self.failUnlessEqual(digest.get_root(), root)
+
+        empty = RuleDigest()
+        empty.add(5, 1, extra)
+        empty.remove(5, 1, extra)
+        self.failUnlessEqual(empty.get_summary()['buckets'], {})
+        self.failUnlessRaises(RuleDigestValueError, empty.remove, 5, 1,
+                              extra)
+
+    def test_diff(self):
+        sdx = make_digest(self.rules)
+        lc = sdx.copy()
+        self.failUnlessEqual(lc.diff(sdx.get_summary()), [])
+
+        # Changed rule, missing rule, extra rule, extra switch.
+        lc.remove(10, 1, self.rules[1])
+        lc.add(10, 1, vlan_rule(1, 10, 42))
+        lc.remove(500, 2, self.rules[150])
+        lc.add(700, 2, vlan_rule(2, 700, 42))
+        lc.add(1, 3, vlan_rule(3, 1, 42))
+        self.failUnlessEqual(lc.diff(sdx.get_summary()),
+                             [(1, 0), (2, 1), (2, 2), (3, 0)])
+        self.failUnlessEqual(sdx.diff(lc.get_summary()),
+                             [(1, 0), (2, 1), (2, 2), (3, 0)])
+
+        self.failUnlessRaises(RuleDigestValueError, make_digest([], 10).diff,
+                              sdx.get_summary())
+
+    def test_buckets(self):
+        self.failUnlessEqual(rule_bucket(300, 1), (1, 1))
+        self.failUnlessEqual(rule_bucket(300, 1, 100), (1, 3))
+        self.failUnlessEqual(rule_bucket("sdonovan-756", 1),
+                             rule_bucket("sdonovan-756", 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,17 @@
 # Unit tests for shared.SDXControllerConnectionManagerConnection module.
 import unittest
 import socket
+import struct
 import threading
 import cPickle as pickle
-from time import sleep
+from time import sleep, time
 from shared.SDXControllerConnectionManagerConnection import *
+from shared.SDXMessageCodec import CODEC_VERSION
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+from shared.RuleDigest import RuleDigest
+from shared.LearnedDestinationLCRule import LearnedDestinationLCRule
+from shared.ManagementLCRecoverRule import ManagementLCRecoverRule
+from shared.L2MultipointEndpointLCRule import L2MultipointEndpointLCRule
 from lib.Connection import select as cxnselect
 
 class dummy_rule(object):
@@ -66,6 +73,12 @@ class SDXMessageInitTest(unittest.TestCase):
         msg2 = SDXMessageCapabilitiesRequest(json_msg=json_msg)
         self.failUnlessEqual(msg, msg2)
 
+    def test_CapabilitiesRequest_offer_init(self):
+        msg = SDXMessageCapabilitiesRequest({'offer':1})
+        json_msg = {'CAPREQ':{'capabilities':{'offer':1}}}
+        msg2 = SDXMessageCapabilitiesRequest(json_msg=json_msg)
+        self.failUnlessEqual(msg, msg2)
+
     def test_CapabilitiesResponse_init(self):
         msg = SDXMessageCapabilitiesResponse('data')
         json_msg = {'CAPRESP':{'capabilities':'data'}}
@@ -90,6 +103,18 @@ class SDXMessageInitTest(unittest.TestCase):
         msg2 = SDXMessageInitialRulesComplete(json_msg=json_msg)
         self.failUnlessEqual(msg, msg2)
 
+    def test_InitialRuleBatch_init(self):
+        msg = SDXMessageInitialRuleBatch(10, [("jibberish!", 3)])
+        json_msg = {'INITRB':{'first':10, 'rules':[("jibberish!", 3)]}}
+        msg2 = SDXMessageInitialRuleBatch(json_msg=json_msg)
+        self.failUnlessEqual(msg, msg2)
+
+    def test_InitialRuleAck_init(self):
+        msg = SDXMessageInitialRuleAck(10, 19)
+        json_msg = {'INITRACK':{'first':10, 'last':19}}
+        msg2 = SDXMessageInitialRuleAck(json_msg=json_msg)
+        self.failUnlessEqual(msg, msg2)
+
     def test_TransitionToMainPhase_init(self):
         msg = SDXMessageTransitionToMainPhase()
         json_msg = {'TRANSMP':{}}
@@ -262,6 +287,543 @@ class SDXConnectionEstablishmentEmptyTest(unittest.TestCase):
         print "close"
 
 
+class SDXConnectionBulkInitialRulesTest(unittest.TestCase):
+    def setUp(self):
+        self.ip = "127.0.0.1"
+        self.port = 5588
+        self.rules = [dummy_rule('rule%d' % i, i % 4) for i in range(25)]
+        self.installed = []
+
+        # This is for the listening socket. 
+        self.ReceivingSocket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM)
+        self.ReceivingSocket.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_REUSEADDR, 1)
+        self.ReceivingSocket.bind((self.ip, self.port))
+
+        #These two will be the client and server side connections.
+        self.ServerCxn = None
+        self.ClientCxn = None
+
+    def tearDown(self):
+        if self.ServerCxn != None:
+            self.ServerCxn.close()
+        if self.ClientCxn != None:
+            self.ClientCxn.close()
+        self.ReceivingSocket.close()
+
+    def receiving_thread(self, server_bulk):
+        self.ReceivingSocket.listen(1)
+        
+        sock, client_address = self.ReceivingSocket.accept()
+
+        self.ServerCxn = SDXControllerConnection(self.ip, self.port,
+                                                 sock, __name__)
+        self.ServerCxn.bulk_initial_rules = server_bulk
+        self.ServerCxn.initial_rules_batch_size = 4
+        self.ServerCxn.initial_rules_window = 2
+        self.ServerCxn.set_new_callback(new_callback)
+        self.ServerCxn.set_delete_callback(del_callback)
+        self.ServerCxn.transition_to_main_phase_SDX(set_name_1,
+                                                    lambda x: self.rules)
+
+    def install_rule(self, msg):
+        self.installed.append(msg.get_data()['rule'].name)
+
+    def establish(self, server_bulk, client_bulk):
+        recv_thread = threading.Thread(target=self.receiving_thread,
+                                       args=(server_bulk,))
+        recv_thread.daemon = True
+        recv_thread.start()
+        sleep(.5)
+
+        self.ClientSocket = socket.socket(socket.AF_INET,
+                                          socket.SOCK_STREAM)
+        self.ClientSocket.connect((self.ip, self.port))
+        self.ClientCxn = SDXControllerConnection(self.ip, self.port,
+                                                 self.ClientSocket, __name__)
+        self.ClientCxn.bulk_initial_rules = client_bulk
+        self.ClientCxn.set_new_callback(new_callback)
+        self.ClientCxn.set_delete_callback(del_callback)
+        self.ClientCxn.transition_to_main_phase_LC('TESTING', "asdfjkl;",
+                                                   self.install_rule)
+        recv_thread.join(5)
+
+        self.failUnlessEqual(self.ClientCxn.get_state(), "MAIN_PHASE")
+        self.failUnlessEqual(self.ServerCxn.get_state(), "MAIN_PHASE")
+        self.failUnlessEqual(self.installed, [r.name for r in self.rules])
+
+    def test_bulk_negotiated(self):
+        self.establish(True, True)
+        self.failUnlessEqual(
+            self.ServerCxn.negotiated_capabilities[
+                CAPABILITY_BULK_INITIAL_RULES],
+            {'batch_size':4, 'window':2})
+        self.failUnlessEqual(self.ServerCxn.negotiated_capabilities,
+                             self.ClientCxn.negotiated_capabilities)
+
+    def test_bulk_declined_by_lc(self):
+        self.establish(True, False)
+        self.failIf(CAPABILITY_BULK_INITIAL_RULES in
+                    self.ServerCxn.negotiated_capabilities)
+
+    def test_bulk_not_offered_by_sdx(self):
+        self.establish(False, True)
+        self.failIf(CAPABILITY_BULK_INITIAL_RULES in
+                    self.ClientCxn.negotiated_capabilities)
+
+
+class SDXConnectionCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.ip = "127.0.0.1"
+        self.port = 5589
+        self.rules = []
+        for i in range(5):
+            rule = VlanTunnelLCRule(1, 1, 2, 100+i, 200+i)
+            rule.set_cookie(i)
+            self.rules.append(rule)
+        self.installed = []
+
+        # This is for the listening socket. 
+        self.ReceivingSocket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM)
+        self.ReceivingSocket.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_REUSEADDR, 1)
+        self.ReceivingSocket.bind((self.ip, self.port))
+
+        #These two will be the client and server side connections.
+        self.ServerCxn = None
+        self.ClientCxn = None
+
+    def tearDown(self):
+        if self.ServerCxn != None:
+            self.ServerCxn.close()
+        if self.ClientCxn != None:
+            self.ClientCxn.close()
+        self.ReceivingSocket.close()
+
+    def receiving_thread(self, pickle_fallback):
+        self.ReceivingSocket.listen(1)
+        
+        sock, client_address = self.ReceivingSocket.accept()
+
+        self.ServerCxn = SDXControllerConnection(self.ip, self.port,
+                                                 sock, __name__)
+        self.ServerCxn.pickle_fallback = pickle_fallback
+        self.ServerCxn.set_new_callback(new_callback)
+        self.ServerCxn.set_delete_callback(del_callback)
+        self.ServerCxn.transition_to_main_phase_SDX(set_name_1,
+                                                    lambda x: self.rules)
+
+    def install_rule(self, msg):
+        self.installed.append(msg.get_data()['rule'])
+
+    def establish(self, client_codec, pickle_fallback=True):
+        recv_thread = threading.Thread(target=self.receiving_thread,
+                                       args=(pickle_fallback,))
+        recv_thread.daemon = True
+        recv_thread.start()
+        sleep(.5)
+
+        self.ClientSocket = socket.socket(socket.AF_INET,
+                                          socket.SOCK_STREAM)
+        self.ClientSocket.connect((self.ip, self.port))
+        self.ClientCxn = SDXControllerConnection(self.ip, self.port,
+                                                 self.ClientSocket, __name__)
+        self.ClientCxn.binary_codec = client_codec
+        self.ClientCxn.pickle_fallback = pickle_fallback
+        self.ClientCxn.set_new_callback(new_callback)
+        self.ClientCxn.set_delete_callback(del_callback)
+        self.ClientCxn.transition_to_main_phase_LC('TESTING', "asdfjkl;",
+                                                   self.install_rule)
+        recv_thread.join(5)
+
+        self.failUnlessEqual(self.ClientCxn.get_state(), "MAIN_PHASE")
+        self.failUnlessEqual(self.ServerCxn.get_state(), "MAIN_PHASE")
+        self.failUnlessEqual(self.installed, self.rules)
+
+    def test_codec_negotiated(self):
+        self.establish(True)
+        self.failUnlessEqual(self.ServerCxn.codec_version, CODEC_VERSION)
+        self.failUnlessEqual(self.ClientCxn.codec_version, CODEC_VERSION)
+
+    def test_compression_negotiated(self):
+        self.establish(True)
+        for cxn in [self.ServerCxn, self.ClientCxn]:
+            self.failUnlessEqual(cxn.compression_algorithm, 'zlib')
+            self.failUnlessEqual(cxn.compression_threshold,
+                                 DEFAULT_COMPRESSION_THRESHOLD)
+
+    def test_codec_declined_by_lc(self):
+        self.establish(False)
+        self.failUnlessEqual(self.ServerCxn.codec_version, None)
+        self.failUnlessEqual(self.ClientCxn.codec_version, None)
+
+    def test_no_pickle_fallback(self):
+        self.establish(True, False)
+        msg = SDXMessageInstallRule(dummy_rule("NOPE", 1), 1)
+        self.failUnlessRaises(SDXMessageTypeError,
+                              self.ServerCxn.send_protocol, msg)
+
+
+class SDXConnectionRuleDigestTest(unittest.TestCase):
+    def setUp(self):
+        self.ip = "127.0.0.1"
+        self.port = 5590
+        self.rules = []
+        for i in range(40):
+            rule = VlanTunnelLCRule(i % 2, 1, 2, 100+i, 200+i)
+            rule.set_cookie(i * 10)
+            self.rules.append(rule)
+        self.sdx_digest = RuleDigest(cookie_range=100)
+        for r in self.rules:
+            self.sdx_digest.add(r.get_cookie(), r.get_switch_id(), r)
+        self.installed = []
+
+        # This is for the listening socket. 
+        self.ReceivingSocket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_STREAM)
+        self.ReceivingSocket.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_REUSEADDR, 1)
+        self.ReceivingSocket.bind((self.ip, self.port))
+
+        #These two will be the client and server side connections.
+        self.ServerCxn = None
+        self.ClientCxn = None
+
+    def tearDown(self):
+        if self.ServerCxn != None:
+            self.ServerCxn.close()
+        if self.ClientCxn != None:
+            self.ClientCxn.close()
+        self.ReceivingSocket.close()
+
+    def receiving_thread(self):
+        self.ReceivingSocket.listen(1)
+        
+        sock, client_address = self.ReceivingSocket.accept()
+
+        self.ServerCxn = SDXControllerConnection(self.ip, self.port,
+                                                 sock, __name__)
+        self.ServerCxn.set_new_callback(new_callback)
+        self.ServerCxn.set_delete_callback(del_callback)
+        self.ServerCxn.transition_to_main_phase_SDX(set_name_1,
+                                                    lambda x: self.rules,
+                                                    lambda x: self.sdx_digest)
+
+    def install_rule(self, msg):
+        self.installed.append(msg.get_data()['rule'])
+
+    def establish(self, lc_digest):
+        recv_thread = threading.Thread(target=self.receiving_thread)
+        recv_thread.daemon = True
+        recv_thread.start()
+        sleep(.5)
+
+        self.ClientSocket = socket.socket(socket.AF_INET,
+                                          socket.SOCK_STREAM)
+        self.ClientSocket.connect((self.ip, self.port))
+        self.ClientCxn = SDXControllerConnection(self.ip, self.port,
+                                                 self.ClientSocket, __name__)
+        self.ClientCxn.set_new_callback(new_callback)
+        self.ClientCxn.set_delete_callback(del_callback)
+        digest_callback = None
+        if lc_digest != None:
+            digest_callback = lambda cookie_range: lc_digest
+        self.ClientCxn.transition_to_main_phase_LC('TESTING', "asdfjkl;",
+                                                   self.install_rule, None,
+                                                   digest_callback)
+        recv_thread.join(5)
+
+        self.failUnlessEqual(self.ClientCxn.get_state(), "MAIN_PHASE")
+        self.failUnlessEqual(self.ServerCxn.get_state(), "MAIN_PHASE")
+
+    def test_digests_match(self):
+        self.establish(self.sdx_digest.copy())
+        self.failUnlessEqual(self.installed, [])
+        self.failUnlessEqual(self.ClientCxn.get_digest_buckets(),
+                             (set(), 100))
+        self.failUnlessEqual(self.ServerCxn.get_digest_buckets(),
+                             (set(), 100))
+
+    def test_digests_differ(self):
+        # LC is missing one rule, and has an extra one somewhere else.
+        lc_digest = self.sdx_digest.copy()
+        lc_digest.remove(0, 0, self.rules[0])
+        lc_digest.add(390, 0, VlanTunnelLCRule(0, 1, 2, 999, 999))
+        self.establish(lc_digest)
+        # Everything in those two buckets is sent
+        self.failUnlessEqual(self.installed,
+                             [r for r in self.rules if r.get_switch_id() == 0
+                              and r.get_cookie() < 100 or
+                              r.get_switch_id() == 0 and
+                              r.get_cookie() >= 300])
+        self.failUnlessEqual(self.ClientCxn.get_digest_buckets(),
+                             (set([(0, 0), (0, 3)]), 100))
+
+    def test_no_lc_digest(self):
+        self.establish(None)
+        self.failUnlessEqual(self.installed, self.rules)
+        self.failIf(CAPABILITY_RULE_DIGEST in
+                    self.ServerCxn.negotiated_capabilities)
+        self.failUnlessEqual(self.ClientCxn.get_digest_buckets(),
+                             (None, None))
+
+
+class SDXConnectionOutboundQueueTest(unittest.TestCase):
+    def setUp(self):
+        (sdx_sock, lc_sock) = [socket.socket(_sock=sock) for sock in
+                               socket.socketpair()]
+        self.SDXCxn = SDXControllerConnection("sdx", 0, sdx_sock, __name__)
+        self.LCCxn = SDXControllerConnection("lc", 0, lc_sock, __name__)
+        for cxn in [self.SDXCxn, self.LCCxn]:
+            cxn.set_new_callback(new_callback)
+            cxn.set_delete_callback(del_callback)
+
+    def tearDown(self):
+        self.SDXCxn.close()
+        self.LCCxn.close()
+
+    def test_coalesced_in_order(self):
+        # Hold the send lock so that messages pile up behind the first.
+        with self.SDXCxn._send_lock:
+            for i in range(100):
+                self.SDXCxn.enqueue_protocol(SDXMessageRemoveRule(i, 1))
+            self.failUnless(self.SDXCxn.get_outbound_stats()['depth'] > 0)
+        self.failUnless(self.SDXCxn.flush_outbound(5))
+
+        for i in range(100):
+            msg = self.LCCxn.recv_protocol()
+            self.failUnlessEqual(msg.get_data()['cookie'], i)
+        stats = self.SDXCxn.get_outbound_stats()
+        self.failUnlessEqual(stats['sent'], 100)
+        self.failUnlessEqual(stats['depth'], 0)
+        self.failUnless(stats['writes'] <= 2)
+        self.failUnless(stats['drain_latency_max'] >= 
+                        stats['drain_latency_avg'])
+
+        # Interleaved with direct sends
+        self.SDXCxn.enqueue_protocol(SDXMessageRemoveRule(100, 1))
+        self.SDXCxn.flush_outbound(5)
+        self.SDXCxn.send_protocol(SDXMessageRemoveRule(101, 1))
+        self.failUnlessEqual(self.LCCxn.recv_protocol().get_data()['cookie'],
+                             100)
+        self.failUnlessEqual(self.LCCxn.recv_protocol().get_data()['cookie'],
+                             101)
+
+    def queue_behind_write(self, msgs):
+        ''' Queues msgs while the writer is stuck on an earlier write, then
+            returns what arrives at the LC. '''
+        with self.SDXCxn._send_lock:
+            self.SDXCxn.enqueue_protocol(SDXMessageInstallRuleComplete(0))
+            while self.SDXCxn._outbound_in_flight == 0:
+                sleep(.01)
+            for msg in msgs:
+                self.SDXCxn.enqueue_protocol(msg)
+        self.failUnless(self.SDXCxn.flush_outbound(5))
+        self.failUnlessEqual(self.LCCxn.recv_protocol().get_data()['cookie'],
+                             0)
+        return [self.LCCxn.recv_protocol().name for msg in msgs]
+
+    def test_priority(self):
+        msgs = [SDXMessageRemoveRule(1, 1),
+                SDXMessageInstallRule(LearnedDestinationLCRule(
+                    1, "00:00:00:00:00:01", 2), 1),
+                SDXMessageInstallRule(VlanTunnelLCRule(1, 1, 2, 100, 200), 1),
+                SDXMessageInstallRule(ManagementLCRecoverRule(1, 1), 1),
+                SDXMessageInstallRuleComplete(1)]
+        self.failUnlessEqual([message_priority(m) for m in msgs],
+                             [PRIORITY_USER, PRIORITY_LEARNED,
+                              PRIORITY_USER, PRIORITY_RECOVERY,
+                              PRIORITY_CONTROL])
+        self.failUnlessEqual(self.queue_behind_write(msgs),
+                             ['INSTCOMP', 'INSTALL', 'REMOVE', 'INSTALL',
+                              'INSTALL'])
+        lanes = self.SDXCxn.get_outbound_stats()['lanes']
+        self.failUnlessEqual(lanes['control']['sent'], 2)
+        self.failUnlessEqual(lanes['learned']['sent'], 1)
+        self.failUnlessEqual(lanes['user']['sent'], 2)
+        self.failUnlessEqual(lanes['user']['depth'], 0)
+
+        # One lane, in order
+        self.SDXCxn.priority_lanes = False
+        self.failUnlessEqual(self.queue_behind_write(msgs),
+                             ['REMOVE', 'INSTALL', 'INSTALL', 'INSTALL',
+                              'INSTCOMP'])
+
+    def test_removal_ordered(self):
+        # Removals wait for anything queued before them, even in a lower
+        # priority lane, and later user installs don't overtake them.
+        msgs = [SDXMessageInstallRule(LearnedDestinationLCRule(
+                    1, "00:00:00:00:00:01", 2), 1),
+                SDXMessageRemoveRule(1, 1),
+                SDXMessageInstallRule(VlanTunnelLCRule(1, 1, 2, 100, 200), 1)]
+        self.failUnlessEqual(self.queue_behind_write(msgs),
+                             ['INSTALL', 'REMOVE', 'INSTALL'])
+
+    def queue_learned_then_user(self, wait):
+        ''' Queues a learned install, then a user install wait seconds later,
+            behind an earlier write. Returns the classes of the rules in the
+            order they arrive. '''
+        with self.SDXCxn._send_lock:
+            self.SDXCxn.enqueue_protocol(SDXMessageInstallRuleComplete(0))
+            while self.SDXCxn._outbound_in_flight == 0:
+                sleep(.01)
+            self.SDXCxn.enqueue_protocol(SDXMessageInstallRule(
+                LearnedDestinationLCRule(1, "00:00:00:00:00:01", 2), 1))
+            sleep(wait)
+            self.SDXCxn.enqueue_protocol(SDXMessageInstallRule(
+                VlanTunnelLCRule(1, 1, 2, 100, 200), 1))
+        self.failUnless(self.SDXCxn.flush_outbound(5))
+        self.LCCxn.recv_protocol()
+        return [self.LCCxn.recv_protocol().get_data()['rule'].__class__
+                for i in range(2)]
+
+    def test_aging(self):
+        self.failUnlessEqual(self.queue_learned_then_user(0),
+                             [VlanTunnelLCRule, LearnedDestinationLCRule])
+        # Waited too long, so it isn't overtaken any more.
+        self.SDXCxn.outbound_max_wait = 0.1
+        self.failUnlessEqual(self.queue_learned_then_user(0.2),
+                             [LearnedDestinationLCRule, VlanTunnelLCRule])
+
+    def test_queue_full(self):
+        self.SDXCxn.outbound_queue_size = 5
+        with self.SDXCxn._send_lock:
+            start = time()
+            self.failUnlessRaises(SDXOutboundQueueFullError,
+                                  lambda: [self.SDXCxn.enqueue_protocol(
+                                      SDXMessageRemoveRule(i, 1))
+                                           for i in range(10)])
+            # Never waits on the writer
+            self.failUnless(time() - start < 1)
+        self.failUnlessRaises(SDXMessageConnectionFailure,
+                              self.SDXCxn.enqueue_protocol,
+                              SDXMessageRemoveRule(1, 1))
+        self.failIf(self.SDXCxn.flush_outbound(5))
+        self.failUnless(self.SDXCxn.get_outbound_stats()['dropped'] >= 5)
+
+
+class SDXConnectionFrameTest(unittest.TestCase):
+    def setUp(self):
+        (sdx_sock, lc_sock) = [socket.socket(_sock=sock) for sock in
+                               socket.socketpair()]
+        self.SDXCxn = SDXControllerConnection("sdx", 0, sdx_sock, __name__)
+        self.LCCxn = SDXControllerConnection("lc", 0, lc_sock, __name__)
+        for cxn in [self.SDXCxn, self.LCCxn]:
+            cxn.set_new_callback(new_callback)
+            cxn.set_delete_callback(del_callback)
+
+    def tearDown(self):
+        self.SDXCxn.close()
+        self.LCCxn.close()
+
+    def frame(self, msg):
+        data = pickle.dumps(msg.get_json())
+        return struct.pack('>iii', 1, 0, len(data)) + data
+
+    def test_partial_frames(self):
+        # A frame that arrives in pieces on a non-blocking socket is picked
+        # up where it left off.
+        endpoints = [(p, 100 + p) for p in range(2000)]
+        rule = L2MultipointEndpointLCRule(1, [1, 2], endpoints, 1000, 100)
+        raw = self.frame(SDXMessageInstallRule(rule, 1))
+        sdx_sock = self.SDXCxn.get_socket()
+        self.LCCxn.get_socket().setblocking(0)
+
+        for piece in [raw[:5], raw[5:12], raw[12:1000]]:
+            sdx_sock.sendall(piece)
+            self.failUnlessEqual(self.LCCxn.recv_protocol(), None)
+        sdx_sock.sendall(raw[1000:] + self.frame(SDXMessageRemoveRule(7, 1)))
+
+        msg = self.LCCxn.recv_protocol()
+        self.failUnlessEqual(msg.get_data()['rule'].get_endpoint_ports_and_vlans(),
+                             endpoints)
+        self.failUnlessEqual(self.LCCxn.recv_protocol().get_data()['cookie'],
+                             7)
+        stats = self.LCCxn.get_inbound_stats()
+        self.failUnlessEqual(stats['frames'], 2)
+        self.failUnlessEqual(stats['bytes'], len(raw) +
+                             len(self.frame(SDXMessageRemoveRule(7, 1))))
+        self.failUnlessEqual(stats['partial'], 0)
+
+    def test_closed_mid_frame(self):
+        raw = self.frame(SDXMessageRemoveRule(7, 1))
+        self.SDXCxn.get_socket().sendall(raw[:20])
+        self.SDXCxn.get_socket().shutdown(socket.SHUT_WR)
+        self.failUnlessRaises(SDXMessageConnectionFailure,
+                              self.LCCxn.recv_protocol)
+
+
+class SDXConnectionCompressionTest(unittest.TestCase):
+    def setUp(self):
+        (sdx_sock, lc_sock) = [socket.socket(_sock=sock) for sock in
+                               socket.socketpair()]
+        self.SDXCxn = SDXControllerConnection("sdx", 0, sdx_sock, __name__)
+        self.LCCxn = SDXControllerConnection("lc", 0, lc_sock, __name__)
+        for cxn in [self.SDXCxn, self.LCCxn]:
+            cxn.set_new_callback(new_callback)
+            cxn.set_delete_callback(del_callback)
+        self.endpoints = [(p, 100 + p) for p in range(2000)]
+        self.big = SDXMessageInstallRule(
+            L2MultipointEndpointLCRule(1, [1, 2], self.endpoints, 1000, 100),
+            1)
+
+    def tearDown(self):
+        self.SDXCxn.close()
+        self.LCCxn.close()
+
+    def negotiate(self, sdx_threshold, lc_threshold, lc_compression=True):
+        self.SDXCxn.compression_threshold = sdx_threshold
+        self.LCCxn.compression_threshold = lc_threshold
+        self.LCCxn.compression = lc_compression
+        accepted = self.LCCxn._accept_capabilities(
+            self.SDXCxn._offer_capabilities())
+        for cxn in [self.SDXCxn, self.LCCxn]:
+            cxn.negotiated_capabilities = accepted
+            cxn._use_negotiated_compression()
+
+    def test_compressed(self):
+        self.negotiate(1024, 2048)
+        for cxn in [self.SDXCxn, self.LCCxn]:
+            self.failUnlessEqual(cxn.compression_algorithm, 'zlib')
+            self.failUnlessEqual(cxn.compression_threshold, 2048)
+
+        self.SDXCxn.send_protocol(self.big)
+        self.SDXCxn.send_protocol(SDXMessageRemoveRule(7, 1))
+        msg = self.LCCxn.recv_protocol()
+        self.failUnlessEqual(
+            msg.get_data()['rule'].get_endpoint_ports_and_vlans(),
+            self.endpoints)
+        self.failUnlessEqual(self.LCCxn.recv_protocol().get_data()['cookie'],
+                             7)
+
+        stats = self.SDXCxn.get_compression_stats()
+        self.failUnlessEqual(stats['compressed'], 1)
+        self.failUnless(stats['bytes_in'] > stats['bytes_out'])
+        self.failUnless(stats['ratio'] > 2.0)
+        self.failUnlessEqual(self.LCCxn.get_compression_stats()['decompressed'],
+                             1)
+        # The frame on the wire was the compressed size.
+        self.failUnless(self.LCCxn.get_inbound_stats()['max_frame'] <
+                        stats['bytes_in'])
+
+    def test_declined_by_lc(self):
+        self.negotiate(1024, 1024, False)
+        self.failUnlessEqual(self.SDXCxn.compression_algorithm, None)
+        self.SDXCxn.send_protocol(self.big)
+        self.LCCxn.recv_protocol()
+        self.failUnlessEqual(self.SDXCxn.get_compression_stats()['compressed'],
+                             0)
+
+    def test_not_negotiated(self):
+        self.SDXCxn.negotiated_capabilities = {
+            CAPABILITY_COMPRESSION:{'algorithm':'zlib', 'threshold':1024}}
+        self.SDXCxn._use_negotiated_compression()
+        self.SDXCxn.send_protocol(self.big)
+        self.failUnlessRaises(SDXMessageValueError, self.LCCxn.recv_protocol)
+
+
 class SDXConnectionHeartbeatTest(unittest.TestCase):
     def setUp(self):
         self.ip = "127.0.0.1"
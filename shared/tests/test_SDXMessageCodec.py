@@ -0,0 +1,169 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Unit tests for shared.SDXMessageCodec module.
+import unittest
+from shared.SDXMessageCodec import *
+from shared.SDXControllerConnectionManagerConnection import *
+
+
+def example_rules():
+    rules = [VlanTunnelLCRule(1, 2, 3, 100, 200, False, 1000),
+             MatchActionLCRule(1,
+                               [IN_PORT(1), ETH_DST('00:11:22:33:44:55'),
+                                ETH_TYPE(0x0800),
+                                IPV4_SRC('10.0.0.1', '255.255.0.0'),
+                                TCP_DST(80), VLAN_VID(100),
+                                METADATA(5, 7)],
+                               [Forward(2), SetField(VLAN_VID(200)),
+                                PushVLAN(), PopVLAN(), WriteMetadata(5, 7),
+                                Continue(), Drop()],
+                               False),
+             EdgePortLCRule(1, 2),
+             FloodTreeLCRule(1, [1, 2, 3]),
+             L2MultipointEndpointLCRule(1, [1, 2, 3], [(4, 100), (5, 200)],
+                                        1000, None),
+             L2MultipointFloodLCRule(1, [1, 2, 3], 1000),
+             L2MultipointLearnedDestinationLCRule(1, 'aa:bb:cc:dd:ee', 2,
+                                                  1000, 100),
+             LearnedDestinationLCRule(1, 'aa:bb:cc:dd:ee', 2),
+             ManagementLCRecoverRule(7, 1),
+             ManagementSDXRecoverRule(1),
+             ManagementVLANLCRule(1, 1411, [1, 2], [3])]
+    for i in range(len(rules)):
+        if type(rules[i]) != ManagementLCRecoverRule:
+            rules[i].set_cookie("cookie-%d" % i)
+    return rules
+
+def state(obj):
+    ''' Recursively compares objects by their attributes. '''
+    if hasattr(obj, '__dict__'):
+        return (type(obj), dict((k, state(v))
+                                for (k, v) in obj.__dict__.items()))
+    if type(obj) in (list, tuple):
+        return type(obj)([state(x) for x in obj])
+    return obj
+
+
+class SchemaTest(unittest.TestCase):
+    def test_message_keys(self):
+        # Message schema keys need to match the SDXMessages.
+        for (msg_id, name, keys) in MESSAGE_SCHEMAS:
+            msg = SDX_MESSAGE_NAME_TO_CLASS[name]()
+            self.failUnlessEqual(keys, msg.data_json_name or [])
+        self.failUnlessEqual(
+            sorted([name for (i, name, k) in MESSAGE_SCHEMAS]),
+            sorted(SDX_MESSAGE_NAME_TO_CLASS.keys()))
+
+    def test_unique_ids(self):
+        msg_ids = [i for (i, n, k) in MESSAGE_SCHEMAS]
+        obj_ids = [i for (i, c, a, t) in OBJECT_SCHEMAS]
+        self.failUnlessEqual(len(msg_ids), len(set(msg_ids)))
+        self.failUnlessEqual(len(obj_ids), len(set(obj_ids)))
+
+    def test_every_rule_type(self):
+        types = set([c for (i, c, a, t) in OBJECT_SCHEMAS])
+        for rule in example_rules():
+            self.failUnless(type(rule) in types)
+
+
+class ValueTest(unittest.TestCase):
+    def test_primitives(self):
+        for value in [None, True, False, 0, 1, 127, 128, -1, -128, 2**31,
+                      -2**63, long(5), 2**128, -2**70, "", "abc", "\xb5\x00",
+                      u"", u"caf\xe9", 1.5, -0.25]:
+            decoded = decode_value(encode_value(value))
+            self.failUnlessEqual(decoded, value)
+            self.failUnlessEqual(type(decoded), type(value))
+
+    def test_containers(self):
+        for value in [[], (), {}, [1, "a", None], (1, (2, 3)),
+                      {'a':[1, 2], 3:{'b':(True, False)}}]:
+            decoded = decode_value(encode_value(value))
+            self.failUnlessEqual(decoded, value)
+            self.failUnlessEqual(type(decoded), type(value))
+
+    def test_rules(self):
+        for rule in example_rules():
+            decoded = decode_value(encode_value(rule))
+            self.failUnlessEqual(state(decoded), state(rule))
+
+    def test_unknown_type(self):
+        self.failUnlessRaises(SDXCodecTypeError, encode_value, object())
+        self.failUnlessRaises(SDXCodecTypeError, encode_value, set([1]))
+
+    def test_bad_input(self):
+        raw = encode_value([1, 2, "abcdef"])
+        self.failUnlessRaises(SDXCodecValueError, decode_value, raw[:-2])
+        self.failUnlessRaises(SDXCodecValueError, decode_value, raw + "\x00")
+        self.failUnlessRaises(SDXCodecValueError, decode_value, "\x7f")
+        # Unknown object ID
+        self.failUnlessRaises(SDXCodecValueError, decode_value, "\x0b\x7f")
+
+
+class MessageTest(unittest.TestCase):
+    def roundtrip(self, msg):
+        raw = encode_message(msg.get_json())
+        self.failUnless(is_binary_message(raw))
+        json_msg = decode_message(raw)
+        return SDX_MESSAGE_NAME_TO_CLASS[json_msg.keys()[0]](json_msg=json_msg)
+
+    def test_all_messages(self):
+        rule = example_rules()[0]
+        msgs = [SDXMessageHello("lc1"),
+                SDXMessageHeartbeatRequest(),
+                SDXMessageHeartbeatResponse(),
+                SDXMessageCapabilitiesRequest(),
+                SDXMessageCapabilitiesRequest({'a':{'versions':[1]}}),
+                SDXMessageCapabilitiesResponse({'b':{'version':1}}),
+                SDXMessageInitialRuleCount(5),
+                SDXMessageInitialRuleRequest(4),
+                SDXMessageInitialRulesComplete(),
+                SDXMessageInitialRuleBatch(0, [(rule, 1)]),
+                SDXMessageInitialRuleAck(0, 1),
+                SDXMessageTransitionToMainPhase(),
+                SDXMessageInstallRule(rule, 1),
+                SDXMessageInstallRuleComplete(3),
+                SDXMessageInstallRuleFailure(3, "reason"),
+                SDXMessageRemoveRule(3, 1),
+                SDXMessageRemoveRuleComplete(3),
+                SDXMessageRemoveRuleFailure(3, "reason"),
+                SDXMessageUnknownSource("00:11:22:33:44:55", 1, "br1"),
+                SDXMessageSwitchChangeCallback({'cookie':1, 'data':[1]})]
+        for msg in msgs:
+            self.failUnlessEqual(self.roundtrip(msg), msg)
+
+    def test_install_every_rule(self):
+        for rule in example_rules():
+            msg = self.roundtrip(SDXMessageInstallRule(rule, 1))
+            self.failUnlessEqual(state(msg.get_data()['rule']), state(rule))
+
+    def test_not_pickle(self):
+        import cPickle as pickle
+        msg = SDXMessageHello("lc1").get_json()
+        self.failIf(is_binary_message(pickle.dumps(msg)))
+        self.failIf(is_binary_message(pickle.dumps(msg, 2)))
+        self.failUnlessRaises(SDXCodecValueError, decode_message,
+                              pickle.dumps(msg))
+
+    def test_bad_messages(self):
+        raw = encode_message(SDXMessageHello("lc1").get_json())
+        # Unsupported version
+        self.failUnlessRaises(SDXCodecValueError, decode_message,
+                              raw[0] + "\x7f" + raw[2:])
+        self.failUnlessRaises(SDXCodecValueError, encode_message,
+                              SDXMessageHello("lc1").get_json(), 127)
+        # Unknown message
+        self.failUnlessRaises(SDXCodecValueError, decode_message,
+                              raw[:2] + "\x7f" + raw[3:])
+        self.failUnlessRaises(SDXCodecValueError, encode_message,
+                              {'NOPE':None})
+        # Key that isn't in the schema
+        self.failUnlessRaises(SDXCodecValueError, encode_message,
+                              {'HELLO':{'name':'lc1', 'extra':1}})
+        # Truncated
+        self.failUnlessRaises(SDXCodecValueError, decode_message, raw[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Micro-benchmarks for encoding and decoding SDX-LC messages. Compares the
+# binary codec (shared/SDXMessageCodec.py) against pickle as it was used on
+# the wire (protocol 0), and against pickle protocol 2 for reference. Times
+# are per message, and include building the SDXMessage on decode as
+# recv_protocol() does.
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/codec_benchmark.py -n 2000
+#
+
+import cPickle as pickle
+import json
+import timeit
+
+from shared.SDXMessageCodec import *
+from shared.SDXControllerConnectionManagerConnection import *
+
+
+def make_messages():
+    ''' Returns a list of (description, SDXMessage). '''
+    vlan_rule = VlanTunnelLCRule(1, 2, 3, 100, 200, True, 1000)
+    vlan_rule.set_cookie(1234)
+    ma_rule = MatchActionLCRule(1,
+                                [IN_PORT(1), ETH_DST('00:11:22:33:44:55'),
+                                 VLAN_VID(100)],
+                                [SetField(VLAN_VID(200)), Forward(2)],
+                                True)
+    ma_rule.set_cookie(1235)
+    mp_rule = L2MultipointEndpointLCRule(1, [1, 2, 3], [(4, 100), (5, 200)],
+                                         1000, 10000)
+    mp_rule.set_cookie(1236)
+    batch = []
+    for i in range(256):
+        rule = VlanTunnelLCRule(i % 4, 1, 2, (i % 4000) + 1, (i % 4000) + 1,
+                                True, 1000)
+        rule.set_cookie(i)
+        batch.append((rule, rule.get_switch_id()))
+
+    return [("HBREQ", SDXMessageHeartbeatRequest()),
+            ("UNKNOWN", SDXMessageUnknownSource("00:11:22:33:44:55", 3,
+                                                "br1")),
+            ("INSTALL VlanTunnel", SDXMessageInstallRule(vlan_rule, 1)),
+            ("INSTALL MatchAction", SDXMessageInstallRule(ma_rule, 1)),
+            ("INSTALL L2MPEndpoint", SDXMessageInstallRule(mp_rule, 1)),
+            ("INITRB 256 rules", SDXMessageInitialRuleBatch(0, batch))]
+
+
+def _to_msg(json_msg):
+    return SDX_MESSAGE_NAME_TO_CLASS[json_msg.keys()[0]](json_msg=json_msg)
+
+CODECS = [('pickle0', pickle.dumps,
+           lambda raw: _to_msg(pickle.loads(raw))),
+          ('pickle2', lambda data: pickle.dumps(data, 2),
+           lambda raw: _to_msg(pickle.loads(raw))),
+          ('binary', encode_message,
+           lambda raw: _to_msg(decode_message(raw)))]
+
+
+def run(iterations):
+    ''' Returns a list of result dictionaries. '''
+    results = []
+    for (desc, msg) in make_messages():
+        data = msg.get_json()
+        # Large messages get fewer iterations.
+        count = max(iterations / len(encode_message(data)) * 16, 10)
+        count = min(count, iterations)
+        for (codec, encode, decode) in CODECS:
+            raw = encode(data)
+            enc = min(timeit.repeat(lambda: encode(data),
+                                    number=count, repeat=3)) / count
+            dec = min(timeit.repeat(lambda: decode(raw),
+                                    number=count, repeat=3)) / count
+            results.append({'message':desc, 'codec':codec, 'bytes':len(raw),
+                            'encode_us':enc * 1e6, 'decode_us':dec * 1e6})
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-n", "--iterations", dest="iterations", type=int,
+                        action="store", default=2000,
+                        help="Iterations per measurement, for small messages")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        action="store", default=None,
+                        help="Write results as JSON to this file")
+    options = parser.parse_args()
+
+    results = run(options.iterations)
+    print "%-22s %-8s %8s %12s %12s" % ("message", "codec", "bytes",
+                                        "encode_us", "decode_us")
+    for r in results:
+        print "%-22s %-8s %8d %12.2f %12.2f" % (r['message'], r['codec'],
+                                                r['bytes'], r['encode_us'],
+                                                r['decode_us'])
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,106 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for compressing SDX-LC messages, as SDXControllerConnection does
+# once compression has been negotiated. For a few large messages, encoded with
+# the binary codec and with pickle, reports the compressed size and ratio, the
+# time taken to compress and decompress, and how long the message would take
+# to cross a link of the given bandwidth with and without compression
+# (compressing and decompressing included).
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/compression_benchmark.py -B 10 -l 1,6
+#
+
+import cPickle as pickle
+import json
+import timeit
+import zlib
+
+from shared.SDXMessageCodec import encode_message
+from shared.SDXControllerConnectionManagerConnection import *
+from shared.L2MultipointEndpointLCRule import L2MultipointEndpointLCRule
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+
+
+def make_messages():
+    ''' Returns a list of (description, SDXMessage). '''
+    mp_rule = L2MultipointEndpointLCRule(1, range(1, 65),
+                                         [(p, 100 + p) for p in range(500)],
+                                         1000, 10000)
+    mp_rule.set_cookie(1236)
+    batch = []
+    for i in range(256):
+        rule = VlanTunnelLCRule(i % 4, 1, 2, (i % 4000) + 1, (i % 4000) + 1,
+                                True, 1000)
+        rule.set_cookie(i)
+        batch.append((rule, rule.get_switch_id()))
+
+    return [("INSTALL L2MPEndpoint 500", SDXMessageInstallRule(mp_rule, 1)),
+            ("INITRB 256 rules", SDXMessageInitialRuleBatch(0, batch))]
+
+CODECS = [('pickle0', pickle.dumps),
+          ('binary', encode_message)]
+
+
+def run(options):
+    ''' Returns a list of result dictionaries. '''
+    bytes_per_second = options.bandwidth * 1e6 / 8
+    results = []
+    for (desc, msg) in make_messages():
+        data = msg.get_json()
+        for (codec, encode) in CODECS:
+            raw = encode(data)
+            for level in [int(l) for l in options.levels.split(',')]:
+                compressed = zlib.compress(raw, level)
+                comp = min(timeit.repeat(lambda: zlib.compress(raw, level),
+                                         number=options.count,
+                                         repeat=3)) / options.count
+                decomp = min(timeit.repeat(lambda: zlib.decompress(compressed),
+                                           number=options.count,
+                                           repeat=3)) / options.count
+                results.append({'message':desc,
+                                'codec':codec,
+                                'level':level,
+                                'bytes':len(raw),
+                                'compressed_bytes':len(compressed),
+                                'ratio':float(len(raw)) / len(compressed),
+                                'compress_us':comp * 1e6,
+                                'decompress_us':decomp * 1e6,
+                                'link_ms':len(raw) / bytes_per_second * 1e3,
+                                'compressed_link_ms':
+                                (len(compressed) / bytes_per_second + comp +
+                                 decomp) * 1e3})
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-B", "--bandwidth", dest="bandwidth", type=float,
+                        default=10.0,
+                        help="Link bandwidth, in Mbit/s")
+    parser.add_argument("-l", "--levels", dest="levels", type=str,
+                        default="1,6,9",
+                        help="Comma separated list of zlib levels")
+    parser.add_argument("-n", "--count", dest="count", type=int,
+                        default=20,
+                        help="Iterations per timing")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        default=None,
+                        help="Write results to this file as JSON")
+    options = parser.parse_args()
+
+    results = run(options)
+    print "%-24s %-8s %5s %8s %8s %6s %10s %10s %9s %9s" % (
+        "message", "codec", "level", "bytes", "zbytes", "ratio",
+        "comp_us", "decomp_us", "link_ms", "zlink_ms")
+    for r in results:
+        print "%-24s %-8s %5d %8d %8d %6.2f %10.1f %10.1f %9.2f %9.2f" % (
+            r['message'], r['codec'], r['level'], r['bytes'],
+            r['compressed_bytes'], r['ratio'], r['compress_us'],
+            r['decompress_us'], r['link_ms'], r['compressed_link_ms'])
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,193 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for the Corsa REST calls made per rule, against the mock Corsa
+# server in localctlr/tests/MockCorsaServer.py. Two workloads:
+#   vlan - a rate-limited VlanTunnelLCRule: find the tunnel on the rate limit
+#          bridge, then patch its meter.
+#   l2mp - an L2MultipointEndpointLCRule endpoint: post four tunnels, then
+#          delete them again, as remove_l2mp_ratelimiting_tunnel() does.
+# Each is run the way it used to be done ("bare": a new requests call, and so
+# a new connection, per call; the whole tunnel list fetched per rule; calls
+# one after another), and with CorsaRestClient ("client"). The mock server
+# can add latency to every call, to stand in for a switch that's further away.
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/corsa_benchmark.py -n 200 -L 0.005
+#
+
+import json
+import requests
+from time import time
+
+from localctlr.CorsaRestClient import CorsaRestClient
+from localctlr.tests.MockCorsaServer import MockCorsaServer
+
+TOKEN = "benchmarktoken"
+BRIDGE = "br20"
+L2MP_BRIDGE = "br21"
+L2MP_RATELIMIT_BRIDGE = "br19"
+RATELIMIT_PORTS = [23, 24]
+
+
+class RestCmd(object):
+    ''' Same getters as TranslatedCorsaRuleContainer. '''
+    def __init__(self, function, url, json, valid_responses):
+        self.function = function
+        self.url = url
+        self.json = json
+        self.valid_responses = valid_responses
+
+    def __str__(self):
+        return "%s:%s" % (self.function, self.url)
+
+    def get_function(self):
+        return self.function
+
+    def get_url(self):
+        return self.url
+
+    def get_json(self):
+        return self.json
+
+    def get_token(self):
+        return TOKEN
+
+    def get_valid_responses(self):
+        return self.valid_responses
+
+
+def meter_patch(bandwidth):
+    return [{'op':'replace', 'path':'/meter/cir', 'value':bandwidth},
+            {'op':'replace', 'path':'/meter/cbs', 'value':bandwidth},
+            {'op':'replace', 'path':'/meter/eir', 'value':0},
+            {'op':'replace', 'path':'/meter/ebs', 'value':0}]
+
+
+def l2mp_posts(base, vlan):
+    ''' The four tunnel posts for an L2Multipoint endpoint on vlan. '''
+    bw_out = vlan + 10000
+    cmds = []
+    for (bridge, ports) in [(L2MP_BRIDGE, [1, 2]),
+                            (L2MP_RATELIMIT_BRIDGE, [3, 4])]:
+        url = base + "api/v1/bridges/" + bridge + "/tunnels"
+        for (ofport, port) in zip([bw_out, vlan], ports):
+            cmds.append(RestCmd('post', url,
+                                {'ofport':ofport, 'port':port,
+                                 'vlan-id':vlan, 'shaped-rate':1000},
+                                [201]))
+    return cmds
+
+
+def l2mp_deletes(base, vlan):
+    return [RestCmd('delete', "%sapi/v1/bridges/%s/tunnels/%s" %
+                    (base, bridge, ofport), None, None)
+            for bridge in [L2MP_BRIDGE, L2MP_RATELIMIT_BRIDGE]
+            for ofport in [vlan, vlan + 10000]]
+
+
+def bare_request(cmd):
+    response = getattr(requests, cmd.get_function())(
+        cmd.get_url(), json=cmd.get_json(),
+        headers={'Authorization':cmd.get_token()}, verify=False)
+    valid = cmd.get_valid_responses()
+    if valid != None and response.status_code not in valid:
+        raise Exception("REST command failed %s: %s" % (cmd,
+                                                        response.status_code))
+    return response
+
+
+def vlan_bare(base, vlan):
+    url = base + "api/v1/bridges/" + BRIDGE + "/tunnels?list=true"
+    tunnels = bare_request(RestCmd('get', url, None, [200])).json()['list']
+    for entry in tunnels:
+        if (entry['vlan-id'] == vlan and
+            int(entry['port']) in RATELIMIT_PORTS):
+            bare_request(RestCmd('patch', entry['links']['self']['href'],
+                                 meter_patch(1000), [204]))
+
+
+def vlan_client(client, base, vlan):
+    tunnels = client.find_tunnels(base, BRIDGE, TOKEN, vlan, RATELIMIT_PORTS)
+    client.dispatch([RestCmd('patch', entry['links']['self']['href'],
+                             meter_patch(1000), [204])
+                     for entry in tunnels])
+
+
+def l2mp_bare(base, vlan):
+    for cmd in l2mp_posts(base, vlan) + l2mp_deletes(base, vlan):
+        bare_request(cmd)
+
+
+def l2mp_client(client, base, vlan):
+    client.dispatch(l2mp_posts(base, vlan))
+    client.dispatch(l2mp_deletes(base, vlan))
+
+
+def run(options):
+    results = []
+    for workload in ['vlan', 'l2mp']:
+        for mode in ['bare', 'client']:
+            server = MockCorsaServer(latency=options.latency, token=TOKEN)
+            base = server.get_url()
+            for vlan in range(1, options.tunnels + 1):
+                for (ofport, port) in enumerate(RATELIMIT_PORTS):
+                    server.add_tunnel(BRIDGE, vlan * 10 + ofport, port, vlan)
+            client = CorsaRestClient(workers=options.workers)
+
+            start = time()
+            for i in range(options.count):
+                vlan = (i % options.tunnels) + 1
+                if workload == 'vlan' and mode == 'bare':
+                    vlan_bare(base, vlan)
+                elif workload == 'vlan':
+                    vlan_client(client, base, vlan)
+                elif mode == 'bare':
+                    l2mp_bare(base, vlan)
+                else:
+                    l2mp_client(client, base, vlan)
+            elapsed = time() - start
+
+            counters = server.get_counters()
+            server.shutdown()
+            result = {'workload':workload,
+                      'mode':mode,
+                      'rules':options.count,
+                      'seconds':elapsed,
+                      'rules_per_second':options.count / elapsed,
+                      'requests':sum(counters.get(f, 0) for f in
+                                     ['get', 'post', 'patch', 'delete']),
+                      'connections':counters.get('connections', 0)}
+            results.append(result)
+            print ("%-5s %-7s %6d rules in %7.3fs: %9.1f rules/s, "
+                   "%6d requests over %6d connections" %
+                   (workload, mode, options.count, elapsed,
+                    result['rules_per_second'], result['requests'],
+                    result['connections']))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--count", dest="count", type=int,
+                        default=200,
+                        help="Number of rules per workload")
+    parser.add_argument("-T", "--tunnels", dest="tunnels", type=int,
+                        default=500,
+                        help="Number of preconfigured VLANs on the rate limit bridge")
+    parser.add_argument("-L", "--latency", dest="latency", type=float,
+                        default=0.0,
+                        help="Seconds the mock switch takes per request")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=4,
+                        help="CorsaRestClient worker threads")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        default=None,
+                        help="Write results to this file as JSON")
+    options = parser.parse_args()
+
+    results = run(options)
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
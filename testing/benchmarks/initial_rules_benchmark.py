@@ -0,0 +1,186 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for the INITIAL_RULES phase of the SDX-LC connection. A stand-in
+# LC connects to a stand-in SDX controller through a local proxy that adds a
+# configurable round trip time, and the time from connect to MAIN_PHASE is
+# reported for both the one-rule-per-request exchange ("legacy") and the
+# bulk exchange negotiated through CAPREQ/CAPRESP ("bulk").
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/initial_rules_benchmark.py -r 100,1000 -t 0,50
+#
+
+import socket
+import threading
+import json
+import logging
+from time import sleep, time
+from Queue import Queue
+
+from shared.SDXControllerConnectionManagerConnection import *
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+
+
+class DelayProxy(object):
+    ''' Forwards a single TCP connection to an upstream address, delaying data
+        by half of the round trip time in each direction. '''
+
+    def __init__(self, upstream_address, rtt):
+        self.upstream_address = upstream_address
+        self.one_way_delay = rtt / 2.0
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_sock.bind(('127.0.0.1', 0))
+        self.listen_sock.listen(1)
+        self.address = self.listen_sock.getsockname()
+
+        self.thread = threading.Thread(target=self._accept_thread)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept_thread(self):
+        downstream, addr = self.listen_sock.accept()
+        upstream = socket.create_connection(self.upstream_address)
+        for (src, dst) in ((downstream, upstream), (upstream, downstream)):
+            q = Queue()
+            for target in (self._reader_thread, self._writer_thread):
+                t = threading.Thread(target=target, args=(src, dst, q))
+                t.daemon = True
+                t.start()
+
+    def _reader_thread(self, src, dst, q):
+        try:
+            while True:
+                data = src.recv(65536)
+                q.put((time() + self.one_way_delay, data))
+                if data == '':
+                    return
+        except socket.error:
+            q.put((time(), ''))
+
+    def _writer_thread(self, src, dst, q):
+        try:
+            while True:
+                (due, data) = q.get()
+                now = time()
+                if due > now:
+                    sleep(due - now)
+                if data == '':
+                    dst.shutdown(socket.SHUT_WR)
+                    return
+                dst.sendall(data)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.listen_sock.close()
+
+
+def make_rules(count):
+    rules = []
+    for i in range(count):
+        rule = VlanTunnelLCRule(i % 4, 1, 2, (i % 4000) + 1, (i % 4000) + 1,
+                                True, 1000)
+        rule.set_cookie(i)
+        rules.append(rule)
+    return rules
+
+
+def run_once(rule_count, rtt, bulk, batch_size, window):
+    ''' Returns the time in seconds for a stand-in LC to get from connecting
+        to MAIN_PHASE while receiving rule_count initial rules. '''
+    rules = make_rules(rule_count)
+    installed = []
+
+    sdx_listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sdx_listen.bind(('127.0.0.1', 0))
+    sdx_listen.listen(1)
+    proxy = DelayProxy(sdx_listen.getsockname(), rtt)
+
+    cxns = {}
+    def sdx_thread():
+        sock, addr = sdx_listen.accept()
+        cxn = SDXControllerConnection(addr[0], addr[1], sock, 'bench.sdx')
+        cxn.initial_rules_batch_size = batch_size
+        cxn.initial_rules_window = window
+        cxn.set_new_callback(lambda c: None)
+        cxn.set_delete_callback(lambda c: None)
+        cxns['sdx'] = cxn
+        cxn.transition_to_main_phase_SDX(lambda name: None,
+                                         lambda name: rules)
+    t = threading.Thread(target=sdx_thread)
+    t.daemon = True
+    t.start()
+
+    start = time()
+    sock = socket.create_connection(proxy.address)
+    lc = SDXControllerConnection(proxy.address[0], proxy.address[1], sock,
+                                 'bench.lc')
+    lc.bulk_initial_rules = bulk
+    lc.set_new_callback(lambda c: None)
+    lc.set_delete_callback(lambda c: None)
+    lc.transition_to_main_phase_LC('benchlc', None, installed.append)
+    elapsed = time() - start
+    t.join()
+
+    if len(installed) != rule_count:
+        raise Exception("Installed %d rules, expected %d" %
+                        (len(installed), rule_count))
+
+    lc.close()
+    cxns['sdx'].close()
+    proxy.close()
+    sdx_listen.close()
+    return elapsed
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-r", "--rules", dest="rules", type=str,
+                        action="store", default="100,1000,10000",
+                        help="Comma separated list of initial rule counts")
+    parser.add_argument("-t", "--rtt", dest="rtt", type=str,
+                        action="store", default="0,20,150",
+                        help="Comma separated list of simulated RTTs in ms")
+    parser.add_argument("-m", "--modes", dest="modes", type=str,
+                        action="store", default="legacy,bulk",
+                        help="Comma separated list of modes: legacy, bulk")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int,
+                        action="store",
+                        default=DEFAULT_INITIAL_RULES_BATCH_SIZE,
+                        help="Rules per INITRB message in bulk mode")
+    parser.add_argument("-w", "--window", dest="window", type=int,
+                        action="store", default=DEFAULT_INITIAL_RULES_WINDOW,
+                        help="Unacknowledged INITRB messages in bulk mode")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        action="store", default=None,
+                        help="Write results as JSON to this file")
+    options = parser.parse_args()
+
+    # The connection logs every initial rule at WARNING.
+    logging.disable(logging.WARNING)
+
+    results = []
+    print "%-8s %8s %8s %12s %12s" % ("mode", "rules", "rtt_ms",
+                                      "seconds", "rules/sec")
+    for rule_count in [int(x) for x in options.rules.split(',')]:
+        for rtt_ms in [float(x) for x in options.rtt.split(',')]:
+            for mode in options.modes.split(','):
+                elapsed = run_once(rule_count, rtt_ms / 1000.0,
+                                   mode == 'bulk', options.batch_size,
+                                   options.window)
+                rate = rule_count / elapsed if elapsed > 0 else 0
+                print "%-8s %8d %8.1f %12.3f %12.1f" % (mode, rule_count,
+                                                        rtt_ms, elapsed, rate)
+                results.append({'mode':mode,
+                                'rules':rule_count,
+                                'rtt_ms':rtt_ms,
+                                'batch_size':options.batch_size,
+                                'window':options.window,
+                                'seconds':elapsed})
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
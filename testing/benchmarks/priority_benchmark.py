@@ -0,0 +1,177 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for control message latency on an SDX-LC connection that is busy
+# with bulk rule installs. A stand-in SDX queues a burst of rule installs for a
+# stand-in LC, which takes a fixed time to handle each one, and meanwhile
+# queues a small control message (an InstallRuleComplete, standing in for a
+# heartbeat) at a fixed interval. Reported is how long the control messages
+# take to reach the LC, with everything queued in order in a single lane
+# ("fifo") and with priority lanes ("lanes"). The socket buffers are kept
+# small, to stand in for a long, thin link.
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/priority_benchmark.py -r 5000 -d 0.0002
+#
+
+import socket
+import threading
+import json
+import logging
+from select import select
+from time import sleep, time
+
+from shared.SDXControllerConnectionManagerConnection import *
+from shared.VlanTunnelLCRule import VlanTunnelLCRule
+
+
+def make_rules(count):
+    rules = []
+    for i in range(count):
+        rule = VlanTunnelLCRule(i % 4, 1, 2, (i % 4000) + 1, (i % 4000) + 1,
+                                True, 1000)
+        rule.set_cookie(i)
+        rules.append(rule)
+    return rules
+
+
+def connect(buffer_size):
+    ''' Returns a connected (sdx, lc) pair of SDXControllerConnections. '''
+    listen = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen.bind(('127.0.0.1', 0))
+    listen.listen(1)
+    lc_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    for sock in [listen, lc_sock]:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    lc_sock.connect(listen.getsockname())
+    (sdx_sock, addr) = listen.accept()
+    listen.close()
+
+    cxns = []
+    for (sock, name) in [(sdx_sock, 'bench.sdx'), (lc_sock, 'bench.lc')]:
+        cxn = SDXControllerConnection(addr[0], addr[1], sock, name)
+        cxn.set_new_callback(lambda c: None)
+        cxn.set_delete_callback(lambda c: None)
+        cxn.connection_state = 'MAIN_PHASE'
+        cxns.append(cxn)
+    return cxns
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_once(rules, lanes, delay, interval, buffer_size):
+    (sdx, lc) = connect(buffer_size)
+    sdx.priority_lanes = lanes
+    sdx.outbound_queue_size = len(rules) + 100000
+
+    probe_sent = {}
+    probe_received = {}
+    done = threading.Event()
+
+    def lc_thread():
+        installed = 0
+        while installed < len(rules):
+            msg = lc.recv_protocol()
+            if isinstance(msg, SDXMessageInstallRuleComplete):
+                probe_received[msg.get_data()['cookie']] = time()
+            elif isinstance(msg, SDXMessageInstallRule):
+                installed += 1
+                if delay > 0:
+                    sleep(delay)
+        done.set()
+
+    def probe_thread():
+        i = 0
+        while not done.is_set():
+            probe_sent[i] = time()
+            sdx.enqueue_protocol(SDXMessageInstallRuleComplete(i))
+            i += 1
+            sleep(interval)
+
+    t = threading.Thread(target=lc_thread)
+    t.daemon = True
+    t.start()
+
+    start = time()
+    for rule in rules:
+        sdx.enqueue_protocol(SDXMessageInstallRule(rule, rule.get_switch_id()))
+    p = threading.Thread(target=probe_thread)
+    p.daemon = True
+    p.start()
+    done.wait()
+    elapsed = time() - start
+    p.join()
+    # Pick up any control messages still on their way.
+    sdx.flush_outbound(5)
+    sleep(0.1)
+    while True:
+        (r, w, e) = select([lc.get_socket()], [], [], 0.1)
+        if len(r) == 0:
+            break
+        msg = lc.recv_protocol()
+        if isinstance(msg, SDXMessageInstallRuleComplete):
+            probe_received[msg.get_data()['cookie']] = time()
+
+    latencies = [(probe_received[i] - probe_sent[i]) * 1000.0
+                 for i in probe_sent.keys() if i in probe_received]
+    sdx.close()
+    lc.close()
+    return {'mode':'lanes' if lanes else 'fifo',
+            'rules':len(rules),
+            'seconds':elapsed,
+            'rules_per_second':len(rules) / elapsed,
+            'control_count':len(latencies),
+            'control_mean_ms':sum(latencies) / len(latencies),
+            'control_p50_ms':percentile(latencies, 0.5),
+            'control_p99_ms':percentile(latencies, 0.99),
+            'control_max_ms':max(latencies)}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-r", "--rules", dest="rules", type=int,
+                        action="store", default=5000,
+                        help="Number of rules in the burst")
+    parser.add_argument("-d", "--delay", dest="delay", type=float,
+                        action="store", default=0.0002,
+                        help="Seconds the LC takes per rule")
+    parser.add_argument("-i", "--interval", dest="interval", type=float,
+                        action="store", default=0.01,
+                        help="Seconds between control messages")
+    parser.add_argument("-b", "--buffer", dest="buffer", type=int,
+                        action="store", default=65536,
+                        help="Socket send and receive buffer sizes, in bytes")
+    parser.add_argument("-m", "--modes", dest="modes", type=str,
+                        action="store", default="fifo,lanes",
+                        help="Comma separated list of modes: fifo, lanes")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        action="store", default=None,
+                        help="Write results as JSON to this file")
+    options = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    rules = make_rules(options.rules)
+    results = []
+    print "%-6s %7s %9s %10s %8s %10s %10s %10s" % ("mode", "rules",
+                                                    "seconds", "rules/sec",
+                                                    "control", "mean_ms",
+                                                    "p99_ms", "max_ms")
+    for mode in options.modes.split(','):
+        r = run_once(rules, mode == 'lanes', options.delay, options.interval,
+                     options.buffer)
+        results.append(r)
+        print "%-6s %7d %9.3f %10.1f %8d %10.3f %10.3f %10.3f" % (
+            r['mode'], r['rules'], r['seconds'], r['rules_per_second'],
+            r['control_count'], r['control_mean_ms'], r['control_p99_ms'],
+            r['control_max_ms'])
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
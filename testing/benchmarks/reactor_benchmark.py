@@ -0,0 +1,214 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for the SDX side of SDX-LC connections. A stand-in SDX controller,
+# running in its own process, accepts a number of stand-in LC connections
+# either with the ConnectionReactor ("reactor") or with the previous thread per
+# accepted socket, thread per heartbeat, and select() polling ("legacy").
+# Reported are the mean time for an LC to get from connecting to MAIN_PHASE,
+# the number of threads in the SDX process once all LCs are connected, and the
+# CPU time used by the SDX process while idle.
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/reactor_benchmark.py -c 10,100 -i 1
+#
+
+import socket
+import threading
+import resource
+import json
+import logging
+from multiprocessing import Process, Queue as ProcessQueue
+from time import sleep, time
+
+from lib.Connection import select as cxnselect
+from lib.ConnectionReactor import ConnectionReactor
+from shared.SDXControllerConnectionManager import *
+from shared.SDXControllerConnectionManagerConnection import *
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def sdx_process(mode, port, heartbeat_interval, idle_time, ready_q, result_q):
+    ''' Stand-in SDX controller. Waits for the expected number of LCs, which is
+        sent on ready_q once the listening socket is open, then measures idle
+        CPU use. '''
+    logging.disable(logging.WARNING)
+    reactor = None
+    if mode == 'reactor':
+        reactor = ConnectionReactor('bench')
+    cm = SDXControllerConnectionManager('bench', reactor)
+
+    def new_cxn(cxn):
+        cxn.heartbeat_sleep_time = heartbeat_interval
+        cxn.transition_to_main_phase_SDX(lambda name: None,
+                                         lambda name: [])
+    cm.new_connection_callback(new_cxn)
+
+    if reactor != None:
+        cm.open_listening_port('127.0.0.1', port)
+    else:
+        t = threading.Thread(target=cm.open_listening_port,
+                             args=('127.0.0.1', port))
+        t.daemon = True
+        t.start()
+
+    def readable(entry):
+        try:
+            entry.recv_protocol()
+        except SDXMessageConnectionFailure:
+            entry.close()
+
+    # The main loops, as SDXController._main_loop() does them
+    connected = []
+    def reactor_loop():
+        while True:
+            q_ele = cm.get_cxn_queue_element()
+            while q_ele != None:
+                (action, cxn) = q_ele
+                if action == NEW_CXN:
+                    connected.append(cxn)
+                    reactor.register(cxn, readable)
+                q_ele = cm.get_cxn_queue_element()
+            reactor.run_once(2.0)
+
+    def legacy_loop():
+        rlist = []
+        while True:
+            q_ele = cm.get_cxn_queue_element()
+            while q_ele != None:
+                (action, cxn) = q_ele
+                if action == NEW_CXN:
+                    connected.append(cxn)
+                    rlist.append(cxn)
+                q_ele = cm.get_cxn_queue_element()
+            if len(rlist) == 0:
+                sleep(1.0)
+                continue
+            readable_cxns, w, x = cxnselect(rlist, [], rlist, 2.0)
+            for entry in readable_cxns:
+                readable(entry)
+
+    if reactor != None:
+        loop = threading.Thread(target=reactor_loop)
+    else:
+        loop = threading.Thread(target=legacy_loop)
+    loop.daemon = True
+    loop.start()
+
+    count = ready_q.get()
+    while len(connected) < count:
+        sleep(0.01)
+
+    threads = threading.active_count()
+    start_cpu = _cpu_time()
+    sleep(idle_time)
+    idle_cpu = _cpu_time() - start_cpu
+    result_q.put({'threads':threads, 'idle_cpu':idle_cpu})
+
+
+def run_once(mode, count, port, heartbeat_interval, idle_time):
+    ''' Connects count stand-in LCs to a stand-in SDX controller. Returns the
+        mean setup time, and the SDX process' thread count and idle CPU time.
+    '''
+    ready_q = ProcessQueue()
+    result_q = ProcessQueue()
+    sdx = Process(target=sdx_process, args=(mode, port, heartbeat_interval,
+                                            idle_time, ready_q, result_q))
+    sdx.daemon = True
+    sdx.start()
+    ready_q.put(count)
+
+    lcs = []
+    setup_times = []
+    for i in range(count):
+        while True:
+            try:
+                sock = socket.create_connection(('127.0.0.1', port))
+                break
+            except socket.error:
+                sleep(0.05)
+        start = time()
+        lc = SDXControllerConnection('127.0.0.1', port, sock, 'bench.lc')
+        # Only the SDX side's heartbeats are of interest.
+        lc.heartbeat_sleep_time = 3600
+        lc.set_new_callback(lambda c: None)
+        lc.set_delete_callback(lambda c: None)
+        lc.transition_to_main_phase_LC('benchlc%d' % i, None,
+                                       lambda msg: None)
+        setup_times.append(time() - start)
+        lcs.append(lc)
+
+    # Answer the SDX's heartbeats while it is idle.
+    def lc_loop():
+        while True:
+            readable_cxns, w, x = cxnselect(lcs, [], [], 1.0)
+            for entry in readable_cxns:
+                try:
+                    entry.recv_protocol()
+                except Exception:
+                    lcs.remove(entry)
+    t = threading.Thread(target=lc_loop)
+    t.daemon = True
+    t.start()
+
+    result = result_q.get()
+    for lc in list(lcs):
+        lcs.remove(lc)
+        lc.close()
+    sdx.terminate()
+    sdx.join()
+
+    result['setup'] = sum(setup_times) / len(setup_times)
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-c", "--connections", dest="connections", type=str,
+                        action="store", default="10,100,300",
+                        help="Comma separated list of LC connection counts")
+    parser.add_argument("-m", "--modes", dest="modes", type=str,
+                        action="store", default="legacy,reactor",
+                        help="Comma separated list of modes: legacy, reactor")
+    parser.add_argument("-i", "--heartbeat-interval", dest="interval",
+                        type=float, action="store", default=1.0,
+                        help="Heartbeat interval in seconds")
+    parser.add_argument("-d", "--idle-time", dest="idle", type=float,
+                        action="store", default=5.0,
+                        help="Seconds to measure idle CPU use over")
+    parser.add_argument("-p", "--port", dest="port", type=int,
+                        action="store", default=5620,
+                        help="First port to listen on")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        action="store", default=None,
+                        help="Write results as JSON to this file")
+    options = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    results = []
+    port = options.port
+    print "%-8s %6s %12s %8s %12s" % ("mode", "cxns", "setup_ms",
+                                      "threads", "idle_cpu_s")
+    for count in [int(x) for x in options.connections.split(',')]:
+        for mode in options.modes.split(','):
+            result = run_once(mode, count, port, options.interval,
+                              options.idle)
+            port += 1
+            print "%-8s %6d %12.2f %8d %12.3f" % (mode, count,
+                                                  result['setup'] * 1000,
+                                                  result['threads'],
+                                                  result['idle_cpu'])
+            result.update({'mode':mode, 'connections':count,
+                           'heartbeat_interval':options.interval})
+            results.append(result)
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,111 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for receiving large length-prefixed frames, as recv_protocol() and
+# Connection.recv() do. Compares the old receive loop ("chunks": recv() into a
+# list of strings, summing their lengths after every recv, then joining them)
+# against lib.Connection.FrameReader ("reader": recv_into() a reused buffer).
+# The sender writes each frame in pieces of a fixed size, and the receive
+# buffer is kept small, standing in for a link that delivers a big message a
+# segment at a time.
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/recv_benchmark.py -s 1000000,16000000 -b 8192
+#
+
+import socket
+import struct
+import threading
+import json
+from time import time
+
+from lib.Connection import FrameReader
+
+
+def recv_chunks(sock):
+    ''' The receive loop from before FrameReader. '''
+    size_data = ''
+    while len(size_data) < 4:
+        size_data += sock.recv(4 - len(size_data))
+    size = struct.unpack('>i', size_data)[0]
+
+    total_len = 0
+    total_data = []
+    recv_size = min(size, 524288)
+    while total_len < size:
+        sock_data = sock.recv(recv_size)
+        total_data.append(sock_data)
+        total_len = sum([len(i) for i in total_data])
+        recv_size = min(size - total_len, 524288)
+    return ''.join(total_data)
+
+
+def sender(sock, data, count, chunk):
+    raw = struct.pack('>i', len(data)) + data
+    for i in range(count):
+        for start in range(0, len(raw), chunk):
+            sock.sendall(raw[start:start + chunk])
+
+
+def run_once(mode, size, count, chunk, buffer_size):
+    (send_sock, recv_sock) = socket.socketpair()
+    for sock in [send_sock, recv_sock]:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+    data = 'x' * size
+    t = threading.Thread(target=sender, args=(send_sock, data, count, chunk))
+    t.daemon = True
+    reader = FrameReader()
+
+    start = time()
+    t.start()
+    for i in range(count):
+        if mode == 'chunks':
+            received = recv_chunks(recv_sock)
+        else:
+            received = reader.read_frame(recv_sock)[1]
+        assert len(received) == size
+    elapsed = time() - start
+    t.join()
+    send_sock.close()
+    recv_sock.close()
+    return {'mode':mode,
+            'size':size,
+            'frames':count,
+            'chunk':chunk,
+            'seconds':elapsed,
+            'mb_per_second':(size * count) / elapsed / 1000000.0}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-s", "--sizes", dest="sizes", type=str,
+                        default="100000,1000000,4000000",
+                        help="Comma separated list of frame sizes, in bytes")
+    parser.add_argument("-n", "--count", dest="count", type=int,
+                        default=5,
+                        help="Frames per size")
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int,
+                        default=1460,
+                        help="Bytes per send by the sender")
+    parser.add_argument("-b", "--buffer", dest="buffer", type=int,
+                        default=8192,
+                        help="Socket send and receive buffer sizes, in bytes")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        default=None,
+                        help="Write results to this file as JSON")
+    options = parser.parse_args()
+
+    results = []
+    for size in [int(s) for s in options.sizes.split(',')]:
+        for mode in ['chunks', 'reader']:
+            r = run_once(mode, size, options.count, options.chunk,
+                         options.buffer)
+            results.append(r)
+            print "%-6s %9d bytes x %3d: %8.3fs, %8.1f MB/s" % (
+                mode, size, options.count, r['seconds'], r['mb_per_second'])
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,720 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# End-to-end rule throughput benchmark. A real SDXController is started on a
+# generated linear topology, and a number of stand-in Local Controllers connect
+# to it over the real SDX-LC protocol. The stand-in LCs replace the
+# RyuTranslateInterface with a recording datapath: rules are queued on a
+# FlowProgrammingQueue per switch, and each batch is confirmed by a barrier
+# reply as soon as it is sent.
+#
+# L2Tunnel, L2Multipoint and SDXEgress policies are added and then removed,
+# either by calling the RuleManager directly ("rulemanager"), through the
+# REST API one at a time ("rest"), or through the REST API all at once
+# ("bulk", which only changes how policies are added). Reported are policies
+# per second, per-stage latency and the time for a stand-in LC to reconnect and
+# reinstall its rules. The stages are:
+#   validity      - ValidityInspector.is_valid_rule()
+#   breakdown     - BreakdownEngine.get_breakdown()
+#   authorization - AuthorizationInspector.is_authorized()
+#   db            - rule and config table inserts, updates and deletes
+#   wire          - from the SDX sending a rule to a stand-in LC receiving it
+#   lc            - from a stand-in LC receiving a rule to the switch
+#                   confirming it
+#   total         - from submitting a policy to the last of its rules being
+#                   confirmed, per policy
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/sdx_throughput_benchmark.py -l 4 -c 100
+#
+
+import os
+import socket
+import tempfile
+import threading
+import json
+import logging
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from multiprocessing import Process, Queue as ProcessQueue
+from Queue import Queue
+from time import sleep, time
+
+import requests
+
+from lib.ConnectionReactor import ConnectionReactor
+from localctlr.FlowProgrammingQueue import FlowProgrammingQueue
+from shared.SDXControllerConnectionManager import *
+from shared.SDXControllerConnectionManagerConnection import *
+from shared.constants import rfc3339format
+from sdxctlr.SDXController import *
+
+USERNAME = "benchuser"
+PASSWORD = "benchpw"
+HOST = "127.0.0.1"
+STAGES = ['validity', 'breakdown', 'authorization', 'db', 'wire', 'lc',
+          'total']
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((HOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_manifest(lc_count):
+    ''' Writes a manifest for a line of lc_count LCs, each with one switch and
+        one host, and returns the filename. Switch swN has the host on port 1,
+        swN-1 on port 2 and swN+1 on port 3. '''
+    endpoints = {}
+    lcs = {}
+    for i in range(1, lc_count + 1):
+        endpoints["sw%dh" % i] = {"type":"host",
+                                  "friendlyname":"Switch %d Host" % i,
+                                  "location":"0,0"}
+        ports = [{"portnumber":1, "speed":80000000000,
+                  "destination":"sw%dh" % i}]
+        if i > 1:
+            ports.append({"portnumber":2, "speed":80000000000,
+                          "destination":"sw%d" % (i - 1)})
+        if i < lc_count:
+            ports.append({"portnumber":3, "speed":80000000000,
+                          "destination":"sw%d" % (i + 1)})
+        lcs["lc%d" % i] = {
+            "shortname":"lc%d" % i,
+            "credentials":"lc%dpw" % i,
+            "location":"0,0",
+            "lcip":HOST,
+            "internalconfig":{"ryucxninternalport":0,
+                              "openflowport":0,
+                              "backuplcswitch":"sw%d" % i},
+            "switchinfo":[{"name":"sw%d" % i,
+                           "friendlyname":"Switch %d" % i,
+                           "ip":HOST,
+                           "dpid":str(i),
+                           "brand":"Open vSwitch",
+                           "model":"2.3.0",
+                           "portinfo":ports,
+                           "internalconfig":{}}],
+            "operatorinfo":{"organization":"Benchmark",
+                            "administrator":"Benchmark",
+                            "contact":"benchmark@localhost"}}
+    participants = {USERNAME:{"credentials":PASSWORD,
+                              "organization":"Benchmark",
+                              "contact":"benchmark@localhost",
+                              "type":"administrator",
+                              "permitted_actions":["tbd"],
+                              "restrictions":["tbd"]}}
+    (fd, filename) = tempfile.mkstemp(suffix=".manifest")
+    with os.fdopen(fd, 'w') as f:
+        json.dump({"endpoints":endpoints,
+                   "localcontrollers":lcs,
+                   "participants":participants}, f, indent=2)
+    return filename
+
+
+def make_policy_json(policytype, i, lc_count):
+    ''' Returns the JSON for the ith policy of policytype. Policy i uses VLAN
+        i+1, and sits between neighbouring switches so that the policies are
+        spread over all the LCs. '''
+    now = datetime.now()
+    start = (now - timedelta(days=1)).strftime(rfc3339format)
+    end = (now + timedelta(days=365)).strftime(rfc3339format)
+    vlan = i + 1
+    first = (i % (lc_count - 1)) + 1
+    second = first + 1
+    if policytype == "L2Tunnel":
+        return {"L2Tunnel":{"starttime":start,
+                            "endtime":end,
+                            "srcswitch":"sw%d" % first,
+                            "dstswitch":"sw%d" % second,
+                            "srcport":1,
+                            "dstport":1,
+                            "srcvlan":vlan,
+                            "dstvlan":vlan,
+                            "bandwidth":1000}}
+    elif policytype == "L2Multipoint":
+        endpoints = [{"switch":"sw%d" % first, "port":1, "vlan":vlan},
+                     {"switch":"sw%d" % second, "port":1, "vlan":vlan}]
+        if lc_count > 2:
+            third = (second % lc_count) + 1
+            endpoints.append({"switch":"sw%d" % third, "port":1,
+                              "vlan":vlan})
+        return {"L2Multipoint":{"starttime":start,
+                                "endtime":end,
+                                "endpoints":endpoints,
+                                "bandwidth":1000}}
+    elif policytype == "SDXEgress":
+        return {"SDXEgress":{"starttime":start,
+                             "endtime":end,
+                             "switch":"sw%d" % first,
+                             "matches":[{"dst_ip":"10.%d.%d.1" % (
+                                 (i >> 8) & 0xff, i & 0xff)}],
+                             "actions":[{"ModifySRCMAC":
+                                         "00:00:00:00:%02x:%02x" % (
+                                             (i >> 8) & 0xff, i & 0xff)}]}}
+    raise ValueError("Unknown policy type %s" % policytype)
+
+
+class LatencyTracker(object):
+    ''' Collects per-stage latency samples, and follows each LC rule from the
+        SDX sending it to the stand-in LC's switch confirming it. Rules are
+        keyed by (operation, cookie, switch_id). '''
+
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.cv:
+            self.samples = defaultdict(list)
+            self.sent = defaultdict(deque)
+            self.received = defaultdict(deque)
+            self.outstanding = defaultdict(int)
+            self.done = {}
+            self.last_event = time()
+
+    def add_sample(self, stage, seconds):
+        with self.cv:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, stage, fcn):
+        ''' Returns fcn, timed as stage. '''
+        def timed(*args, **kwargs):
+            start = time()
+            try:
+                return fcn(*args, **kwargs)
+            finally:
+                self.add_sample(stage, time() - start)
+        return timed
+
+    def rule_sent(self, op, cookie, switch_id):
+        with self.cv:
+            self.sent[(op, cookie, switch_id)].append(time())
+            self.outstanding[(op, cookie)] += 1
+
+    def rule_received(self, op, cookie, switch_id, when):
+        key = (op, cookie, switch_id)
+        with self.cv:
+            self.last_event = time()
+            if len(self.sent[key]) > 0:
+                self.samples['wire'].append(when - self.sent[key].popleft())
+                self.received[key].append(when)
+
+    def rule_confirmed(self, op, cookie, switch_id, when):
+        key = (op, cookie, switch_id)
+        with self.cv:
+            self.last_event = time()
+            if len(self.received[key]) == 0:
+                # Not sent while tracking, e.g., an initial rule
+                return
+            self.samples['lc'].append(when - self.received[key].popleft())
+            self.outstanding[(op, cookie)] -= 1
+            if self.outstanding[(op, cookie)] == 0:
+                self.done[(op, cookie)] = when
+                self.cv.notify_all()
+
+    def wait_for_quiet(self, quiet_time=0.5):
+        ''' Waits until nothing has been heard from the LCs for quiet_time. '''
+        while True:
+            with self.cv:
+                remaining = self.last_event + quiet_time - time()
+            if remaining <= 0:
+                return
+            sleep(remaining)
+
+    def wait(self, op, cookies, timeout):
+        ''' Waits for all the rules of each cookie to be confirmed. Returns a
+            dictionary of cookie:completion time. '''
+        deadline = time() + timeout
+        with self.cv:
+            while True:
+                pending = [c for c in cookies
+                           if self.outstanding[(op, c)] != 0 or
+                           (op, c) not in self.done]
+                if len(pending) == 0:
+                    return dict((c, self.done[(op, c)]) for c in cookies)
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise Exception("Timed out waiting for %d %s policies" %
+                                    (len(pending), op))
+                self.cv.wait(remaining)
+
+    def summary(self):
+        ''' Returns stage:{count, mean_ms, p50_ms, p99_ms, max_ms}. '''
+        retval = {}
+        with self.cv:
+            for stage in STAGES:
+                values = sorted(self.samples[stage])
+                if len(values) == 0:
+                    continue
+                retval[stage] = {
+                    'count':len(values),
+                    'mean_ms':sum(values) / len(values) * 1000,
+                    'p50_ms':values[len(values) / 2] * 1000,
+                    'p99_ms':values[min(len(values) - 1,
+                                        len(values) * 99 / 100)] * 1000,
+                    'max_ms':values[-1] * 1000}
+        return retval
+
+
+class BarrierStandin(object):
+    def __init__(self, datapath):
+        self.xid = None
+        self.buf = None
+    def serialize(self):
+        self.buf = ""
+
+class RuleMsgStandin(BarrierStandin):
+    ''' Takes the place of the FlowMods an LC rule would be translated to. '''
+    def __init__(self, datapath, rule):
+        super(RuleMsgStandin, self).__init__(datapath)
+        self.rule = rule
+
+class ParserStandin(object):
+    OFPBarrierRequest = BarrierStandin
+
+class DatapathRecorder(object):
+    ''' Stands in for a Ryu Datapath, recording what is sent to it. '''
+    def __init__(self, switch_id):
+        self.id = switch_id
+        self.ofproto = None
+        self.ofproto_parser = ParserStandin
+        self.xid = 0
+        self.sent_count = 0
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.xid = self.xid
+        return self.xid
+    def send(self, buf):
+        self.sent_count += 1
+
+
+class StandinLocalController(object):
+    ''' Connects to the SDX controller as the LC name, using the real
+        SDXControllerConnectionManager, and runs a main loop like
+        LocalController._main_loop(). Each stand-in runs in its own process,
+        as the connection manager is a singleton. What happens to rules is
+        reported on event_q as (event, op, cookie, switch_id, time) tuples,
+        once per pass of the main loop. '''
+
+    def __init__(self, name, sdx_address, event_q):
+        self.name = name
+        self.sdx_address = sdx_address
+        self.event_q = event_q
+        self.events = []
+        self.logger = logging.getLogger('bench.' + name)
+        self.reactor = ConnectionReactor('bench.' + name)
+        self.sdx_cm = SDXControllerConnectionManager('bench.' + name,
+                                                     self.reactor)
+        self.cxn = None
+        self.queues = {}
+        self.initial_rules = 0
+
+        self.thread = threading.Thread(target=self._main_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _get_queue(self, switch_id):
+        if switch_id not in self.queues.keys():
+            self.queues[switch_id] = FlowProgrammingQueue(
+                DatapathRecorder(switch_id), self._batch_complete,
+                self.logger)
+        return self.queues[switch_id]
+
+    def connect(self):
+        ''' Connects and gets to MAIN_PHASE. Returns the time taken, including
+            the switches confirming the initial rules. '''
+        start = time()
+        self.initial_rules = 0
+        self.cxn = self.sdx_cm.open_outbound_connection(*self.sdx_address)
+        self.cxn.transition_to_main_phase_LC(self.name, None,
+                                             self._initial_rule_install,
+                                             self._initial_rules_complete)
+        return time() - start
+
+    def disconnect(self):
+        self.cxn.close()
+
+    def _initial_rule_install(self, msg):
+        self.initial_rules += 1
+        self._install(msg.get_data()['switch_id'], msg.get_data()['rule'])
+
+    def _initial_rules_complete(self):
+        self._flush()
+
+    def _install(self, switch_id, rule):
+        queue = self._get_queue(switch_id)
+        queue.add(RuleMsgStandin(queue.datapath, rule))
+        queue.note_installed(rule.get_cookie())
+
+    def _flush(self):
+        for queue in self.queues.values():
+            batch = queue.flush()
+            if batch != None:
+                # The switch replies to the barrier straight away.
+                queue.barrier_reply(batch.closing_xid)
+        if len(self.events) > 0:
+            self.event_q.put(self.events)
+            self.events = []
+
+    def _batch_complete(self, batch):
+        for cookie in batch.installed:
+            self.events.append(('confirmed', 'add', cookie, batch.switch_id,
+                                batch.end_time))
+        for cookie in batch.removed:
+            self.events.append(('confirmed', 'rm', cookie, batch.switch_id,
+                                batch.end_time))
+
+    def _main_loop(self):
+        active = set()
+        while True:
+            q_ele = self.sdx_cm.get_cxn_queue_element()
+            while q_ele != None:
+                (action, cxn) = q_ele
+                if action == NEW_CXN and cxn not in active:
+                    active.add(cxn)
+                    self.reactor.register(cxn, self._handle_readable)
+                elif action == DEL_CXN and cxn in active:
+                    active.remove(cxn)
+                    self.reactor.unregister(cxn)
+                q_ele = self.sdx_cm.get_cxn_queue_element()
+
+            self.reactor.run_once(1.0)
+            # As the RyuTranslateInterface does, flush after each round of
+            # messages.
+            self._flush()
+
+    def _handle_readable(self, entry):
+        try:
+            msg = entry.recv_protocol()
+        except SDXMessageConnectionFailure as e:
+            entry.close()
+            return
+        if msg == None:
+            return
+
+        if type(msg) == SDXMessageInstallRule:
+            rule = msg.get_data()['rule']
+            switch_id = msg.get_data()['switch_id']
+            self.events.append(('received', 'add', rule.get_cookie(),
+                                switch_id, time()))
+            self._install(switch_id, rule)
+        elif type(msg) == SDXMessageRemoveRule:
+            cookie = msg.get_data()['cookie']
+            switch_id = msg.get_data()['switch_id']
+            self.events.append(('received', 'rm', cookie, switch_id, time()))
+            self._get_queue(switch_id).note_removed(cookie)
+        else:
+            self.logger.warning("Unexpected message %s" % msg)
+
+
+def lc_process(name, sdx_address, event_q, cmd_q):
+    ''' Runs a StandinLocalController. It connects straight away, retrying
+        until the SDX controller is listening, then follows commands from
+        cmd_q. Connection times are reported on event_q as ('connected', name,
+        seconds, initial rule count). '''
+    logging.disable(logging.CRITICAL)
+    lc = StandinLocalController(name, sdx_address, event_q)
+    cmd = 'connect'
+    while cmd != 'exit':
+        if cmd == 'connect':
+            elapsed = lc.connect()
+            event_q.put([('connected', name, elapsed, lc.initial_rules)])
+        elif cmd == 'disconnect':
+            lc.disconnect()
+        cmd = cmd_q.get()
+
+
+class Options(object):
+    ''' The command line options that SDXController expects. '''
+    def __init__(self, manifest, database):
+        self.manifest = manifest
+        self.database = database
+        self.topo = True
+        self.host = HOST
+        self.port = free_port()
+        self.sport = free_port()
+        self.lcport = free_port()
+        self.shib = False
+
+
+class ThroughputBenchmark(object):
+    def __init__(self, lc_count, database, timeout):
+        self.lc_count = lc_count
+        self.timeout = timeout
+        self.tracker = LatencyTracker()
+        self.manifest = make_manifest(lc_count)
+        self.options = Options(self.manifest, database)
+
+        # The stand-in LCs are forked before the SDX controller starts any
+        # threads.
+        self.event_q = ProcessQueue()
+        self.connected_q = Queue()
+        self.lcs = {}
+        for i in range(1, lc_count + 1):
+            name = "lc%d" % i
+            cmd_q = ProcessQueue()
+            p = Process(target=lc_process,
+                        args=(name, (HOST, self.options.lcport),
+                              self.event_q, cmd_q))
+            p.daemon = True
+            p.start()
+            self.lcs[name] = (p, cmd_q)
+
+        self.sdx = SDXController(False, self.options)
+        self._instrument()
+        self.sdx.start_main_loop()
+        self.collector = threading.Thread(target=self._collector_thread)
+        self.collector.daemon = True
+        self.collector.start()
+
+        for i in range(lc_count):
+            self.connected_q.get(timeout=self.timeout)
+        # Let the EdgePort policies for the new connections settle.
+        self.tracker.wait_for_quiet()
+
+        self._wait_for_port(self.options.port)
+        self.session = requests.Session()
+        self.base_url = "http://%s:%d" % (HOST, self.options.port)
+        resp = self.session.post(self.base_url + EP_LOGIN,
+                                 json={'username':USERNAME,
+                                       'password':PASSWORD},
+                                 allow_redirects=False)
+        if resp.status_code != 303:
+            raise Exception("Login failed: %s" % resp.status_code)
+
+    def close(self):
+        for (p, cmd_q) in self.lcs.values():
+            cmd_q.put('exit')
+            p.join(1.0)
+        os.remove(self.manifest)
+
+    def _wait_for_port(self, port):
+        deadline = time() + self.timeout
+        while time() < deadline:
+            try:
+                socket.create_connection((HOST, port)).close()
+                return
+            except socket.error:
+                sleep(0.05)
+        raise Exception("Port %d never opened" % port)
+
+    def _collector_thread(self):
+        ''' Passes events from the stand-in LCs to the tracker. '''
+        while True:
+            for event in self.event_q.get():
+                if event[0] == 'received':
+                    self.tracker.rule_received(*event[1:])
+                elif event[0] == 'confirmed':
+                    self.tracker.rule_confirmed(*event[1:])
+                elif event[0] == 'connected':
+                    self.connected_q.put(event[1:])
+
+    def _instrument(self):
+        ''' Wraps the methods of the SDX modules that make up each stage. '''
+        t = self.tracker
+        vi = ValidityInspector()
+        vi.is_valid_rule = t.wrap('validity', vi.is_valid_rule)
+        be = BreakdownEngine()
+        be.get_breakdown = t.wrap('breakdown', be.get_breakdown)
+        azi = AuthorizationInspector()
+        azi.is_authorized = t.wrap('authorization', azi.is_authorized)
+        rm = RuleManager()
+        for table in (rm.rule_table, rm.config_table):
+            for method in ('insert', 'update', 'delete'):
+                setattr(table, method, t.wrap('db', getattr(table, method)))
+
+        cm = self.sdx.sdx_cm
+        def wrap_send(op, send):
+            def sender(bd):
+                for rule in bd.get_list_of_rules():
+                    t.rule_sent(op, rule.get_cookie(), rule.get_switch_id())
+                return send(bd)
+            return sender
+        cm.send_breakdown_rule_add = wrap_send('add',
+                                               cm.send_breakdown_rule_add)
+        cm.send_breakdown_rule_rm = wrap_send('rm', cm.send_breakdown_rule_rm)
+        rm.set_send_add_rule(cm.send_breakdown_rule_add)
+        rm.set_send_rm_rule(cm.send_breakdown_rule_rm)
+
+    def _add(self, interface, policytype, json_rule):
+        if interface == 'rulemanager':
+            policyclass = RuleRegistry().get_rule_class(policytype)
+            return RuleManager().add_rule(policyclass(USERNAME, json_rule))
+        resp = self.session.post(
+            self.base_url + EP_POLICIESTYPE + "/" + policytype,
+            json=json_rule, headers={'Accept':'application/json'})
+        if resp.status_code != 201:
+            raise Exception("POST %s failed %s: %s" % (policytype,
+                                                       resp.status_code,
+                                                       resp.text))
+        return int(resp.json()['policy']['href'].split('/')[-1])
+
+    def _add_bulk(self, jsons):
+        resp = self.session.post(self.base_url + EP_POLICIESBULK,
+                                 json={'atomic':True, 'policies':jsons},
+                                 headers={'Accept':'application/json'})
+        if resp.status_code != 201:
+            raise Exception("POST bulk failed %s: %s" % (resp.status_code,
+                                                         resp.text))
+        return [p['policynumber'] for p in resp.json()['policies']]
+
+    def _remove(self, interface, rule_hash):
+        if interface == 'rulemanager':
+            return RuleManager().remove_rule(rule_hash, USERNAME)
+        resp = self.session.delete(self.base_url + EP_POLICIES +
+                                   "/number/%s" % rule_hash,
+                                   headers={'Accept':'application/json'})
+        if resp.status_code != 204:
+            raise Exception("DELETE %s failed %s" % (rule_hash,
+                                                     resp.status_code))
+
+    def run(self, interface, policytype, count):
+        ''' Adds then removes count policies. Returns a result dictionary per
+            operation. '''
+        results = []
+        jsons = [make_policy_json(policytype, i, self.lc_count)
+                 for i in range(count)]
+        hashes = []
+
+        for op in ('add', 'rm'):
+            self.tracker.reset()
+            starts = {}
+            start = time()
+            if op == 'add' and interface == 'bulk':
+                hashes = self._add_bulk(jsons)
+                for rule_hash in hashes:
+                    starts[rule_hash] = start
+            elif op == 'add':
+                for json_rule in jsons:
+                    submitted = time()
+                    rule_hash = self._add(interface, policytype, json_rule)
+                    starts[rule_hash] = submitted
+                    hashes.append(rule_hash)
+            else:
+                for rule_hash in hashes:
+                    starts[rule_hash] = time()
+                    self._remove(interface, rule_hash)
+            submit_time = time() - start
+            done = self.tracker.wait(op, hashes, self.timeout)
+            elapsed = max(done.values()) - start
+            for rule_hash in hashes:
+                self.tracker.add_sample('total',
+                                        done[rule_hash] - starts[rule_hash])
+
+            results.append({'lcs':self.lc_count,
+                            'interface':interface,
+                            'policy':policytype,
+                            'operation':op,
+                            'count':count,
+                            'submit_seconds':submit_time,
+                            'seconds':elapsed,
+                            'policies_per_sec':count / elapsed,
+                            'stages':self.tracker.summary()})
+        return results
+
+    def reconnect(self, interface, count):
+        ''' Installs count L2Tunnels, then disconnects the first LC and times
+            it reconnecting and reinstalling its rules. '''
+        hashes = [self._add(interface, "L2Tunnel",
+                            make_policy_json("L2Tunnel", i, self.lc_count))
+                  for i in range(count)]
+        self.tracker.wait_for_quiet()
+
+        (p, cmd_q) = self.lcs["lc1"]
+        cmd_q.put('disconnect')
+        while "lc1" in self.sdx.sdx_cm.associations.keys():
+            sleep(0.01)
+        self.tracker.wait_for_quiet()
+
+        cmd_q.put('connect')
+        (name, elapsed, initial_rules) = self.connected_q.get(
+            timeout=self.timeout)
+
+        for rule_hash in hashes:
+            self._remove(interface, rule_hash)
+        self.tracker.wait_for_quiet()
+        return {'lcs':self.lc_count,
+                'interface':interface,
+                'policy':'L2Tunnel',
+                'operation':'reconnect',
+                'count':count,
+                'initial_rules':initial_rules,
+                'seconds':elapsed}
+
+
+def print_result(r):
+    if r['operation'] == 'reconnect':
+        print "%-12s %-13s %-10s %6d %10.3f %10s  initial rules %d" % (
+            r['interface'], r['policy'], r['operation'], r['count'],
+            r['seconds'], "", r['initial_rules'])
+        return
+    print "%-12s %-13s %-10s %6d %10.3f %10.1f" % (
+        r['interface'], r['policy'], r['operation'], r['count'],
+        r['seconds'], r['policies_per_sec'])
+    for stage in STAGES:
+        if stage in r['stages'].keys():
+            s = r['stages'][stage]
+            print "    %-14s %7d %10.3f %10.3f %10.3f %10.3f" % (
+                stage, s['count'], s['mean_ms'], s['p50_ms'], s['p99_ms'],
+                s['max_ms'])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-l", "--lcs", dest="lcs", type=int,
+                        action="store", default=4,
+                        help="Number of stand-in Local Controllers, at least 2")
+    parser.add_argument("-c", "--count", dest="count", type=int,
+                        action="store", default=100,
+                        help="Policies added and removed per run")
+    parser.add_argument("-p", "--policies", dest="policies", type=str,
+                        action="store",
+                        default="L2Tunnel,L2Multipoint,SDXEgress",
+                        help="Comma separated list of policy types")
+    parser.add_argument("-i", "--interfaces", dest="interfaces", type=str,
+                        action="store", default="rulemanager,rest",
+                        help="Comma separated list of: rulemanager, rest, bulk")
+    parser.add_argument("-d", "--database", dest="database", type=str,
+                        action="store", default=":memory:",
+                        help="SDX controller database")
+    parser.add_argument("-t", "--timeout", dest="timeout", type=float,
+                        action="store", default=60.0,
+                        help="Seconds to wait for rules to be confirmed")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        action="store", default=None,
+                        help="Write results as JSON to this file")
+    options = parser.parse_args()
+
+    if options.lcs < 2:
+        parser.error("At least 2 LCs are needed")
+
+    # Rules are logged at every step, and the SDX controller prints a lot,
+    # so results are printed at the end.
+    logging.disable(logging.CRITICAL)
+
+    bench = ThroughputBenchmark(options.lcs, options.database,
+                                options.timeout)
+    results = []
+    for interface in options.interfaces.split(','):
+        for policytype in options.policies.split(','):
+            results += bench.run(interface, policytype, options.count)
+        results.append(bench.reconnect(interface, options.count))
+
+    print "%-12s %-13s %-10s %6s %10s %10s" % ("interface", "policy",
+                                               "operation", "count",
+                                               "seconds", "per sec")
+    print "    %-14s %7s %10s %10s %10s %10s" % ("stage", "count", "mean_ms",
+                                                 "p50_ms", "p99_ms", "max_ms")
+    for r in results:
+        print_result(r)
+
+    bench.close()
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
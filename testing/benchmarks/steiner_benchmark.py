@@ -0,0 +1,110 @@
+# Copyright 2019 - Sean Donovan
+# AtlanticWave/SDX Project
+
+# Benchmark for Steiner tree computation, as used for L2Multipoint admission.
+# Builds a grid topology of switches with random link speeds, picks a pool of
+# edge switches that hosts attach to, and times make_steiner_tree() for random
+# sets of terminals from that pool, both with a fresh metric closure every
+# time and with one MetricClosure reused between calls, as the TopologyManager
+# does until the topology changes.
+#
+# To run, from the root of the repository:
+#   python testing/benchmarks/steiner_benchmark.py -s 20 -e 40 -t 20 -n 50
+#
+
+import json
+import random
+from time import time
+
+import networkx as nx
+from lib.SteinerTree import make_steiner_tree, steiner_tree_cost, MetricClosure
+
+
+def make_topology(side, seed):
+    ''' Returns a side x side grid of switches with random link speeds. '''
+    rand = random.Random(seed)
+    topo = nx.Graph()
+    for x in range(side):
+        for y in range(side):
+            if x + 1 < side:
+                topo.add_edge("sw%d-%d" % (x, y), "sw%d-%d" % (x + 1, y),
+                              weight=rand.choice([1, 10, 40, 100]) * 10**9)
+            if y + 1 < side:
+                topo.add_edge("sw%d-%d" % (x, y), "sw%d-%d" % (x, y + 1),
+                              weight=rand.choice([1, 10, 40, 100]) * 10**9)
+    return topo
+
+
+def run(side, edge, terminals, count, seed):
+    ''' Returns a list of result dictionaries, one per closure strategy. '''
+    topo = make_topology(side, seed)
+    rand = random.Random(seed)
+    nodes = sorted(topo.nodes())
+    pool = rand.sample(nodes, max(edge, terminals))
+    trials = [rand.sample(pool, terminals) for i in range(count)]
+
+    results = []
+    for (desc, reuse) in [('fresh', False), ('cached', True)]:
+        closure = MetricClosure(topo)
+        times = []
+        costs = []
+        for voi in trials:
+            start = time()
+            if reuse:
+                tree = make_steiner_tree(topo, voi, closure=closure)
+            else:
+                tree = make_steiner_tree(topo, voi)
+            times.append(time() - start)
+            costs.append(steiner_tree_cost(tree))
+        times.sort()
+        results.append({'closure':desc,
+                        'switches':len(nodes),
+                        'terminals':terminals,
+                        'trees':count,
+                        'mean_ms':sum(times) / len(times) * 1000,
+                        'p50_ms':times[len(times) / 2] * 1000,
+                        'max_ms':times[-1] * 1000,
+                        'mean_cost':sum(costs) / len(costs)})
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument("-s", "--side", dest="side", type=int,
+                        action="store", default=20,
+                        help="Grid is side x side switches")
+    parser.add_argument("-e", "--edge", dest="edge", type=int,
+                        action="store", default=40,
+                        help="Number of edge switches endpoints are on")
+    parser.add_argument("-t", "--terminals", dest="terminals", type=int,
+                        action="store", default=20,
+                        help="Endpoints per tree")
+    parser.add_argument("-n", "--count", dest="count", type=int,
+                        action="store", default=50,
+                        help="Number of trees to compute")
+    parser.add_argument("-r", "--seed", dest="seed", type=int,
+                        action="store", default=1,
+                        help="Random seed")
+    parser.add_argument("-j", "--json", dest="json", type=str,
+                        action="store", default=None,
+                        help="Write results as JSON to this file")
+    options = parser.parse_args()
+
+    results = run(options.side, options.edge, options.terminals,
+                  options.count, options.seed)
+    print "%-8s %8s %9s %10s %10s %10s" % ("closure", "switches",
+                                           "terminals", "mean_ms", "p50_ms",
+                                           "max_ms")
+    for r in results:
+        print "%-8s %8d %9d %10.2f %10.2f %10.2f" % (r['closure'],
+                                                     r['switches'],
+                                                     r['terminals'],
+                                                     r['mean_ms'],
+                                                     r['p50_ms'],
+                                                     r['max_ms'])
+
+    if options.json != None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)